@@ -34,6 +34,8 @@ local dbcon = nil
 
 local results = {}
 local incr = 0
+local COMMIT_INTERVAL = 1 -- flush the pending events at least every second
+local last_commit = os.time()
 
 -- DROP TABLE if exists call_event;
 local create_table_sql = [[
@@ -56,9 +58,15 @@ local create_table_sql = [[
         leg varchar(10) DEFAULT 'aleg',
         starting_date timestamp with time zone,
         status smallint,
-        created_date timestamp with time zone NOT NULL
+        created_date timestamp with time zone NOT NULL,
+        claimed_by varchar(100),
+        claimed_at timestamp with time zone
         );
-    CREATE INDEX call_event_idx_status ON call_event (status);
+    ALTER TABLE call_event ADD COLUMN IF NOT EXISTS claimed_by varchar(100);
+    ALTER TABLE call_event ADD COLUMN IF NOT EXISTS claimed_at timestamp with time zone;
+    CREATE INDEX IF NOT EXISTS call_event_idx_status ON call_event (status);
+    CREATE INDEX IF NOT EXISTS call_event_pending_idx ON call_event (id) WHERE status = 1;
+    CREATE INDEX IF NOT EXISTS call_event_claimed_idx ON call_event (claimed_at) WHERE status = 3;
     ]]
 
 function logger(message)
@@ -152,7 +160,8 @@ function commit_event()
         -- VALUES ('%s', '%s', '%s', 4'%s', '%s', now(), 7'%s', '%s', '%s', '%s', '%s', 12'%s', '%s', '%s', 15'%s', %s)]], event_name, body, job_uuid, call_uuid, status, used_gateway_id, callrequest_id, alarm_request_id, duration, billsec, callerid, phonenumber, hangup_cause, hangup_cause_q850, amd_status, 0)
         sql_result = sql_result.."('"..v[1].."', '"..v[2].."', '"..v[3].."', '"..v[4].."', "..v[5]..", "..v[6]..", "..v[7]..", "..v[8]..", "..v[9]..", "..v[10]..", '"..v[11].."', '"..v[12].."', '"..v[13].."', '"..v[14].."', '"..v[15].."', "..""..v[16]..", "..v[16]..", '"..v[18].."')"
     end
-    insertsql = "INSERT INTO call_event (event_name, body, job_uuid, call_uuid, used_gateway_id, callrequest_id, alarm_request_id, status, duration, billsec, callerid, phonenumber, hangup_cause, hangup_cause_q850, amd_status, starting_date, created_date, leg) VALUES "..sql_result
+    -- NOTIFY wakes up the callevent_listener once the transaction is committed
+    insertsql = "INSERT INTO call_event (event_name, body, job_uuid, call_uuid, used_gateway_id, callrequest_id, alarm_request_id, status, duration, billsec, callerid, phonenumber, hangup_cause, hangup_cause_q850, amd_status, starting_date, created_date, leg) VALUES "..sql_result.."; NOTIFY call_event"
     if count > 0 then
         --logger(insertsql)
         connect()
@@ -168,6 +177,7 @@ function commit_event()
         results = {}
         incr = 0
     end
+    last_commit = os.time()
 end
 
 function push_event(event_name, body, job_uuid, call_uuid, used_gateway_id, callrequest_id, alarm_request_id, status, duration, billsec, callerid, phonenumber, hangup_cause, hangup_cause_q850, amd_status, starting_date, leg)
@@ -228,7 +238,7 @@ while true do
     i = i + 1
     -- pop(1) blocks until there is an event
     -- pop(1,500) blocks for max half a second until there is an event
-    e = fscon:pop(1)
+    e = fscon:pop(1, 500)
 
     if e then
         --default status: Pending
@@ -338,4 +348,9 @@ while true do
         end -- not a custom message
     end
 
+    -- Push the events to the database without waiting for the HEARTBEAT
+    if incr > 0 and os.time() - last_commit >= COMMIT_INTERVAL then
+        commit_event()
+    end
+
 end -- while
@@ -14,9 +14,54 @@
 #
 from rest_framework.views import APIView
 from rest_framework.response import Response
+from rest_framework.parsers import JSONParser, BaseParser
+from rest_framework.exceptions import ParseError
 from rest_framework.authentication import BasicAuthentication, SessionAuthentication
 from dialer_contact.models import Phonebook, Contact
+from dialer_contact.importer import validate_record, get_existing_contacts, get_e164_values, load_contacts
 from dialer_campaign.function_def import dialer_setting_limit, check_dialer_setting
+import json
+
+BULK_CONTACT_CREATED = 'created'
+BULK_CONTACT_DUPLICATE = 'duplicate'
+BULK_CONTACT_ERROR = 'error'
+BULK_CONTACT_LIMIT = 'limit'
+
+
+class NDJSONParser(BaseParser):
+
+    """
+    Parses a stream of contacts, one JSON object per line. The lines are
+    read lazily from the request stream
+    """
+    media_type = 'application/x-ndjson'
+
+    def parse(self, stream, media_type=None, parser_context=None):
+        if stream is None:
+            return []
+        return self.read_records(stream)
+
+    def read_records(self, stream):
+        for line in stream:
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                yield json.loads(line)
+            except ValueError:
+                # reported as a row in error
+                yield line
+
+
+def get_remaining_contacts(user):
+    """Number of contacts the user can still create, None for no limit"""
+    try:
+        dialer_set_obj = user.userprofile.dialersetting
+    except:
+        return None
+    if not dialer_set_obj:
+        return None
+    return max(0, dialer_set_obj.max_contact - Contact.objects.filter(phonebook__user=user).count())
 
 
 class BulkContactViewSet(APIView):
@@ -24,8 +69,18 @@ class BulkContactViewSet(APIView):
     """
     **Create**:
 
+        The contacts are sent as a JSON object with a list of contact records,
+        as NDJSON (one contact record per line, the phonebook in the query string)
+        or as a comma separated list of numbers. The numbers already present in a
+        phonebook of the user, or earlier in the same request, are skipped, the
+        numbers are compared by their E.164 form.
+
         CURL Usage::
 
+            curl -u username:password --dump-header - -H "Content-Type:application/json" -X POST --data '{"phonebook_id": "1", "contacts": [{"contact": "12345", "first_name": "John", "status": 1}, {"contact": "54344"}]}' http://localhost:8000/rest-api/bulkcontact/
+
+            curl -u username:password --dump-header - -H "Content-Type:application/x-ndjson" -X POST --data-binary @contacts.ndjson http://localhost:8000/rest-api/bulkcontact/?phonebook_id=1
+
             curl -u username:password --dump-header - -H "Content-Type:application/json" -X POST --data '{"phonebook_id": "1", "phoneno_list" : "12345,54344"}' http://localhost:8000/rest-api/bulkcontact/
 
         Response::
@@ -37,55 +92,102 @@ class BulkContactViewSet(APIView):
             Content-Language: en-us
             Allow: POST, OPTIONS
 
-            {"result": "Bulk contacts are created"}
+            {"result": "Bulk contacts are created", "created": 1, "duplicate": 1, "error": 0, "limit": 0,
+             "rows": [{"row": 0, "contact": "12345", "status": "created"},
+                      {"row": 1, "contact": "54344", "status": "duplicate"}]}
     """
     authentication = (BasicAuthentication, SessionAuthentication)
+    parser_classes = (JSONParser, NDJSONParser)
+
+    def get_records(self, request):
+        """Return the phonebook_id and the contact records of the request"""
+        if isinstance(request.DATA, dict):
+            phonebook_id = request.DATA.get('phonebook_id') or request.QUERY_PARAMS.get('phonebook_id')
+            if request.DATA.get('phoneno_list'):
+                records = [{'contact': phoneno} for phoneno in request.DATA.get('phoneno_list').split(',')]
+            else:
+                records = request.DATA.get('contacts') or []
+        else:
+            # a JSON array or a NDJSON stream
+            phonebook_id = request.QUERY_PARAMS.get('phonebook_id')
+            records = request.DATA
+        return (phonebook_id, records)
 
     def post(self, request):
         """
         create contacts in bulk
         """
         error = {}
-        if request.method == 'POST':
-            if not request.DATA:
-                error['error'] = 'Data set is empty'
-
-            if check_dialer_setting(request, check_for="contact"):
-                error['error'] = "You have too many contacts per campaign. You are allowed a maximum of %s" % \
-                    dialer_setting_limit(request, limit_for="contact")
-
-            phonebook_id = request.DATA.get('phonebook_id')
-            if phonebook_id and phonebook_id != '':
-                try:
-                    Phonebook.objects.get(id=phonebook_id, user=request.user)
-                except Phonebook.DoesNotExist:
-                    error['error'] = 'Phonebook is not valid!'
-            else:
-                error['error'] = 'Phonebook is not selected!'
+        try:
+            (phonebook_id, records) = self.get_records(request)
+        except ParseError as e:
+            return Response({'error': 'Data set is not valid (%s)' % e.detail})
+
+        if check_dialer_setting(request, check_for="contact"):
+            error['error'] = "You have too many contacts per campaign. You are allowed a maximum of %s" % \
+                dialer_setting_limit(request, limit_for="contact")
+
+        if phonebook_id and phonebook_id != '':
+            try:
+                Phonebook.objects.get(id=phonebook_id, user=request.user)
+            except (Phonebook.DoesNotExist, ValueError):
+                error['error'] = 'Phonebook is not valid!'
+        else:
+            error['error'] = 'Phonebook is not selected!'
 
         if error:
             return Response(error)
 
-        phoneno_list = request.DATA.get('phoneno_list')
-        phonebook_id = request.DATA.get('phonebook_id')
-        phonenolist = list(phoneno_list.split(","))
-
-        obj_phonebook = Phonebook.objects.get(id=phonebook_id, user=request.user)
-        new_contact_count = 0
-        for phoneno in phonenolist:
-            # check phoneno in Contact
-            dup_count = Contact.objects.filter(contact=phoneno, phonebook__user=request.user).count()
-
-            # If dup_count is zero, create new contact
-            if dup_count == 0:
-                new_contact = Contact.objects.create(
-                    phonebook=obj_phonebook,
-                    contact=phoneno,
-                )
-                new_contact_count = new_contact_count + 1
-                new_contact.save()
+        # Validate the records
+        rows = []
+        list_values = []
+        for (position, record) in enumerate(records):
+            (values, error_msg) = validate_record(record)
+            if error_msg:
+                rows.append({'row': position, 'status': BULK_CONTACT_ERROR, 'error': error_msg})
+                continue
+            rows.append({'row': position, 'contact': values[0]})
+            list_values.append(values)
+
+        if not rows:
+            return Response({'error': 'Data set is empty'})
+
+        # The numbers are compared by their E.164 form, raw if they have none,
+        # the numbers seen twice keep their first row
+        list_valid = []
+        seen = set()
+        list_e164 = get_e164_values(int(phonebook_id), list_values) if list_values else []
+        for (row, values, e164) in zip([row for row in rows if 'status' not in row], list_values, list_e164):
+            key = e164 or values[0]
+            if key in seen:
+                row['status'] = BULK_CONTACT_DUPLICATE
+                continue
+            seen.add(key)
+            list_valid.append((row, values, key))
+
+        # the contacts stored before their E.164 form was kept are matched raw
+        existing = get_existing_contacts(request.user.id, seen.union([valid[1][0] for valid in list_valid]))
+        remaining = get_remaining_contacts(request.user)
+        list_new = []
+        for (row, values, key) in list_valid:
+            if key in existing or values[0] in existing:
+                row['status'] = BULK_CONTACT_DUPLICATE
+            elif remaining is not None and len(list_new) >= remaining:
+                row['status'] = BULK_CONTACT_LIMIT
             else:
-                error_msg = "The contact duplicated (%s)!\n" % phoneno
-                return Response({'error': error_msg})
+                row['status'] = BULK_CONTACT_CREATED
+                list_new.append(values)
+        if list_new:
+            load_contacts(int(phonebook_id), list_new)
 
-        return Response({'result': 'Bulk contacts are created'})
+        result = {
+            'result': 'Bulk contacts are created',
+            BULK_CONTACT_CREATED: 0,
+            BULK_CONTACT_DUPLICATE: 0,
+            BULK_CONTACT_ERROR: 0,
+            BULK_CONTACT_LIMIT: 0,
+        }
+        for row in rows:
+            result[row['status']] += 1
+        result['rows'] = rows
+        return Response(result)
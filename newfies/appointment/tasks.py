@@ -28,6 +28,7 @@ from dialer_cdr.tasks import init_callrequest
 from dialer_cdr.constants import CALLREQUEST_STATUS, CALLREQUEST_TYPE
 from sms.tasks import SendMessage
 from mod_sms.models import SMSMessage
+from mod_metrics import metrics
 from math import floor
 from datetime import datetime, timedelta
 from django.utils.timezone import utc
@@ -141,6 +142,7 @@ def perform_alarm(obj_event, obj_alarm):
     as Call, SMS and Email
     """
     logger.info("TASK :: perform_alarm -> %d-%s" % (obj_alarm.id, obj_alarm.method))
+    metrics.inc('newfies_alarm_total', method=obj_alarm.method)
 
     if obj_alarm.method == ALARM_METHOD.CALL:
         # send alarm via CALL
@@ -175,6 +177,7 @@ def perform_alarm(obj_event, obj_alarm):
         logger.warning("[perform_alarm - SendMessage] Call msg_obj id:%d - gateway_id:%d" %
                        (msg_obj.id, sms_gateway.id))
         SendMessage.delay(msg_obj.id, sms_gateway.id)
+        metrics.inc('newfies_sms_total', origin='alarm')
 
         # Mark the Alarm as SUCCESS
         obj_alarm.status = ALARM_STATUS.SUCCESS
@@ -0,0 +1,267 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Long-running dispatcher releasing the calls of all the running campaigns
+at a smooth per-second rate, used instead of the campaign_running
+heartbeat when ``settings.DIALER_DISPATCHER`` is enabled.
+
+The callrequests waiting in the timing wheel are PENDING with their
+subscriber IN_PROCESS. When the dispatcher stops they are put back for
+the next spool, and on start the ones left by a dispatcher which died
+are put back once their call_time is older than
+DIALER_DISPATCHER_STALE seconds.
+"""
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+from django.utils.timezone import utc
+from celery.utils.log import get_task_logger
+from dialer_campaign.constants import SUBSCRIBER_STATUS
+from dialer_campaign.models import Campaign, Subscriber
+from dialer_campaign.pacing import get_campaign_budget
+from dialer_campaign.tasks import start_campaign, get_campaign_call_type, spool_callrequest
+from dialer_cdr.constants import CALLREQUEST_STATUS
+from dialer_cdr.models import Callrequest
+from dialer_cdr.tasks import init_callrequest
+from dialer_cdr.tracing import trace_stage, STAGE_SPOOL
+from mod_metrics import metrics
+from datetime import datetime, timedelta
+import time
+
+logger = get_task_logger(__name__)
+
+
+def requeue_callrequests(list_callrequest_id):
+    """
+    Put back the callrequests spooled but never originated : the retries
+    go back to RETRY, due now, the first attempts are removed and their
+    subscribers go back to PENDING. Return the number put back
+    """
+    if not list_callrequest_id:
+        return 0
+    updated_date = datetime.utcnow().replace(tzinfo=utc)
+    with transaction.atomic():
+        list_callrequest = list(Callrequest.objects.select_for_update()
+                                .filter(id__in=list_callrequest_id, status=CALLREQUEST_STATUS.PENDING,
+                                        last_attempt_time__isnull=True)
+                                .values_list('id', 'campaign_id', 'subscriber_id', 'parent_callrequest_id'))
+        list_retry = [item[0] for item in list_callrequest if item[3]]
+        list_first = [item for item in list_callrequest if not item[3]]
+        if list_retry:
+            Callrequest.objects.filter(id__in=list_retry).update(
+                status=CALLREQUEST_STATUS.RETRY, next_attempt_at=updated_date, updated_date=updated_date)
+        if list_first:
+            Subscriber.objects.filter(id__in=[item[2] for item in list_first], status=SUBSCRIBER_STATUS.IN_PROCESS)\
+                .update(status=SUBSCRIBER_STATUS.PENDING, updated_date=updated_date)
+            Callrequest.objects.filter(id__in=[item[0] for item in list_first]).delete()
+    metrics.dec('newfies_originate_backlog', len(list_callrequest))
+    pending = {}
+    for item in list_first:
+        pending[item[1]] = pending.get(item[1], 0) + 1
+    for (campaign_id, count) in pending.items():
+        metrics.inc('newfies_subscribers_pending', count, campaign_id=campaign_id)
+    return len(list_callrequest)
+
+
+class TimingWheel(object):
+
+    """
+    Ring of ``size`` slots of ``resolution`` seconds, items scheduled
+    beyond the last slot are released with the last slot
+
+    - schedule : add an item to release in ``delay`` seconds
+    - advance : return the items due
+    """
+
+    def __init__(self, resolution=0.1, size=600):
+        self.resolution = resolution
+        self.size = size
+        self.slots = [[] for count in range(size)]
+        self.position = 0
+        # time of the first advance and number of slots released since
+        self.start = None
+        self.ticks = 0
+        self.pending = 0
+
+    def schedule(self, item, delay):
+        ticks = min(max(int(delay / self.resolution), 0), self.size - 1)
+        self.slots[(self.position + ticks) % self.size].append(item)
+        self.pending += 1
+
+    def advance(self, now):
+        """Return the items of all the slots started before ``now``"""
+        if self.start is None:
+            self.start = now
+        # slots are counted from the start so float errors don't add up
+        target = int((now - self.start) / self.resolution + 1e-6)
+        due = []
+        while self.ticks <= target:
+            if self.slots[self.position]:
+                due.extend(self.slots[self.position])
+                self.slots[self.position] = []
+            self.position = (self.position + 1) % self.size
+            self.ticks += 1
+        self.pending -= len(due)
+        return due
+
+    def clear(self):
+        """Remove and return the items not released yet"""
+        items = []
+        for slot in self.slots:
+            items.extend(slot)
+        self.slots = [[] for count in range(self.size)]
+        self.pending = 0
+        return items
+
+
+class CampaignState(object):
+
+    """State of a running campaign kept by the dispatcher between ticks"""
+
+    def __init__(self, obj_campaign, call_type):
+        self.campaign = obj_campaign
+        self.call_type = call_type
+        # memory of the pacing controller
+        self.memory = {}
+        # no subscriber to spool until then
+        self.idle_until = 0
+        self.spooled = 0
+
+
+class CampaignDispatcher(object):
+
+    """
+    CampaignDispatcher spools the running campaigns every ``tick`` seconds
+    and releases their callrequests from a timing wheel
+
+    **Attributes**:
+
+        * ``tick`` - Seconds between two spools of a campaign
+        * ``refresh_interval`` - Seconds between two reloads of the running campaigns
+        * ``resolution`` - Precision of the timing wheel
+        * ``originate`` - Callable receiving (callrequest_id, campaign_id, callmaxduration)
+        * ``stale`` - Seconds after which a PENDING callrequest is put back on start
+    """
+
+    def __init__(self, tick=1.0, refresh_interval=None, resolution=0.1, originate=None, stale=None):
+        self.tick = tick
+        if refresh_interval is None:
+            refresh_interval = getattr(settings, 'DIALER_DISPATCHER_REFRESH', 10)
+        if stale is None:
+            stale = getattr(settings, 'DIALER_DISPATCHER_STALE', 300)
+        self.refresh_interval = refresh_interval
+        self.stale = stale
+        self.resolution = resolution
+        self.wheel = TimingWheel(resolution=resolution, size=int(60 / resolution))
+        self.originate = originate or self.send_callrequest
+        self.campaigns = {}
+        self.next_refresh = 0
+        self.next_spool = 0
+
+    def send_callrequest(self, callrequest_id, campaign_id, callmaxduration):
+        init_callrequest.delay(callrequest_id, campaign_id, callmaxduration)
+
+    def refresh(self):
+        """Reload the running campaigns, keep the state of the ones still running"""
+        close_old_connections()
+        running = set()
+        list_campaign = Campaign.objects.get_running_campaign()\
+            .select_related('user__userprofile__dialersetting', 'aleg_gateway', 'content_type')
+        for obj_campaign in list_campaign:
+            start_campaign(obj_campaign)
+            call_type = get_campaign_call_type(obj_campaign)
+            if call_type is None:
+                continue
+            running.add(obj_campaign.id)
+            state = self.campaigns.get(obj_campaign.id)
+            if state is None:
+                logger.info("Dispatcher : start campaign %s (id:%d)" % (obj_campaign.name, obj_campaign.id))
+                self.campaigns[obj_campaign.id] = CampaignState(obj_campaign, call_type)
+            else:
+                # pick up the changes on frequency, gateway...
+                state.campaign = obj_campaign
+                state.call_type = call_type
+        for campaign_id in list(self.campaigns.keys()):
+            if campaign_id not in running:
+                logger.info("Dispatcher : stop campaign id:%d" % campaign_id)
+                del self.campaigns[campaign_id]
+
+    def spool(self, now):
+        """Spool the budget of each campaign and spread it over the next tick"""
+        for state in self.campaigns.values():
+            if state.idle_until > now:
+                continue
+            budget = get_campaign_budget(state.campaign, self.tick, state.memory)
+            if not budget:
+                continue
+            with trace_stage(STAGE_SPOOL):
+                list_cr = spool_callrequest(state.campaign, budget, state.call_type)
+            if not list_cr:
+                # nothing to call, wait for the next refresh
+                state.idle_until = now + self.refresh_interval
+                continue
+            state.spooled += len(list_cr)
+            spacing = self.tick / len(list_cr)
+            for count, cr in enumerate(list_cr):
+                self.wheel.schedule(
+                    (cr.id, state.campaign.id, state.campaign.callmaxduration), count * spacing)
+
+    def run_once(self, now):
+        """Refresh, spool and release the calls due at ``now``"""
+        if now >= self.next_refresh:
+            self.refresh()
+            self.next_refresh = now + self.refresh_interval
+        if now >= self.next_spool:
+            self.spool(now)
+            self.next_spool = now + self.tick
+        due = self.wheel.advance(now)
+        for item in due:
+            self.originate(*item)
+        return len(due)
+
+    def sweep(self):
+        """Put back the callrequests left PENDING by a dispatcher which died"""
+        stale_date = datetime.utcnow().replace(tzinfo=utc) - timedelta(seconds=self.stale)
+        list_id = list(Callrequest.objects
+                       .filter(status=CALLREQUEST_STATUS.PENDING, campaign__isnull=False,
+                               last_attempt_time__isnull=True, call_time__lt=stale_date)
+                       .values_list('id', flat=True))
+        count = requeue_callrequests(list_id)
+        if count:
+            logger.warning("Dispatcher : %d stale callrequests put back" % count)
+        return count
+
+    def drain(self):
+        """Put back the callrequests still in the wheel"""
+        list_id = [item[0] for item in self.wheel.clear()]
+        try:
+            count = requeue_callrequests(list_id)
+        except Exception as e:
+            # the sweep of the next start puts them back
+            logger.error("Dispatcher : %d callrequests not put back : %s" % (len(list_id), e))
+            return 0
+        if count:
+            logger.info("Dispatcher : %d callrequests put back" % count)
+        return count
+
+    def run(self):
+        logger.info("Dispatcher started (tick:%s, refresh:%s)" % (self.tick, self.refresh_interval))
+        self.sweep()
+        try:
+            while True:
+                self.run_once(time.time())
+                time.sleep(self.resolution)
+        finally:
+            self.drain()
@@ -0,0 +1,48 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from dialer_campaign.dispatcher import CampaignDispatcher
+import signal
+import sys
+
+
+class Command(BaseCommand):
+    args = 'tick, refresh'
+    help = "Run the dispatcher releasing the calls of the running campaigns\n" \
+           "set DIALER_DISPATCHER = True so campaign_running stops spooling\n" \
+           "----------------------------------------------------------------\n" \
+           "python manage.py run_dispatcher --tick=1 --refresh=10"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--tick', default=1.0, dest='tick',
+                    help='seconds between two spools of a campaign'),
+        make_option('--refresh', default=None, dest='refresh',
+                    help='seconds between two reloads of the running campaigns'),
+    )
+
+    def handle(self, *args, **options):
+        refresh = options.get('refresh')
+        if refresh is not None:
+            refresh = float(refresh)
+        dispatcher = CampaignDispatcher(tick=float(options['tick']), refresh_interval=refresh)
+        # stop on SIGTERM like on CTRL-C, the calls of the wheel are put back
+        signal.signal(signal.SIGTERM, lambda signum, frame: sys.exit(0))
+        print "Dispatcher running, CTRL-C to stop"
+        try:
+            dispatcher.run()
+        except (KeyboardInterrupt, SystemExit):
+            print "Dispatcher stopped"
@@ -0,0 +1,112 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from django.core.management.base import BaseCommand
+from django.utils.module_loading import import_string
+from optparse import make_option
+from dialer_campaign.pacing import PacingSimulator
+from dialer_cdr.constants import DISPOSITION_CODE, LEG_TYPE
+from dialer_cdr.models import VoIPCall
+import csv
+import json
+
+
+def load_outcomes_campaign(campaign_id, limit):
+    """Recorded outcomes of the A-Leg calls of a campaign"""
+    outcomes = []
+    list_voipcall = VoIPCall.objects\
+        .filter(callrequest__campaign_id=campaign_id, leg_type=LEG_TYPE.A_LEG)\
+        .values_list('duration', 'billsec', 'disposition_code').order_by('-id')[:limit]
+    for (duration, billsec, disposition_code) in list_voipcall:
+        duration = duration or 0
+        billsec = billsec or 0
+        answered = disposition_code == DISPOSITION_CODE.ANSWER
+        outcomes.append((max(duration - billsec, 0), answered, billsec))
+    return outcomes
+
+
+def load_outcomes_csv(filename):
+    """Recorded outcomes from a CSV file : ring_seconds, answered (0/1), talk_seconds"""
+    outcomes = []
+    with open(filename) as csvfile:
+        for row in csv.reader(csvfile):
+            if not row or row[0].startswith('#'):
+                continue
+            outcomes.append((float(row[0]), row[1].strip() == '1', float(row[2])))
+    return outcomes
+
+
+class Command(BaseCommand):
+    args = 'campaign_id, csv, controller, frequency, duration'
+    help = "Replay recorded call outcomes against a pacing controller\n" \
+           "------------------------------------------------------------\n" \
+           "python manage.py simulate_pacing --campaign_id=1 --frequency=60 --duration=3600\n" \
+           "python manage.py simulate_pacing --csv=outcomes.csv " \
+           "--controller=dialer_campaign.pacing.AbandonRateController --options='{\"target_abandon\": 0.03}'"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--campaign_id', default=None, dest='campaign_id',
+                    help='replay the A-Leg calls of this campaign'),
+        make_option('--csv', default=None, dest='csv',
+                    help='replay the outcomes of a CSV file (ring_seconds,answered,talk_seconds)'),
+        make_option('--limit', default=5000, dest='limit',
+                    help='number of calls to load from the campaign'),
+        make_option('--controller', default=None, dest='controller',
+                    help='pacing controller, default settings.DIALER_PACING_CONTROLLER'),
+        make_option('--options', default=None, dest='options',
+                    help='controller options as JSON, default settings.DIALER_PACING_OPTIONS'),
+        make_option('--frequency', default=10, dest='frequency',
+                    help='campaign frequency in calls per minute'),
+        make_option('--max_channels', default=0, dest='max_channels',
+                    help='gateway limit of concurrent calls'),
+        make_option('--duration', default=3600, dest='duration',
+                    help='simulated time in seconds'),
+        make_option('--tick', default=None, dest='tick',
+                    help='tick in seconds, default 60 / HEARTBEAT_MIN'),
+    )
+
+    def handle(self, *args, **options):
+        if options.get('campaign_id'):
+            outcomes = load_outcomes_campaign(int(options['campaign_id']), int(options['limit']))
+        elif options.get('csv'):
+            outcomes = load_outcomes_csv(options['csv'])
+        else:
+            print "Set --campaign_id or --csv"
+            return False
+        if not outcomes:
+            print "No call outcome to replay"
+            return False
+
+        path = options.get('controller') or settings.DIALER_PACING_CONTROLLER
+        if options.get('options'):
+            controller_options = json.loads(options['options'])
+        else:
+            controller_options = settings.DIALER_PACING_OPTIONS
+        controller = import_string(path)(**controller_options)
+
+        tick = float(options.get('tick') or 60.0 / settings.HEARTBEAT_MIN)
+        simulator = PacingSimulator(
+            controller, outcomes, int(options['frequency']), tick_seconds=tick,
+            max_channels=int(options['max_channels']),
+            abandon_seconds=settings.DIALER_PACING_ABANDON_BILLSEC,
+            window=settings.DIALER_PACING_WINDOW)
+        ticks = simulator.run(int(options['duration']))
+
+        for result in ticks:
+            print "%(time)6d budget:%(budget)4d calling:%(calling)4d " \
+                  "answer:%(answer_ratio)s abandon:%(abandon_ratio)s" % result
+        placed = sum([result['budget'] for result in ticks])
+        print "%s on %d recorded calls" % (path, len(outcomes))
+        print "calls placed:%d max concurrent:%d" % (placed, max([result['calling'] for result in ticks]))
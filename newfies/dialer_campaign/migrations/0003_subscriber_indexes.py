@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Subscriber status PENDING = 1
+INDEXES = [
+    ('dialer_subscriber_campaign_status_idx',
+     'ON dialer_subscriber (campaign_id, status)'),
+    # claim of the pending subscribers of a campaign, ORDER BY id LIMIT n
+    ('dialer_subscriber_pending_idx',
+     'ON dialer_subscriber (campaign_id, id) WHERE status = 1'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for (name, definition) in INDEXES:
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS %s %s' % (name, definition))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for (name, definition) in INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dialer_campaign', '0002_campaign_stoppeddate'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,48 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+def create_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    # range of the contacts of a phonebook added since the last collection
+    schema_editor.execute('CREATE INDEX IF NOT EXISTS dialer_contact_phonebook_id_idx '
+                          'ON dialer_contact (phonebook_id, id)')
+
+
+def drop_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS dialer_contact_phonebook_id_idx')
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dialer_contact', '0002_contactimport'),
+        ('dialer_campaign', '0003_subscriber_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='CampaignPhonebookImport',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('last_contact_id', models.IntegerField(default=0)),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+                ('campaign', models.ForeignKey(to='dialer_campaign.Campaign')),
+                ('phonebook', models.ForeignKey(to='dialer_contact.Phonebook')),
+            ],
+            options={
+                'db_table': 'dialer_campaign_phonebook_import',
+            },
+            bases=(models.Model,),
+        ),
+        migrations.AlterUniqueTogether(
+            name='campaignphonebookimport',
+            unique_together=set([('campaign', 'phonebook')]),
+        ),
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -12,13 +12,12 @@
 # Arezqui Belaid <info@star2billing.com>
 #
 
-from django.db import models
+from django.db import models, connection
 from django.utils.translation import ugettext_lazy as _
 from django.utils.translation import ugettext
 from django.utils.timezone import now
 from django.core.urlresolvers import reverse
 from django.core.cache import cache
-from django.db.models.signals import post_save
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from django.db import transaction
@@ -425,8 +424,23 @@ class Campaign(Model):
     # OPTIMIZATION - GOOD
     @transaction.atomic
     def get_pending_subscriber_update(self, limit, status):
-        """Get all the pending subscribers from the campaign"""
-        # TODO: Improve this part with a PL/SQL
+        """
+        Claim up to ``limit`` pending subscribers of the campaign and move
+        them to ``status``, return (list_subscriber, count)
+
+        On PostgreSQL the claim is a single UPDATE ... RETURNING over a
+        FOR UPDATE SKIP LOCKED subselect, so concurrent workers spooling the
+        same campaign get disjoint batches without waiting on each other
+        """
+        if connection.vendor == 'postgresql':
+            sql_statement = "UPDATE dialer_subscriber SET status = %s, updated_date = %s " \
+                "WHERE id IN (SELECT id FROM dialer_subscriber WHERE campaign_id = %s AND status = %s " \
+                "ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) RETURNING *"
+            list_subscriber = list(Subscriber.objects.raw(
+                sql_statement, [status, now(), self.id, SUBSCRIBER_STATUS.PENDING, limit]))
+            if not list_subscriber:
+                return (False, 0)
+            return (list_subscriber, len(list_subscriber))
 
         # We cannot use select_related here as it's not compliant with locking the rows
         list_subscriber = Subscriber.objects.select_for_update()\
@@ -532,36 +546,33 @@ class Subscriber(Model):
     """
 
 
-# Note : This will cause the running campaign to add the new contacts to the subscribers list
-def post_save_add_contact(sender, **kwargs):
-    """A ``post_save`` signal is sent by the Contact model instance whenever
-    it is going to save.
+class CampaignPhonebookImport(models.Model):
 
-    **Logic Description**:
+    """This defines the progress of the collection of the contacts of a
+    phonebook as subscribers of a campaign
+
+    **Attributes**:
 
-        * When new contact is added into ``Contact`` model, active the
-          campaign list will be checked with the contact status.
-        * If the active campaign list count is more than one & the contact
-          is active, the contact will be added into ``Subscriber``
-          model.
+        * ``last_contact_id`` - highest contact id of the phonebook already collected
+
+    **Relationships**:
+
+        * ``campaign`` - Foreign key relationship to the Campaign model.
+        * ``phonebook`` - Foreign key relationship to the Phonebook model.
+
+    **Name of DB table**: dialer_campaign_phonebook_import
     """
-    obj = kwargs['instance']
-    active_campaign_list = Campaign.objects.filter(phonebook__contact__id=obj.id,
-                                                   status=CAMPAIGN_STATUS.START)
-    # created instance = True + active contact + active_campaign
-    if kwargs['created'] and obj.status == CONTACT_STATUS.ACTIVE \
-            and active_campaign_list.count() >= 1:
-        for elem_campaign in active_campaign_list:
-            try:
-                Subscriber.objects.create(
-                    contact=obj,
-                    duplicate_contact=obj.contact,
-                    status=SUBSCRIBER_STATUS.PENDING,
-                    campaign=elem_campaign)
-            except:
-                pass
+    campaign = models.ForeignKey(Campaign)
+    phonebook = models.ForeignKey(Phonebook)
+    last_contact_id = models.IntegerField(default=0)
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = u'dialer_campaign_phonebook_import'
+        unique_together = ['campaign', 'phonebook']
 
-post_save.connect(post_save_add_contact, sender=Contact)
+    def __unicode__(self):
+        return u"%s-%s" % (self.campaign_id, self.phonebook_id)
 
 
 # def post_update_campaign_status(sender, **kwargs):
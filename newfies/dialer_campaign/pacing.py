@@ -0,0 +1,327 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Pacing controllers compute how many calls a running campaign may
+originate on each tick of the spooler.
+
+A controller receives a ``PacingState`` describing the live feedback of
+the campaign and a ``memory`` dict that the caller keeps between ticks
+(PID integral, fractional carry...), and returns the originate budget.
+The controller used is defined by ``settings.DIALER_PACING_CONTROLLER``
+with the options of ``settings.DIALER_PACING_OPTIONS``.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db.models import Count
+from django.utils.module_loading import import_string
+from django.utils.timezone import utc
+from datetime import datetime, timedelta
+from collections import deque
+from math import floor
+import logging
+
+logger = logging.getLogger('newfies.filelog')
+
+PACING_MEMORY_EXPIRE = 60 * 60  # Controller memory expires after 1 hour without tick
+
+
+class PacingState(object):
+
+    """
+    Live feedback of a campaign
+
+    **Attributes**:
+
+        * ``frequency`` - Calls per minute set on the campaign
+        * ``tick_seconds`` - Duration of a tick in seconds
+        * ``calling`` - Callrequests of the campaign in CALLING state
+        * ``gateway_calling`` - Callrequests in CALLING state on the campaign's gateway
+        * ``max_channels`` - Max concurrent calls of the gateway, 0 for no limit
+        * ``answered`` - Answered calls over the feedback window
+        * ``abandoned`` - Answered calls dropped within the first seconds
+        * ``attempts`` - Calls over the feedback window
+    """
+
+    def __init__(self, frequency, tick_seconds, calling=0, gateway_calling=0, max_channels=0,
+                 answered=0, abandoned=0, attempts=0):
+        self.frequency = frequency or 0
+        self.tick_seconds = tick_seconds
+        self.calling = calling
+        self.gateway_calling = gateway_calling
+        self.max_channels = max_channels or 0
+        self.answered = answered
+        self.abandoned = abandoned
+        self.attempts = attempts
+
+    def answer_ratio(self):
+        if not self.attempts:
+            return None
+        return float(self.answered) / self.attempts
+
+    def abandon_ratio(self):
+        if not self.answered:
+            return None
+        return float(self.abandoned) / self.answered
+
+    def frequency_budget(self, memory):
+        """Calls allowed by the campaign frequency on this tick, the fraction is carried over"""
+        budget = self.frequency * self.tick_seconds / 60.0 + memory.get('carry', 0.0)
+        calls = int(floor(budget))
+        memory['carry'] = budget - calls
+        return calls
+
+    def channel_room(self):
+        """Calls the gateway can still take, None if there is no limit"""
+        if not self.max_channels:
+            return None
+        return max(self.max_channels - self.gateway_calling, 0)
+
+
+class BasePacingController(object):
+
+    """Base class of the pacing controllers"""
+
+    # Set to True if the controller uses the live feedback of the campaign
+    needs_feedback = False
+
+    def __init__(self, **options):
+        self.options = options
+
+    def get_budget(self, state, memory):
+        raise NotImplementedError
+
+    def cap(self, budget, state):
+        """Never go over the gateway limit"""
+        room = state.channel_room()
+        if room is not None:
+            budget = min(budget, room)
+        return max(int(budget), 0)
+
+
+class FixedFrequencyController(BasePacingController):
+
+    """Spool ``frequency`` calls per minute, whatever happens to the calls"""
+
+    def get_budget(self, state, memory):
+        return self.cap(state.frequency_budget(memory), state)
+
+
+class ConcurrentCallsController(BasePacingController):
+
+    """
+    Spool at the campaign frequency while keeping the calls in CALLING
+    state under ``max_concurrent``
+
+    **Options**:
+
+        * ``max_concurrent`` - Ceiling of concurrent calls per campaign
+    """
+    needs_feedback = True
+
+    def get_budget(self, state, memory):
+        budget = state.frequency_budget(memory)
+        max_concurrent = self.options.get('max_concurrent')
+        if max_concurrent:
+            budget = min(budget, max(max_concurrent - state.calling, 0))
+        return self.cap(budget, state)
+
+
+class AbandonRateController(BasePacingController):
+
+    """
+    PID controller on the abandon ratio: the campaign frequency is scaled
+    down when the abandon ratio goes over ``target_abandon`` and back up
+    when it falls below
+
+    **Options**:
+
+        * ``target_abandon`` - Target abandon ratio, default 0.03
+        * ``kp``, ``ki``, ``kd`` - PID gains
+        * ``min_rate`` - Lowest share of the frequency, default 0.1
+        * ``max_concurrent`` - Optional ceiling of concurrent calls
+    """
+    needs_feedback = True
+
+    def get_budget(self, state, memory):
+        target = self.options.get('target_abandon', 0.03)
+        kp = self.options.get('kp', 4.0)
+        ki = self.options.get('ki', 1.0)
+        kd = self.options.get('kd', 0.5)
+        min_rate = self.options.get('min_rate', 0.1)
+
+        abandon_ratio = state.abandon_ratio()
+        rate = memory.get('rate', 1.0)
+        if abandon_ratio is not None:
+            error = target - abandon_ratio
+            integral = memory.get('integral', 0.0) + error
+            derivative = error - memory.get('error', error)
+            output = kp * error + ki * integral + kd * derivative
+            # anti-windup : the integral stops growing once the rate saturates
+            rate = min(max(1.0 + output, min_rate), 1.0)
+            if min_rate < 1.0 + output < 1.0:
+                memory['integral'] = integral
+            memory['error'] = error
+            memory['rate'] = rate
+
+        budget = state.frequency_budget(memory) * rate
+        max_concurrent = self.options.get('max_concurrent')
+        if max_concurrent:
+            budget = min(budget, max(max_concurrent - state.calling, 0))
+        return self.cap(budget, state)
+
+
+_controller = None
+
+
+def get_pacing_controller():
+    """Return the pacing controller set in the settings"""
+    global _controller
+    if _controller is None:
+        path = getattr(settings, 'DIALER_PACING_CONTROLLER',
+                       'dialer_campaign.pacing.FixedFrequencyController')
+        options = getattr(settings, 'DIALER_PACING_OPTIONS', {})
+        _controller = import_string(path)(**options)
+    return _controller
+
+
+def get_pacing_state(obj_campaign, tick_seconds, feedback=True):
+    """
+    Build the PacingState of a campaign, the feedback queries are
+    only run if the controller needs them
+    """
+    max_channels = obj_campaign.aleg_gateway.maximum_call or 0
+    state = PacingState(obj_campaign.frequency, tick_seconds, max_channels=max_channels)
+    if not feedback and not max_channels:
+        return state
+
+    from dialer_cdr.models import Callrequest, VoIPCall
+    from dialer_cdr.constants import CALLREQUEST_STATUS, DISPOSITION_CODE, LEG_TYPE
+
+    if max_channels:
+        state.gateway_calling = Callrequest.objects\
+            .filter(aleg_gateway_id=obj_campaign.aleg_gateway_id, status=CALLREQUEST_STATUS.CALLING)\
+            .count()
+    if not feedback:
+        return state
+
+    state.calling = Callrequest.objects\
+        .filter(campaign_id=obj_campaign.id, status=CALLREQUEST_STATUS.CALLING).count()
+
+    window = getattr(settings, 'DIALER_PACING_WINDOW', 300)
+    abandon_billsec = getattr(settings, 'DIALER_PACING_ABANDON_BILLSEC', 2)
+    start_window = datetime.utcnow().replace(tzinfo=utc) - timedelta(seconds=window)
+    list_voipcall = VoIPCall.objects\
+        .filter(callrequest__campaign_id=obj_campaign.id, leg_type=LEG_TYPE.A_LEG,
+                starting_date__gte=start_window)
+    for row in list_voipcall.values('disposition_code').annotate(total=Count('id')):
+        state.attempts += row['total']
+        if row['disposition_code'] == DISPOSITION_CODE.ANSWER:
+            state.answered += row['total']
+    state.abandoned = list_voipcall\
+        .filter(disposition_code=DISPOSITION_CODE.ANSWER, billsec__lt=abandon_billsec).count()
+    return state
+
+
+def get_campaign_budget(obj_campaign, tick_seconds, memory=None):
+    """
+    Return the number of calls the campaign may originate on this tick,
+    the controller memory is kept in the cache between ticks unless
+    the caller holds it in ``memory``
+    """
+    controller = get_pacing_controller()
+    state = get_pacing_state(obj_campaign, tick_seconds, controller.needs_feedback)
+    if memory is not None:
+        budget = controller.get_budget(state, memory)
+    else:
+        key = 'pacing_memory_campaign_id_%d' % obj_campaign.id
+        memory = cache.get(key) or {}
+        budget = controller.get_budget(state, memory)
+        cache.set(key, memory, PACING_MEMORY_EXPIRE)
+    logger.debug('Pacing campaign %d : budget=%d calling=%d abandon_ratio=%s' %
+                 (obj_campaign.id, budget, state.calling, state.abandon_ratio()))
+    return budget
+
+
+class PacingSimulator(object):
+
+    """
+    Replay recorded call outcomes against a pacing controller, in order
+    to tune it offline
+
+    **Attributes**:
+
+        * ``controller`` - Pacing controller to evaluate
+        * ``outcomes`` - list of (ring_seconds, answered, talk_seconds) recorded calls
+        * ``frequency`` - Campaign frequency in calls per minute
+        * ``tick_seconds`` - Duration of a tick
+        * ``max_channels`` - Gateway limit, 0 for no limit
+        * ``abandon_seconds`` - Answered calls shorter than this are counted as abandoned
+        * ``window`` - Feedback window in seconds
+    """
+
+    def __init__(self, controller, outcomes, frequency, tick_seconds=60, max_channels=0,
+                 abandon_seconds=2, window=300):
+        self.controller = controller
+        self.outcomes = outcomes
+        self.frequency = frequency
+        self.tick_seconds = tick_seconds
+        self.max_channels = max_channels
+        self.abandon_seconds = abandon_seconds
+        self.window = window
+
+    def run(self, duration):
+        """
+        Simulate ``duration`` seconds, return a list of one dict per tick
+        with the budget, the concurrent calls and the ratios
+        """
+        memory = {}
+        # end of ringing / end of call for the calls in progress
+        calling = []
+        # (end_time, answered, abandoned) of the finished calls
+        finished = deque()
+        ticks = []
+        placed = 0
+        now = 0
+        while now < duration:
+            calling = [end for end in calling if end > now]
+            while finished and finished[0][0] < now - self.window:
+                finished.popleft()
+            done = [item for item in finished if item[0] <= now]
+            state = PacingState(
+                self.frequency, self.tick_seconds,
+                calling=len(calling), gateway_calling=len(calling), max_channels=self.max_channels,
+                attempts=len(done),
+                answered=len([item for item in done if item[1]]),
+                abandoned=len([item for item in done if item[2]]))
+            budget = self.controller.get_budget(state, memory)
+            for count in range(budget):
+                offset = now + float(count) * self.tick_seconds / max(budget, 1)
+                (ring_seconds, answered, talk_seconds) = self.outcomes[placed % len(self.outcomes)]
+                placed += 1
+                end = offset + ring_seconds + (talk_seconds if answered else 0)
+                calling.append(end)
+                abandoned = answered and talk_seconds < self.abandon_seconds
+                finished.append((end, answered, abandoned))
+            finished = deque(sorted(finished))
+            ticks.append({
+                'time': now,
+                'budget': budget,
+                'calling': state.calling,
+                'answer_ratio': state.answer_ratio(),
+                'abandon_ratio': state.abandon_ratio(),
+            })
+            now += self.tick_seconds
+        return ticks
@@ -19,18 +19,20 @@ from celery.task import Task
 from celery.utils.log import get_task_logger
 from dialer_campaign.models import Campaign
 from dialer_campaign.constants import SUBSCRIBER_STATUS, CAMPAIGN_STATUS
+from dialer_campaign.pacing import get_campaign_budget
 from dialer_cdr.constants import CALLREQUEST_STATUS, CALLREQUEST_TYPE
 from dialer_cdr.models import Callrequest
-from dialer_cdr.tasks import init_callrequest
+from dialer_cdr.tasks import init_callrequest, init_callrequest_batch
+from dialer_cdr.tracing import trace_stage, STAGE_SPOOL
+from mod_metrics import metrics
 from dialer_contact.tasks import collect_subscriber
-from dnc.models import DNCContact
+from dnc.index import get_dnc_index
 from survey.models import Survey_template
 from django_lets_go.only_one_task import only_one
 from datetime import datetime, timedelta
 from django.utils.timezone import utc
 from math import floor
 from common_functions import debug_query
-from uuid import uuid1
 # from celery.task.http import HttpDispatchTask
 # from common_functions import isint
 
@@ -68,10 +70,142 @@ class campaign_spool_contact(PeriodicTask):
             collect_subscriber.delay(campaign.id)
 
 
+def start_campaign(obj_campaign):
+    """
+    Ensure the content_type become "survey" when the campaign starts
+    and collect its subscribers
+    """
+    if obj_campaign.has_been_started:
+        return
+    # change has_been_started flag
+    obj_campaign.has_been_started = True
+    obj_campaign.save()
+
+    if obj_campaign.content_type.model == 'survey_template':
+        # Copy survey
+        survey_template = Survey_template.objects.get(user=obj_campaign.user, pk=obj_campaign.object_id)
+        survey_template.copy_survey_template(obj_campaign.id)
+    collect_subscriber.delay(obj_campaign.id)
+
+
+def get_campaign_call_type(obj_campaign):
+    """
+    Return the call_type of the callrequests of a campaign,
+    None if the user has no dialersetting
+    """
+    # TODO: move this logic of setting call_type after CallRequest post_save
+    # Default call_type
+    call_type = CALLREQUEST_TYPE.ALLOW_RETRY
+    # Check campaign's maxretry
+    if obj_campaign.maxretry == 0:
+        call_type = CALLREQUEST_TYPE.CANNOT_RETRY
+
+    # Check user's dialer setting maxretry
+    try:
+        obj_campaign.user.userprofile.dialersetting
+        if obj_campaign.user.userprofile.dialersetting.maxretry == 0:
+            call_type = CALLREQUEST_TYPE.CANNOT_RETRY
+    except ObjectDoesNotExist:
+        logger.error("Can't find user's dialersetting")
+        return None
+    return call_type
+
+
+def spool_callrequest(obj_campaign, callfrequency, call_type):
+    """
+    Return up to ``callfrequency`` callrequests to originate : the retries
+    of the campaign which are due first, then the callrequests created for
+    pending subscribers moved IN_PROCESS. The retries share the pacing
+    budget of the campaign with the first attempts
+
+    **Attributes**:
+
+        * ``obj_campaign`` - Campaign with user__userprofile__dialersetting and aleg_gateway
+        * ``callfrequency`` - Max number of subscribers to spool
+        * ``call_type`` - call_type of the new callrequests
+    """
+    list_retry = Callrequest.objects.claim_due_retries(obj_campaign.id, callfrequency)
+    if list_retry:
+        logger.info("##retry=%d campaign_id=%d" % (len(list_retry), obj_campaign.id))
+        metrics.inc('newfies_callrequests_spooled_total', len(list_retry), campaign_id=obj_campaign.id)
+        metrics.inc('newfies_originate_backlog', len(list_retry))
+        callfrequency -= len(list_retry)
+        if callfrequency <= 0:
+            return list_retry
+
+    (list_subscriber, no_subscriber) = obj_campaign\
+        .get_pending_subscriber_update(callfrequency, SUBSCRIBER_STATUS.IN_PROCESS)
+    logger.info("##subscriber=%d campaign_id=%d callfreq=%d freq=%d" %
+                (no_subscriber, obj_campaign.id, callfrequency, obj_campaign.frequency))
+    debug_query(3)
+
+    if no_subscriber == 0:
+        return list_retry
+    metrics.dec('newfies_subscribers_pending', no_subscriber, campaign_id=obj_campaign.id)
+
+    # Screen the batch against the whitelist / blacklist and the DNC list
+    # with a constant number of queries
+    list_rejected = []
+    list_allowed = []
+    for elem_camp_subscriber in list_subscriber:
+        phone_number = elem_camp_subscriber.duplicate_contact
+        # Verify that the contact is authorized
+        if not obj_campaign.is_authorized_contact(obj_campaign.user.userprofile.dialersetting, phone_number):
+            logger.error("Error : Contact (%s) not authorized" % phone_number)
+            list_rejected.append(elem_camp_subscriber.id)
+        else:
+            list_allowed.append(elem_camp_subscriber)
+    debug_query(4)
+
+    # Verify that the contacts are not in the DNC list
+    if obj_campaign.dnc_id and list_allowed:
+        dnc_numbers = get_dnc_index(obj_campaign.dnc_id)\
+            .filter_numbers([sb.duplicate_contact for sb in list_allowed], user_id=obj_campaign.user_id)
+        if dnc_numbers:
+            for elem_camp_subscriber in list_allowed:
+                if elem_camp_subscriber.duplicate_contact in dnc_numbers:
+                    logger.error("Contact (%s) in DNC list" % elem_camp_subscriber.duplicate_contact)
+                    list_rejected.append(elem_camp_subscriber.id)
+            list_allowed = [sb for sb in list_allowed if sb.duplicate_contact not in dnc_numbers]
+
+    debug_query(5)
+
+    bulk_record = []
+    for elem_camp_subscriber in list_allowed:
+        phone_number = elem_camp_subscriber.duplicate_contact
+        bulk_record.append(
+            Callrequest(
+                status=CALLREQUEST_STATUS.PENDING,
+                call_type=call_type,
+                call_time=datetime.utcnow().replace(tzinfo=utc),
+                timeout=obj_campaign.calltimeout,
+                callerid=obj_campaign.callerid,
+                caller_name=obj_campaign.caller_name,
+                phone_number=phone_number,
+                campaign=obj_campaign,
+                aleg_gateway=obj_campaign.aleg_gateway,
+                content_type=obj_campaign.content_type,
+                object_id=obj_campaign.object_id,
+                user=obj_campaign.user,
+                extra_data=obj_campaign.extra_data,
+                timelimit=obj_campaign.callmaxduration,
+                subscriber=elem_camp_subscriber,
+            )
+        )
+        debug_query(6)
+
+    # Create Callrequests in Bulk, their ids are returned by the insert
+    # and the rejected subscribers are updated in the same statement
+    logger.info("Bulk Create CallRequest => %d" % (len(bulk_record)))
+    metrics.inc('newfies_callrequests_spooled_total', len(bulk_record), campaign_id=obj_campaign.id)
+    metrics.inc('newfies_originate_backlog', len(bulk_record))
+    return list_retry + Callrequest.objects.bulk_create_returning(bulk_record, list_rejected)
+
+
 # OPTIMIZATION - FINE
 class pending_call_processing(Task):
 
-    @only_one(ikey="check_pendingcall", timeout=LOCK_EXPIRE)
+    # No lock, concurrent runs for a campaign claim disjoint batches of subscribers
     def run(self, campaign_id):
         """
         This task retrieves the next outbound call to be made for a given
@@ -95,123 +229,44 @@ class pending_call_processing(Task):
             logger.error("Can't find this campaign")
             return False
 
-        # Ensure the content_type become "survey" when campagin starts
-        if not obj_campaign.has_been_started:
-            # change has_been_started flag
-            obj_campaign.has_been_started = True
-            obj_campaign.save()
-
-            if obj_campaign.content_type.model == 'survey_template':
-                # Copy survey
-                survey_template = Survey_template.objects.get(user=obj_campaign.user, pk=obj_campaign.object_id)
-                survey_template.copy_survey_template(obj_campaign.id)
-            collect_subscriber.delay(obj_campaign.id)
-
-        # TODO : Control the Speed
-        # if there is many task pending we should slow down
-        frequency = obj_campaign.frequency  # default 10 calls per minutes
+        start_campaign(obj_campaign)
 
         debug_query(1)
 
-        # TODO: move this logic of setting call_type after CallRequest post_save
-        # Default call_type
-        call_type = CALLREQUEST_TYPE.ALLOW_RETRY
-        # Check campaign's maxretry
-        if obj_campaign.maxretry == 0:
-            call_type = CALLREQUEST_TYPE.CANNOT_RETRY
-
-        # Check user's dialer setting maxretry
-        try:
-            obj_campaign.user.userprofile.dialersetting
-            if obj_campaign.user.userprofile.dialersetting.maxretry == 0:
-                call_type = CALLREQUEST_TYPE.CANNOT_RETRY
-        except ObjectDoesNotExist:
-            logger.error("Can't find user's dialersetting")
+        call_type = get_campaign_call_type(obj_campaign)
+        if call_type is None:
             return False
 
         debug_query(2)
 
         # Speed
-        # Check if the other tasks send for this campaign finished to be ran
-
-        # Get the subscriber of this campaign
-        # get_pending_subscriber get Max 1000 records
-        if settings.HEARTBEAT_MIN == 1:  # 1 task per minute
-            callfrequency = frequency  # task run only once per minute, so we can assign frequency
-        else:
-            callfrequency = int(frequency / settings.HEARTBEAT_MIN) + 1  # 1000 per minutes
-            # callfrequency = int(frequency) + 1  # 1000 per minutes
-
-        (list_subscriber, no_subscriber) = obj_campaign\
-            .get_pending_subscriber_update(callfrequency, SUBSCRIBER_STATUS.IN_PROCESS)
-        logger.info("##subscriber=%d campaign_id=%d callfreq=%d freq=%d" %
-                    (no_subscriber, campaign_id, callfrequency, frequency))
-        debug_query(3)
-
-        if no_subscriber == 0:
+        # The pacing controller computes the calls to originate on this tick
+        # from the campaign frequency and the live feedback (calls in progress,
+        # abandon ratio, gateway limit), get_pending_subscriber get Max 1000 records
+        callfrequency = get_campaign_budget(obj_campaign, 60.0 / settings.HEARTBEAT_MIN)
+        if callfrequency == 0:
+            logger.info("No call budget for campaign_id=%d on this tick" % campaign_id)
             return False
 
-        list_cr = []
-        bulk_record = []
-        # this is used to tag and retrieve the id that are inserted
-        bulk_uuid = str(uuid1())
-        for elem_camp_subscriber in list_subscriber:
-            phone_number = elem_camp_subscriber.duplicate_contact
-            debug_query(4)
-
-            # Verify that the contact is authorized
-            if not obj_campaign.is_authorized_contact(obj_campaign.user.userprofile.dialersetting, phone_number):
-                logger.error("Error : Contact not authorized")
-                elem_camp_subscriber.status = SUBSCRIBER_STATUS.NOT_AUTHORIZED
-                elem_camp_subscriber.save()
-                continue
-            # Verify that the contact is not in the DNC list
-            if obj_campaign.dnc:
-                res_dnc = DNCContact.objects.filter(dnc_id=obj_campaign.dnc_id, phone_number=phone_number)
-                if res_dnc:
-                    logger.error("Contact (%s) in DNC list" % phone_number)
-                    elem_camp_subscriber.status = SUBSCRIBER_STATUS.NOT_AUTHORIZED
-                    elem_camp_subscriber.save()
-                    continue
-                else:
-                    logger.debug("Contact (%s) not in DNC list" % phone_number)
-
-            debug_query(5)
-
-            bulk_record.append(
-                Callrequest(
-                    status=CALLREQUEST_STATUS.PENDING,
-                    call_type=call_type,
-                    call_time=datetime.utcnow().replace(tzinfo=utc),
-                    timeout=obj_campaign.calltimeout,
-                    callerid=obj_campaign.callerid,
-                    caller_name=obj_campaign.caller_name,
-                    phone_number=phone_number,
-                    campaign=obj_campaign,
-                    aleg_gateway=obj_campaign.aleg_gateway,
-                    content_type=obj_campaign.content_type,
-                    object_id=obj_campaign.object_id,
-                    user=obj_campaign.user,
-                    extra_data=obj_campaign.extra_data,
-                    timelimit=obj_campaign.callmaxduration,
-                    subscriber=elem_camp_subscriber,
-                    request_uuid=bulk_uuid
-                )
-            )
-            debug_query(6)
-
-        # Create Callrequests in Bulk
-        logger.info("Bulk Create CallRequest => %d" % (len(bulk_record)))
-        Callrequest.objects.bulk_create(bulk_record)
+        with trace_stage(STAGE_SPOOL):
+            list_cr = spool_callrequest(obj_campaign, callfrequency, call_type)
+        if not list_cr:
+            return False
 
         # Set time to wait for balanced dispatching of calls
-        time_to_wait = (60.0 / settings.HEARTBEAT_MIN) / no_subscriber
+        time_to_wait = (60.0 / settings.HEARTBEAT_MIN) / len(list_cr)
         count = 0
         loopnow = datetime.utcnow()
-        loopnow + timedelta(seconds=1.55)
 
-        # Retrienve the one we just created
-        list_cr = Callrequest.objects.filter(request_uuid=bulk_uuid).all()
+        if settings.DIALER_BATCH_DISPATCH:
+            # One task originates the whole heartbeat at the scheduled offsets
+            list_cr_id = [cr.id for cr in list_cr]
+            schedule = [(position + 1) * time_to_wait for position in range(len(list_cr_id))]
+            logger.info("Init CallRequest batch of %d calls (cmpg:%d)" % (len(list_cr_id), campaign_id))
+            init_callrequest_batch.delay(list_cr_id, obj_campaign.id, obj_campaign.callmaxduration, schedule)
+            debug_query(7)
+            return True
+
         for cr in list_cr:
             # Loop on Subscriber and start the initcall's task
             count = count + 1
@@ -224,7 +279,7 @@ class pending_call_processing(Task):
             ms_addtowait = 0
 
             logger.info("Init CallRequest in %d seconds (cmpg:%d,subscr:%d:eta_delta:%s)" %
-                        (second_towait, campaign_id, elem_camp_subscriber.id, eta_delta))
+                        (second_towait, campaign_id, cr.subscriber_id, eta_delta))
 
             init_callrequest.apply_async(
                 args=[cr.id, obj_campaign.id, obj_campaign.callmaxduration, ms_addtowait],
@@ -234,7 +289,7 @@ class pending_call_processing(Task):
             second_towait = second_towait + settings.DELAY_OUTBOUND
 
             # Shell_plus
-            # from dialer_cdr.tasks import init_callrequest
+            # from dialer_cdr.tasks import init_callrequest, init_callrequest_batch
             # from datetime import datetime
             # new_callrequest_id = 112
             # obj_campaign_id = 3
@@ -258,8 +313,8 @@ class campaign_running(PeriodicTask):
 
     """
     run_every = timedelta(seconds=int(60 / settings.HEARTBEAT_MIN))
-    # NOTE : until we implement a PID Controller :
-    # http://en.wikipedia.org/wiki/PID_controller
+    # NOTE : the number of calls spooled on each run is set by the pacing
+    # controller, see dialer_campaign.pacing
 
     # The campaign have to run every minutes in order to control the number
     # of calls per minute. Cons : new calls might delay 60seconds
@@ -267,11 +322,13 @@ class campaign_running(PeriodicTask):
 
     def run(self, **kwargs):
         logger.debug("TASK :: campaign_running")
+        if settings.DIALER_DISPATCHER:
+            # the calls are spooled by the run_dispatcher process
+            return True
 
         for campaign in Campaign.objects.get_running_campaign():
             logger.info("=> Campaign name %s (id:%s)" % (campaign.name, campaign.id))
-            keytask = 'check_campaign_pendingcall-%d' % (campaign.id)
-            pending_call_processing().delay(campaign.id, keytask=keytask)
+            pending_call_processing().delay(campaign.id)
         return True
 
 
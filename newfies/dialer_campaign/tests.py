@@ -23,11 +23,20 @@ from dialer_campaign.views import campaign_list, campaign_add,\
     update_campaign_status_admin, campaign_duplicate, subscriber_list,\
     subscriber_export
 from dialer_campaign.tasks import campaign_running, pending_call_processing,\
-    collect_subscriber, campaign_expire_check
+    collect_subscriber, campaign_expire_check, spool_callrequest
 from dialer_campaign.templatetags.dialer_campaign_tags import get_campaign_status_url
 from dialer_settings.models import DialerSetting
 from dialer_campaign.constants import SUBSCRIBER_STATUS
+from dialer_cdr.constants import CALLREQUEST_TYPE, CALLREQUEST_STATUS
+from dialer_cdr.models import Callrequest
+from dialer_contact.models import Contact
+from dialer_campaign.dispatcher import TimingWheel, CampaignDispatcher
+from dialer_campaign.pacing import PacingState, PacingSimulator, FixedFrequencyController,\
+    ConcurrentCallsController, AbandonRateController
 from django_lets_go.utils import BaseAuthenticatedClient
+from django.utils.timezone import utc
+from datetime import datetime, timedelta
+from uuid import uuid1
 
 
 class DialerCampaignView(BaseAuthenticatedClient):
@@ -298,6 +307,31 @@ class DialerCampaignCeleryTaskTestCase(TestCase):
         result = collect_subscriber.delay(1)
         self.assertEqual(result.successful(), True)
 
+    def test_get_pending_subscriber_update(self):
+        """Test that claimed subscribers are not claimed twice"""
+        obj_campaign = Campaign.objects.get(pk=1)
+        (list_subscriber, count) = obj_campaign.get_pending_subscriber_update(10, SUBSCRIBER_STATUS.IN_PROCESS)
+        self.assertEqual(count, 1)
+        self.assertEqual(Subscriber.objects.get(pk=list_subscriber[0].id).status, SUBSCRIBER_STATUS.IN_PROCESS)
+        self.assertEqual(obj_campaign.get_pending_subscriber_update(10, SUBSCRIBER_STATUS.IN_PROCESS), (False, 0))
+
+    def test_spool_callrequest_dnc(self):
+        """Test that the subscribers in the campaign's DNC list are
+        screened in one step and marked NOT_AUTHORIZED"""
+        obj_campaign = Campaign.objects\
+            .select_related('user__userprofile__dialersetting', 'aleg_gateway', 'content_type')\
+            .get(pk=1)
+        contact = Contact.objects.create(phonebook_id=1, contact='123456789')
+        (subscriber, created) = Subscriber.objects.get_or_create(
+            contact=contact, campaign=obj_campaign,
+            defaults={'duplicate_contact': '123456789'})
+        Subscriber.objects.filter(campaign=obj_campaign).update(status=SUBSCRIBER_STATUS.PENDING)
+
+        list_cr = spool_callrequest(obj_campaign, 100, CALLREQUEST_TYPE.ALLOW_RETRY)
+        self.assertEqual([cr.phone_number for cr in list_cr], ['640234000'])
+        self.assertEqual(Callrequest.objects.get(pk=list_cr[0].id).subscriber_id, 1)
+        self.assertEqual(Subscriber.objects.get(pk=subscriber.id).status, SUBSCRIBER_STATUS.NOT_AUTHORIZED)
+
     def test_campaign_expire_check(self):
         """Test that the ``campaign_expire_check``
         periodic task runs with no errors, and returns the correct result."""
@@ -305,6 +339,150 @@ class DialerCampaignCeleryTaskTestCase(TestCase):
         self.assertEqual(result.successful(), True)
 
 
+class PacingControllerTestCase(TestCase):
+
+    """Test the pacing controllers"""
+
+    def test_fixed_frequency(self):
+        """10 calls per minute on 6 seconds ticks, the fraction is carried over"""
+        controller = FixedFrequencyController()
+        memory = {}
+        budgets = [controller.get_budget(PacingState(10, 6), memory) for count in range(10)]
+        self.assertEqual(sum(budgets), 10)
+        self.assertEqual(max(budgets), 1)
+
+    def test_gateway_limit(self):
+        controller = FixedFrequencyController()
+        state = PacingState(60, 60, gateway_calling=8, max_channels=10)
+        self.assertEqual(controller.get_budget(state, {}), 2)
+        state = PacingState(60, 60, gateway_calling=12, max_channels=10)
+        self.assertEqual(controller.get_budget(state, {}), 0)
+
+    def test_concurrent_calls(self):
+        controller = ConcurrentCallsController(max_concurrent=5)
+        self.assertEqual(controller.get_budget(PacingState(60, 60, calling=4), {}), 1)
+        self.assertEqual(controller.get_budget(PacingState(60, 60, calling=0), {}), 5)
+
+    def test_abandon_rate(self):
+        """The controller slows down when the abandon ratio is over the target"""
+        controller = AbandonRateController(target_abandon=0.03)
+        memory = {}
+        state = PacingState(60, 60, answered=100, abandoned=30, attempts=200)
+        self.assertTrue(controller.get_budget(state, memory) < 60)
+        state = PacingState(60, 60, answered=100, abandoned=0, attempts=200)
+        for count in range(20):
+            budget = controller.get_budget(state, memory)
+        self.assertEqual(budget, 60)
+
+    def test_simulator(self):
+        """Replay the same outcomes with and without abandoned calls"""
+        abandoned = [(10, True, 1), (20, False, 0)]
+        completed = [(10, True, 60), (20, False, 0)]
+        controller = AbandonRateController(target_abandon=0.03)
+        ticks_abandoned = PacingSimulator(controller, abandoned, 30, tick_seconds=10).run(1800)
+        ticks_completed = PacingSimulator(controller, completed, 30, tick_seconds=10).run(1800)
+        self.assertEqual(len(ticks_abandoned), 180)
+        self.assertTrue(sum([tick['budget'] for tick in ticks_abandoned]) <
+                        sum([tick['budget'] for tick in ticks_completed]))
+
+        ticks = PacingSimulator(ConcurrentCallsController(max_concurrent=5), completed, 60).run(600)
+        self.assertTrue(max([tick['calling'] for tick in ticks]) <= 5)
+
+
+class DialerDispatcherTestCase(TestCase):
+
+    """Test the dispatcher and its timing wheel"""
+
+    fixtures = ['auth_user.json', 'gateway.json',
+                'dialer_setting.json', 'user_profile.json',
+                'phonebook.json', 'contact.json', 'survey.json',
+                'dnc_list.json', 'dnc_contact.json',
+                'campaign.json', 'subscriber.json',
+                ]
+
+    def test_timing_wheel(self):
+        wheel = TimingWheel(resolution=0.1, size=100)
+        self.assertEqual(wheel.advance(1000.0), [])
+        wheel.schedule('a', 0)
+        wheel.schedule('b', 0.5)
+        wheel.schedule('c', 60)
+        self.assertEqual(wheel.advance(1000.1), ['a'])
+        self.assertEqual(wheel.advance(1000.3), [])
+        self.assertEqual(wheel.advance(1000.6), ['b'])
+        # beyond the wheel, released with the last slot
+        self.assertEqual(wheel.advance(1010.0), ['c'])
+        self.assertEqual(wheel.pending, 0)
+
+    def start_sample_campaign(self):
+        # the sample campaign runs at 2 calls per tick with 3 pending subscribers
+        today = datetime.utcnow().replace(tzinfo=utc)
+        Campaign.objects.filter(pk=1).update(
+            frequency=120, startingdate=today - timedelta(days=1), expirationdate=today + timedelta(days=1))
+        for phone_number in ['640234001', '640234002']:
+            Contact.objects.create(phonebook_id=1, contact=phone_number)
+        self.assertEqual(Subscriber.objects.filter(campaign_id=1, status=SUBSCRIBER_STATUS.PENDING).count(), 3)
+
+    def test_run_once(self):
+        self.start_sample_campaign()
+        originated = []
+        dispatcher = CampaignDispatcher(
+            tick=1.0, refresh_interval=10,
+            originate=lambda *item: originated.append(item))
+        now = 1000.0
+        for count in range(20):
+            dispatcher.run_once(now + count * 0.1)
+        self.assertEqual(dispatcher.next_refresh, now + 10)
+        self.assertEqual(list(dispatcher.campaigns.keys()), [1])
+        # 2 calls spread over the first tick, the last one on the second tick
+        self.assertEqual(dispatcher.campaigns[1].spooled, 3)
+        self.assertEqual(dispatcher.wheel.pending, 0)
+        list_callrequest = Callrequest.objects.filter(campaign_id=1).order_by('id')
+        self.assertEqual(sorted(originated), [(callrequest.id, 1, 1800) for callrequest in list_callrequest])
+        self.assertEqual([callrequest.status for callrequest in list_callrequest],
+                         [CALLREQUEST_STATUS.PENDING] * 3)
+        self.assertEqual(Subscriber.objects.filter(campaign_id=1, status=SUBSCRIBER_STATUS.IN_PROCESS).count(), 3)
+
+    def test_drain(self):
+        self.start_sample_campaign()
+        originated = []
+        dispatcher = CampaignDispatcher(
+            tick=1.0, refresh_interval=10,
+            originate=lambda *item: originated.append(item))
+        # the first call is released, the second waits in the wheel
+        dispatcher.run_once(1000.0)
+        self.assertEqual(len(originated), 1)
+        self.assertEqual(dispatcher.wheel.pending, 1)
+        waiting = Callrequest.objects.filter(campaign_id=1).exclude(id=originated[0][0]).get()
+
+        self.assertEqual(dispatcher.drain(), 1)
+        self.assertEqual(dispatcher.wheel.pending, 0)
+        self.assertFalse(Callrequest.objects.filter(pk=waiting.id).exists())
+        self.assertEqual(Subscriber.objects.get(pk=waiting.subscriber_id).status, SUBSCRIBER_STATUS.PENDING)
+        self.assertEqual(Callrequest.objects.get(pk=originated[0][0]).status, CALLREQUEST_STATUS.PENDING)
+
+    def test_sweep(self):
+        self.start_sample_campaign()
+        dispatcher = CampaignDispatcher(tick=1.0, refresh_interval=10, originate=lambda *item: None)
+        for count in range(20):
+            dispatcher.run_once(1000.0 + count * 0.1)
+        (recent, first, retry) = list(Callrequest.objects.filter(campaign_id=1).order_by('id'))
+        # a retry of an earlier attempt of the subscriber
+        parent = Callrequest.objects.get(pk=retry.id)
+        parent.pk = None
+        parent.request_uuid = str(uuid1())
+        parent.status = CALLREQUEST_STATUS.FAILURE
+        parent.save()
+        Callrequest.objects.filter(pk=retry.id).update(parent_callrequest=parent)
+        Callrequest.objects.filter(id__in=[first.id, retry.id])\
+            .update(call_time=datetime.utcnow().replace(tzinfo=utc) - timedelta(seconds=600))
+
+        self.assertEqual(CampaignDispatcher(stale=300).sweep(), 2)
+        self.assertFalse(Callrequest.objects.filter(pk=first.id).exists())
+        self.assertEqual(Subscriber.objects.get(pk=first.subscriber_id).status, SUBSCRIBER_STATUS.PENDING)
+        self.assertEqual(Callrequest.objects.get(pk=retry.id).status, CALLREQUEST_STATUS.RETRY)
+        self.assertEqual(Callrequest.objects.get(pk=recent.id).status, CALLREQUEST_STATUS.PENDING)
+
+
 class DialerCampaignModel(TestCase):
 
     """Test Campaign, Subscriber models"""
@@ -0,0 +1,355 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Q
+from django.utils.timezone import now
+from celery.utils.log import get_task_logger
+from dialer_campaign.constants import SUBSCRIBER_STATUS, AMD_BEHAVIOR
+from dialer_campaign.models import Subscriber
+from dialer_cdr.models import Callrequest
+from dialer_cdr.constants import CALLREQUEST_STATUS, CALLREQUEST_TYPE, CALLEVENT_STATUS
+from dialer_cdr.utils import BufferVoIPCall
+from dialer_cdr.tracing import trace_callevent, is_tracing
+from mod_metrics import metrics
+from datetime import timedelta
+from uuid import uuid1
+import os
+import socket
+
+logger = get_task_logger(__name__)
+
+# Columns of call_event, in the order expected by parse_callevent
+CALLEVENT_COLUMNS = "id, event_name, body, job_uuid, call_uuid, used_gateway_id, " \
+    "callrequest_id, alarm_request_id, callerid, phonenumber, duration, billsec, hangup_cause, " \
+    "hangup_cause_q850, starting_date, status, created_date, amd_status, leg"
+
+
+def parse_callevent(record):
+    """
+    Return a dict of the fields of a call_event row, selected with
+    CALLEVENT_COLUMNS
+    """
+    event = {
+        'id': record[0],
+        'event_name': record[1],
+        'body': record[2],
+        'job_uuid': record[3],
+        'call_uuid': record[4],
+        'used_gateway_id': record[5],
+        'callrequest_id': record[6],
+        'alarm_request_id': record[7],
+        'callerid': record[8],
+        'phonenumber': record[9],
+        'duration': record[10],
+        'billsec': record[11],
+        'hangup_cause': record[12],
+        'hangup_cause_q850': record[13],
+        'starting_date': record[14],
+        'status': record[15],
+        'created_date': record[16],
+        'amd_status': record[17],
+        'leg': record[18],
+    }
+    if event['event_name'] == 'BACKGROUND_JOB' or event['hangup_cause'] == '':
+        # hangup cause come from body
+        event['hangup_cause'] = event['body'][5:]
+    return event
+
+
+def get_consumer_name():
+    """Name of the current process, stored in claimed_by"""
+    return '%s:%d' % (socket.gethostname(), os.getpid())
+
+
+def reclaim_callevents(claim_timeout=None):
+    """
+    Put back to pending the events claimed more than ``claim_timeout``
+    seconds ago, their consumer died or got stuck
+    """
+    if claim_timeout is None:
+        claim_timeout = settings.CALLEVENT_CLAIM_TIMEOUT
+    cursor = connection.cursor()
+    cursor.execute(
+        "UPDATE call_event SET status = %s, claimed_by = NULL, claimed_at = NULL "
+        "WHERE status = %s AND claimed_at < %s",
+        [CALLEVENT_STATUS.PENDING, CALLEVENT_STATUS.CLAIMED, now() - timedelta(seconds=claim_timeout)])
+    if cursor.rowcount:
+        logger.warning("Reclaimed %d expired call events" % cursor.rowcount)
+    return cursor.rowcount
+
+
+def claim_callevents(claimed_by, limit):
+    """
+    Claim up to ``limit`` pending events for ``claimed_by`` and return them,
+    SKIP LOCKED lets the consumers of other hosts claim the next events
+    at the same time instead of waiting on ours
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        "UPDATE call_event SET status = %s, claimed_by = %s, claimed_at = %s WHERE id IN ("
+        "SELECT id FROM call_event WHERE status = %s ORDER BY id LIMIT %s FOR UPDATE SKIP LOCKED) "
+        "RETURNING " + CALLEVENT_COLUMNS,
+        [CALLEVENT_STATUS.CLAIMED, claimed_by, now(), CALLEVENT_STATUS.PENDING, limit])
+    return sorted(cursor.fetchall())
+
+
+class CallEventClaimLost(Exception):
+
+    """Some events of a batch were reclaimed by another consumer"""
+
+    def __init__(self, list_owned):
+        super(CallEventClaimLost, self).__init__('%d call events still owned' % len(list_owned))
+        self.list_owned = list_owned
+
+
+def lock_callevents(list_id, claimed_by):
+    """
+    Lock the events of ``list_id`` still claimed by ``claimed_by`` until the
+    end of the transaction and return their ids, a concurrent reclaim waits
+    for the transaction and then finds them released
+    """
+    if not list_id:
+        return set()
+    cursor = connection.cursor()
+    cursor.execute("SELECT id FROM call_event WHERE id = ANY(%s) AND claimed_by = %s FOR UPDATE",
+                   [list(list_id), claimed_by])
+    return set([row[0] for row in cursor.fetchall()])
+
+
+def release_callevents(list_id, claimed_by):
+    """
+    Remove the processed events (or flag them processed), only while the
+    claim is still ours : a reclaimed event belongs to its new consumer
+    """
+    if not list_id:
+        return 0
+    cursor = connection.cursor()
+    if settings.CALLEVENT_DELETE:
+        cursor.execute("DELETE FROM call_event WHERE id = ANY(%s) AND claimed_by = %s",
+                       [list(list_id), claimed_by])
+    else:
+        cursor.execute("UPDATE call_event SET status = %s WHERE id = ANY(%s) AND claimed_by = %s",
+                       [CALLEVENT_STATUS.PROCESSED, list(list_id), claimed_by])
+    return cursor.rowcount
+
+
+def copy_callrequest(callrequest, delay=0, **kwargs):
+    """
+    Return a new callrequest to call the same subscriber again in ``delay``
+    seconds, it waits with the RETRY status until the campaign spools it
+    """
+    return Callrequest(
+        status=CALLREQUEST_STATUS.RETRY,
+        next_attempt_at=now() + timedelta(seconds=delay or 0),
+        request_uuid=uuid1(),
+        parent_callrequest_id=callrequest.id,
+        call_type=CALLREQUEST_TYPE.ALLOW_RETRY,
+        num_attempt=callrequest.num_attempt + 1,
+        user_id=callrequest.user_id,
+        campaign=callrequest.campaign,
+        aleg_gateway_id=callrequest.aleg_gateway_id,
+        content_type_id=callrequest.content_type_id,
+        object_id=callrequest.object_id,
+        phone_number=callrequest.phone_number,
+        timelimit=callrequest.timelimit,
+        callerid=callrequest.callerid,
+        caller_name=callrequest.caller_name,
+        timeout=callrequest.timeout,
+        subscriber_id=callrequest.subscriber_id,
+        **kwargs)
+
+
+class CallEventBatch(object):
+
+    """
+    CallEventBatch processes a page of call_event rows of campaign calls
+
+    - load : fetch all the callrequests of the page with one query
+    - process : compute the callrequest / subscriber transitions in memory,
+      buffer the CDRs and the retry callrequests
+    - commit : write the changes with bulk updates and inserts
+    - publish : once the writes are committed, update the gauges and the
+      traces, a page rolled back or processed again is not counted twice
+
+    The events of alarm calls are returned by ``process`` to be handled
+    one by one.
+    """
+
+    def __init__(self, list_record):
+        self.list_record = list_record
+        self.list_event = [parse_callevent(record) for record in list_record]
+        self.callrequests = {}
+        self.callrequests_uuid = {}
+        self.buff_voipcall = BufferVoIPCall()
+        # changed callrequests and subscribers, by id
+        self.changed_callrequest = {}
+        self.changed_subscriber = {}
+        # retry callrequests to insert
+        self.retries = []
+        # CALLING callrequests ended per campaign, and (callrequest, event) to trace, for publish
+        self.calling_ended = {}
+        self.traced = []
+
+    def load(self):
+        list_id = [ev['callrequest_id'] for ev in self.list_event if ev['callrequest_id']]
+        list_uuid = [ev['job_uuid'].strip(' \t\n\r') for ev in self.list_event
+                     if not ev['callrequest_id'] and ev['job_uuid']]
+        if not list_id and not list_uuid:
+            return
+        list_callrequest = Callrequest.objects \
+            .select_related('aleg_gateway', 'subscriber', 'campaign') \
+            .filter(Q(id__in=list_id) | Q(request_uuid__in=list_uuid))
+        subscribers = {}
+        for callrequest in list_callrequest:
+            if callrequest.subscriber_id:
+                # callrequests of the same subscriber share its instance
+                callrequest.subscriber = subscribers.setdefault(callrequest.subscriber_id, callrequest.subscriber)
+            self.callrequests[callrequest.id] = callrequest
+            self.callrequests_uuid[callrequest.request_uuid] = callrequest
+
+    def get_callrequest(self, event):
+        if event['callrequest_id']:
+            return self.callrequests.get(event['callrequest_id'])
+        return self.callrequests_uuid.get((event['job_uuid'] or '').strip(' \t\n\r'))
+
+    def process(self):
+        """Process the campaign events, return the records of the alarm events"""
+        self.load()
+        list_alarm = []
+        for (event, record) in zip(self.list_event, self.list_record):
+            callrequest = self.get_callrequest(event)
+            if callrequest is None:
+                logger.error("Cannot find Callrequest job_uuid : %s" % event['job_uuid'])
+                continue
+            if callrequest.alarm_request_id:
+                list_alarm.append(record)
+                continue
+            try:
+                self.process_event(event, callrequest)
+            except Exception as e:
+                logger.error("Error processing call_event %s : %s" % (event['id'], e))
+        return list_alarm
+
+    def process_event(self, event, callrequest):
+        hangup_cause = event['hangup_cause']
+        subscriber = callrequest.subscriber
+        if subscriber is None:
+            logger.error("Callrequest %d has no subscriber" % callrequest.id)
+            return
+        if event['leg'] == 'aleg':
+            if callrequest.status == CALLREQUEST_STATUS.CALLING:
+                self.calling_ended[callrequest.campaign_id] = self.calling_ended.get(callrequest.campaign_id, 0) + 1
+            # Only the aleg will update the subscriber status / Bleg is only recorded
+            if hangup_cause == 'NORMAL_CLEARING':
+                callrequest.status = CALLREQUEST_STATUS.SUCCESS
+                if subscriber.status != SUBSCRIBER_STATUS.COMPLETED:
+                    subscriber.status = SUBSCRIBER_STATUS.SENT
+            else:
+                callrequest.status = CALLREQUEST_STATUS.FAILURE
+                subscriber.status = SUBSCRIBER_STATUS.FAIL
+            callrequest.hangup_cause = hangup_cause
+            self.changed_callrequest[callrequest.id] = callrequest
+            self.changed_subscriber[subscriber.id] = subscriber
+
+        self.buff_voipcall.save(
+            obj_callrequest=callrequest,
+            request_uuid=event['job_uuid'],
+            leg=event['leg'],
+            hangup_cause=hangup_cause,
+            hangup_cause_q850=event['hangup_cause_q850'],
+            callerid=event['callerid'] or callrequest.callerid,
+            phonenumber=event['phonenumber'] or callrequest.phone_number,
+            starting_date=event['starting_date'],
+            call_uuid=event['call_uuid'] or event['job_uuid'],
+            duration=event['duration'],
+            billsec=event['billsec'],
+            amd_status=event['amd_status'])
+
+        if is_tracing():
+            self.traced.append((callrequest, event))
+
+        campaign = callrequest.campaign
+        # If the call failed we will check if we want to make a retry call
+        # Add condition to retry when it s machine and we want to reach a human
+        if (hangup_cause != 'NORMAL_CLEARING' and callrequest.call_type == CALLREQUEST_TYPE.ALLOW_RETRY) or \
+           (event['amd_status'] == 'machine' and campaign.voicemail and
+                campaign.amd_behavior == AMD_BEHAVIOR.HUMAN_ONLY):
+            # Update to Retry Done
+            callrequest.call_type = CALLREQUEST_TYPE.RETRY_DONE
+            self.changed_callrequest[callrequest.id] = callrequest
+
+            # check if we are allowed to retry on failure
+            if (subscriber.count_attempt - 1) >= campaign.maxretry or not campaign.maxretry:
+                logger.error("Not allowed retry - Maxretry (%d)" % campaign.maxretry)
+                self.check_retrycall_completion(callrequest)
+            else:
+                logger.error("Allowed Retry - Maxretry (%d)" % campaign.maxretry)
+                self.retries.append(copy_callrequest(callrequest, campaign.intervalretry))
+        else:
+            # Check if we should relaunch a new call to achieve completion
+            self.check_retrycall_completion(callrequest)
+
+    def check_retrycall_completion(self, callrequest):
+        """Same rules as dialer_cdr.tasks.check_retrycall_completion, applied in memory"""
+        subscriber = callrequest.subscriber
+        campaign = callrequest.campaign
+        if (subscriber.status == SUBSCRIBER_STATUS.COMPLETED
+                or not campaign.completion_maxretry
+                or subscriber.completion_count_attempt >= campaign.completion_maxretry):
+            logger.debug("Subscriber completed or limit reached!")
+            return
+        subscriber.completion_count_attempt = (subscriber.completion_count_attempt or 0) + 1
+        self.changed_subscriber[subscriber.id] = subscriber
+        self.retries.append(copy_callrequest(callrequest, campaign.completion_intervalretry))
+
+    def commit(self):
+        """
+        Write the page : one update per distinct callrequest / subscriber
+        state, one insert for the CDRs and one for the retry callrequests,
+        return the retry callrequests created
+        """
+        updated_date = now()
+        groups = {}
+        for callrequest in self.changed_callrequest.values():
+            key = (callrequest.status, callrequest.hangup_cause, callrequest.call_type)
+            groups.setdefault(key, []).append(callrequest.id)
+        for ((status, hangup_cause, call_type), list_id) in groups.items():
+            Callrequest.objects.filter(id__in=list_id).update(
+                status=status, hangup_cause=hangup_cause, call_type=call_type, updated_date=updated_date)
+
+        groups = {}
+        for subscriber in self.changed_subscriber.values():
+            key = (subscriber.status, subscriber.completion_count_attempt)
+            groups.setdefault(key, []).append(subscriber.id)
+        for ((status, completion_count_attempt), list_id) in groups.items():
+            list_subscriber = Subscriber.objects.filter(id__in=list_id)
+            if status == SUBSCRIBER_STATUS.SENT:
+                # the survey might have completed the subscriber meanwhile
+                list_subscriber = list_subscriber.exclude(status=SUBSCRIBER_STATUS.COMPLETED)
+            list_subscriber.update(
+                status=status, completion_count_attempt=completion_count_attempt, updated_date=updated_date)
+
+        self.buff_voipcall.commit()
+        if self.retries:
+            Callrequest.objects.bulk_create_returning(self.retries)
+        return self.retries
+
+    def publish(self):
+        """Update the gauges and the traces of the page, to call once ``commit`` is committed"""
+        for (campaign_id, count) in self.calling_ended.items():
+            metrics.dec('newfies_callrequests_calling', count, campaign_id=campaign_id)
+        for (callrequest, event) in self.traced:
+            trace_callevent(callrequest, event)
@@ -0,0 +1,238 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, DatabaseError
+from django.utils.timezone import utc
+from celery.utils.log import get_task_logger
+from dialer_cdr.callevent import claim_callevents, get_consumer_name, parse_callevent, reclaim_callevents
+from dialer_cdr.constants import CALLEVENT_STATUS
+from dialer_cdr.tasks import process_callevent, write_claimed_callevents
+from dialer_cdr.tracing import trace_stage, STAGE_CDR_WRITE
+from collections import deque
+from datetime import datetime, timedelta
+import select
+import time
+
+logger = get_task_logger(__name__)
+
+CALLEVENT_CHANNEL = 'call_event'
+# Cache key of the latency stats, read by the monitoring
+CALLEVENT_LATENCY_KEY = 'callevent_latency'
+
+
+def get_hangup_date(event):
+    """
+    Return when the call of a call_event hung up, the event carries the
+    start of the channel and its duration
+    """
+    starting_date = event['starting_date']
+    if starting_date is None:
+        return None
+    return starting_date + timedelta(seconds=int(event['duration'] or 0))
+
+
+def is_connection_usable():
+    try:
+        return connection.connection is not None and connection.is_usable()
+    except DatabaseError:
+        return False
+
+
+class CallEventLatency(object):
+
+    """
+    Delay between the hangup of a call and its CDR being written,
+    over the latest ``size`` events
+    """
+
+    def __init__(self, size=1000):
+        self.samples = deque(maxlen=size)
+        self.count = 0
+        self.max = 0.0
+
+    def add(self, seconds):
+        seconds = max(seconds, 0.0)
+        self.samples.append(seconds)
+        self.count += 1
+        if seconds > self.max:
+            self.max = seconds
+
+    def percentile(self, ratio):
+        if not self.samples:
+            return 0.0
+        ordered = sorted(self.samples)
+        return ordered[min(int(len(ordered) * ratio), len(ordered) - 1)]
+
+    def get_stats(self):
+        return {
+            'count': self.count,
+            'avg': sum(self.samples) / len(self.samples) if self.samples else 0.0,
+            'p50': self.percentile(0.5),
+            'p95': self.percentile(0.95),
+            'max': self.max,
+        }
+
+
+class CallEventListener(object):
+
+    """
+    CallEventListener waits on the call_event channel notified by
+    listener.lua and processes the new events as soon as they are inserted
+
+    - the events are claimed like callevent_processing does (status
+      CLAIMED with claimed_by / claimed_at, FOR UPDATE SKIP LOCKED) so
+      several listeners and the periodic task can run side by side
+    - each micro-batch is written and released in one transaction, the
+      claim of a listener that died is put back to pending by
+      reclaim_callevents after CALLEVENT_CLAIM_TIMEOUT
+    - a batch failing is written again event by event, an event failing
+      on its own goes back to pending, and after CALLEVENT_MAX_ATTEMPTS
+      stays in call_event with the FAILED status
+    - the table is also drained every ``timeout`` seconds, in case a
+      notification was missed while reconnecting
+    """
+
+    def __init__(self, batch_size=None, timeout=5, stats_interval=10):
+        if batch_size is None:
+            batch_size = settings.CALLEVENT_LISTENER_BATCH
+        self.batch_size = batch_size
+        self.timeout = timeout
+        self.stats_interval = stats_interval
+        self.consumer = get_consumer_name()
+        # failed attempts per call event id
+        self.failures = {}
+        self.latency = CallEventLatency()
+        self.processed = 0
+        self.last_stats = time.time()
+
+    def listen(self):
+        cursor = connection.cursor()
+        cursor.execute("LISTEN %s" % CALLEVENT_CHANNEL)
+        logger.info('Listening on channel %s' % CALLEVENT_CHANNEL)
+
+    def wait(self):
+        """Block until a notification comes in or the timeout expires"""
+        pg_conn = connection.connection
+        if select.select([pg_conn], [], [], self.timeout) != ([], [], []):
+            pg_conn.poll()
+            # one drain handles all the events notified so far
+            del pg_conn.notifies[:]
+
+    def drain_once(self):
+        """Claim, process and release one micro-batch, return the number of events"""
+        list_record = claim_callevents(self.consumer, self.batch_size)
+        if not list_record:
+            return 0
+        with trace_stage(STAGE_CDR_WRITE):
+            try:
+                (list_written, list_alarm) = write_claimed_callevents(list_record, self.consumer)
+            except Exception as e:
+                if not is_connection_usable():
+                    raise
+                # one bad event rolls back the whole batch
+                logger.error('Call event batch failed, writing its events one by one : %s' % e)
+                (list_written, list_alarm) = self.write_one_by_one(list_record)
+        self.record_latency([parse_callevent(record) for record in list_written])
+
+        for record in list_alarm:
+            process_callevent(record)
+        self.processed += len(list_record)
+        return len(list_record)
+
+    def write_one_by_one(self, list_record):
+        list_written = []
+        list_alarm = []
+        for record in list_record:
+            try:
+                (written, alarm) = write_claimed_callevents([record], self.consumer)
+            except Exception as e:
+                if not is_connection_usable():
+                    raise
+                self.fail_callevent(record[0], e)
+                continue
+            list_written.extend(written)
+            list_alarm.extend(alarm)
+        return (list_written, list_alarm)
+
+    def fail_callevent(self, callevent_id, error):
+        """Put a failing event back to pending, or set it FAILED after CALLEVENT_MAX_ATTEMPTS"""
+        attempts = self.failures.pop(callevent_id, 0) + 1
+        if attempts < settings.CALLEVENT_MAX_ATTEMPTS:
+            self.failures[callevent_id] = attempts
+            status = CALLEVENT_STATUS.PENDING
+            logger.error('Call event %d failed (attempt %d) : %s' % (callevent_id, attempts, error))
+        else:
+            status = CALLEVENT_STATUS.FAILED
+            logger.error('Call event %d failed %d times, left with the failed status : %s' %
+                         (callevent_id, attempts, error))
+        cursor = connection.cursor()
+        cursor.execute(
+            "UPDATE call_event SET status = %s, claimed_by = NULL, claimed_at = NULL "
+            "WHERE id = %s AND claimed_by = %s", [status, callevent_id, self.consumer])
+
+    def drain(self):
+        """Process the pending events until call_event is empty"""
+        total = 0
+        while True:
+            count = self.drain_once()
+            total += count
+            if count < self.batch_size:
+                return total
+
+    def purge(self):
+        """Remove the events listener.lua stored as not to be processed (status 0)"""
+        cursor = connection.cursor()
+        cursor.execute("DELETE FROM call_event WHERE status = %s", [CALLEVENT_STATUS.IGNORED])
+        return cursor.rowcount
+
+    def record_latency(self, events):
+        written = datetime.utcnow().replace(tzinfo=utc)
+        for event in events:
+            hangup_date = get_hangup_date(event)
+            if hangup_date:
+                self.latency.add((written - hangup_date).total_seconds())
+
+    def publish_stats(self):
+        stats = self.latency.get_stats()
+        stats['processed'] = self.processed
+        cache.set(CALLEVENT_LATENCY_KEY, stats, self.stats_interval * 6)
+        logger.info('Call events processed: %(processed)d - latency avg=%(avg).3f p95=%(p95).3f max=%(max).3f' % stats)
+        self.last_stats = time.time()
+
+    def run_once(self):
+        self.drain()
+        if time.time() - self.last_stats >= self.stats_interval:
+            # events left claimed by a dead callevent_processing
+            reclaim_callevents()
+            if settings.CALLEVENT_DELETE:
+                self.purge()
+            self.publish_stats()
+        self.wait()
+
+    def run(self):
+        listening = False
+        while True:
+            try:
+                if not listening:
+                    self.listen()
+                    listening = True
+                self.run_once()
+            except Exception as e:
+                # the connection might be lost, LISTEN again on a new one
+                logger.error('Call event listener error : %s' % e)
+                listening = False
+                connection.close()
+                time.sleep(self.timeout)
@@ -62,6 +62,31 @@ class CALL_DISPOSITION(Choice):
     FAILED = 'FAILED', _('FAILED')  # Added to catch all
 
 
+class DISPOSITION_CODE(Choice):
+
+    """
+    Store the Call Disposition as an integer, see dialer_cdr.disposition
+    """
+    ANSWER = 1, _('ANSWER')
+    BUSY = 2, _('BUSY')
+    NOANSWER = 3, _('NOANSWER')
+    CANCEL = 4, _('CANCEL')
+    CONGESTION = 5, _('CONGESTION')
+    FAILED = 6, _('FAILED')
+
+
+class CALLEVENT_STATUS(Choice):
+
+    """
+    Store the status of the call_event rows written by listener.lua
+    """
+    IGNORED = 0, _('ignored')
+    PENDING = 1, _('pending')
+    PROCESSED = 2, _('processed')
+    CLAIMED = 3, _('claimed')
+    FAILED = 4, _('failed')
+
+
 # Column Name for the CDR Report
 CDR_REPORT_COLUMN_NAME = {
     'date': _('start date'),
@@ -0,0 +1,267 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from celery.utils.log import get_task_logger
+from dialer_cdr.esl_pool import ESLConnectionPool, ESLPoolError
+from collections import deque
+from threading import Lock
+import os
+import re
+import time
+
+logger = get_task_logger(__name__)
+
+NODE_STRATEGY_LEAST_LOADED = 'least_loaded'
+NODE_STRATEGY_WEIGHTED_ROUND_ROBIN = 'weighted_round_robin'
+
+
+def parse_request_uuid(ev):
+    """
+    Extract the Job-UUID from the reply of a bgapi command,
+    return 'error' if there is none
+    """
+    if not ev:
+        return 'error'
+    result = ev.serialize()
+    logger.debug(result)
+    pos = result.find('Job-UUID:')
+    if pos == -1:
+        return 'error'
+    return result[pos + 10:pos + 46]
+
+
+class DialerNode(object):
+
+    """
+    A FreeSWITCH media server we can originate calls on
+
+    **Attributes**:
+
+        * ``name`` - Name of the node
+        * ``weight`` - Share of calls for weighted round-robin
+        * ``max_channels`` - Max concurrent channels, 0 for no limit
+        * ``channels`` - Live channels, as reported by FreeSWITCH plus
+          the calls originated since the last refresh
+    """
+
+    def __init__(self, name, hostname, port, secret, weight=1, max_channels=0,
+                 connection_class=None):
+        self.name = name
+        self.weight = max(int(weight), 1)
+        self.max_channels = int(max_channels)
+        self.pool = ESLConnectionPool(hostname, port, secret, connection_class=connection_class)
+        self.channels = 0
+        self.channels_refreshed = 0
+        self.current_weight = 0
+        self.originates = 0
+        self.errors = 0
+        self.consecutive_errors = 0
+        self.down_until = 0
+        # outcome of the latest originates, used for the error rate
+        self.recent = deque(maxlen=100)
+
+    def __unicode__(self):
+        return u"%s (%s)" % (self.name, self.pool.hostname)
+
+    def is_available(self, now=None):
+        """Return True if the node is in rotation and has room for a call"""
+        if now is None:
+            now = time.time()
+        if self.down_until > now:
+            return False
+        if self.max_channels and self.channels >= self.max_channels:
+            return False
+        return True
+
+    def load(self):
+        """Ratio used by least-loaded selection"""
+        if self.max_channels:
+            return float(self.channels) / self.max_channels
+        return float(self.channels) / self.weight
+
+    def refresh_channels(self):
+        """Read the number of live channels from FreeSWITCH"""
+        try:
+            ev = self.pool.api('show', 'channels count')
+        except ESLPoolError as e:
+            logger.error('Cannot refresh channels on node %s : %s' % (self.name, e))
+            return False
+        self.channels_refreshed = time.time()
+        if ev:
+            match = re.search(r'(\d+) total', ev.serialize())
+            if match:
+                self.channels = int(match.group(1))
+                return True
+        return False
+
+    def record_result(self, success, max_errors, quarantine):
+        """Update the counters, take the node out of rotation after too many failures"""
+        self.originates += 1
+        self.recent.append(success)
+        if success:
+            self.channels += 1
+            self.consecutive_errors = 0
+            return
+        self.errors += 1
+        self.consecutive_errors += 1
+        if self.consecutive_errors >= max_errors:
+            logger.error('Node %s failed %d times, out of rotation for %d seconds' %
+                         (self.name, self.consecutive_errors, quarantine))
+            self.down_until = time.time() + quarantine
+            self.consecutive_errors = 0
+
+    def error_rate(self):
+        """Error rate over the latest originates"""
+        if not self.recent:
+            return 0.0
+        return 1.0 - float(sum(self.recent)) / len(self.recent)
+
+    def get_stats(self):
+        return {
+            'name': self.name,
+            'hostname': self.pool.hostname,
+            'weight': self.weight,
+            'max_channels': self.max_channels,
+            'channels': self.channels,
+            'available': self.is_available(),
+            'originates': self.originates,
+            'errors': self.errors,
+            'error_rate': self.error_rate(),
+            'pool': self.pool.get_stats(),
+        }
+
+
+class DialerNodeRegistry(object):
+
+    """
+    DialerNodeRegistry spreads the originates over the FreeSWITCH nodes
+
+    - select : pick a node with the configured strategy
+    - originate : send the bgapi originate on the selected node
+    - get_stats : live channels and error rate of each node
+    """
+
+    def __init__(self, nodes, strategy=None, max_errors=None, quarantine=None, refresh_interval=None):
+        self.nodes = nodes
+        self.strategy = strategy or getattr(settings, 'ESL_NODE_STRATEGY', NODE_STRATEGY_LEAST_LOADED)
+        if max_errors is None:
+            max_errors = getattr(settings, 'ESL_NODE_MAX_ERRORS', 3)
+        if quarantine is None:
+            quarantine = getattr(settings, 'ESL_NODE_QUARANTINE', 60)
+        if refresh_interval is None:
+            refresh_interval = getattr(settings, 'ESL_NODE_REFRESH', 5)
+        self.max_errors = max_errors
+        self.quarantine = quarantine
+        self.refresh_interval = refresh_interval
+        self._lock = Lock()
+
+    def refresh(self, force=False):
+        """Refresh the live channel count of the nodes in rotation"""
+        now = time.time()
+        for node in self.nodes:
+            if node.down_until > now:
+                continue
+            if force or now - node.channels_refreshed >= self.refresh_interval:
+                node.refresh_channels()
+
+    def select(self):
+        """Return the node to use for the next call, None if all nodes are busy or down"""
+        if self.refresh_interval:
+            self.refresh()
+        now = time.time()
+        with self._lock:
+            candidates = [node for node in self.nodes if node.is_available(now)]
+            if not candidates:
+                return None
+            if self.strategy == NODE_STRATEGY_WEIGHTED_ROUND_ROBIN:
+                # Smooth weighted round-robin, as used by nginx
+                total = 0
+                best = None
+                for node in candidates:
+                    node.current_weight += node.weight
+                    total += node.weight
+                    if best is None or node.current_weight > best.current_weight:
+                        best = node
+                best.current_weight -= total
+                return best
+            return min(candidates, key=lambda node: node.load())
+
+    def originate(self, dial_command):
+        """
+        Send the originate on the selected node,
+        return (request_uuid, node), request_uuid is 'error' on failure
+        """
+        node = self.select()
+        if node is None:
+            logger.error('No dialer node available')
+            return ('error', None)
+        logger.info("Selected Node to dialout: %s" % node.name)
+        try:
+            ev = node.pool.api('bgapi', str(dial_command))
+        except ESLPoolError as e:
+            logger.error('ESL error on node %s : %s' % (node.name, e))
+            ev = None
+        request_uuid = parse_request_uuid(ev)
+        node.record_result(request_uuid != 'error', self.max_errors, self.quarantine)
+        return (request_uuid, node)
+
+    def get_stats(self):
+        return [node.get_stats() for node in self.nodes]
+
+
+def get_nodes_config():
+    """
+    Return the list of node definitions from settings.ESL_NODES,
+    falling back on the single ESL_HOSTNAME node
+    """
+    nodes = getattr(settings, 'ESL_NODES', None)
+    if nodes:
+        return nodes
+    return [{
+        'name': settings.ESL_HOSTNAME,
+        'hostname': settings.ESL_HOSTNAME,
+        'port': settings.ESL_PORT,
+        'secret': settings.ESL_SECRET,
+    }]
+
+
+def build_node_registry(connection_class=None):
+    nodes = []
+    for conf in get_nodes_config():
+        nodes.append(DialerNode(
+            name=conf.get('name', conf['hostname']),
+            hostname=conf['hostname'],
+            port=conf.get('port', settings.ESL_PORT),
+            secret=conf.get('secret', settings.ESL_SECRET),
+            weight=conf.get('weight', 1),
+            max_channels=conf.get('max_channels', 0),
+            connection_class=connection_class))
+    return DialerNodeRegistry(nodes)
+
+
+_registry = None
+_registry_pid = None
+
+
+def get_node_registry():
+    """
+    Return the node registry of the current process,
+    a new one is built after a fork so ESL sockets are never shared
+    """
+    global _registry, _registry_pid
+    if _registry is None or _registry_pid != os.getpid():
+        _registry = build_node_registry()
+        _registry_pid = os.getpid()
+    return _registry
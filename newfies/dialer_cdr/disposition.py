@@ -0,0 +1,153 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Disposition of a call from its FreeSWITCH hangup cause.
+
+The lookup tables are built once at import: every hangup cause of
+FreeSWITCH, with its Q.850 code, maps to one of the DISPOSITION_CODE,
+so the CDR writes and the reports compare integers instead of walking
+string comparisons.
+"""
+
+from dialer_cdr.constants import DISPOSITION_CODE, CALL_DISPOSITION
+
+# FreeSWITCH hangup causes and their Q.850 code (switch_types.h)
+HANGUP_CAUSES = [
+    ('UNSPECIFIED', 0),
+    ('UNALLOCATED_NUMBER', 1),
+    ('NO_ROUTE_TRANSIT_NET', 2),
+    ('NO_ROUTE_DESTINATION', 3),
+    ('CHANNEL_UNACCEPTABLE', 6),
+    ('CALL_AWARDED_DELIVERED', 7),
+    ('NORMAL_CLEARING', 16),
+    ('USER_BUSY', 17),
+    ('NO_USER_RESPONSE', 18),
+    ('NO_ANSWER', 19),
+    ('SUBSCRIBER_ABSENT', 20),
+    ('CALL_REJECTED', 21),
+    ('NUMBER_CHANGED', 22),
+    ('REDIRECTION_TO_NEW_DESTINATION', 23),
+    ('EXCHANGE_ROUTING_ERROR', 25),
+    ('DESTINATION_OUT_OF_ORDER', 27),
+    ('INVALID_NUMBER_FORMAT', 28),
+    ('FACILITY_REJECTED', 29),
+    ('RESPONSE_TO_STATUS_ENQUIRY', 30),
+    ('NORMAL_UNSPECIFIED', 31),
+    ('NORMAL_CIRCUIT_CONGESTION', 34),
+    ('NETWORK_OUT_OF_ORDER', 38),
+    ('NORMAL_TEMPORARY_FAILURE', 41),
+    ('SWITCH_CONGESTION', 42),
+    ('ACCESS_INFO_DISCARDED', 43),
+    ('REQUESTED_CHAN_UNAVAIL', 44),
+    ('PRE_EMPTED', 45),
+    ('FACILITY_NOT_SUBSCRIBED', 50),
+    ('OUTGOING_CALL_BARRED', 52),
+    ('INCOMING_CALL_BARRED', 54),
+    ('BEARERCAPABILITY_NOTAUTH', 57),
+    ('BEARERCAPABILITY_NOTAVAIL', 58),
+    ('SERVICE_UNAVAILABLE', 63),
+    ('BEARERCAPABILITY_NOTIMPL', 65),
+    ('CHAN_NOT_IMPLEMENTED', 66),
+    ('FACILITY_NOT_IMPLEMENTED', 69),
+    ('SERVICE_NOT_IMPLEMENTED', 79),
+    ('INVALID_CALL_REFERENCE', 81),
+    ('INCOMPATIBLE_DESTINATION', 88),
+    ('INVALID_MSG_UNSPECIFIED', 95),
+    ('MANDATORY_IE_MISSING', 96),
+    ('MESSAGE_TYPE_NONEXIST', 97),
+    ('WRONG_MESSAGE', 98),
+    ('IE_NONEXIST', 99),
+    ('INVALID_IE_CONTENTS', 100),
+    ('WRONG_CALL_STATE', 101),
+    ('RECOVERY_ON_TIMER_EXPIRE', 102),
+    ('MANDATORY_IE_LENGTH_ERROR', 103),
+    ('PROTOCOL_ERROR', 111),
+    ('INTERWORKING', 127),
+    ('SUCCESS', 142),
+    ('ORIGINATOR_CANCEL', 487),
+    ('CRASH', 500),
+    ('SYSTEM_SHUTDOWN', 501),
+    ('LOSE_RACE', 502),
+    ('MANAGER_REQUEST', 503),
+    ('BLIND_TRANSFER', 600),
+    ('ATTENDED_TRANSFER', 601),
+    ('ALLOTTED_TIMEOUT', 602),
+    ('USER_CHALLENGE', 603),
+    ('MEDIA_TIMEOUT', 604),
+    ('PICKED_OFF', 605),
+    ('USER_NOT_REGISTERED', 606),
+    ('PROGRESS_TIMEOUT', 607),
+    ('INVALID_GATEWAY', 608),
+    ('GATEWAY_DOWN', 609),
+    ('INVALID_URL', 610),
+    ('INVALID_PROFILE', 611),
+    ('NO_PICKUP', 612),
+    ('SRTP_READ_ERROR', 613),
+]
+
+# Causes not listed here are FAILED, the mapping of the CDRs written so far
+CAUSE_DISPOSITION = {
+    'NORMAL_CLEARING': DISPOSITION_CODE.ANSWER,
+    'ALLOTTED_TIMEOUT': DISPOSITION_CODE.ANSWER,
+    'USER_BUSY': DISPOSITION_CODE.BUSY,
+    'NO_ANSWER': DISPOSITION_CODE.NOANSWER,
+    'ORIGINATOR_CANCEL': DISPOSITION_CODE.CANCEL,
+    'NORMAL_CIRCUIT_CONGESTION': DISPOSITION_CODE.CONGESTION,
+}
+
+# Disposition name stored in VoIPCall.disposition of each code
+DISPOSITION_NAME = {
+    DISPOSITION_CODE.ANSWER: CALL_DISPOSITION.ANSWER,
+    DISPOSITION_CODE.BUSY: CALL_DISPOSITION.BUSY,
+    DISPOSITION_CODE.NOANSWER: CALL_DISPOSITION.NOANSWER,
+    DISPOSITION_CODE.CANCEL: CALL_DISPOSITION.CANCEL,
+    DISPOSITION_CODE.CONGESTION: CALL_DISPOSITION.CONGESTION,
+    DISPOSITION_CODE.FAILED: CALL_DISPOSITION.FAILED,
+}
+
+# hangup cause -> disposition code
+CAUSE_CODE = dict((cause, CAUSE_DISPOSITION.get(cause, DISPOSITION_CODE.FAILED))
+                  for (cause, q850) in HANGUP_CAUSES)
+# Q.850 code -> disposition code
+Q850_CODE = dict((str(q850), CAUSE_CODE[cause]) for (cause, q850) in HANGUP_CAUSES)
+# disposition name or hangup cause -> disposition code, the old CDRs
+# may hold a hangup cause in their disposition
+NAME_CODE = dict(CAUSE_CODE)
+NAME_CODE.update(dict((name, code) for (code, name) in DISPOSITION_NAME.items()))
+
+
+def get_disposition_code(hangup_cause, hangup_cause_q850=None):
+    """
+    Return the disposition code of a hangup cause, the first word only
+    is used ('USER_BUSY extra text'). An unknown cause falls back on the
+    Q.850 code, then on FAILED
+    """
+    cause = (hangup_cause or '').split()
+    if cause and cause[0] in CAUSE_CODE:
+        return CAUSE_CODE[cause[0]]
+    if hangup_cause_q850:
+        return Q850_CODE.get(str(hangup_cause_q850).strip(), DISPOSITION_CODE.FAILED)
+    return DISPOSITION_CODE.FAILED
+
+
+def get_disposition(hangup_cause, hangup_cause_q850=None):
+    """Return the (disposition name, disposition code) of a hangup cause"""
+    code = get_disposition_code(hangup_cause, hangup_cause_q850)
+    return (DISPOSITION_NAME[code], code)
+
+
+def get_disposition_code_from_name(disposition):
+    """Return the code of a disposition name, FAILED if unknown"""
+    return NAME_CODE.get(disposition, DISPOSITION_CODE.FAILED)
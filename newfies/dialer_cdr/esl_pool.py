@@ -0,0 +1,180 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from celery.utils.log import get_task_logger
+from threading import Lock
+import time
+try:
+    import ESL as ESL
+except ImportError:
+    ESL = None
+
+logger = get_task_logger(__name__)
+
+
+class ESLPoolError(Exception):
+
+    """Raised when the pool cannot provide an authenticated connection"""
+    pass
+
+
+class ESLConnectionPool(object):
+
+    """
+    ESLConnectionPool keeps authenticated connections to the FreeSWITCH
+    event socket open across tasks, so an originate doesn't pay for
+    a TCP connect and an auth round trip every time.
+
+    - acquire : get an idle connection or open a new one
+    - release : give the connection back to the pool (or close it)
+    - api : run an API command on a pooled connection, reconnect once on
+      failure except for bgapi
+
+    The pool is not shared between processes, each dialer node
+    of the current worker process holds its own pool.
+    """
+
+    def __init__(self, hostname, port, secret, size=None,
+                 check_interval=None, connection_class=None):
+        self.hostname = hostname
+        self.port = str(port)
+        self.secret = secret
+        if size is None:
+            size = getattr(settings, 'ESL_POOL_SIZE', 2)
+        if check_interval is None:
+            check_interval = getattr(settings, 'ESL_POOL_CHECK_INTERVAL', 30)
+        self.size = max(int(size), 1)
+        self.check_interval = check_interval
+        if connection_class is None and ESL:
+            connection_class = ESL.ESLconnection
+        self.connection_class = connection_class
+        # list of (connection, last_used)
+        self._idle = []
+        self._lock = Lock()
+        self.stats = {
+            'hits': 0,
+            'connects': 0,
+            'reconnects': 0,
+            'errors': 0,
+            'originates': 0,
+            'originate_time': 0.0,
+            'originate_time_max': 0.0,
+        }
+
+    def _connect(self):
+        """Open and authenticate a new connection"""
+        if not self.connection_class:
+            raise ESLPoolError('ESL not installed')
+        self.stats['connects'] += 1
+        conn = self.connection_class(self.hostname, self.port, self.secret)
+        if not conn.connected():
+            self.stats['errors'] += 1
+            raise ESLPoolError('Cannot connect to ESL %s:%s' % (self.hostname, self.port))
+        return conn
+
+    def _is_healthy(self, conn, last_used):
+        """Check that an idle connection can still be used"""
+        if not conn.connected():
+            return False
+        if self.check_interval and time.time() - last_used > self.check_interval:
+            # the connection has been idle for a while, ping FreeSWITCH
+            return conn.api('status', '') is not None
+        return True
+
+    def _close(self, conn):
+        try:
+            conn.disconnect()
+        except Exception:
+            pass
+
+    def acquire(self):
+        """Return a healthy connection, either from the pool or a new one"""
+        while True:
+            with self._lock:
+                if not self._idle:
+                    break
+                (conn, last_used) = self._idle.pop()
+            if self._is_healthy(conn, last_used):
+                self.stats['hits'] += 1
+                return conn
+            logger.warning('ESL connection to %s lost, reconnecting' % self.hostname)
+            self.stats['reconnects'] += 1
+            self._close(conn)
+        return self._connect()
+
+    def release(self, conn, discard=False):
+        """Give a connection back to the pool, close it if the pool is full"""
+        if not discard and conn.connected():
+            with self._lock:
+                if len(self._idle) < self.size:
+                    self._idle.append((conn, time.time()))
+                    return
+        self._close(conn)
+
+    def api(self, command, arg='', retry=None):
+        """
+        Run ``command`` on a pooled connection and return the ESLevent,
+        a broken connection is replaced and the command sent once more if
+        ``retry``. By default bgapi is never sent twice: a connection lost
+        while waiting for the reply may have delivered the originate, and
+        sending it again would place the call twice
+        """
+        if retry is None:
+            retry = command != 'bgapi'
+        start = time.time()
+        conn = self.acquire()
+        try:
+            ev = conn.api(command, arg)
+            if ev is None and retry:
+                # The socket was closed on FreeSWITCH side
+                logger.warning('ESL connection to %s closed, reconnecting' % self.hostname)
+                self.stats['reconnects'] += 1
+                self._close(conn)
+                conn = self._connect()
+                ev = conn.api(command, arg)
+        except Exception:
+            self.stats['errors'] += 1
+            self.release(conn, discard=True)
+            raise
+        if ev is None:
+            self.stats['errors'] += 1
+        self.release(conn, discard=ev is None)
+
+        elapsed = time.time() - start
+        if command == 'bgapi':
+            self.stats['originates'] += 1
+            self.stats['originate_time'] += elapsed
+            if elapsed > self.stats['originate_time_max']:
+                self.stats['originate_time_max'] = elapsed
+        return ev
+
+    def close_all(self):
+        """Close all the idle connections"""
+        with self._lock:
+            idle = self._idle
+            self._idle = []
+        for (conn, last_used) in idle:
+            self._close(conn)
+
+    def get_stats(self):
+        """Return a copy of the counters with the average originate latency"""
+        stats = dict(self.stats)
+        stats['idle'] = len(self._idle)
+        if stats['originates']:
+            stats['originate_time_avg'] = stats['originate_time'] / stats['originates']
+        else:
+            stats['originate_time_avg'] = 0.0
+        return stats
+
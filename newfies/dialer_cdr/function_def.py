@@ -15,6 +15,7 @@
 from django.conf import settings
 from django_lets_go.common_functions import getvar, ceil_strdate
 from country_dialcode.models import Prefix
+from dialer_cdr.prefix_index import get_dialcode
 from datetime import datetime
 from django.utils.timezone import utc
 
@@ -157,15 +158,11 @@ def prefix_list_string(phone_number):
 
 
 def get_prefix_obj(phonenumber):
-    """Get Prefix object"""
-    prefix_obj = None
-    list_prefix = prefix_list_string(phonenumber)
-    if list_prefix:
-        split_prefix_list = list_prefix.split(',')
-        for prefix in split_prefix_list:
-            try:
-                prefix_obj = Prefix.objects.get(prefix=int(prefix))
-                break
-            except:
-                prefix_obj = None
-    return prefix_obj
+    """Get Prefix object, the longest prefix of the phonenumber"""
+    dialcode = get_dialcode(phonenumber)
+    if dialcode is None:
+        return None
+    try:
+        return Prefix.objects.get(prefix=dialcode)
+    except Prefix.DoesNotExist:
+        return None
@@ -0,0 +1,72 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.core.management.base import BaseCommand
+from optparse import make_option
+from dialer_cdr.models import VoIPCall
+from dialer_cdr.prefix_index import get_prefix_index
+import time
+
+
+def backfill_dialcode(batch_size=5000, overwrite=False, report=None):
+    """
+    Set the dialcode of the CDRs by batch of ids, one UPDATE per
+    dialcode found in the batch. Return the number of CDRs updated
+    """
+    index = get_prefix_index()
+    index.load()
+    queryset = VoIPCall.objects.all()
+    if not overwrite:
+        queryset = queryset.filter(dialcode__isnull=True)
+    last_id = 0
+    updated = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id')
+                    .values_list('id', 'phone_number')[:batch_size])
+        if not rows:
+            break
+        dialcodes = {}
+        for (voipcall_id, phone_number) in rows:
+            dialcode = index.lookup(phone_number)
+            if dialcode is not None:
+                dialcodes.setdefault(dialcode, []).append(voipcall_id)
+        for (dialcode, list_id) in dialcodes.items():
+            updated += VoIPCall.objects.filter(id__in=list_id).update(dialcode=dialcode)
+        last_id = rows[-1][0]
+        if report:
+            report(last_id, updated)
+    return updated
+
+
+class Command(BaseCommand):
+    args = 'batch, overwrite'
+    help = "Set the dialcode of the existing CDRs from the dialcode prefixes\n" \
+           "---------------------------------------------------------------\n" \
+           "python manage.py backfill_dialcode --batch=5000 [--overwrite]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', default=5000, dest='batch',
+                    help='CDRs read per query'),
+        make_option('--overwrite', action='store_true', default=False, dest='overwrite',
+                    help='also recompute the CDRs which already have a dialcode'),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+
+        def report(last_id, updated):
+            print "CDR id %d reached, %d updated (%.1fs)" % (last_id, updated, time.time() - start)
+
+        updated = backfill_dialcode(int(options['batch']), options['overwrite'], report)
+        print "%d CDRs updated in %.1fs" % (updated, time.time() - start)
@@ -0,0 +1,37 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.core.management.base import BaseCommand
+from dialer_cdr.tracing import get_trace_stats, get_percentile, STAGES
+
+
+class Command(BaseCommand):
+    help = "Show the latency of each stage of the calls recorded with CALL_TRACING = True\n" \
+           "-------------------------------------------------------------------------------\n" \
+           "python manage.py call_trace_stats"
+
+    def handle(self, *args, **options):
+        stats = get_trace_stats()
+        print "%-18s %10s %10s %8s %8s %12s" % ('stage', 'count', 'avg (s)', 'p50 <=', 'p95 <=', 'queries/run')
+        for stage in STAGES:
+            stat = stats[stage]
+            if not stat['count']:
+                continue
+            queries = '-'
+            if stat['runs']:
+                queries = '%.1f' % (float(stat['queries']) / stat['runs'])
+            print "%-18s %10d %10.3f %8s %8s %12s" % (
+                stage, stat['count'], stat['sum'] / stat['count'],
+                get_percentile(stat['buckets'], stat['count'], 50),
+                get_percentile(stat['buckets'], stat['count'], 95), queries)
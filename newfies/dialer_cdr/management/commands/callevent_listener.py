@@ -0,0 +1,50 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from dialer_cdr.callevent_listener import CallEventListener
+
+
+class Command(BaseCommand):
+    args = 'batch, timeout'
+    help = "Process the call events as soon as listener.lua inserts them (LISTEN/NOTIFY)\n" \
+           "set CALLEVENT_LISTENER = True so task_pending_callevent stops polling\n" \
+           "--------------------------------------------------------------------------\n" \
+           "python manage.py callevent_listener --batch=200 --timeout=5"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', default=None, dest='batch',
+                    help='call events processed per transaction'),
+        make_option('--timeout', default=5, dest='timeout',
+                    help='seconds between two drains without notification'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("The call event listener requires PostgreSQL")
+
+        batch = options.get('batch')
+        if batch is not None:
+            batch = int(batch)
+        listener = CallEventListener(batch_size=batch, timeout=float(options['timeout']))
+        print "Call event listener running, CTRL-C to stop"
+        try:
+            listener.run()
+        except KeyboardInterrupt:
+            stats = listener.latency.get_stats()
+            stats['processed'] = listener.processed
+            print "Call event listener stopped after %(processed)d events, " \
+                  "hangup to CDR latency avg=%(avg).3fs p95=%(p95).3fs max=%(max).3fs" % stats
@@ -0,0 +1,38 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.core.management.base import BaseCommand
+from dialer_cdr.dialer_node import build_node_registry
+
+
+class Command(BaseCommand):
+    args = ''
+    help = "Display the FreeSWITCH dialer nodes with their live channels\n" \
+           "------------------------------------------------------------\n" \
+           "python manage.py dialer_node_status"
+
+    def handle(self, *args, **options):
+        """Query each node for its live channel count"""
+        registry = build_node_registry()
+        for node in registry.nodes:
+            if not node.refresh_channels():
+                print "%s (%s) unreachable" % (node.name, node.pool.hostname)
+                continue
+            stats = node.get_stats()
+            if stats['max_channels']:
+                stats['usage'] = "%(channels)d/%(max_channels)d" % stats
+            else:
+                stats['usage'] = "%(channels)d" % stats
+            print "%(name)s (%(hostname)s) weight:%(weight)d channels:%(usage)s" % stats
+            node.pool.close_all()
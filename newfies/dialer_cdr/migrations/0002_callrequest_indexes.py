@@ -0,0 +1,47 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# Callrequest status PENDING = 1, CALLING = 7
+INDEXES = [
+    # pacing : calls in progress per campaign and per gateway
+    ('dialer_callrequest_calling_campaign_idx',
+     'ON dialer_callrequest (campaign_id) WHERE status = 7'),
+    ('dialer_callrequest_calling_gateway_idx',
+     'ON dialer_callrequest (aleg_gateway_id) WHERE status = 7'),
+    ('dialer_callrequest_pending_idx',
+     'ON dialer_callrequest (call_time) WHERE status = 1'),
+]
+
+# call_event is created by listener.lua, status 1 is pending
+CALL_EVENT_INDEX = ('call_event_pending_idx', 'ON call_event (id) WHERE status = 1')
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for (name, definition) in INDEXES:
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS %s %s' % (name, definition))
+    # the listener might not have been started yet, it creates the index with the table
+    schema_editor.execute(
+        "DO $$ BEGIN IF to_regclass('call_event') IS NOT NULL THEN "
+        "CREATE INDEX IF NOT EXISTS %s %s; END IF; END $$" % CALL_EVENT_INDEX)
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for (name, definition) in INDEXES + [CALL_EVENT_INDEX]:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dialer_cdr', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+# call_event is created by listener.lua, status 3 is claimed by a consumer
+ADD_CLAIM_COLUMNS = \
+    "DO $$ BEGIN IF to_regclass('call_event') IS NOT NULL THEN " \
+    "ALTER TABLE call_event ADD COLUMN IF NOT EXISTS claimed_by varchar(100); " \
+    "ALTER TABLE call_event ADD COLUMN IF NOT EXISTS claimed_at timestamp with time zone; " \
+    "CREATE INDEX IF NOT EXISTS call_event_claimed_idx ON call_event (claimed_at) WHERE status = 3; " \
+    "END IF; END $$"
+
+
+def add_claim_columns(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(ADD_CLAIM_COLUMNS)
+
+
+def drop_claim_columns(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute(
+        "DO $$ BEGIN IF to_regclass('call_event') IS NOT NULL THEN "
+        "DROP INDEX IF EXISTS call_event_claimed_idx; "
+        "ALTER TABLE call_event DROP COLUMN IF EXISTS claimed_by; "
+        "ALTER TABLE call_event DROP COLUMN IF EXISTS claimed_at; "
+        "END IF; END $$")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dialer_cdr', '0002_callrequest_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(add_claim_columns, drop_claim_columns),
+    ]
@@ -0,0 +1,46 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from dialer_cdr.disposition import get_disposition_code, get_disposition_code_from_name
+
+
+def fill_disposition_code(apps, schema_editor):
+    """One UPDATE per distinct disposition, the CDRs without one use their hangup cause"""
+    VoIPCall = apps.get_model('dialer_cdr', 'VoIPCall')
+    list_disposition = VoIPCall.objects.filter(disposition_code__isnull=True)\
+        .exclude(disposition__isnull=True).values_list('disposition', flat=True).distinct()
+    for disposition in list(list_disposition):
+        VoIPCall.objects.filter(disposition=disposition, disposition_code__isnull=True)\
+            .update(disposition_code=get_disposition_code_from_name(disposition))
+
+    list_cause = VoIPCall.objects.filter(disposition_code__isnull=True, disposition__isnull=True)\
+        .values_list('hangup_cause', flat=True).distinct()
+    for hangup_cause in list(list_cause):
+        VoIPCall.objects.filter(hangup_cause=hangup_cause, disposition_code__isnull=True)\
+            .update(disposition_code=get_disposition_code(hangup_cause))
+
+
+def clear_disposition_code(apps, schema_editor):
+    # the column is dropped by the AddField reversal
+    pass
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dialer_cdr', '0003_call_event_claim'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='voipcall',
+            name='disposition_code',
+            field=models.PositiveSmallIntegerField(
+                blank=True, null=True, db_index=True, verbose_name='disposition code',
+                choices=[(1, 'ANSWER'), (2, 'BUSY'), (3, 'NOANSWER'), (4, 'CANCEL'), (5, 'CONGESTION'),
+                         (6, 'FAILED')]),
+            preserve_default=True,
+        ),
+        migrations.RunPython(fill_disposition_code, clear_disposition_code),
+    ]
@@ -0,0 +1,37 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+# Callrequest status RETRY = 3, spooled by their campaign once next_attempt_at is past
+RETRY_INDEX = ('dialer_callrequest_retry_idx',
+               'ON dialer_callrequest (campaign_id, next_attempt_at) WHERE status = 3')
+
+
+def create_retry_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('CREATE INDEX IF NOT EXISTS %s %s' % RETRY_INDEX)
+
+
+def drop_retry_index(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    schema_editor.execute('DROP INDEX IF EXISTS %s' % RETRY_INDEX[0])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dialer_cdr', '0004_voipcall_disposition_code'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callrequest',
+            name='next_attempt_at',
+            field=models.DateTimeField(null=True, verbose_name='next attempt', blank=True),
+            preserve_default=True,
+        ),
+        migrations.RunPython(create_retry_index, drop_retry_index),
+    ]
@@ -12,21 +12,27 @@
 # Arezqui Belaid <info@star2billing.com>
 #
 
-from django.db import models
+from django.db import models, connection
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now
 from django.contrib.contenttypes.models import ContentType
 from django.contrib.contenttypes import generic
 from dialer_gateway.models import Gateway
 from dialer_campaign.models import Campaign, Subscriber
+from dialer_campaign.constants import SUBSCRIBER_STATUS
 from dialer_cdr.constants import CALLREQUEST_STATUS, CALLREQUEST_TYPE, LEG_TYPE, CALL_DISPOSITION,\
-    VOIPCALL_AMD_STATUS
+    VOIPCALL_AMD_STATUS, DISPOSITION_CODE
+from dialer_cdr.disposition import get_disposition_code_from_name
 from django_lets_go.intermediate_model_base_class import Model
 from country_dialcode.models import Prefix
 from datetime import datetime
 from django.utils.timezone import utc
 from uuid import uuid1
 
+# Max callrequests per INSERT statement
+BULK_INSERT_SIZE = 1000
+
 
 class CallRequestManager(models.Manager):
 
@@ -43,6 +49,82 @@ class CallRequestManager(models.Manager):
         # return Callrequest.objects.all()
         return Callrequest.objects.filter(**kwargs)
 
+    def bulk_create_returning(self, list_callrequest, list_rejected_id=None):
+        """
+        Insert the callrequests and set their primary keys, the subscribers
+        of ``list_rejected_id`` are marked NOT_AUTHORIZED in the same statement
+
+        On PostgreSQL each batch is a single INSERT ... RETURNING id, other
+        databases fall back on one save() per callrequest
+        """
+        list_rejected_id = list_rejected_id or []
+        if connection.vendor != 'postgresql':
+            if list_rejected_id:
+                Subscriber.objects.filter(id__in=list_rejected_id).update(status=SUBSCRIBER_STATUS.NOT_AUTHORIZED)
+            for obj in list_callrequest:
+                obj.save()
+            return list_callrequest
+
+        cursor = connection.cursor()
+        if not list_callrequest:
+            if list_rejected_id:
+                Subscriber.objects.filter(id__in=list_rejected_id).update(status=SUBSCRIBER_STATUS.NOT_AUTHORIZED)
+            return list_callrequest
+
+        fields = [f for f in self.model._meta.local_concrete_fields if not isinstance(f, models.AutoField)]
+        sql_columns = ', '.join([connection.ops.quote_name(f.column) for f in fields])
+        sql_row = '(%s)' % ', '.join(['%s'] * len(fields))
+        for start in range(0, len(list_callrequest), BULK_INSERT_SIZE):
+            batch = list_callrequest[start:start + BULK_INSERT_SIZE]
+            params = []
+            sql_with = ''
+            if list_rejected_id:
+                sql_with = "WITH rejected AS (UPDATE dialer_subscriber SET status = %%s, updated_date = %%s " \
+                    "WHERE id IN (%s)) " % ','.join(['%s'] * len(list_rejected_id))
+                params.extend([SUBSCRIBER_STATUS.NOT_AUTHORIZED, now()])
+                params.extend(list_rejected_id)
+                list_rejected_id = []
+            for obj in batch:
+                for f in fields:
+                    params.append(f.get_db_prep_save(f.pre_save(obj, True), connection=connection))
+            sql_statement = "%sINSERT INTO %s (%s) VALUES %s RETURNING id" % \
+                (sql_with, self.model._meta.db_table, sql_columns, ', '.join([sql_row] * len(batch)))
+            cursor.execute(sql_statement, params)
+            # the ids come back in the order of the VALUES
+            for (obj, row) in zip(batch, cursor.fetchall()):
+                obj.pk = row[0]
+        return list_callrequest
+
+    def claim_due_retries(self, campaign_id, limit):
+        """
+        Move up to ``limit`` retry callrequests of the campaign whose
+        next_attempt_at is past back to PENDING, oldest due first, and
+        return them. Concurrent spools of a campaign claim disjoint rows
+        """
+        if limit <= 0:
+            return []
+        call_time = now()
+        if connection.vendor == 'postgresql':
+            cursor = connection.cursor()
+            cursor.execute(
+                "UPDATE dialer_callrequest SET status = %s, call_time = %s, updated_date = %s "
+                "WHERE id IN (SELECT id FROM dialer_callrequest WHERE status = %s AND campaign_id = %s "
+                "AND next_attempt_at <= %s ORDER BY next_attempt_at LIMIT %s FOR UPDATE SKIP LOCKED) "
+                "RETURNING id",
+                [CALLREQUEST_STATUS.PENDING, call_time, call_time, CALLREQUEST_STATUS.RETRY, campaign_id,
+                 call_time, limit])
+            list_id = [row[0] for row in cursor.fetchall()]
+        else:
+            list_id = list(Callrequest.objects
+                           .filter(status=CALLREQUEST_STATUS.RETRY, campaign_id=campaign_id,
+                                   next_attempt_at__lte=call_time)
+                           .order_by('next_attempt_at').values_list('id', flat=True)[:limit])
+            Callrequest.objects.filter(id__in=list_id, status=CALLREQUEST_STATUS.RETRY)\
+                .update(status=CALLREQUEST_STATUS.PENDING, call_time=call_time, updated_date=call_time)
+        if not list_id:
+            return []
+        return list(Callrequest.objects.filter(id__in=list_id).order_by('id'))
+
 
 def str_uuid1():
     return str(uuid1())
@@ -70,6 +152,7 @@ class Callrequest(Model):
         * ``extra_data`` -
         * ``num_attempt`` -
         * ``hangup_cause`` -
+        * ``next_attempt_at`` - Due time of a retry callrequest (status RETRY)
 
 
     **Relationships**:
@@ -134,8 +217,10 @@ class Callrequest(Model):
     result = models.CharField(max_length=180, blank=True)
     hangup_cause = models.CharField(max_length=80, blank=True)
 
-    # if the call fails, create a new pending instance and link them
+    # if the call fails, create a new retry instance and link them,
+    # the campaign spools it with its other calls once next_attempt_at is past
     parent_callrequest = models.ForeignKey('self', null=True, blank=True)
+    next_attempt_at = models.DateTimeField(null=True, blank=True, verbose_name=_('next attempt'))
 
     # AlarmRequest call / if this value is set then this is not a campaign call
     alarm_request_id = models.IntegerField(default=0, null=True, blank=True, verbose_name=_('alarm request id'))
@@ -169,6 +254,7 @@ class VoIPCall(models.Model):
         * ``answersec`` -
         * ``waitsec`` -
         * ``disposition`` - Disposition of the call
+        * ``disposition_code`` - Disposition of the call as an integer, used by the reports
         * ``hangup_cause`` -
         * ``hangup_cause_q850`` -
 
@@ -201,6 +287,8 @@ class VoIPCall(models.Model):
     waitsec = models.IntegerField(null=True, blank=True, verbose_name=_("wait sec"))
     disposition = models.CharField(choices=CALL_DISPOSITION, null=True, blank=True,
                                    max_length=40, verbose_name=_("disposition"))
+    disposition_code = models.PositiveSmallIntegerField(choices=list(DISPOSITION_CODE), null=True, blank=True,
+                                                        db_index=True, verbose_name=_("disposition code"))
     hangup_cause = models.CharField(max_length=40, null=True, blank=True,
                                     verbose_name=_("hangup cause"))
     hangup_cause_q850 = models.CharField(max_length=10, null=True, blank=True)
@@ -216,6 +304,11 @@ class VoIPCall(models.Model):
         else:
             return self.dialcode.name
 
+    def save(self, *args, **kwargs):
+        if self.disposition_code is None and self.disposition:
+            self.disposition_code = get_disposition_code_from_name(self.disposition)
+        super(VoIPCall, self).save(*args, **kwargs)
+
     def min_duration(self):
         """Return duration in min & sec"""
         if self.duration:
@@ -235,3 +328,12 @@ class VoIPCall(models.Model):
 
     def __unicode__(self):
         return u"%d - %s" % (self.id, self.callid)
+
+
+def prefix_changed(sender, **kwargs):
+    """Reload the prefix index of all the processes"""
+    from dialer_cdr.prefix_index import invalidate_prefix_index
+    invalidate_prefix_index()
+
+post_save.connect(prefix_changed, sender=Prefix)
+post_delete.connect(prefix_changed, sender=Prefix)
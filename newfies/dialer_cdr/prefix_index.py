@@ -0,0 +1,131 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+In-process longest prefix match on the dialcode prefixes.
+
+The Prefix table is loaded once per process in one dict per prefix
+length, a lookup tries the lengths present in the table from the
+longest down, so a phone number costs a few dict lookups instead of a
+query per candidate prefix. A change of the Prefix table bumps a version
+in the cache which triggers a reload by all the processes.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+import time
+
+PREFIX_INDEX_VERSION_KEY = 'prefix_index_version'
+
+
+def invalidate_prefix_index():
+    """Force a reload of the prefix index by all the processes"""
+    cache.set(PREFIX_INDEX_VERSION_KEY, time.time(), 60 * 60 * 24 * 30)
+
+
+def get_ignored_prefixes():
+    """Prefixes of settings.PREFIX_TO_IGNORE, longest first"""
+    list_prefix = [prefix.strip() for prefix in settings.PREFIX_TO_IGNORE.split(',') if prefix.strip()]
+    return sorted(set(list_prefix), key=len, reverse=True)
+
+
+def clean_phonenumber(phonenumber, ignored_prefixes):
+    """
+    Remove the first prefix to ignore and the characters which are not digits
+
+    >>> clean_phonenumber('+34 650 123456', ['00', '+'])
+    '34650123456'
+    >>> clean_phonenumber('0034650123456', ['00', '+'])
+    '34650123456'
+    """
+    phonenumber = (phonenumber or '').strip()
+    for prefix in ignored_prefixes:
+        if phonenumber.startswith(prefix):
+            phonenumber = phonenumber[len(prefix):]
+            break
+    return ''.join([char for char in phonenumber if char.isdigit()])
+
+
+class PrefixIndex(object):
+
+    """
+    PrefixIndex holds the dialcode prefixes of the Prefix table
+
+    - load : full load of the table
+    - lookup : return the longest prefix matching a phone number
+    """
+
+    def __init__(self):
+        self.prefixes = {}
+        self.lengths = []
+        self.ignored_prefixes = []
+        self.version = None
+        self.loaded_at = 0
+
+    def __len__(self):
+        return sum([len(prefixes) for prefixes in self.prefixes.values()])
+
+    def add(self, prefix):
+        key = str(prefix)
+        length = len(key)
+        if length not in self.prefixes:
+            self.prefixes[length] = {}
+            self.lengths = sorted(self.prefixes, reverse=True)
+        self.prefixes[length][key] = prefix
+
+    def load(self):
+        """Full load of the Prefix table"""
+        from country_dialcode.models import Prefix
+        self.version = cache.get(PREFIX_INDEX_VERSION_KEY)
+        self.prefixes = {}
+        self.lengths = []
+        self.ignored_prefixes = get_ignored_prefixes()
+        for prefix in Prefix.objects.values_list('prefix', flat=True).iterator():
+            self.add(prefix)
+        self.loaded_at = time.time()
+
+    def refresh(self):
+        """Reload the table if it changed since the last load"""
+        if self.loaded_at == 0 or cache.get(PREFIX_INDEX_VERSION_KEY) != self.version:
+            self.load()
+        else:
+            self.loaded_at = time.time()
+
+    def lookup(self, phonenumber):
+        """Return the longest prefix of the phone number, None if no prefix matches"""
+        phonenumber = clean_phonenumber(phonenumber, self.ignored_prefixes)
+        for length in self.lengths:
+            if length <= len(phonenumber):
+                prefix = self.prefixes[length].get(phonenumber[:length])
+                if prefix is not None:
+                    return prefix
+        return None
+
+
+_index = PrefixIndex()
+
+
+def get_prefix_index():
+    """
+    Return the prefix index of the current process,
+    checked for changes every settings.PREFIX_INDEX_REFRESH seconds
+    """
+    if time.time() - _index.loaded_at >= getattr(settings, 'PREFIX_INDEX_REFRESH', 60):
+        _index.refresh()
+    return _index
+
+
+def get_dialcode(phonenumber):
+    """Return the dialcode prefix of a phone number, None if unknown"""
+    return get_prefix_index().lookup(phonenumber)
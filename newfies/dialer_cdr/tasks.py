@@ -13,16 +13,24 @@
 #
 
 from django.contrib.contenttypes.models import ContentType
-from django.db import connection
+from django.db import connection, transaction, DatabaseError
+from django.db.models import F
 from django.conf import settings
 from celery.utils.log import get_task_logger
 from celery.decorators import task
 from celery.task import PeriodicTask
 
 from dialer_campaign.constants import SUBSCRIBER_STATUS, AMD_BEHAVIOR
+from dialer_campaign.models import Subscriber
 from dialer_cdr.models import Callrequest
 from dialer_cdr.constants import CALLREQUEST_STATUS, CALLREQUEST_TYPE
-from dialer_cdr.utils import voipcall_save  # BufferVoIPCall
+from dialer_cdr.utils import voipcall_save
+from dialer_cdr.callevent import CallEventBatch, CallEventClaimLost, get_consumer_name, reclaim_callevents, \
+    claim_callevents, lock_callevents, release_callevents, copy_callrequest, parse_callevent
+from dialer_cdr.dialer_node import get_node_registry
+from dialer_cdr.tracing import trace_stage, trace_callevent, is_tracing, observe_stage, STAGE_INIT, \
+    STAGE_ETA_WAIT, STAGE_BGAPI, STAGE_CDR_WRITE
+from mod_metrics import metrics
 
 from user_profile.models import CalendarUserProfile
 from appointment.models.alarms import AlarmRequest
@@ -30,12 +38,11 @@ from appointment.constants import ALARMREQUEST_STATUS, ALARM_STATUS
 from sms.models import Message
 from sms.tasks import SendMessage
 from dialer_gateway.utils import prepare_phonenumber
+from dialer_contact.phonenumber import to_e164
 from datetime import datetime, timedelta
 from django.utils.timezone import utc
-from django_lets_go.only_one_task import only_one
 from common_functions import debug_query
-from uuid import uuid1
-from time import sleep
+from time import sleep, time
 try:
     import ESL as ESL
 except ImportError:
@@ -45,42 +52,20 @@ except ImportError:
 logger = get_task_logger(__name__)
 
 LOCK_EXPIRE = 60 * 10 * 1  # Lock expires in 10 minutes
-NODES_NUMBER = 3
-
-
-def find_dialer_node(callrequest_id):
-    # Load balance
-    # from random import randint, seed
-    # seed()
-    # randval = randint(1, max)
-    # return "newfiesfs%d" % randval
-    c_node = (callrequest_id % NODES_NUMBER) + 1
-    return "newfiesfs%d" % c_node
+BATCH_FLUSH_INTERVAL = 1  # Seconds between status writes of a batch originate
+CALLEVENT_PAGE_SIZE = 1000  # Call events claimed at once by callevent_processing
 
 
 def dial_out(dial_command, callrequest_id):
+    """
+    Originate the call on one of the dialer nodes, return the Job-UUID
+    of the bgapi command or a string starting with 'error'
+    """
     if not ESL:
         logger.debug('ESL not installed')
         return 'load esl error'
 
-    reload(ESL)
-    hostname = settings.ESL_HOSTNAME
-    # hostname = find_dialer_node(callrequest_id)
-    logger.info("Selected Node to dialout: %s" % hostname)
-    c = ESL.ESLconnection(hostname, settings.ESL_PORT, settings.ESL_SECRET)
-    c.connected()
-    ev = c.api("bgapi", str(dial_command))
-    c.disconnect()
-    if ev:
-        result = ev.serialize()
-        logger.debug(result)
-        pos = result.find('Job-UUID:')
-        if pos:
-            request_uuid = result[pos + 10:pos + 46]
-        else:
-            request_uuid = 'error'
-    else:
-        request_uuid = 'error'
+    (request_uuid, node) = get_node_registry().originate(dial_command)
     return request_uuid
 
 
@@ -105,33 +90,12 @@ def check_retrycall_completion(callrequest):
             callrequest.subscriber.completion_count_attempt = 1
         callrequest.subscriber.save()
 
-        # TODO: Add method in models.Callrequest to create copy
-        # Init new callrequest -> delay at completion_intervalretry
-        new_callrequest = Callrequest(
-            request_uuid=uuid1(),
-            parent_callrequest_id=callrequest.id,
-            call_type=CALLREQUEST_TYPE.ALLOW_RETRY,
-            num_attempt=callrequest.num_attempt + 1,
-            user=callrequest.user,
-            campaign_id=callrequest.campaign_id,
-            aleg_gateway_id=callrequest.aleg_gateway_id,
-            content_type=callrequest.content_type,
-            object_id=callrequest.object_id,
-            phone_number=callrequest.phone_number,
-            timelimit=callrequest.timelimit,
-            callerid=callrequest.callerid,
-            caller_name=callrequest.caller_name,
-            timeout=callrequest.timeout,
-            content_object=callrequest.content_object,
-            subscriber=callrequest.subscriber
-        )
+        # Init new callrequest -> delay at completion_intervalretry,
+        # the campaign spools it once due
+        new_callrequest = copy_callrequest(callrequest, callrequest.campaign.completion_intervalretry)
         new_callrequest.save()
-        # NOTE : implement a PID algorithm
-        second_towait = callrequest.campaign.completion_intervalretry
-        logger.info("Init Completion Retry CallRequest %d in %d seconds" % (new_callrequest.id, second_towait))
-        init_callrequest.apply_async(
-            args=[new_callrequest.id, callrequest.campaign.id, callrequest.campaign.callmaxduration],
-            countdown=second_towait)
+        logger.info("Completion Retry CallRequest %d due in %d seconds" %
+                    (new_callrequest.id, callrequest.campaign.completion_intervalretry))
 
 
 @task(ignore_result=True)
@@ -211,11 +175,15 @@ def process_callevent(record):
 
     logger.debug("Find Callrequest id : %d" % callrequest.id)
     debug_query(23)
+    if is_tracing():
+        trace_callevent(callrequest, parse_callevent(record))
 
     if leg == 'aleg' and app_type == 'campaign':
         # Update callrequest
         # update_callrequest.delay(callrequest, opt_hangup_cause)
         # Disabled above tasks to reduce amount of tasks
+        if callrequest.status == CALLREQUEST_STATUS.CALLING:
+            metrics.dec('newfies_callrequests_calling', campaign_id=callrequest.campaign_id)
 
         # Only the aleg will update the subscriber status / Bleg is only recorded
         # Update Callrequest Status
@@ -327,32 +295,13 @@ def process_callevent(record):
             logger.error("Allowed Retry - Maxretry (%d)" % callrequest.campaign.maxretry)
 
             # Create new callrequest, Assign parent_callrequest,
-            # Change callrequest_type & num_attempt
-            new_callrequest = Callrequest(
-                request_uuid=uuid1(),
-                parent_callrequest_id=callrequest.id,
-                call_type=CALLREQUEST_TYPE.ALLOW_RETRY,
-                num_attempt=callrequest.num_attempt + 1,
-                user=callrequest.user,
-                campaign_id=callrequest.campaign_id,
-                aleg_gateway_id=callrequest.aleg_gateway_id,
-                content_type=callrequest.content_type,
-                object_id=callrequest.object_id,
-                phone_number=callrequest.phone_number,
-                timelimit=callrequest.timelimit,
-                callerid=callrequest.callerid,
-                timeout=callrequest.timeout,
-                subscriber_id=callrequest.subscriber_id
-            )
+            # Change callrequest_type & num_attempt, the campaign
+            # spools it once due
+            new_callrequest = copy_callrequest(callrequest, callrequest.campaign.intervalretry)
             new_callrequest.save()
-            # NOTE : implement a PID algorithm
-            second_towait = callrequest.campaign.intervalretry
             debug_query(29)
 
-            logger.debug("Init Retry CallRequest in  %d seconds" % second_towait)
-            init_callrequest.apply_async(
-                args=[new_callrequest.id, callrequest.campaign.id, callrequest.campaign.callmaxduration],
-                countdown=second_towait)
+            logger.debug("Retry CallRequest due in %d seconds" % callrequest.campaign.intervalretry)
 
     elif app_type == 'campaign':
         # The Call is Answered and it's a campaign call
@@ -372,7 +321,68 @@ def process_callevent(record):
         logger.info("Retry: No matching conditions")
 
 
-# OPTIMIZATION - TO REVIEW
+def write_callevent_batch(list_record, claimed_by=None):
+    """
+    Process a page of call_event rows and write the changes, return the
+    records of the alarm events
+
+    The events claimed by ``claimed_by`` are locked before the writes and
+    released in the same transaction, CallEventClaimLost is raised and
+    nothing is written if some of them were reclaimed by another consumer
+    """
+    batch = CallEventBatch(list_record)
+    list_alarm = batch.process()
+    debug_query(23)
+    list_id = [record[0] for record in list_record]
+    with transaction.atomic():
+        if claimed_by:
+            list_owned = lock_callevents(list_id, claimed_by)
+            if len(list_owned) < len(list_id):
+                raise CallEventClaimLost(list_owned)
+        batch.commit()
+        if claimed_by and release_callevents(list_id, claimed_by) < len(list_id):
+            # rolls back the writes, the lock should prevent it
+            raise CallEventClaimLost(lock_callevents(list_id, claimed_by))
+    batch.publish()
+    return list_alarm
+
+
+def write_claimed_callevents(list_record, claimed_by):
+    """
+    Write a page of call events claimed by ``claimed_by``, without the
+    events reclaimed by another consumer meanwhile, return the
+    (records written, records of the alarm events)
+    """
+    while list_record:
+        try:
+            return (list_record, write_callevent_batch(list_record, claimed_by))
+        except CallEventClaimLost as e:
+            logger.warning("%d call events reclaimed by another consumer" %
+                           (len(list_record) - len(e.list_owned)))
+            list_record = [record for record in list_record if record[0] in e.list_owned]
+    return ([], [])
+
+
+@task(ignore_result=True)
+def process_callevent_batch(list_record, claimed_by=None):
+    """
+    Process a page of call_event rows in one go: the callrequests are
+    loaded with one query, the changes written with bulk updates and
+    inserts, and all the retry callrequests created together.
+    The events of alarm calls go through process_callevent
+
+    The events reclaimed by another consumer while the page was processed
+    are left to it, the page is processed again without them
+    """
+    debug_query(22)
+    with trace_stage(STAGE_CDR_WRITE):
+        (list_record, list_alarm) = write_claimed_callevents(list_record, claimed_by)
+    debug_query(24)
+
+    for record in list_alarm:
+        process_callevent(record)
+
+
 def callevent_processing():
     """
     Retrieve callevents and process them
@@ -398,48 +408,48 @@ def callevent_processing():
         starting_date timestamp with time zone,
         status smallint,
         leg smallint,
-        created_date timestamp with time zone NOT NULL
+        created_date timestamp with time zone NOT NULL,
+        claimed_by varchar(100),
+        claimed_at timestamp with time zone
         );
     CREATE INDEX call_event_idx_status ON call_event (status);
+    CREATE INDEX call_event_pending_idx ON call_event (id) WHERE status = 1;
+    CREATE INDEX call_event_claimed_idx ON call_event (claimed_at) WHERE status = 3;
     --CREATE INDEX call_event_idx_date ON call_event (created_date);
     --CREATE INDEX call_event_idx_uuid ON call_event (call_uuid);
+
+    Each page of events is claimed atomically (status 3 with claimed_by /
+    claimed_at), so several consumers on several hosts can drain the
+    table together. A claim not released after CALLEVENT_CLAIM_TIMEOUT
+    seconds goes back to pending.
     """
     debug_query(20)
-
-    cursor = connection.cursor()
-    # TODO (Areski)
-    # Replace this for ORM with select_for_update or transaction
-
+    claimed_by = get_consumer_name()
     try:
-        sql_statement = "SELECT id, event_name, body, job_uuid, call_uuid, used_gateway_id, " \
-            "callrequest_id, alarm_request_id, callerid, phonenumber, duration, billsec, hangup_cause, " \
-            "hangup_cause_q850, starting_date, status, created_date, amd_status, leg " \
-            "FROM call_event WHERE status=1 LIMIT 1000 OFFSET 0"
-
-        cursor.execute(sql_statement)
-        row = cursor.fetchall()
-    except:
+        reclaim_callevents()
+    except DatabaseError:
         # Error on sql / Lua listener might not be on
-        logger.error("Error Fetching call_event")
-    else:
+        logger.error("Error Reclaiming call_event")
+        return
+
+    while True:
+        list_record = claim_callevents(claimed_by, CALLEVENT_PAGE_SIZE)
         debug_query(21)
-        # buff_voipcall = BufferVoIPCall()
-        call_event_list = []
-        for record in row:
-            call_event_id = record[0]
-            event_name = record[1]
-            call_event_list.append(str(call_event_id))
-            logger.info("Processing Call_Event : %s" % event_name)
-            process_callevent.delay(record)
-
-        if call_event_list:
-            # Update Call Event
-            sql_statement = "UPDATE call_event SET status=2 WHERE id IN (%s)" % ','.join(call_event_list)
-            cursor.execute(sql_statement)
-            debug_query(30)
-        # buff_voipcall.commit()
-        # debug_query(31)
-        logger.debug('End Loop : callevent_processing')
+        if not list_record:
+            break
+        for record in list_record:
+            logger.info("Processing Call_Event : %s" % record[1])
+        if settings.CALLEVENT_BATCH:
+            # the task releases the events once processed
+            process_callevent_batch.delay(list_record, claimed_by)
+        else:
+            for record in list_record:
+                process_callevent.delay(record)
+            release_callevents([record[0] for record in list_record], claimed_by)
+        debug_query(30)
+        if len(list_record) < CALLEVENT_PAGE_SIZE:
+            break
+    logger.debug('End Loop : callevent_processing')
 
 
 class task_pending_callevent(PeriodicTask):
@@ -457,10 +467,13 @@ class task_pending_callevent(PeriodicTask):
 
     # run_every = timedelta(seconds=15)
 
-    # TODO: problem of the lock if it's a cloud, it won't be shared
-    @only_one(ikey="task_pending_callevent", timeout=LOCK_EXPIRE)
+    # No lock : the call events are claimed atomically, the task can run
+    # on several hosts at the same time
     def run(self, **kwargs):
         logger.info("TASK :: task_pending_callevent")
+        if settings.CALLEVENT_LISTENER:
+            # call events are pushed to the callevent_listener command
+            return True
         callevent_processing()
 
 """
@@ -494,51 +507,26 @@ def callrequest_pending(*args, **kwargs):
 """
 
 
-@task(ignore_result=True)
-def init_callrequest(callrequest_id, campaign_id, callmaxduration, ms_addtowait=0, alarm_request_id=None):
+def build_dial_command(obj_callrequest, campaign_id, callmaxduration,
+                       subscriber_id=None, contact_id=None, alarm_request_id=None):
     """
-    This task read the callrequest, update it as 'In Process'
-    then proceed on the call outbound, using the different call engine supported
+    Build the ESL originate command of a callrequest,
+    return False if the phone number cannot be dialed
 
     **Attributes**:
 
-        * ``callrequest_id`` - Callrequest ID
+        * ``obj_callrequest`` - Callrequest with aleg_gateway and user__userprofile loaded
         * ``campaign_id`` - Campaign ID
         * ``callmaxduration`` - Max duration
-        * ``ms_addtowait`` - Milliseconds to wait before outbounding the call
-
     """
-    outbound_failure = False
-    subscriber_id = None
-    contact_id = None
-    debug_query(8)
-
-    if ms_addtowait > 0:
-        sleep(ms_addtowait)
-
-    # Survey Call or Alarm Call
-    if campaign_id:
-        # TODO: use only
-        # https://docs.djangoproject.com/en/dev/ref/models/querysets/#django.db.models.query.QuerySet.only
-        obj_callrequest = Callrequest.objects\
-            .select_related('aleg_gateway', 'user__userprofile', 'subscriber', 'campaign').get(id=callrequest_id)
-        subscriber_id = obj_callrequest.subscriber_id
-        contact_id = obj_callrequest.subscriber.contact_id
-    elif alarm_request_id:
-        obj_callrequest = Callrequest.objects.select_related('aleg_gateway', 'user__userprofile').get(id=callrequest_id)
-        alarm_request_id = obj_callrequest.alarm_request_id
-    else:
-        logger.info("TASK :: init_callrequest, wrong campaign_id & alarm_request_id")
-        return False
-
-    debug_query(9)
-    logger.info("TASK :: init_callrequest - status:%s;cmpg:%s;alarm:%s" %
-                (obj_callrequest.status, campaign_id, alarm_request_id))
-
+    phone_number = obj_callrequest.phone_number
+    if getattr(settings, 'PHONENUMBER_DIAL_E164', False):
+        # the gateway prefixes apply to the E.164 form, the numbers which can't be read are dialed raw
+        phone_number = to_e164(phone_number, user_id=obj_callrequest.user_id) or phone_number
     # TODO: move method prepare_phonenumber into the model gateway
     # Obj_callrequest.aleg_gatewayprepare_phonenumber()
     dialout_phone_number = prepare_phonenumber(
-        obj_callrequest.phone_number,
+        phone_number,
         obj_callrequest.aleg_gateway.addprefix,
         obj_callrequest.aleg_gateway.removeprefix,
         obj_callrequest.aleg_gateway.status)
@@ -566,7 +554,6 @@ def init_callrequest(callrequest_id, campaign_id, callmaxduration, ms_addtowait=
             dialing_timeout = 10
     except ValueError:
         dialing_timeout = 45
-    originate_dial_string = obj_callrequest.aleg_gateway.originate_dial_string
 
     debug_query(11)
 
@@ -582,97 +569,152 @@ def init_callrequest(callrequest_id, campaign_id, callmaxduration, ms_addtowait=
 
     debug_query(12)
 
-    if settings.NEWFIES_DIALER_ENGINE.lower() == 'esl':
+    args_list = []
+    send_digits = False
+    time_limit = callmaxduration
+
+    # To wait before sending DTMF to the extension, you can add leading 'w'
+    # characters.
+    # Each 'w' character waits 0.5 seconds instead of sending a digit.
+    # Each 'W' character waits 1.0 seconds instead of sending a digit.
+    # You can also add the tone duration in ms by appending @[duration] after string.
+    # Eg. 1w2w3@1000
+    check_senddigit = dialout_phone_number.partition('w')
+    if check_senddigit[1] == 'w':
+        send_digits = check_senddigit[1] + check_senddigit[2]
+        dialout_phone_number = check_senddigit[0]
+
+    if obj_callrequest.callerid and len(obj_callrequest.callerid) > 0:
+        args_list.append("origination_caller_id_number='%s'" % obj_callrequest.callerid)
+    if obj_callrequest.caller_name and len(obj_callrequest.caller_name) > 0:
+        args_list.append("origination_caller_id_name='%s'" % obj_callrequest.caller_name)
+
+    # Add App Vars
+    args_list.append("campaign_id=%s,subscriber_id=%s,alarm_request_id=%s,used_gateway_id=%s,callrequest_id=%s,contact_id=%s,dialout_phone_number=%s" %
+                     (campaign_id, subscriber_id, alarm_request_id, gateway_id, obj_callrequest.id, contact_id, obj_callrequest.phone_number))
+    args_list.append(originate_dial_string)
+
+    early_media = settings.EARLY_MEDIA
+    if early_media and len(early_media) > 0:
+        early_media = early_media + ","
+
+    # Call Vars
+    callvars = "%soriginate_timeout=%d,newfiesdialer=true,leg_type=1" % \
+        (early_media, dialing_timeout, )
+    args_list.append(callvars)
+
+    # Default Test
+    hangup_on_ring = ''
+    send_preanswer = False
+    # set hangup_on_ring
+    try:
+        hangup_on_ring = int(hangup_on_ring)
+    except ValueError:
+        hangup_on_ring = -1
+    exec_on_media = 1
+    if hangup_on_ring >= 10:  # 0->10 fraud protection on short calls
+        args_list.append("execute_on_media_%d='sched_hangup +%d ORIGINATOR_CANCEL'" %
+                         (exec_on_media, hangup_on_ring))
+        exec_on_media += 1
+
+    # TODO: look and test http://wiki.freeswitch.org/wiki/Misc._Dialplan_Tools_queue_dtmf
+    # Send digits
+    if send_digits:
+        if send_preanswer:
+            args_list.append("execute_on_media_%d='send_dtmf %s'" % (exec_on_media, send_digits))
+            exec_on_media += 1
+        else:
+            args_list.append("execute_on_answer='send_dtmf %s'" % send_digits)
+
+    # Set time_limit
+    try:
+        time_limit = int(time_limit)
+        if time_limit > 0:
+            args_list.append("execute_on_answer='sched_hangup +%d ALLOTTED_TIMEOUT'" % time_limit)
+    except ValueError:
+        logger.error('ValueError time_limit :> %s' % time_limit)
+
+    # build originate string
+    args_str = ','.join(args_list)
+
+    # DEBUG
+    # settings.ESL_SCRIPT = '&playback(/usr/local/freeswitch/sounds/en/us/callie/voicemail/8000/vm-record_greeting.wav)'
+    if settings.DIALERDEBUG:
+        dial_command = "originate {%s}user/areski '%s'" % (args_str, settings.ESL_SCRIPT)
+    else:
+        dial_command = "originate {%s}%s%s '%s'" % \
+            (args_str, gateways, dialout_phone_number, settings.ESL_SCRIPT)
+
+    # originate {bridge_early_media=true,hangup_after_bridge=true,originate_timeout=10}user/areski &playback(/tmp/myfile.wav)
+    # dial = "originate {bridge_early_media=true,hangup_after_bridge=true,originate_timeout=,newfiesdialer=true,used_gateway_id=1,callrequest_id=38,leg_type=1,origination_caller_id_number=234234234,origination_caller_id_name=234234,effective_caller_id_number=234234234,effective_caller_id_name=234234,}user//1000 '&lua(/usr/share/newfies-lua/newfies.lua)'"
+    return dial_command
+
+
+@task(ignore_result=True)
+def init_callrequest(callrequest_id, campaign_id, callmaxduration, ms_addtowait=0, alarm_request_id=None):
+    """
+    This task read the callrequest, update it as 'In Process'
+    then proceed on the call outbound, using the different call engine supported
+
+    **Attributes**:
+
+        * ``callrequest_id`` - Callrequest ID
+        * ``campaign_id`` - Campaign ID
+        * ``callmaxduration`` - Max duration
+        * ``ms_addtowait`` - Milliseconds to wait before outbounding the call
+
+    """
+    with trace_stage(STAGE_INIT):
         try:
-            args_list = []
-            send_digits = False
-            time_limit = callmaxduration
-
-            # To wait before sending DTMF to the extension, you can add leading 'w'
-            # characters.
-            # Each 'w' character waits 0.5 seconds instead of sending a digit.
-            # Each 'W' character waits 1.0 seconds instead of sending a digit.
-            # You can also add the tone duration in ms by appending @[duration] after string.
-            # Eg. 1w2w3@1000
-            check_senddigit = dialout_phone_number.partition('w')
-            if check_senddigit[1] == 'w':
-                send_digits = check_senddigit[1] + check_senddigit[2]
-                dialout_phone_number = check_senddigit[0]
-
-            if obj_callrequest.callerid and len(obj_callrequest.callerid) > 0:
-                args_list.append("origination_caller_id_number='%s'" % obj_callrequest.callerid)
-            if obj_callrequest.caller_name and len(obj_callrequest.caller_name) > 0:
-                args_list.append("origination_caller_id_name='%s'" % obj_callrequest.caller_name)
-
-            # Add App Vars
-            args_list.append("campaign_id=%s,subscriber_id=%s,alarm_request_id=%s,used_gateway_id=%s,callrequest_id=%s,contact_id=%s,dialout_phone_number=%s" %
-                             (campaign_id, subscriber_id, alarm_request_id, gateway_id, obj_callrequest.id, contact_id, obj_callrequest.phone_number))
-            args_list.append(originate_dial_string)
-
-            early_media = settings.EARLY_MEDIA
-            if early_media and len(early_media) > 0:
-                early_media = early_media + ","
-
-            # Call Vars
-            callvars = "%soriginate_timeout=%d,newfiesdialer=true,leg_type=1" % \
-                (early_media, dialing_timeout, )
-            args_list.append(callvars)
-
-            # Default Test
-            hangup_on_ring = ''
-            send_preanswer = False
-            # set hangup_on_ring
-            try:
-                hangup_on_ring = int(hangup_on_ring)
-            except ValueError:
-                hangup_on_ring = -1
-            exec_on_media = 1
-            if hangup_on_ring >= 10:  # 0->10 fraud protection on short calls
-                args_list.append("execute_on_media_%d='sched_hangup +%d ORIGINATOR_CANCEL'" %
-                                 (exec_on_media, hangup_on_ring))
-                exec_on_media += 1
-
-            # TODO: look and test http://wiki.freeswitch.org/wiki/Misc._Dialplan_Tools_queue_dtmf
-            # Send digits
-            if send_digits:
-                if send_preanswer:
-                    args_list.append("execute_on_media_%d='send_dtmf %s'" % (exec_on_media, send_digits))
-                    exec_on_media += 1
-                else:
-                    args_list.append("execute_on_answer='send_dtmf %s'" % send_digits)
-
-            # Set time_limit
-            try:
-                time_limit = int(time_limit)
-                if time_limit > 0:
-                    args_list.append("execute_on_answer='sched_hangup +%d ALLOTTED_TIMEOUT'" % time_limit)
-            except ValueError:
-                logger.error('ValueError time_limit :> %s' % time_limit)
-
-            # build originate string
-            args_str = ','.join(args_list)
-
-            # DEBUG
-            # settings.ESL_SCRIPT = '&playback(/usr/local/freeswitch/sounds/en/us/callie/voicemail/8000/vm-record_greeting.wav)'
-            if settings.DIALERDEBUG:
-                dial_command = "originate {%s}user/areski '%s'" % (args_str, settings.ESL_SCRIPT)
-            else:
-                dial_command = "originate {%s}%s%s '%s'" % \
-                    (args_str, gateways, dialout_phone_number, settings.ESL_SCRIPT)
+            return originate_callrequest(callrequest_id, campaign_id, callmaxduration, ms_addtowait,
+                                         alarm_request_id)
+        finally:
+            if campaign_id:
+                # the spooled callrequest leaves the backlog whatever the outcome
+                metrics.dec('newfies_originate_backlog')
+
+
+def originate_callrequest(callrequest_id, campaign_id, callmaxduration, ms_addtowait=0, alarm_request_id=None):
+    """Originate the call of a callrequest, see init_callrequest"""
+    outbound_failure = False
+    subscriber_id = None
+    contact_id = None
+    debug_query(8)
 
-            # originate {bridge_early_media=true,hangup_after_bridge=true,originate_timeout=10}user/areski &playback(/tmp/myfile.wav)
-            # dial = "originate {bridge_early_media=true,hangup_after_bridge=true,originate_timeout=,newfiesdialer=true,used_gateway_id=1,callrequest_id=38,leg_type=1,origination_caller_id_number=234234234,origination_caller_id_name=234234,effective_caller_id_number=234234234,effective_caller_id_name=234234,}user//1000 '&lua(/usr/share/newfies-lua/newfies.lua)'"
+    if ms_addtowait > 0:
+        sleep(ms_addtowait)
 
-            # Load balance on testing
-            # from random import randint, seed
-            # seed()
-            # randval = randint(1, 2)
-            # if randval == 1:
-            #     dial_command = dial_command.replace('88.208.208.244', '88.208.208.209')
-            # logger.warn('dial_command (%d): %s' % (randval, dial_command))
+    # Survey Call or Alarm Call
+    if campaign_id:
+        # TODO: use only
+        # https://docs.djangoproject.com/en/dev/ref/models/querysets/#django.db.models.query.QuerySet.only
+        obj_callrequest = Callrequest.objects\
+            .select_related('aleg_gateway', 'user__userprofile', 'subscriber', 'campaign').get(id=callrequest_id)
+        subscriber_id = obj_callrequest.subscriber_id
+        contact_id = obj_callrequest.subscriber.contact_id
+    elif alarm_request_id:
+        obj_callrequest = Callrequest.objects.select_related('aleg_gateway', 'user__userprofile').get(id=callrequest_id)
+        alarm_request_id = obj_callrequest.alarm_request_id
+    else:
+        logger.info("TASK :: init_callrequest, wrong campaign_id & alarm_request_id")
+        return False
 
+    debug_query(9)
+    logger.info("TASK :: init_callrequest - status:%s;cmpg:%s;alarm:%s" %
+                (obj_callrequest.status, campaign_id, alarm_request_id))
+    observe_stage(STAGE_ETA_WAIT, (datetime.utcnow().replace(tzinfo=utc) - obj_callrequest.call_time).total_seconds())
+
+    dial_command = build_dial_command(obj_callrequest, campaign_id, callmaxduration,
+                                      subscriber_id, contact_id, alarm_request_id)
+    if not dial_command:
+        return False
+
+    if settings.NEWFIES_DIALER_ENGINE.lower() == 'esl':
+        try:
             logger.warn('dial_command : %s' % dial_command)
-            request_uuid = dial_out(dial_command, obj_callrequest.id)
+            with trace_stage(STAGE_BGAPI):
+                request_uuid = dial_out(dial_command, obj_callrequest.id)
+            obj_callrequest.last_attempt_time = datetime.utcnow().replace(tzinfo=utc)
 
             debug_query(14)
 
@@ -712,8 +754,12 @@ def init_callrequest(callrequest_id, campaign_id, callmaxduration, ms_addtowait=
     # check if the outbound call failed
     if outbound_failure:
         obj_callrequest.status = CALLREQUEST_STATUS.FAILURE
+        metrics.inc('newfies_originate_total', result='error')
     else:
         obj_callrequest.status = CALLREQUEST_STATUS.CALLING
+        metrics.inc('newfies_originate_total', result='success')
+        if campaign_id:
+            metrics.inc('newfies_callrequests_calling', campaign_id=campaign_id)
     obj_callrequest.save()
 
     debug_query(14)
@@ -721,6 +767,130 @@ def init_callrequest(callrequest_id, campaign_id, callmaxduration, ms_addtowait=
     return True
 
 
+def update_callrequest_batch(calling, failed, campaign_id=None):
+    """
+    Write back the result of a batch of originates with bulk updates
+
+    **Attributes**:
+
+        * ``calling`` - dict of {callrequest_id: (subscriber_id, request_uuid)}
+        * ``failed`` - dict of {callrequest_id: (subscriber_id, request_uuid)}
+        * ``campaign_id`` - Campaign ID of the callrequests
+    """
+    results = dict(calling)
+    results.update(failed)
+    if not results:
+        return
+    metrics.dec('newfies_originate_backlog', len(results))
+    metrics.inc('newfies_originate_total', len(calling), result='success')
+    metrics.inc('newfies_originate_total', len(failed), result='error')
+    if campaign_id:
+        metrics.inc('newfies_callrequests_calling', len(calling), campaign_id=campaign_id)
+    now = datetime.utcnow().replace(tzinfo=utc)
+
+    # Only the callrequests still pending are updated, the call event of a
+    # quickly failing call may already have been processed
+    params = []
+    sql_case = []
+    for (callrequest_id, (subscriber_id, request_uuid)) in results.items():
+        sql_case.append('WHEN %s THEN %s')
+        params.extend([callrequest_id, request_uuid])
+    sql_status = ''
+    if failed:
+        sql_status = 'CASE WHEN id IN (%s) THEN %d ELSE %d END' % (
+            ','.join(['%s'] * len(failed)), CALLREQUEST_STATUS.FAILURE, CALLREQUEST_STATUS.CALLING)
+        params.extend(failed.keys())
+    else:
+        sql_status = '%d' % CALLREQUEST_STATUS.CALLING
+    # updated_date and last_attempt_time
+    params.extend([now, now])
+    params.extend(results.keys())
+    sql_statement = "UPDATE dialer_callrequest SET request_uuid = CASE id %s END, status = %s, " \
+        "updated_date = %%s, last_attempt_time = %%s WHERE id IN (%s) AND status = %d" % \
+        (' '.join(sql_case), sql_status, ','.join(['%s'] * len(results)), CALLREQUEST_STATUS.PENDING)
+    cursor = connection.cursor()
+    cursor.execute(sql_statement, params)
+
+    # Update Subscribers
+    list_subscriber_id = [subscriber_id for (subscriber_id, request_uuid) in results.values()]
+    Subscriber.objects.filter(id__in=list_subscriber_id, count_attempt__isnull=True).update(count_attempt=0)
+    Subscriber.objects.filter(id__in=list_subscriber_id)\
+        .update(count_attempt=F('count_attempt') + 1, last_attempt=now, updated_date=now)
+    if failed:
+        list_failed_id = [subscriber_id for (subscriber_id, request_uuid) in failed.values()]
+        Subscriber.objects.filter(id__in=list_failed_id).update(status=SUBSCRIBER_STATUS.FAIL)
+
+
+@task(ignore_result=True)
+def init_callrequest_batch(list_callrequest_id, campaign_id, callmaxduration, schedule):
+    """
+    Originate a batch of campaign callrequests from a single task,
+    the callrequests are loaded with one query, sent over the pooled ESL
+    connections at their scheduled offset and their status is written
+    back with bulk updates.
+
+    **Attributes**:
+
+        * ``list_callrequest_id`` - list of Callrequest ID
+        * ``campaign_id`` - Campaign ID
+        * ``callmaxduration`` - Max duration
+        * ``schedule`` - list of offsets in seconds from the start of the task,
+          one per callrequest
+    """
+    start = time()
+    debug_query(8)
+    if settings.NEWFIES_DIALER_ENGINE.lower() != 'esl':
+        logger.error('No other method supported!')
+        Callrequest.objects.filter(id__in=list_callrequest_id)\
+            .update(status=CALLREQUEST_STATUS.FAILURE)
+        metrics.dec('newfies_originate_backlog', len(list_callrequest_id))
+        return False
+
+    dict_offset = dict(zip(list_callrequest_id, schedule))
+    list_callrequest = Callrequest.objects\
+        .select_related('aleg_gateway', 'user__userprofile', 'subscriber')\
+        .filter(id__in=list_callrequest_id)
+    list_callrequest = sorted(list_callrequest, key=lambda cr: dict_offset.get(cr.id, 0))
+    debug_query(9)
+    logger.info("TASK :: init_callrequest_batch - cmpg:%s;callrequests:%d" %
+                (campaign_id, len(list_callrequest)))
+
+    calling = {}
+    failed = {}
+    last_flush = time()
+    for obj_callrequest in list_callrequest:
+        to_wait = start + dict_offset.get(obj_callrequest.id, 0) - time()
+        if to_wait > 0:
+            sleep(to_wait)
+        observe_stage(STAGE_ETA_WAIT,
+                      (datetime.utcnow().replace(tzinfo=utc) - obj_callrequest.call_time).total_seconds())
+
+        dial_command = build_dial_command(obj_callrequest, campaign_id, callmaxduration,
+                                          obj_callrequest.subscriber_id,
+                                          obj_callrequest.subscriber.contact_id)
+        if not dial_command:
+            request_uuid = 'error'
+        else:
+            logger.warn('dial_command : %s' % dial_command)
+            with trace_stage(STAGE_BGAPI):
+                request_uuid = dial_out(dial_command, obj_callrequest.id)
+        if request_uuid[:5] == 'error':
+            failed[obj_callrequest.id] = (obj_callrequest.subscriber_id, request_uuid)
+        else:
+            calling[obj_callrequest.id] = (obj_callrequest.subscriber_id, request_uuid)
+
+        # Flush every second, so the call events can find the request_uuid
+        if time() - last_flush >= BATCH_FLUSH_INTERVAL:
+            update_callrequest_batch(calling, failed, campaign_id)
+            calling = {}
+            failed = {}
+            last_flush = time()
+
+    update_callrequest_batch(calling, failed, campaign_id)
+    debug_query(14)
+    return True
+
+
 # def event_replace_tag(text, phone_number, additional_vars):
 #     """
 #     Replace tag by contact values
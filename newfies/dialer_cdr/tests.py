@@ -14,17 +14,477 @@
 
 from django.contrib.auth.models import User
 from django.contrib.contenttypes.models import ContentType
+from django.core.cache import cache
 from django.core.management import call_command
+from django.db import connection
 from django.test import TestCase
+from django.test.utils import override_settings
 from django_lets_go.utils import BaseAuthenticatedClient
-from dialer_campaign.models import Campaign
+from dialer_campaign.models import Campaign, Subscriber
+from dialer_campaign.constants import SUBSCRIBER_STATUS
 from dialer_cdr.models import Callrequest, VoIPCall
+from dialer_cdr.constants import CALLREQUEST_STATUS, CALL_DISPOSITION, DISPOSITION_CODE, CALLEVENT_STATUS
+from dialer_cdr.disposition import HANGUP_CAUSES, CAUSE_DISPOSITION, DISPOSITION_NAME, get_disposition, \
+    get_disposition_code, get_disposition_code_from_name
+from dialer_cdr.prefix_index import PrefixIndex, clean_phonenumber
+from dialer_cdr.tracing import LatencyHistogram, CallTracer, get_percentile, trace_stage, trace_callevent, \
+    get_call_tracer, STAGE_CHANNEL, STAGE_RING, STAGE_CALL_EVENT, STAGE_PROCESS
 from dialer_cdr.forms import VoipSearchForm
 from dialer_cdr.views import export_voipcall_report, voipcall_report
 from dialer_cdr.function_def import voipcall_search_admin_form_fun
-# from dialer_cdr.tasks import init_callrequest
-from datetime import datetime
+from dialer_cdr.esl_pool import ESLConnectionPool, ESLPoolError
+from dialer_cdr.dialer_node import DialerNode, DialerNodeRegistry, \
+    NODE_STRATEGY_LEAST_LOADED, NODE_STRATEGY_WEIGHTED_ROUND_ROBIN
+from dialer_cdr.tasks import init_callrequest_batch, process_callevent_batch
+from dialer_cdr import tasks as cdr_tasks
+from dialer_cdr.callevent_listener import CallEventListener, CallEventLatency, get_hangup_date
+from mod_metrics.metrics import get_series_key
+from dialer_cdr.callevent import CallEventBatch, claim_callevents, reclaim_callevents, release_callevents, \
+    copy_callrequest
+from datetime import datetime, timedelta
 from django.utils.timezone import utc
+from unittest import skipUnless
+from uuid import uuid1
+import SocketServer
+import socket
+import threading
+import time
+
+
+class FakeESLHandler(SocketServer.BaseRequestHandler):
+
+    """Speak enough of the inbound event socket protocol to authenticate
+    and reply to api commands"""
+
+    def handle(self):
+        self.server.connections.append(self.request)
+        self.request.sendall('Content-Type: auth/request\n\n')
+        buff = ''
+        while True:
+            try:
+                data = self.request.recv(4096)
+            except socket.error:
+                return
+            if not data:
+                return
+            buff += data
+            while '\n\n' in buff:
+                (command, buff) = buff.split('\n\n', 1)
+                if command.startswith('auth '):
+                    if command[5:] != self.server.secret:
+                        self.request.sendall('Content-Type: command/reply\nReply-Text: -ERR invalid\n\n')
+                        return
+                    self.request.sendall('Content-Type: command/reply\nReply-Text: +OK accepted\n\n')
+                elif command == 'api show channels count':
+                    body = '\n%d total.\n' % self.server.channels
+                    self.request.sendall('Content-Type: api/response\nContent-Length: %d\n\n%s' %
+                                         (len(body), body))
+                else:
+                    self.server.commands.append(command)
+                    body = '+OK Job-UUID: %s' % uuid1()
+                    self.request.sendall('Content-Type: api/response\nContent-Length: %d\n\n%s' %
+                                         (len(body), body))
+
+
+class FakeESLServer(SocketServer.ThreadingTCPServer):
+
+    """Local fake FreeSWITCH event socket listening on a random port"""
+    allow_reuse_address = True
+    daemon_threads = True
+
+    def __init__(self, secret='ClueCon'):
+        SocketServer.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeESLHandler)
+        self.secret = secret
+        self.connections = []
+        self.commands = []
+        self.channels = 0
+        self.port = self.server_address[1]
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def drop_connections(self):
+        for conn in self.connections:
+            try:
+                conn.shutdown(socket.SHUT_RDWR)
+            except socket.error:
+                pass
+            conn.close()
+
+    def stop(self):
+        self.drop_connections()
+        self.shutdown()
+        self.server_close()
+
+
+class FakeESLEvent(object):
+
+    def __init__(self, headers, body):
+        self.headers = headers
+        self.body = body
+
+    def serialize(self):
+        return self.headers + '\n\n' + self.body
+
+
+class SocketESLConnection(object):
+
+    """Minimal socket client with the interface of ESL.ESLconnection"""
+
+    def __init__(self, hostname, port, secret):
+        self.sock = None
+        self.buff = ''
+        try:
+            self.sock = socket.create_connection((hostname, int(port)), timeout=2)
+            self._read()
+            self.sock.sendall('auth %s\n\n' % secret)
+            (headers, body) = self._read()
+            if '+OK' not in headers:
+                self.disconnect()
+        except socket.error:
+            self.sock = None
+
+    def _read(self):
+        while '\n\n' not in self.buff:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error('connection closed')
+            self.buff += data
+        (headers, self.buff) = self.buff.split('\n\n', 1)
+        length = 0
+        for line in headers.split('\n'):
+            if line.startswith('Content-Length:'):
+                length = int(line.split(':')[1])
+        while len(self.buff) < length:
+            data = self.sock.recv(4096)
+            if not data:
+                raise socket.error('connection closed')
+            self.buff += data
+        body = self.buff[:length]
+        self.buff = self.buff[length:]
+        return (headers, body)
+
+    def connected(self):
+        return self.sock is not None
+
+    def api(self, command, arg):
+        try:
+            self.sock.sendall('api %s %s\n\n' % (command, arg))
+            (headers, body) = self._read()
+        except (socket.error, AttributeError):
+            return None
+        return FakeESLEvent(headers, body)
+
+    def disconnect(self):
+        if self.sock:
+            self.sock.close()
+        self.sock = None
+
+
+class ESLConnectionPoolTestCase(TestCase):
+
+    """Test the ESL connection pool against a local fake ESL server"""
+
+    def setUp(self):
+        self.server = FakeESLServer()
+        self.server.start()
+        self.pool = ESLConnectionPool('127.0.0.1', self.server.port, 'ClueCon', size=1,
+                                      check_interval=0, connection_class=SocketESLConnection)
+
+    def tearDown(self):
+        self.pool.close_all()
+        self.server.stop()
+
+    def test_connection_reuse(self):
+        for i in range(3):
+            ev = self.pool.api('bgapi', 'originate user/1000 &park')
+            self.assertTrue('Job-UUID:' in ev.serialize())
+        self.assertEqual(len(self.server.connections), 1)
+        self.assertEqual(len(self.server.commands), 3)
+        stats = self.pool.get_stats()
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['hits'], 2)
+        self.assertEqual(stats['originates'], 3)
+        self.assertTrue(stats['originate_time_avg'] > 0)
+
+    def test_reconnect(self):
+        self.pool.api('status')
+        self.server.drop_connections()
+        ev = self.pool.api('status')
+        self.assertTrue('Job-UUID:' in ev.serialize())
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(self.pool.get_stats()['reconnects'], 1)
+
+    def test_originate_not_resent(self):
+        self.pool.api('bgapi', 'originate user/1000 &park')
+        self.server.drop_connections()
+        # the originate may have reached FreeSWITCH before the connection was lost
+        self.assertEqual(self.pool.api('bgapi', 'originate user/1000 &park'), None)
+        self.assertEqual(len(self.server.commands), 1)
+        self.assertEqual(self.pool.get_stats()['reconnects'], 0)
+        # the broken connection is not put back in the pool
+        ev = self.pool.api('bgapi', 'originate user/1000 &park')
+        self.assertTrue('Job-UUID:' in ev.serialize())
+        self.assertEqual(len(self.server.connections), 2)
+        self.assertEqual(len(self.server.commands), 2)
+
+    def test_pool_size(self):
+        conn1 = self.pool.acquire()
+        conn2 = self.pool.acquire()
+        self.pool.release(conn1)
+        self.pool.release(conn2)
+        self.assertEqual(self.pool.get_stats()['idle'], 1)
+        self.assertFalse(conn2.connected())
+
+    def test_wrong_secret(self):
+        pool = ESLConnectionPool('127.0.0.1', self.server.port, 'wrong',
+                                 connection_class=SocketESLConnection)
+        self.assertRaises(ESLPoolError, pool.api, 'bgapi', 'originate user/1000 &park')
+
+
+class DialerNodeRegistryTestCase(TestCase):
+
+    """Test the node selection over two fake ESL servers"""
+
+    def setUp(self):
+        self.servers = [FakeESLServer(), FakeESLServer()]
+        for server in self.servers:
+            server.start()
+
+    def tearDown(self):
+        for server in self.servers:
+            server.stop()
+
+    def get_registry(self, strategy, weights=(1, 1), max_channels=(0, 0), secrets=('ClueCon', 'ClueCon')):
+        nodes = []
+        for i, server in enumerate(self.servers):
+            nodes.append(DialerNode('fs%d' % i, '127.0.0.1', server.port, secrets[i],
+                                    weight=weights[i], max_channels=max_channels[i],
+                                    connection_class=SocketESLConnection))
+        return DialerNodeRegistry(nodes, strategy=strategy, max_errors=2, quarantine=60, refresh_interval=0)
+
+    def test_weighted_round_robin(self):
+        registry = self.get_registry(NODE_STRATEGY_WEIGHTED_ROUND_ROBIN, weights=(3, 1))
+        for i in range(8):
+            (request_uuid, node) = registry.originate('originate user/1000 &park')
+            self.assertNotEqual(request_uuid, 'error')
+        self.assertEqual(len(self.servers[0].commands), 6)
+        self.assertEqual(len(self.servers[1].commands), 2)
+
+    def test_least_loaded(self):
+        registry = self.get_registry(NODE_STRATEGY_LEAST_LOADED)
+        self.servers[0].channels = 10
+        registry.refresh(force=True)
+        for i in range(3):
+            (request_uuid, node) = registry.originate('originate user/1000 &park')
+            self.assertEqual(node.name, 'fs1')
+        self.assertEqual(registry.nodes[0].channels, 10)
+        self.assertEqual(registry.nodes[1].channels, 3)
+
+    def test_max_channels(self):
+        registry = self.get_registry(NODE_STRATEGY_LEAST_LOADED, max_channels=(1, 1))
+        registry.originate('originate user/1000 &park')
+        registry.originate('originate user/1000 &park')
+        (request_uuid, node) = registry.originate('originate user/1000 &park')
+        self.assertEqual(request_uuid, 'error')
+        self.assertEqual(node, None)
+
+    def test_failing_node_out_of_rotation(self):
+        registry = self.get_registry(NODE_STRATEGY_WEIGHTED_ROUND_ROBIN, secrets=('wrong', 'ClueCon'))
+        for i in range(6):
+            registry.originate('originate user/1000 &park')
+        stats = registry.get_stats()
+        self.assertEqual(stats[0]['errors'], 2)
+        self.assertEqual(stats[0]['error_rate'], 1.0)
+        self.assertFalse(stats[0]['available'])
+        self.assertEqual(len(self.servers[1].commands), 4)
+
+
+class DispositionTestCase(TestCase):
+
+    """Test the disposition lookup over the hangup cause catalogue"""
+
+    def test_catalogue(self):
+        self.assertEqual(len(HANGUP_CAUSES), len(set(cause for (cause, q850) in HANGUP_CAUSES)))
+        self.assertEqual(len(HANGUP_CAUSES), len(set(q850 for (cause, q850) in HANGUP_CAUSES)))
+        for (cause, q850) in HANGUP_CAUSES:
+            code = CAUSE_DISPOSITION.get(cause, DISPOSITION_CODE.FAILED)
+            self.assertEqual(get_disposition_code(cause), code, cause)
+            self.assertEqual(get_disposition_code(cause + ' extra text'), code, cause)
+            # the Q.850 code gives the same disposition when the cause is unknown
+            self.assertEqual(get_disposition_code('', str(q850)), code, cause)
+            self.assertEqual(get_disposition_code_from_name(cause), code, cause)
+        for cause in CAUSE_DISPOSITION:
+            self.assertTrue(cause in dict(HANGUP_CAUSES), cause)
+
+    def test_disposition(self):
+        self.assertEqual(get_disposition('NORMAL_CLEARING'), (CALL_DISPOSITION.ANSWER, DISPOSITION_CODE.ANSWER))
+        self.assertEqual(get_disposition('ALLOTTED_TIMEOUT'), (CALL_DISPOSITION.ANSWER, DISPOSITION_CODE.ANSWER))
+        self.assertEqual(get_disposition('USER_BUSY'), (CALL_DISPOSITION.BUSY, DISPOSITION_CODE.BUSY))
+        self.assertEqual(get_disposition('NO_ANSWER'), (CALL_DISPOSITION.NOANSWER, DISPOSITION_CODE.NOANSWER))
+        self.assertEqual(get_disposition('ORIGINATOR_CANCEL'), (CALL_DISPOSITION.CANCEL, DISPOSITION_CODE.CANCEL))
+        self.assertEqual(get_disposition('NORMAL_CIRCUIT_CONGESTION'),
+                         (CALL_DISPOSITION.CONGESTION, DISPOSITION_CODE.CONGESTION))
+        self.assertEqual(get_disposition('CALL_REJECTED'), (CALL_DISPOSITION.FAILED, DISPOSITION_CODE.FAILED))
+        # the causes the baseline reported as FAILED stay FAILED
+        self.assertEqual(get_disposition('NO_USER_RESPONSE'), (CALL_DISPOSITION.FAILED, DISPOSITION_CODE.FAILED))
+        self.assertEqual(get_disposition('SWITCH_CONGESTION'), (CALL_DISPOSITION.FAILED, DISPOSITION_CODE.FAILED))
+        self.assertEqual(get_disposition(''), (CALL_DISPOSITION.FAILED, DISPOSITION_CODE.FAILED))
+        self.assertEqual(get_disposition(None, '17'), (CALL_DISPOSITION.BUSY, DISPOSITION_CODE.BUSY))
+        self.assertEqual(get_disposition('UNKNOWN_CAUSE', '999'), (CALL_DISPOSITION.FAILED, DISPOSITION_CODE.FAILED))
+        for code in DISPOSITION_NAME:
+            self.assertEqual(get_disposition_code_from_name(DISPOSITION_NAME[code]), code)
+
+
+class PrefixIndexTestCase(TestCase):
+
+    """Test the longest prefix match of the dialcode prefixes"""
+
+    def setUp(self):
+        self.index = PrefixIndex()
+        self.index.ignored_prefixes = ['011', '00', '+']
+        for prefix in [1, 34, 346, 3465, 44, 447, 4420]:
+            self.index.add(prefix)
+
+    def test_lookup(self):
+        self.assertEqual(len(self.index), 7)
+        self.assertEqual(self.index.lengths, [4, 3, 2, 1])
+        self.assertEqual(self.index.lookup('34650123456'), 3465)
+        self.assertEqual(self.index.lookup('34912345678'), 34)
+        self.assertEqual(self.index.lookup('+44 20 7123 4567'), 4420)
+        self.assertEqual(self.index.lookup('00447700900123'), 447)
+        self.assertEqual(self.index.lookup('01112125550100'), 1)
+        self.assertEqual(self.index.lookup('34'), 34)
+        self.assertEqual(self.index.lookup('99123456'), None)
+        self.assertEqual(self.index.lookup(''), None)
+        self.assertEqual(self.index.lookup(None), None)
+
+    def test_clean_phonenumber(self):
+        self.assertEqual(clean_phonenumber('+34 650-123-456', ['00', '+']), '34650123456')
+        self.assertEqual(clean_phonenumber('0034650123456', ['00', '+']), '34650123456')
+        self.assertEqual(clean_phonenumber('sip:1000', ['00', '+']), '1000')
+
+
+class CallTracingTestCase(TestCase):
+
+    """Test the latency histograms of the call stages"""
+
+    def test_histogram(self):
+        histogram = LatencyHistogram(buckets=(0.1, 1, 10))
+        for seconds in [0.05, 0.1, 0.5, 2, 20]:
+            histogram.observe(seconds)
+        self.assertEqual(histogram.counts, [2, 1, 1, 1])
+        self.assertEqual(histogram.cumulative(), [(0.1, 2), (1, 3), (10, 4), ('+Inf', 5)])
+        self.assertEqual(get_percentile(histogram.cumulative(), histogram.count, 50), 1)
+        self.assertEqual(get_percentile(histogram.cumulative(), histogram.count, 95), '+Inf')
+        self.assertEqual(get_percentile([], 0, 50), None)
+
+    def test_counters(self):
+        tracer = CallTracer(flush_interval=60)
+        tracer.observe('spool', 0.02, queries=5)
+        tracer.observe('spool', 0.03, queries=3)
+        tracer.observe('ring', -1)
+        counters = tracer.get_counters()
+        self.assertEqual(counters['call_trace_spool_count'], 2)
+        self.assertEqual(counters['call_trace_spool_sum_ms'], 50)
+        self.assertEqual(counters['call_trace_spool_queries'], 8)
+        self.assertEqual(counters['call_trace_spool_runs'], 2)
+        self.assertEqual(counters['call_trace_ring_bucket_0'], 1)
+        self.assertFalse('call_trace_ring_queries' in counters)
+
+    @override_settings(CALL_TRACING=True)
+    def test_trace_stage(self):
+        use_debug_cursor = connection.use_debug_cursor
+        tracer = get_call_tracer()
+        tracer.reset()
+        # no flush to the cache at the end of the block
+        tracer.last_flush = time.time()
+        with trace_stage(STAGE_PROCESS):
+            with trace_stage(STAGE_RING):
+                User.objects.count()
+            self.assertTrue(connection.use_debug_cursor)
+        self.assertEqual(tracer.histograms[STAGE_RING].count, 1)
+        self.assertEqual(tracer.queries[STAGE_RING], 1)
+        # the queries outside the traced blocks are no longer logged
+        self.assertEqual(connection.use_debug_cursor, use_debug_cursor)
+        tracer.reset()
+
+    @override_settings(CALL_TRACING=True)
+    def test_trace_callevent(self):
+        start = datetime(2015, 1, 1, 12, 0, 0).replace(tzinfo=utc)
+        callrequest = Callrequest(id=1, call_time=start, last_attempt_time=start + timedelta(seconds=1))
+        event = {'starting_date': start + timedelta(seconds=2), 'duration': 30, 'billsec': 20,
+                 'created_date': start + timedelta(seconds=33), 'leg': 'aleg'}
+        tracer = get_call_tracer()
+        tracer.reset()
+        trace_callevent(callrequest, event, written=start + timedelta(seconds=34))
+        self.assertEqual(tracer.histograms[STAGE_CHANNEL].sum, 1)
+        self.assertEqual(tracer.histograms[STAGE_RING].sum, 10)
+        self.assertEqual(tracer.histograms[STAGE_CALL_EVENT].sum, 1)
+        self.assertEqual(tracer.histograms[STAGE_PROCESS].sum, 1)
+        tracer.reset()
+
+
+class CallEventLatencyTestCase(TestCase):
+
+    """Test the hangup to CDR latency of the call event listener"""
+
+    def test_hangup_date(self):
+        starting_date = datetime(2015, 1, 1, 10, 0, 0).replace(tzinfo=utc)
+        self.assertEqual(get_hangup_date({'starting_date': starting_date, 'duration': 30}),
+                         starting_date + timedelta(seconds=30))
+        self.assertEqual(get_hangup_date({'starting_date': None, 'duration': 30}), None)
+
+    def test_stats(self):
+        latency = CallEventLatency(size=100)
+        for seconds in range(1, 101):
+            latency.add(seconds / 100.0)
+        latency.add(-1)
+        stats = latency.get_stats()
+        self.assertEqual(stats['count'], 101)
+        self.assertEqual(stats['max'], 1.0)
+        self.assertEqual(stats['p50'], 0.51)
+        self.assertEqual(stats['p95'], 0.96)
+
+
+def create_call_event_table(cursor):
+    # call_event is created by listener.lua, the temporary table stands in for it
+    cursor.execute(
+        "CREATE TEMPORARY TABLE call_event (id serial PRIMARY KEY, event_name varchar(200), "
+        "body varchar(200), job_uuid varchar(200), call_uuid varchar(200), used_gateway_id integer, "
+        "callrequest_id integer, alarm_request_id integer, callerid varchar(200), "
+        "phonenumber varchar(200), duration integer, billsec integer, hangup_cause varchar(40), "
+        "hangup_cause_q850 varchar(10), amd_status varchar(40), leg varchar(10), "
+        "starting_date timestamp with time zone, status smallint, "
+        "created_date timestamp with time zone, claimed_by varchar(100), "
+        "claimed_at timestamp with time zone)")
+
+
+class CallEventClaimTestCase(TestCase):
+
+    """Test the claim protocol of the call_event consumers"""
+
+    @skipUnless(connection.vendor == 'postgresql', 'call_event is claimed with SKIP LOCKED on PostgreSQL')
+    def test_claim(self):
+        cursor = connection.cursor()
+        create_call_event_table(cursor)
+        cursor.execute(
+            "INSERT INTO call_event (event_name, body, status, created_date) "
+            "SELECT 'CHANNEL_HANGUP_COMPLETE', '', 1, now() FROM generate_series(1, 10)")
+
+        first = claim_callevents('host1:1', 6)
+        second = claim_callevents('host2:1', 6)
+        self.assertEqual(len(first), 6)
+        self.assertEqual(len(second), 4)
+        self.assertFalse(set(row[0] for row in first) & set(row[0] for row in second))
+
+        # host2 releases its events, host1 dies without releasing
+        self.assertEqual(release_callevents([row[0] for row in second], 'host2:1'), 4)
+        self.assertEqual(release_callevents([row[0] for row in first], 'host2:1'), 0)
+        self.assertEqual(reclaim_callevents(claim_timeout=0), 6)
+        self.assertEqual(len(claim_callevents('host2:1', 10)), 6)
 
 
 class DialerCdrView(BaseAuthenticatedClient):
@@ -141,6 +601,201 @@ class DialerCdrCeleryTaskTestCase(TestCase):
         self.callrequest = Callrequest.objects.get(pk=1)
         self.campaign = Campaign.objects.get(pk=1)
 
+    def test_init_callrequest_batch(self):
+        """Test that the ``init_callrequest_batch``
+        task originates the batch and writes back the statuses."""
+        (answered, failed) = [Callrequest.objects.create(
+            status=CALLREQUEST_STATUS.PENDING,
+            user=self.callrequest.user,
+            phone_number=phone_number,
+            subscriber_id=1,
+            campaign=self.campaign,
+            aleg_gateway_id=1,
+            content_type=self.callrequest.content_type,
+            object_id=1) for phone_number in ['123456', '654321']]
+        subscriber = Subscriber.objects.get(pk=1)
+        (count_attempt, status) = (subscriber.count_attempt or 0, subscriber.status)
+
+        # the bgapi Job-UUID of the originate, an error for the second number
+        dial_out = cdr_tasks.dial_out
+        cdr_tasks.dial_out = lambda dial_command, callrequest_id: \
+            'job-uuid-%d' % callrequest_id if callrequest_id == answered.id else 'error: no gateway'
+        try:
+            result = init_callrequest_batch.delay([answered.id], self.campaign.id, 30, [0])
+            self.assertEqual(result.successful(), True)
+            answered = Callrequest.objects.get(pk=answered.id)
+            self.assertEqual(answered.status, CALLREQUEST_STATUS.CALLING)
+            self.assertEqual(answered.request_uuid, 'job-uuid-%d' % answered.id)
+            self.assertNotEqual(answered.last_attempt_time, None)
+            subscriber = Subscriber.objects.get(pk=1)
+            self.assertEqual(subscriber.count_attempt, count_attempt + 1)
+            self.assertEqual(subscriber.status, status)
+
+            init_callrequest_batch.delay([failed.id], self.campaign.id, 30, [0])
+            self.assertEqual(Callrequest.objects.get(pk=failed.id).status, CALLREQUEST_STATUS.FAILURE)
+            subscriber = Subscriber.objects.get(pk=1)
+            self.assertEqual(subscriber.count_attempt, count_attempt + 2)
+            self.assertEqual(subscriber.status, SUBSCRIBER_STATUS.FAIL)
+        finally:
+            cdr_tasks.dial_out = dial_out
+
+    def test_process_callevent_batch(self):
+        """Test that ``process_callevent_batch`` writes the statuses
+        and the CDRs of a page of call events."""
+        (answered, failed) = [Callrequest.objects.create(
+            status=CALLREQUEST_STATUS.CALLING,
+            user=self.callrequest.user,
+            phone_number='123456',
+            subscriber_id=1,
+            campaign=self.campaign,
+            aleg_gateway_id=1,
+            content_type=self.callrequest.content_type,
+            object_id=1) for count in range(2)]
+        now = datetime.utcnow().replace(tzinfo=utc)
+        list_record = []
+        for (event_id, callrequest, hangup_cause) in [(1, answered, 'NORMAL_CLEARING'),
+                                                       (2, failed, 'USER_BUSY')]:
+            list_record.append((
+                event_id, 'CHANNEL_HANGUP_COMPLETE', '', str(uuid1()), str(uuid1()), 1, callrequest.id, 0,
+                '', '', 30, 20, hangup_cause, '16', now, 1, now, 'person', 'aleg'))
+        count_voipcall = VoIPCall.objects.count()
+
+        result = process_callevent_batch.delay(list_record)
+        self.assertEqual(result.successful(), True)
+        self.assertEqual(Callrequest.objects.get(pk=answered.id).status, CALLREQUEST_STATUS.SUCCESS)
+        self.assertEqual(Callrequest.objects.get(pk=failed.id).status, CALLREQUEST_STATUS.FAILURE)
+        self.assertEqual(Callrequest.objects.get(pk=failed.id).hangup_cause, 'USER_BUSY')
+        self.assertEqual(VoIPCall.objects.count(), count_voipcall + 2)
+        self.assertEqual(VoIPCall.objects.filter(callrequest=failed, disposition='BUSY',
+                                                 disposition_code=DISPOSITION_CODE.BUSY).count(), 1)
+        self.assertEqual(Subscriber.objects.get(pk=1).status, SUBSCRIBER_STATUS.FAIL)
+
+    @skipUnless(connection.vendor == 'postgresql', 'call_event is claimed with SKIP LOCKED on PostgreSQL')
+    def test_process_callevent_batch_claim_lost(self):
+        """Test that the events reclaimed by another consumer between the
+        processing and the writes of a page are left to it."""
+        (stolen, kept) = [Callrequest.objects.create(
+            status=CALLREQUEST_STATUS.CALLING,
+            user=self.callrequest.user,
+            phone_number='123456',
+            subscriber_id=1,
+            campaign=self.campaign,
+            aleg_gateway_id=1,
+            content_type=self.callrequest.content_type,
+            object_id=1) for count in range(2)]
+        cursor = connection.cursor()
+        create_call_event_table(cursor)
+        for (callrequest, hangup_cause) in [(stolen, 'NORMAL_CLEARING'), (kept, 'USER_BUSY')]:
+            cursor.execute(
+                "INSERT INTO call_event (event_name, body, job_uuid, call_uuid, used_gateway_id, callrequest_id, "
+                "alarm_request_id, callerid, phonenumber, duration, billsec, hangup_cause, hangup_cause_q850, "
+                "amd_status, leg, starting_date, status, created_date) "
+                "VALUES ('CHANNEL_HANGUP_COMPLETE', '', %s, %s, 1, %s, 0, '', '', 30, 20, %s, '16', "
+                "'person', 'aleg', now(), 1, now())", [str(uuid1()), str(uuid1()), callrequest.id, hangup_cause])
+        list_record = claim_callevents('host1:1', 10)
+        stolen_event_id = [record[0] for record in list_record if record[6] == stolen.id][0]
+        count_voipcall = VoIPCall.objects.count()
+        calling_key = get_series_key('newfies_callrequests_calling', (self.campaign.id,))
+        cache.set(calling_key, 2)
+
+        # another consumer reclaims an event once the page is processed
+        process = CallEventBatch.process
+
+        def process_and_steal(batch):
+            list_alarm = process(batch)
+            cursor.execute("UPDATE call_event SET claimed_by = 'host2:1' WHERE id = %s", [stolen_event_id])
+            return list_alarm
+
+        CallEventBatch.process = process_and_steal
+        try:
+            process_callevent_batch(list_record, 'host1:1')
+        finally:
+            CallEventBatch.process = process
+
+        self.assertEqual(Callrequest.objects.get(pk=stolen.id).status, CALLREQUEST_STATUS.CALLING)
+        self.assertEqual(Callrequest.objects.get(pk=kept.id).status, CALLREQUEST_STATUS.FAILURE)
+        self.assertEqual(VoIPCall.objects.count(), count_voipcall + 1)
+        self.assertEqual(VoIPCall.objects.filter(callrequest=stolen).count(), 0)
+        # only the committed call leaves the calling gauge, the page processed twice counts once
+        self.assertEqual(cache.get(calling_key), 1)
+        cursor.execute("SELECT claimed_by, status FROM call_event WHERE id = %s", [stolen_event_id])
+        self.assertEqual(cursor.fetchone(), ('host2:1', CALLEVENT_STATUS.CLAIMED))
+
+    @skipUnless(connection.vendor == 'postgresql', 'call_event is claimed with SKIP LOCKED on PostgreSQL')
+    def test_callevent_listener_drain(self):
+        """Test that the listener claims the events like callevent_processing
+        and releases them once written."""
+        callrequest = Callrequest.objects.create(
+            status=CALLREQUEST_STATUS.CALLING,
+            user=self.callrequest.user,
+            phone_number='123456',
+            subscriber_id=1,
+            campaign=self.campaign,
+            aleg_gateway_id=1,
+            content_type=self.callrequest.content_type,
+            object_id=1)
+        cursor = connection.cursor()
+        create_call_event_table(cursor)
+        cursor.execute(
+            "INSERT INTO call_event (event_name, body, job_uuid, call_uuid, used_gateway_id, callrequest_id, "
+            "alarm_request_id, callerid, phonenumber, duration, billsec, hangup_cause, hangup_cause_q850, "
+            "amd_status, leg, starting_date, status, created_date) "
+            "VALUES ('CHANNEL_HANGUP_COMPLETE', '', %s, %s, 1, %s, 0, '', '', 30, 20, 'NORMAL_CLEARING', '16', "
+            "'person', 'aleg', now(), 1, now())", [str(uuid1()), str(uuid1()), callrequest.id])
+
+        listener = CallEventListener(batch_size=10)
+        self.assertEqual(listener.drain_once(), 1)
+        self.assertEqual(Callrequest.objects.get(pk=callrequest.id).status, CALLREQUEST_STATUS.SUCCESS)
+        cursor.execute("SELECT status FROM call_event WHERE callrequest_id = %s", [callrequest.id])
+        self.assertEqual(cursor.fetchone()[0], CALLEVENT_STATUS.PROCESSED)
+        self.assertEqual(listener.drain_once(), 0)
+
+    @skipUnless(connection.vendor == 'postgresql', 'call_event is claimed with SKIP LOCKED on PostgreSQL')
+    @override_settings(CALLEVENT_MAX_ATTEMPTS=2)
+    def test_callevent_listener_failed_event(self):
+        """Test that an event failing on its own doesn't hold back the
+        others of its batch, and is left with the FAILED status."""
+        (good, bad) = [Callrequest.objects.create(
+            status=CALLREQUEST_STATUS.CALLING,
+            user=self.callrequest.user,
+            phone_number='123456',
+            subscriber_id=1,
+            campaign=self.campaign,
+            aleg_gateway_id=1,
+            content_type=self.callrequest.content_type,
+            object_id=1) for count in range(2)]
+        cursor = connection.cursor()
+        create_call_event_table(cursor)
+        for callrequest in (good, bad):
+            cursor.execute(
+                "INSERT INTO call_event (event_name, body, job_uuid, call_uuid, used_gateway_id, callrequest_id, "
+                "alarm_request_id, callerid, phonenumber, duration, billsec, hangup_cause, hangup_cause_q850, "
+                "amd_status, leg, starting_date, status, created_date) "
+                "VALUES ('CHANNEL_HANGUP_COMPLETE', '', %s, %s, 1, %s, 0, '', '', 30, 20, 'USER_BUSY', '16', "
+                "'person', 'aleg', now(), 1, now())", [str(uuid1()), str(uuid1()), callrequest.id])
+        commit = CallEventBatch.commit
+
+        def commit_or_fail(batch):
+            if bad.id in batch.changed_callrequest:
+                raise ValueError('bad event')
+            return commit(batch)
+
+        CallEventBatch.commit = commit_or_fail
+        try:
+            listener = CallEventListener(batch_size=10)
+            self.assertEqual(listener.drain_once(), 2)
+            # the failed event went back to pending for a second attempt
+            self.assertEqual(listener.drain_once(), 1)
+            self.assertEqual(listener.drain_once(), 0)
+        finally:
+            CallEventBatch.commit = commit
+
+        self.assertEqual(Callrequest.objects.get(pk=good.id).status, CALLREQUEST_STATUS.FAILURE)
+        self.assertEqual(Callrequest.objects.get(pk=bad.id).status, CALLREQUEST_STATUS.CALLING)
+        cursor.execute("SELECT callrequest_id, status FROM call_event ORDER BY id")
+        self.assertEqual(cursor.fetchall(), [(good.id, CALLEVENT_STATUS.PROCESSED),
+                                             (bad.id, CALLEVENT_STATUS.FAILED)])
+
     # def test_init_callrequest(self):
     #    """Test that the ``init_callrequest``
     #    task runs with no errors, and returns the correct result."""
@@ -212,6 +867,21 @@ class DialerCdrModel(TestCase):
         self.voipcall.duration = 12
         self.voipcall.min_duration()
 
+    def test_claim_due_retries(self):
+        due = copy_callrequest(self.callrequest, 0)
+        due.save()
+        later = copy_callrequest(self.callrequest, 3600)
+        later.save()
+        self.assertEqual(due.status, CALLREQUEST_STATUS.RETRY)
+        self.assertEqual(due.parent_callrequest_id, self.callrequest.id)
+
+        list_retry = Callrequest.objects.claim_due_retries(1, 10)
+        self.assertEqual([cr.id for cr in list_retry], [due.id])
+        self.assertEqual(list_retry[0].status, CALLREQUEST_STATUS.PENDING)
+        self.assertEqual(Callrequest.objects.get(pk=later.id).status, CALLREQUEST_STATUS.RETRY)
+        self.assertEqual(Callrequest.objects.claim_due_retries(1, 10), [])
+        self.assertEqual(Callrequest.objects.claim_due_retries(1, 0), [])
+
     def teardown(self):
         self.callrequest.delete()
         self.voipcall.delete()
@@ -0,0 +1,274 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Tracing of the call lifecycle.
+
+The timestamps of a call are the ones already stored along the way,
+correlated by callrequest id:
+
+    call_time          the callrequest is spooled and due (Callrequest)
+    init_callrequest   the originate task starts
+    last_attempt_time  the bgapi originate is sent (Callrequest)
+    starting_date      FreeSWITCH creates the channel (call_event)
+    answer             starting_date + duration - billsec
+    hangup             starting_date + duration
+    created_date       listener.lua inserts the call_event
+    CDR write          the call event is processed
+
+The latency of each stage, and the SQL queries of the stages run in
+Python, go to per-process histograms flushed to the cache every
+CALL_TRACING_FLUSH seconds, get_trace_stats adds up all the processes.
+Nothing is recorded unless CALL_TRACING is set.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import connection, reset_queries
+from celery.utils.log import get_task_logger
+from bisect import bisect_left
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+from django.utils.timezone import utc
+import time
+
+logger = get_task_logger(__name__)
+
+STAGE_SPOOL = 'spool'
+STAGE_ETA_WAIT = 'eta_wait'
+STAGE_INIT = 'init_callrequest'
+STAGE_BGAPI = 'bgapi'
+STAGE_CHANNEL = 'channel'
+STAGE_RING = 'ring'
+STAGE_CALL_EVENT = 'call_event'
+STAGE_PROCESS = 'process_callevent'
+# processing of a page of call events, timed per page
+STAGE_CDR_WRITE = 'cdr_write'
+
+STAGES = [STAGE_SPOOL, STAGE_ETA_WAIT, STAGE_INIT, STAGE_BGAPI, STAGE_CHANNEL, STAGE_RING,
+          STAGE_CALL_EVENT, STAGE_PROCESS, STAGE_CDR_WRITE]
+
+# Upper bounds in seconds of the histogram buckets, the last bucket is +Inf
+BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300)
+
+TRACE_KEY_EXPIRE = 60 * 60 * 24 * 30
+
+
+def get_trace_key(stage, name):
+    return 'call_trace_%s_%s' % (stage, name)
+
+
+class LatencyHistogram(object):
+
+    """Count of the latencies per bucket, with their number and sum"""
+
+    def __init__(self, buckets=BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+
+    def observe(self, seconds):
+        self.counts[bisect_left(self.buckets, seconds)] += 1
+        self.count += 1
+        self.sum += seconds
+
+    def cumulative(self):
+        """Return the (upper bound, count of latencies lower or equal) of the buckets"""
+        result = []
+        total = 0
+        for (bound, count) in zip(list(self.buckets) + ['+Inf'], self.counts):
+            total += count
+            result.append((bound, total))
+        return result
+
+
+class CallTracer(object):
+
+    """
+    CallTracer holds the latencies and query counts of the stages run
+    by the current process since its last flush to the cache
+
+    - observe : add the latency of a stage
+    - flush : add the counters to the ones of the cache
+    """
+
+    def __init__(self, flush_interval=None):
+        if flush_interval is None:
+            flush_interval = getattr(settings, 'CALL_TRACING_FLUSH', 10)
+        self.flush_interval = flush_interval
+        self.last_flush = time.time()
+        self.reset()
+
+    def reset(self):
+        self.histograms = {}
+        self.queries = {}
+        self.runs = {}
+
+    def observe(self, stage, seconds, queries=None):
+        if seconds < 0:
+            # clocks of the dialer node and the database are not in sync
+            seconds = 0
+        histogram = self.histograms.get(stage)
+        if histogram is None:
+            histogram = self.histograms[stage] = LatencyHistogram()
+        histogram.observe(seconds)
+        if queries is not None:
+            self.queries[stage] = self.queries.get(stage, 0) + queries
+            self.runs[stage] = self.runs.get(stage, 0) + 1
+
+    def get_counters(self):
+        """Return the {cache key: value to add} of the counters"""
+        counters = {}
+        for (stage, histogram) in self.histograms.items():
+            for (position, count) in enumerate(histogram.counts):
+                if count:
+                    counters[get_trace_key(stage, 'bucket_%d' % position)] = count
+            counters[get_trace_key(stage, 'count')] = histogram.count
+            # cache.incr only handles integers
+            counters[get_trace_key(stage, 'sum_ms')] = int(round(histogram.sum * 1000))
+        for (stage, queries) in self.queries.items():
+            counters[get_trace_key(stage, 'queries')] = queries
+            counters[get_trace_key(stage, 'runs')] = self.runs[stage]
+        return counters
+
+    def flush(self):
+        for (key, value) in self.get_counters().items():
+            cache.add(key, 0, TRACE_KEY_EXPIRE)
+            try:
+                cache.incr(key, value)
+            except ValueError:
+                # expired between add and incr
+                cache.set(key, value, TRACE_KEY_EXPIRE)
+        self.reset()
+        self.last_flush = time.time()
+
+    def maybe_flush(self):
+        if time.time() - self.last_flush >= self.flush_interval:
+            self.flush()
+
+
+_tracer = CallTracer()
+_depth = [0]
+
+
+def get_call_tracer():
+    return _tracer
+
+
+def is_tracing():
+    return getattr(settings, 'CALL_TRACING', False)
+
+
+def observe_stage(stage, seconds):
+    """Add the latency of a stage measured elsewhere"""
+    if not is_tracing():
+        return
+    _tracer.observe(stage, seconds)
+    _tracer.maybe_flush()
+
+
+@contextmanager
+def trace_stage(stage):
+    """Time the block and count its SQL queries as ``stage``"""
+    if not is_tracing():
+        yield
+        return
+    # the queries are only logged by the debug cursor, turned back off
+    # by the outermost traced block
+    use_debug_cursor = connection.use_debug_cursor
+    connection.use_debug_cursor = True
+    first_query = len(connection.queries)
+    start = time.time()
+    _depth[0] += 1
+    try:
+        yield
+    finally:
+        _depth[0] -= 1
+        _tracer.observe(stage, time.time() - start, len(connection.queries) - first_query)
+        if _depth[0] == 0:
+            connection.use_debug_cursor = use_debug_cursor
+            reset_queries()
+            _tracer.maybe_flush()
+
+
+def trace_callevent(callrequest, event, written=None):
+    """
+    Add the latencies of the stages ending with the call event of a
+    callrequest, and log its timeline
+    """
+    if not is_tracing():
+        return
+    if written is None:
+        written = datetime.utcnow().replace(tzinfo=utc)
+    timeline = [('call_time', callrequest.call_time),
+                ('bgapi', callrequest.last_attempt_time)]
+    starting_date = event['starting_date']
+    if starting_date:
+        hangup = starting_date + timedelta(seconds=event['duration'] or 0)
+        timeline.append(('channel', starting_date))
+        if event['billsec']:
+            answer = hangup - timedelta(seconds=event['billsec'])
+            timeline.append(('answer', answer))
+            _tracer.observe(STAGE_RING, (answer - starting_date).total_seconds())
+        if callrequest.last_attempt_time:
+            _tracer.observe(STAGE_CHANNEL, (starting_date - callrequest.last_attempt_time).total_seconds())
+        timeline.append(('hangup', hangup))
+        if event['created_date']:
+            _tracer.observe(STAGE_CALL_EVENT, (event['created_date'] - hangup).total_seconds())
+    if event['created_date']:
+        timeline.append(('call_event', event['created_date']))
+        _tracer.observe(STAGE_PROCESS, (written - event['created_date']).total_seconds())
+    timeline.append(('cdr', written))
+    logger.info('trace callrequest_id=%d leg=%s %s' % (
+        callrequest.id, event['leg'],
+        ' '.join(['%s=%s' % (name, value.isoformat()) for (name, value) in timeline if value])))
+
+
+def get_percentile(buckets, count, percent):
+    """Upper bound of the bucket holding the ``percent`` percentile"""
+    if not count:
+        return None
+    for (bound, total) in buckets:
+        if total >= count * percent / 100.0:
+            return bound
+    return '+Inf'
+
+
+def get_trace_stats():
+    """
+    Return the counters of all the processes by stage : the cumulative
+    histogram buckets, the count and sum of the latencies and the SQL
+    queries per run
+    """
+    keys = []
+    for stage in STAGES:
+        keys.extend([get_trace_key(stage, 'bucket_%d' % position) for position in range(len(BUCKETS) + 1)])
+        keys.extend([get_trace_key(stage, name) for name in ('count', 'sum_ms', 'queries', 'runs')])
+    values = cache.get_many(keys)
+    stats = {}
+    for stage in STAGES:
+        histogram = LatencyHistogram()
+        histogram.counts = [values.get(get_trace_key(stage, 'bucket_%d' % position), 0)
+                            for position in range(len(BUCKETS) + 1)]
+        histogram.count = values.get(get_trace_key(stage, 'count'), 0)
+        histogram.sum = values.get(get_trace_key(stage, 'sum_ms'), 0) / 1000.0
+        stats[stage] = {
+            'buckets': histogram.cumulative(),
+            'count': histogram.count,
+            'sum': histogram.sum,
+            'queries': values.get(get_trace_key(stage, 'queries'), 0),
+            'runs': values.get(get_trace_key(stage, 'runs'), 0),
+        }
+    return stats
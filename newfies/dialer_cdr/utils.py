@@ -14,12 +14,65 @@
 
 from dialer_cdr.models import VoIPCall
 from dialer_cdr.constants import VOIPCALL_AMD_STATUS, LEG_TYPE
+from dialer_cdr.disposition import get_disposition
+from dialer_cdr.prefix_index import get_dialcode
+from mod_metrics import metrics
 from celery.utils.log import get_task_logger
-# from dialer_cdr.function_def import get_prefix_obj
 
 logger = get_task_logger(__name__)
 
 
+def build_voipcall(callrequest, request_uuid, leg='aleg', hangup_cause='',
+                   hangup_cause_q850='', callerid='', phonenumber='', starting_date='',
+                   call_uuid='', duration=0, billsec=0, amd_status='person'):
+    """
+    Return the VoIPCall (CDR) of a call, not saved yet,
+    the disposition is looked up from the hangup cause
+    and the dialcode from the in-memory prefix index
+    """
+    used_gateway = callrequest.aleg_gateway
+    # Set Leg Type
+    if leg == 'aleg':
+        leg_type = LEG_TYPE.A_LEG
+    else:
+        leg_type = LEG_TYPE.B_LEG
+        # This code is useful if we want to let the survey editor select the gateway
+        # if callrequest.content_object.__class__.__name__ == 'Survey':
+        #     #Get the gateway from the App
+        #     used_gateway = callrequest.content_object.gateway
+    # Set AMD status
+    if amd_status == 'machine':
+        amd_status_id = VOIPCALL_AMD_STATUS.MACHINE
+    else:
+        amd_status_id = VOIPCALL_AMD_STATUS.PERSON
+
+    logger.debug('Create CDR - request_uuid=%s;leg=%d;hangup_cause=%s;billsec=%s;amd_status=%s' %
+                 (request_uuid, leg_type, hangup_cause, str(billsec), amd_status))
+
+    (disposition, disposition_code) = get_disposition(hangup_cause, hangup_cause_q850)
+    # Get the first word only
+    hangup_cause = (hangup_cause.split() or [''])[0]
+
+    return VoIPCall(
+        user_id=callrequest.user_id,
+        request_uuid=request_uuid,
+        leg_type=leg_type,
+        used_gateway=used_gateway,
+        callrequest_id=callrequest.id,
+        callid=call_uuid,
+        callerid=callerid,
+        phone_number=phonenumber,
+        dialcode_id=get_dialcode(phonenumber),
+        starting_date=starting_date,
+        duration=duration,
+        billsec=billsec,
+        disposition=disposition,
+        disposition_code=disposition_code,
+        hangup_cause=hangup_cause,
+        hangup_cause_q850=hangup_cause_q850,
+        amd_status=amd_status_id)
+
+
 class BufferVoIPCall:
 
     """
@@ -39,78 +92,24 @@ class BufferVoIPCall:
         """
         Save voip call into buffer
         """
-        if leg == 'aleg':
-            # A-Leg
-            leg_type = LEG_TYPE.A_LEG
-            used_gateway = obj_callrequest.aleg_gateway
-        else:
-            # B-Leg
-            leg_type = LEG_TYPE.B_LEG
-            used_gateway = obj_callrequest.aleg_gateway
-            # This code is useful if we want to let the survey editor select the gateway
-            # if obj_callrequest.content_object.__class__.__name__ == 'Survey':
-            #     #Get the gateway from the App
-            #     used_gateway = obj_callrequest.content_object.gateway
-            # else:
-            #     #Survey
-            #     used_gateway = obj_callrequest.aleg_gateway
-        if amd_status == 'machine':
-            amd_status_id = VOIPCALL_AMD_STATUS.MACHINE
-        else:
-            amd_status_id = VOIPCALL_AMD_STATUS.PERSON
-
-        logger.debug('Create CDR - request_uuid=%s;leg=%d;hangup_cause=%s;billsec=%s;amd_status=%s' %
-                     (request_uuid, leg_type, hangup_cause, str(billsec), amd_status))
-
-        # Get the first word only
-        hangup_cause = hangup_cause.split()[0]
-
-        if hangup_cause == 'NORMAL_CLEARING' or hangup_cause == 'ALLOTTED_TIMEOUT':
-            hangup_cause = 'ANSWER'
-
-        if hangup_cause == 'ANSWER':
-            disposition = 'ANSWER'
-        elif hangup_cause == 'USER_BUSY':
-            disposition = 'BUSY'
-        elif hangup_cause == 'NO_ANSWER':
-            disposition = 'NOANSWER'
-        elif hangup_cause == 'ORIGINATOR_CANCEL':
-            disposition = 'CANCEL'
-        elif hangup_cause == 'NORMAL_CIRCUIT_CONGESTION':
-            disposition = 'CONGESTION'
-        else:
-            disposition = 'FAILED'
-
-        # Note: Removed for test performance
-        # Note: Look at prefix PG module : https://github.com/dimitri/prefix
-        #prefix_obj = get_prefix_obj(phonenumber)
-
         # Save this for bulk saving
-        self.list_voipcall.append(
-            VoIPCall(
-                user_id=obj_callrequest.user_id,
-                request_uuid=request_uuid,
-                leg_type=leg_type,
-                used_gateway=used_gateway,
-                callrequest_id=obj_callrequest.id,
-                callid=call_uuid,
-                callerid=callerid,
-                phone_number=phonenumber,
-                # dialcode=prefix_obj,
-                starting_date=starting_date,
-                duration=duration,
-                billsec=billsec,
-                disposition=disposition,
-                hangup_cause=hangup_cause,
-                hangup_cause_q850=hangup_cause_q850,
-                amd_status=amd_status_id)
-        )
+        self.list_voipcall.append(build_voipcall(
+            obj_callrequest, request_uuid, leg=leg, hangup_cause=hangup_cause,
+            hangup_cause_q850=hangup_cause_q850, callerid=callerid, phonenumber=phonenumber,
+            starting_date=starting_date, call_uuid=call_uuid, duration=duration, billsec=billsec,
+            amd_status=amd_status))
 
     def commit(self):
         """
         function to create CDR / VoIP Call
         """
         VoIPCall.objects.bulk_create(self.list_voipcall)
+        count_disposition = {}
+        for voipcall in self.list_voipcall:
+            count_disposition[voipcall.disposition] = count_disposition.get(voipcall.disposition, 0) + 1
+        for (disposition, count) in count_disposition.items():
+            metrics.inc('newfies_cdr_total', count, disposition=disposition)
+        self.list_voipcall = []
 
 
 def voipcall_save(callrequest, request_uuid, leg='aleg', hangup_cause='',
@@ -120,59 +119,10 @@ def voipcall_save(callrequest, request_uuid, leg='aleg', hangup_cause='',
     This task will save the voipcall(CDR) to the DB,
     it will also reformat the disposition
     """
-    # TODO: following code is duplicated, see above
-
-    used_gateway = callrequest.aleg_gateway
-    # Set Leg Type
-    if leg == 'aleg':
-        leg_type = LEG_TYPE.A_LEG
-    else:
-        leg_type = LEG_TYPE.B_LEG
-    # Set AMD status
-    if amd_status == 'machine':
-        amd_status_id = VOIPCALL_AMD_STATUS.MACHINE
-    else:
-        amd_status_id = VOIPCALL_AMD_STATUS.PERSON
-
-    logger.debug('Create CDR - request_uuid=%s;leg=%d;hangup_cause=%s;billsec=%s;amd_status=%s' %
-                 (request_uuid, leg_type, hangup_cause, str(billsec), amd_status))
-
-    # Get the first word only
-    hangup_cause = hangup_cause.split()[0]
-
-    if hangup_cause == 'NORMAL_CLEARING' or hangup_cause == 'ALLOTTED_TIMEOUT':
-        disposition = 'ANSWER'
-    elif hangup_cause == 'USER_BUSY':
-        disposition = 'BUSY'
-    elif hangup_cause == 'NO_ANSWER':
-        disposition = 'NOANSWER'
-    elif hangup_cause == 'ORIGINATOR_CANCEL':
-        disposition = 'CANCEL'
-    elif hangup_cause == 'NORMAL_CIRCUIT_CONGESTION':
-        disposition = 'CONGESTION'
-    else:
-        disposition = 'FAILED'
-
-    # Note: Removed for test performance
-    # Note: Look at prefix PG module : https://github.com/dimitri/prefix
-    #prefix_obj = get_prefix_obj(phonenumber)
-
-    # Save the VoIPCall
-    new_voipcall = VoIPCall(
-        user_id=callrequest.user_id,
-        request_uuid=request_uuid,
-        leg_type=leg_type,
-        used_gateway=used_gateway,
-        callrequest_id=callrequest.id,
-        callid=call_uuid,
-        callerid=callerid,
-        phone_number=phonenumber,
-        # dialcode=prefix_obj,
-        starting_date=starting_date,
-        duration=duration,
-        billsec=billsec,
-        disposition=disposition,
-        hangup_cause=hangup_cause,
-        hangup_cause_q850=hangup_cause_q850,
-        amd_status=amd_status_id)
+    new_voipcall = build_voipcall(
+        callrequest, request_uuid, leg=leg, hangup_cause=hangup_cause,
+        hangup_cause_q850=hangup_cause_q850, callerid=callerid, phonenumber=phonenumber,
+        starting_date=starting_date, call_uuid=call_uuid, duration=duration, billsec=billsec,
+        amd_status=amd_status)
     new_voipcall.save()
+    metrics.inc('newfies_cdr_total', disposition=new_voipcall.disposition)
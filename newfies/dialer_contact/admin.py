@@ -23,6 +23,7 @@ from django.shortcuts import render_to_response
 
 from dialer_contact.models import Phonebook, Contact
 from dialer_contact.forms import Contact_fileImport
+from dialer_contact.ingest import bulk_create_contacts
 from dialer_campaign.function_def import check_dialer_setting, dialer_setting_limit
 from user_profile.constants import NOTIFICATION_NAME
 from frontend_notification.views import frontend_send_notification
@@ -196,11 +197,11 @@ class ContactAdmin(admin.ModelAdmin):
 
                 if contact_cnt % BULK_SIZE == 0:
                     # Bulk insert
-                    Contact.objects.bulk_create(bulk_record)
+                    bulk_create_contacts(bulk_record)
                     bulk_record = []
 
             # remaining record
-            Contact.objects.bulk_create(bulk_record)
+            bulk_create_contacts(bulk_record)
             bulk_record = []
 
             # check if there is contact imported
@@ -21,6 +21,13 @@ class CONTACT_STATUS(Choice):
     INACTIVE = 0, _('inactive')
 
 
+class IMPORT_STATUS(Choice):
+    PENDING = 1, _('pending')
+    RUNNING = 2, _('running')
+    SUCCESS = 3, _('success')
+    FAILURE = 4, _('failure')
+
+
 class CHOICE_TYPE(Choice):
     CONTAINS = 1, _('contains')
     EQUALS = 2, _('equals')
@@ -0,0 +1,296 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Import of the contact CSV files.
+
+The upload is written to disk by the view and read back by the
+import_contact_file task as a stream of rows, validated by chunk of
+CONTACT_IMPORT_CHUNK rows. On PostgreSQL each chunk is loaded with COPY
+into a temporary staging table and moved to dialer_contact with a single
+INSERT ... SELECT, elsewhere with bulk_create, along with the E.164 form
+of their numbers, then the new contacts go through the contact ingest.
+The rows in error are written to a CSV report with their line number
+and the reason.
+"""
+
+from django.conf import settings
+from django.core.exceptions import ValidationError
+from django.core.validators import validate_email
+from django.db import connection, transaction
+from django.db.models import Q
+from django_lets_go.common_functions import striplist
+from dialer_contact.constants import CONTACT_STATUS, IMPORT_STATUS
+from dialer_contact.models import Phonebook, Contact, ContactImport
+from dialer_contact.ingest import ingest_contacts, bulk_create_contacts
+from dialer_contact.phonenumber import to_e164_list
+from cStringIO import StringIO
+from itertools import islice
+from uuid import uuid1
+import csv
+import json
+import os
+
+# col_no - field name
+#  0     - contact
+#  1     - last_name
+#  2     - first_name
+#  3     - email
+#  4     - description
+#  5     - status
+#  6     - address
+#  7     - city
+#  8     - state
+#  9     - country
+# 10     - unit_number
+# 11     - additional_vars
+CONTACT_COLUMNS = ['contact', 'last_name', 'first_name', 'email', 'description', 'status',
+                   'address', 'city', 'state', 'country', 'unit_number', 'additional_vars']
+
+
+def save_upload(uploaded_file, directory=None):
+    """Write the uploaded file to disk chunk by chunk, return its path"""
+    directory = directory or settings.CONTACT_IMPORT_DIR
+    if not os.path.isdir(directory):
+        os.makedirs(directory)
+    path = os.path.join(directory, '%s.csv' % uuid1())
+    with open(path, 'wb') as destination:
+        for chunk in uploaded_file.chunks():
+            destination.write(chunk)
+    return path
+
+
+def count_lines(path):
+    with open(path, 'rb') as csv_file:
+        return sum(1 for line in csv_file)
+
+
+def read_rows(csv_file):
+    """Yield the (line number, row) of a pipe separated file, the blank rows are skipped"""
+    reader = csv.reader(csv_file, delimiter='|', quotechar='"')
+    for row in reader:
+        row = striplist(row)
+        if any(row):
+            yield (reader.line_num, row)
+
+
+def get_max_length(field_name):
+    return Contact._meta.get_field(field_name).max_length
+
+
+def validate_row(row):
+    """
+    Return the (values, error) of a row, the values are in the order of
+    CONTACT_COLUMNS and None if the row is not valid
+    """
+    row = list(row[:len(CONTACT_COLUMNS)])
+    row.extend([''] * (len(CONTACT_COLUMNS) - len(row)))
+    values = dict(zip(CONTACT_COLUMNS, row))
+
+    if not values['contact']:
+        return (None, 'missing contact number')
+    for field_name in ['contact', 'last_name', 'first_name', 'email', 'address', 'city', 'state',
+                       'unit_number']:
+        if len(values[field_name]) > get_max_length(field_name):
+            return (None, 'value too long for %s' % field_name)
+
+    if values['status'] == '':
+        values['status'] = CONTACT_STATUS.ACTIVE
+    else:
+        try:
+            values['status'] = int(values['status'])
+        except ValueError:
+            values['status'] = None
+        if values['status'] not in (CONTACT_STATUS.ACTIVE, CONTACT_STATUS.INACTIVE):
+            return (None, 'invalid status, it needs to be 1 (active) or 0 (inactive)')
+
+    if values['email']:
+        try:
+            validate_email(values['email'])
+        except ValidationError:
+            return (None, 'invalid email')
+
+    if len(values['country']) > 2:
+        return (None, 'invalid country code, it needs to be a valid ISO 3166-1 alpha-2 code')
+    values['country'] = values['country'].upper()
+
+    if values['additional_vars']:
+        try:
+            values['additional_vars'] = json.loads(values['additional_vars'])
+        except ValueError:
+            return (None, 'invalid additional variables, it needs to be JSON')
+    else:
+        values['additional_vars'] = None
+
+    return ([values[field_name] for field_name in CONTACT_COLUMNS], None)
+
+
+def validate_record(record):
+    """
+    Return the (values, error) of a contact given as a dict keyed by the
+    names of CONTACT_COLUMNS, as validate_row
+    """
+    if not isinstance(record, dict):
+        return (None, 'a contact needs to be a JSON object')
+    row = []
+    for field_name in CONTACT_COLUMNS:
+        value = record.get(field_name)
+        if value is None:
+            value = ''
+        elif field_name == 'additional_vars' and not isinstance(value, basestring):
+            value = json.dumps(value)
+        elif isinstance(value, unicode):
+            value = value.encode('utf-8')
+        row.append(str(value).strip())
+    return validate_row(row)
+
+
+def copy_escape(value):
+    """Format a value for the text format of COPY"""
+    if value is None:
+        return '\\N'
+    if isinstance(value, unicode):
+        value = value.encode('utf-8')
+    return str(value).replace('\\', '\\\\').replace('\t', '\\t').replace('\n', '\\n').replace('\r', '\\r')
+
+
+def get_e164_values(phonebook_id, list_values):
+    """E.164 forms of the numbers of the validated contacts of a phonebook"""
+    user_id = Phonebook.objects.filter(pk=phonebook_id).values_list('user_id', flat=True)[0]
+    country_position = CONTACT_COLUMNS.index('country')
+    return to_e164_list([values[0] for values in list_values], user_id=user_id,
+                        list_country=[values[country_position] for values in list_values])
+
+
+def copy_contacts(phonebook_id, list_values):
+    """Load the contacts with COPY into a staging table merged into dialer_contact"""
+    buffer = StringIO()
+    for (values, e164) in zip(list_values, get_e164_values(phonebook_id, list_values)):
+        values = list(values)
+        if values[-1] is not None:
+            values[-1] = json.dumps(values[-1])
+        values.append(e164)
+        buffer.write('\t'.join([copy_escape(value) for value in values]) + '\n')
+    buffer.seek(0)
+    columns = ', '.join(CONTACT_COLUMNS + ['e164'])
+    with transaction.atomic():
+        cursor = connection.cursor()
+        # the staging table has the types of dialer_contact and is dropped on commit
+        cursor.execute("CREATE TEMP TABLE contact_import_staging ON COMMIT DROP AS "
+                       "SELECT %s FROM dialer_contact WITH NO DATA" % columns)
+        cursor.copy_expert("COPY contact_import_staging (%s) FROM STDIN" % columns, buffer)
+        cursor.execute("INSERT INTO dialer_contact (phonebook_id, %s, created_date, updated_date) "
+                       "SELECT %%s, %s, NOW(), NOW() FROM contact_import_staging RETURNING id" % (columns, columns),
+                       [phonebook_id])
+        list_contact_id = [row[0] for row in cursor.fetchall()]
+        # dropped now as well, the import can run in an outer transaction
+        cursor.execute("DROP TABLE contact_import_staging")
+    ingest_contacts(list_contact_id)
+    return len(list_contact_id)
+
+
+def create_contacts(phonebook_id, list_values):
+    return bulk_create_contacts([Contact(phonebook_id=phonebook_id, **dict(zip(CONTACT_COLUMNS, values)))
+                                 for values in list_values])
+
+
+def load_contacts(phonebook_id, list_values):
+    """
+    Insert the validated contacts in the phonebook and add them to the
+    running campaigns, return the number of contacts created
+    """
+    if connection.vendor == 'postgresql':
+        return copy_contacts(phonebook_id, list_values)
+    return create_contacts(phonebook_id, list_values)
+
+
+def get_existing_contacts(user_id, list_contact):
+    """
+    Return the set of the numbers of ``list_contact`` already in a phonebook
+    of the user, the numbers are compared raw and to the E.164 forms
+    """
+    if not list_contact:
+        return set()
+    list_contact = list(list_contact)
+    existing = set()
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        # a single query whatever the number of contacts, the list is sent as an array
+        cursor.execute("SELECT DISTINCT c.contact, c.e164 FROM dialer_contact c "
+                       "JOIN dialer_phonebook p ON p.id = c.phonebook_id "
+                       "WHERE p.user_id = %s AND (c.contact = ANY(%s) OR c.e164 = ANY(%s))",
+                       [user_id, list_contact, list_contact])
+        for row in cursor.fetchall():
+            existing.update(row)
+    else:
+        # keep the IN lists under the SQLite limit of parameters
+        for position in range(0, len(list_contact), 250):
+            chunk = list_contact[position:position + 250]
+            for row in Contact.objects.filter(Q(contact__in=chunk) | Q(e164__in=chunk), phonebook__user_id=user_id)\
+                    .values_list('contact', 'e164'):
+                existing.update(row)
+    return existing.intersection(list_contact)
+
+
+def import_contacts(contact_import, chunk_size=None):
+    """
+    Import the CSV file of a ContactImport, its counters are updated
+    after each chunk so the progress can be polled
+    """
+    chunk_size = chunk_size or settings.CONTACT_IMPORT_CHUNK
+    counters = {
+        'total_rows': count_lines(contact_import.csv_path),
+        'processed_rows': 0,
+        'imported_rows': 0,
+        'error_rows': 0,
+    }
+    ContactImport.objects.filter(pk=contact_import.id).update(status=IMPORT_STATUS.RUNNING, **counters)
+
+    error_path = contact_import.csv_path[:-len('.csv')] + '.errors.csv'
+    error_writer = None
+    status = IMPORT_STATUS.FAILURE
+    try:
+        with open(contact_import.csv_path, 'rb') as csv_file:
+            rows = read_rows(csv_file)
+            while True:
+                chunk = list(islice(rows, chunk_size))
+                if not chunk:
+                    break
+                list_values = []
+                for (line, row) in chunk:
+                    (values, error) = validate_row(row)
+                    if error:
+                        if error_writer is None:
+                            error_file = open(error_path, 'wb')
+                            error_writer = csv.writer(error_file)
+                            error_writer.writerow(['line', 'error', 'row'])
+                        error_writer.writerow([line, error, '|'.join(row)])
+                        counters['error_rows'] += 1
+                    else:
+                        list_values.append(values)
+                if list_values:
+                    counters['imported_rows'] += load_contacts(contact_import.phonebook_id, list_values)
+                counters['processed_rows'] += len(chunk)
+                ContactImport.objects.filter(pk=contact_import.id).update(**counters)
+        status = IMPORT_STATUS.SUCCESS
+    finally:
+        # a failed import keeps the counters and the report of the rows processed
+        if error_writer is not None:
+            error_file.close()
+            counters['error_path'] = error_path
+        ContactImport.objects.filter(pk=contact_import.id).update(status=status, **counters)
+        # the report of the errors is kept, the upload is no longer needed
+        if os.path.exists(contact_import.csv_path):
+            os.remove(contact_import.csv_path)
+    return counters
@@ -0,0 +1,207 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Subscription of the new contacts to the running campaigns.
+
+Whatever the path creating the contacts (a form, the API, the CSV import
+or the bulk API), their ids go through ingest_contacts, which resolves
+the running voice and SMS campaigns of their phonebooks and inserts the
+subscribers with one statement per campaign type and batch.
+
+The post_save signal of Contact sends the contacts saved one by one, in
+a contact_batch block they are only collected and ingested together at
+the end of the block.
+"""
+
+from django.db import connection
+from django.db.models import F, Max
+from celery.utils.log import get_task_logger
+from dialer_contact.constants import CONTACT_STATUS
+from dialer_contact.models import Contact, Phonebook
+from dialer_contact.phonenumber import to_e164_list
+from mod_metrics import metrics
+from contextlib import contextmanager
+import threading
+
+logger = get_task_logger(__name__)
+
+# Contacts per query on the databases without arrays
+INGEST_CHUNK = 500
+
+_batch = threading.local()
+
+
+def get_campaign_types():
+    """
+    Return the (campaign model, subscriber model, campaign field of the
+    subscriber, running status, subscriber status) of the campaign types
+    """
+    from dialer_campaign.models import Campaign, Subscriber
+    from dialer_campaign.constants import CAMPAIGN_STATUS, SUBSCRIBER_STATUS
+    from mod_sms.models import SMSCampaign, SMSCampaignSubscriber
+    from mod_sms.constants import SMS_CAMPAIGN_STATUS, SMS_SUBSCRIBER_STATUS
+    return [
+        (Campaign, Subscriber, 'campaign', CAMPAIGN_STATUS.START, SUBSCRIBER_STATUS.PENDING),
+        (SMSCampaign, SMSCampaignSubscriber, 'sms_campaign', SMS_CAMPAIGN_STATUS.START,
+         SMS_SUBSCRIBER_STATUS.PENDING),
+    ]
+
+
+def subscribe_sql(list_contact_id, campaign_model, subscriber_model, campaign_field, running_status,
+                  subscriber_status):
+    """Insert the subscribers with a single INSERT ... SELECT, return the {campaign_id: count}"""
+    phonebook_field = campaign_model._meta.get_field('phonebook')
+    campaign_column = subscriber_model._meta.get_field(campaign_field).column
+    cursor = connection.cursor()
+    cursor.execute(
+        "WITH new_subscriber AS ("
+        "INSERT INTO %(subscriber_table)s "
+        "(contact_id, %(campaign_column)s, duplicate_contact, status, created_date, updated_date) "
+        "SELECT c.id, cp.%(through_campaign)s, c.contact, %%s, NOW(), NOW() FROM dialer_contact c "
+        "JOIN %(through_table)s cp ON cp.%(through_phonebook)s = c.phonebook_id "
+        "JOIN %(campaign_table)s k ON k.id = cp.%(through_campaign)s "
+        "WHERE c.id = ANY(%%s) AND c.status = %%s AND k.status = %%s "
+        "ON CONFLICT (contact_id, %(campaign_column)s) DO NOTHING "
+        "RETURNING %(campaign_column)s) "
+        "SELECT %(campaign_column)s, count(*) FROM new_subscriber GROUP BY %(campaign_column)s" % {
+            'subscriber_table': subscriber_model._meta.db_table,
+            'campaign_column': campaign_column,
+            'through_table': phonebook_field.m2m_db_table(),
+            'through_campaign': phonebook_field.m2m_column_name(),
+            'through_phonebook': phonebook_field.m2m_reverse_name(),
+            'campaign_table': campaign_model._meta.db_table,
+        },
+        [subscriber_status, list(list_contact_id), CONTACT_STATUS.ACTIVE, running_status])
+    return dict(cursor.fetchall())
+
+
+def subscribe_orm(list_contact_id, campaign_model, subscriber_model, campaign_field, running_status,
+                  subscriber_status):
+    """Insert the subscribers with bulk_create, return the {campaign_id: count}"""
+    list_contact = Contact.objects.filter(id__in=list_contact_id, status=CONTACT_STATUS.ACTIVE)\
+        .values_list('id', 'phonebook_id', 'contact')
+    list_contact = list(list_contact)
+    if not list_contact:
+        return {}
+    campaign_phonebook = {}
+    list_campaign = campaign_model.objects\
+        .filter(status=running_status, phonebook__in=set([item[1] for item in list_contact]))\
+        .values_list('id', 'phonebook')
+    for (campaign_id, phonebook_id) in list_campaign:
+        campaign_phonebook.setdefault(phonebook_id, []).append(campaign_id)
+    if not campaign_phonebook:
+        return {}
+    existing = set(subscriber_model.objects.filter(contact_id__in=[item[0] for item in list_contact])
+                   .values_list('contact_id', '%s_id' % campaign_field))
+    bulk_record = []
+    count_subscriber = {}
+    for (contact_id, phonebook_id, contact) in list_contact:
+        for campaign_id in campaign_phonebook.get(phonebook_id, []):
+            if (contact_id, campaign_id) in existing:
+                continue
+            bulk_record.append(subscriber_model(**{
+                'contact_id': contact_id,
+                '%s_id' % campaign_field: campaign_id,
+                'duplicate_contact': contact,
+                'status': subscriber_status,
+            }))
+            count_subscriber[campaign_id] = count_subscriber.get(campaign_id, 0) + 1
+    subscriber_model.objects.bulk_create(bulk_record)
+    return count_subscriber
+
+
+def ingest_contacts(list_contact_id):
+    """
+    Add the active contacts of ``list_contact_id`` to the subscribers of
+    the running voice and SMS campaigns of their phonebook, return the
+    number of subscribers created
+    """
+    if not list_contact_id:
+        return 0
+    total = 0
+    for (campaign_model, subscriber_model, campaign_field, running_status, subscriber_status) \
+            in get_campaign_types():
+        if connection.vendor == 'postgresql':
+            count_subscriber = subscribe_sql(list_contact_id, campaign_model, subscriber_model, campaign_field,
+                                             running_status, subscriber_status)
+        else:
+            count_subscriber = {}
+            for position in range(0, len(list_contact_id), INGEST_CHUNK):
+                chunk = subscribe_orm(list_contact_id[position:position + INGEST_CHUNK], campaign_model,
+                                      subscriber_model, campaign_field, running_status, subscriber_status)
+                for (campaign_id, count) in chunk.items():
+                    count_subscriber[campaign_id] = count_subscriber.get(campaign_id, 0) + count
+        for (campaign_id, count) in count_subscriber.items():
+            campaign_model.objects.filter(pk=campaign_id).update(totalcontact=F('totalcontact') + count)
+            if campaign_field == 'campaign':
+                metrics.inc('newfies_subscribers_pending', count, campaign_id=campaign_id)
+            total += count
+    return total
+
+
+def contact_created(contact):
+    """Ingest a contact saved on its own, or add it to the current contact_batch"""
+    if contact.status != CONTACT_STATUS.ACTIVE:
+        return
+    list_contact_id = getattr(_batch, 'list_contact_id', None)
+    if list_contact_id is not None:
+        list_contact_id.append(contact.id)
+    else:
+        ingest_contacts([contact.id])
+
+
+@contextmanager
+def contact_batch():
+    """Ingest the contacts created one by one in the block together at its end"""
+    if getattr(_batch, 'list_contact_id', None) is not None:
+        # already in a batch
+        yield
+        return
+    _batch.list_contact_id = []
+    try:
+        yield
+        list_contact_id = _batch.list_contact_id
+    finally:
+        _batch.list_contact_id = None
+    ingest_contacts(list_contact_id)
+
+
+def set_e164(list_contact):
+    """Set the E.164 form of the contacts, done by save but not by bulk_create"""
+    phonebook_contacts = {}
+    for contact in list_contact:
+        phonebook_contacts.setdefault(contact.phonebook_id, []).append(contact)
+    phonebook_user = dict(Phonebook.objects.filter(id__in=phonebook_contacts.keys()).values_list('id', 'user_id'))
+    for (phonebook_id, contacts) in phonebook_contacts.items():
+        list_e164 = to_e164_list([contact.contact for contact in contacts], user_id=phonebook_user.get(phonebook_id),
+                                 list_country=[contact.country for contact in contacts])
+        for (contact, e164) in zip(contacts, list_e164):
+            contact.e164 = e164
+
+
+def bulk_create_contacts(list_contact):
+    """bulk_create the contacts and ingest them, return their number"""
+    if not list_contact:
+        return 0
+    set_e164(list_contact)
+    last_id = Contact.objects.aggregate(Max('id'))['id__max'] or 0
+    Contact.objects.bulk_create(list_contact)
+    # bulk_create does not set the ids, the contacts added meanwhile by others
+    # are ingested again without effect
+    list_contact_id = Contact.objects\
+        .filter(id__gt=last_id, phonebook_id__in=set([contact.phonebook_id for contact in list_contact]))\
+        .values_list('id', flat=True)
+    ingest_contacts(list(list_contact_id))
+    return len(list_contact)
@@ -0,0 +1,101 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.core.management.base import BaseCommand
+from django.db import connection, transaction
+from optparse import make_option
+from dialer_contact.models import Contact
+from dialer_contact.phonenumber import get_phonenumber_rules
+from dnc.models import DNCContact
+from dnc.index import invalidate_dnc_index
+import time
+
+
+def update_e164(model, list_e164):
+    """Write the (id, e164) of ``list_e164``, with a single UPDATE on PostgreSQL"""
+    if not list_e164:
+        return 0
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        cursor.execute("UPDATE %s t SET e164 = v.e164 FROM (VALUES %s) AS v (id, e164) WHERE t.id = v.id" %
+                       (model._meta.db_table, ', '.join(['(%s, %s)'] * len(list_e164))),
+                       [value for row in list_e164 for value in row])
+        return cursor.rowcount
+    with transaction.atomic():
+        for (row_id, e164) in list_e164:
+            model.objects.filter(pk=row_id).update(e164=e164)
+    return len(list_e164)
+
+
+def backfill_e164(model, fields, batch_size=5000, overwrite=False, report=None):
+    """
+    Set the E.164 form of the numbers of ``model`` by batch of ids, the
+    ``fields`` are the (number, country, user id) of the rows, country
+    None if the rows have none. Return the number of rows updated
+    """
+    rules = get_phonenumber_rules()
+    rules.load()
+    queryset = model.objects.all()
+    if not overwrite:
+        queryset = queryset.filter(e164__isnull=True)
+    (number_field, country_field, user_field) = fields
+    columns = ['id', number_field, user_field] + ([country_field] if country_field else [])
+    last_id = 0
+    updated = 0
+    while True:
+        rows = list(queryset.filter(id__gt=last_id).order_by('id').values_list(*columns)[:batch_size])
+        if not rows:
+            break
+        list_e164 = []
+        for row in rows:
+            e164 = rules.to_e164(row[1], row[3] if country_field else None, row[2])
+            if e164 is not None:
+                list_e164.append((row[0], e164))
+        updated += update_e164(model, list_e164)
+        last_id = rows[-1][0]
+        if report:
+            report(last_id, updated)
+    return updated
+
+
+class Command(BaseCommand):
+    args = 'batch, overwrite'
+    help = "Set the E.164 form of the numbers of the existing contacts and DNC contacts\n" \
+           "----------------------------------------------------------------------------\n" \
+           "python manage.py backfill_e164 --batch=5000 [--overwrite]"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--batch', default=5000, dest='batch',
+                    help='rows read per query'),
+        make_option('--overwrite', action='store_true', default=False, dest='overwrite',
+                    help='also recompute the rows which already have an E.164 form'),
+    )
+
+    def handle(self, *args, **options):
+        start = time.time()
+        batch_size = int(options['batch'])
+
+        for (name, model, fields) in [
+                ('contacts', Contact, ('contact', 'country', 'phonebook__user_id')),
+                ('DNC contacts', DNCContact, ('phone_number', None, 'dnc__user_id'))]:
+
+            def report(last_id, updated):
+                print "%s : id %d reached, %d updated (%.1fs)" % (name, last_id, updated, time.time() - start)
+
+            updated = backfill_e164(model, fields, batch_size, options['overwrite'], report)
+            print "%d %s updated in %.1fs" % (updated, name, time.time() - start)
+
+        # the update doesn't touch updated_date, the DNC indexes are fully reloaded
+        for dnc_id in DNCContact.objects.values_list('dnc_id', flat=True).distinct():
+            invalidate_dnc_index(dnc_id)
@@ -14,6 +14,7 @@
 
 from django.core.management.base import BaseCommand
 from dialer_contact.models import Phonebook, Contact
+from dialer_contact.ingest import bulk_create_contacts
 from optparse import make_option
 from django.db import IntegrityError
 from random import choice
@@ -86,7 +87,7 @@ class Command(BaseCommand):
             if k % BULK_SIZE == 0:
                 # Bulk insert
                 try:
-                    Contact.objects.bulk_create(bulk_record)
+                    bulk_create_contacts(bulk_record)
                 except IntegrityError:
                     print "Error : Duplicate contact - %s" % phone_no
                 bulk_record = []
@@ -95,7 +96,7 @@ class Command(BaseCommand):
         if bulk_record:
             # Bulk insert
             try:
-                Contact.objects.bulk_create(bulk_record)
+                bulk_create_contacts(bulk_record)
             except IntegrityError:
                 print "Error : Duplicate contact - %s" % phone_no
 
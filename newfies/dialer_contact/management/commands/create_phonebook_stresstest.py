@@ -14,6 +14,7 @@
 
 from django.core.management.base import BaseCommand
 from dialer_contact.models import Phonebook, Contact
+from dialer_contact.ingest import contact_batch
 from optparse import make_option
 from django.db import IntegrityError
 from random import choice
@@ -61,19 +62,21 @@ class Command(BaseCommand):
                 print "Can't create Phonebook"
                 return False
 
-            for k in range(1, int(amount) + 1):
-                if k % 1000 == 0:
-                    print "%d contacts created..." % k
-                phonenumber = '' . join([choice("1234567890") for i in range(PHONENUMBER_LENGHT)])
+            # the new contacts are sent to the running campaigns at the end
+            with contact_batch():
+                for k in range(1, int(amount) + 1):
+                    if k % 1000 == 0:
+                        print "%d contacts created..." % k
+                    phonenumber = '' . join([choice("1234567890") for i in range(PHONENUMBER_LENGHT)])
 
-                # TODO: Use generate_series to speed up the contact creation
-                # INSERT INTO numbers (num) VALUES ( generate_series(1,1000));
+                    # TODO: Use generate_series to speed up the contact creation
+                    # INSERT INTO numbers (num) VALUES ( generate_series(1,1000));
 
-                try:
-                    Contact.objects.create(
-                        contact=phonenumber + prefix,
-                        phonebook=obj_phonebook)
-                except IntegrityError:
-                    print "Error : Duplicate contact - %s" % phonenumber
+                    try:
+                        Contact.objects.create(
+                            contact=phonenumber + prefix,
+                            phonebook=obj_phonebook)
+                    except IntegrityError:
+                        print "Error : Duplicate contact - %s" % phonenumber
 
             print "\nTotal contacts created : %(count)s" % {'count': amount}
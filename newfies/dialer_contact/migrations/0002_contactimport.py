@@ -0,0 +1,40 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+from django.conf import settings
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('dialer_contact', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ContactImport',
+            fields=[
+                ('id', models.AutoField(verbose_name='ID', serialize=False, auto_created=True, primary_key=True)),
+                ('filename', models.CharField(max_length=250, verbose_name='file')),
+                ('csv_path', models.CharField(max_length=250)),
+                ('error_path', models.CharField(max_length=250, null=True, blank=True)),
+                ('status', models.IntegerField(default=1, verbose_name='status', choices=[(1, 'pending'), (2, 'running'), (3, 'success'), (4, 'failure')])),
+                ('total_rows', models.IntegerField(default=0, verbose_name='total rows')),
+                ('processed_rows', models.IntegerField(default=0, verbose_name='processed rows')),
+                ('imported_rows', models.IntegerField(default=0, verbose_name='imported rows')),
+                ('error_rows', models.IntegerField(default=0, verbose_name='rows in error')),
+                ('created_date', models.DateTimeField(auto_now_add=True, verbose_name='date')),
+                ('updated_date', models.DateTimeField(auto_now=True)),
+                ('phonebook', models.ForeignKey(verbose_name='phonebook', to='dialer_contact.Phonebook')),
+                ('user', models.ForeignKey(related_name='contact_import', to=settings.AUTH_USER_MODEL)),
+            ],
+            options={
+                'db_table': 'dialer_contact_import',
+                'verbose_name': 'contact import',
+                'verbose_name_plural': 'contact imports',
+            },
+            bases=(models.Model,),
+        ),
+    ]
@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dialer_contact', '0002_contactimport'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='contact',
+            name='e164',
+            field=models.CharField(max_length=15, null=True, verbose_name='E.164 number', db_index=True,
+                                   editable=False, blank=True),
+            preserve_default=True,
+        ),
+    ]
@@ -13,10 +13,13 @@
 #
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
 from django_countries.fields import CountryField
 from django_lets_go.intermediate_model_base_class import Model
-from dialer_contact.constants import CONTACT_STATUS
+from country_dialcode.models import Country
+from dialer_contact.constants import CONTACT_STATUS, IMPORT_STATUS
+from dialer_contact.phonenumber import to_e164, get_owner_id, invalidate_phonenumber_rules
 import jsonfield
 import re
 
@@ -68,6 +71,7 @@ class Contact(Model):
     **Attributes**:
 
         * ``contact`` - Contact no
+        * ``e164`` - E.164 form of the contact no, without the +
         * ``last_name`` - Contact's last name
         * ``first_name`` - Contact's first name
         * ``email`` - Contact's e-mail address
@@ -87,6 +91,8 @@ class Contact(Model):
     """
     phonebook = models.ForeignKey(Phonebook, verbose_name=_('phonebook'))
     contact = models.CharField(max_length=90, verbose_name=_('contact number'))
+    e164 = models.CharField(max_length=15, blank=True, null=True, db_index=True, editable=False,
+                            verbose_name=_('E.164 number'))
     status = models.IntegerField(choices=list(CONTACT_STATUS), default=CONTACT_STATUS.ACTIVE,
                                  verbose_name=_("status"), blank=True, null=True)
     last_name = models.CharField(max_length=120, blank=True, null=True, verbose_name=_('last name'))
@@ -116,6 +122,12 @@ class Contact(Model):
         # this will be used by duplicate_contact
         return u"%s" % (self.contact)
 
+    def save(self, *args, **kwargs):
+        # national numbers are read with the country of the contact, else of the phonebook owner
+        user_id = None if self.country else get_owner_id(self, 'phonebook')
+        self.e164 = to_e164(self.contact, self.country, user_id)
+        super(Contact, self).save(*args, **kwargs)
+
     def contact_name(self):
         """Return Contact Name"""
         return u"%s %s" % (self.first_name, self.last_name)
@@ -156,3 +168,83 @@ class Contact(Model):
 
     contact_name.allow_tags = True
     contact_name.short_description = _('name')
+
+
+class ContactImport(Model):
+
+    """This defines the import of a CSV file of contacts, run by a
+    background task
+
+    **Attributes**:
+
+        * ``filename`` - name of the uploaded file
+        * ``csv_path`` - path of the uploaded file on disk
+        * ``error_path`` - path of the report of the rows in error
+        * ``status`` - import status
+        * ``total_rows`` - number of lines of the file
+        * ``processed_rows`` - number of rows read so far
+        * ``imported_rows`` - number of contacts created
+        * ``error_rows`` - number of rows in error
+
+    **Relationships**:
+
+        * ``user`` - Foreign key relationship to the User model
+        * ``phonebook`` - Foreign key relationship to the Phonebook model
+
+    **Name of DB table**: dialer_contact_import
+    """
+    user = models.ForeignKey('auth.User', related_name='contact_import')
+    phonebook = models.ForeignKey(Phonebook, verbose_name=_('phonebook'))
+    filename = models.CharField(max_length=250, verbose_name=_('file'))
+    csv_path = models.CharField(max_length=250)
+    error_path = models.CharField(max_length=250, blank=True, null=True)
+    status = models.IntegerField(choices=list(IMPORT_STATUS), default=IMPORT_STATUS.PENDING,
+                                 verbose_name=_("status"))
+    total_rows = models.IntegerField(default=0, verbose_name=_('total rows'))
+    processed_rows = models.IntegerField(default=0, verbose_name=_('processed rows'))
+    imported_rows = models.IntegerField(default=0, verbose_name=_('imported rows'))
+    error_rows = models.IntegerField(default=0, verbose_name=_('rows in error'))
+    created_date = models.DateTimeField(auto_now_add=True, verbose_name=_('date'))
+    updated_date = models.DateTimeField(auto_now=True)
+
+    class Meta:
+        db_table = u'dialer_contact_import'
+        verbose_name = _("contact import")
+        verbose_name_plural = _("contact imports")
+
+    def __unicode__(self):
+        return u"%s" % self.filename
+
+    def progress(self):
+        """Percentage of the rows processed"""
+        if self.status == IMPORT_STATUS.SUCCESS:
+            return 100
+        if not self.total_rows:
+            return 0
+        return min(100, int(self.processed_rows * 100 / self.total_rows))
+
+
+def post_save_ingest_contact(sender, **kwargs):
+    """A ``post_save`` signal is sent by the Contact model instance whenever
+    it is going to save.
+
+    **Logic Description**:
+
+        * A new contact is sent to the contact ingest, which adds it to the
+          subscribers of the running voice and SMS campaigns of its phonebook,
+          see dialer_contact.ingest
+    """
+    if kwargs['created']:
+        # the ingest depends on the campaign models
+        from dialer_contact.ingest import contact_created
+        contact_created(kwargs['instance'])
+
+post_save.connect(post_save_ingest_contact, sender=Contact)
+
+
+def country_changed(sender, **kwargs):
+    """Reload the numbering rules of all the processes"""
+    invalidate_phonenumber_rules()
+
+post_save.connect(country_changed, sender=Country)
+post_delete.connect(country_changed, sender=Country)
@@ -0,0 +1,274 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Normalisation of the phone numbers to their E.164 form.
+
+The numbers are parsed once when they are stored (contacts, DNC
+numbers) and their E.164 form, the digits without the leading ``+``,
+is kept next to the raw number, so the DNC lists and the deduplication
+compare the canonical forms whatever the formatting of the input.
+
+A number without international prefix is read with the numbering rule
+of its country: the country of the contact, else the country of the
+profile of the user, else settings.PHONENUMBER_DEFAULT_COUNTRY. The
+rules are compiled once per process from the dialcode Country table and
+the NUMBERING_PLANS below, overridden by settings.PHONENUMBER_RULES.
+A change of the Country table bumps a version in the cache which
+triggers a reload by all the processes, the countries of the users are
+read again every settings.PHONENUMBER_RULES_REFRESH seconds.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+import time
+
+PHONENUMBER_RULES_VERSION_KEY = 'phonenumber_rules_version'
+
+# E.164 numbers have at most 15 digits, below 7 digits they are short codes
+E164_MIN_DIGITS = 7
+E164_MAX_DIGITS = 15
+
+# characters used to format a number, ignored by the parsing
+FORMAT_CHARS = ' -./()'
+
+# Numbering plans departing from the default one (international prefix 00,
+# national prefix 0, national numbers of at most 10 digits), keyed by
+# country calling code or by ISO 3166-1 alpha-2 code
+DEFAULT_NUMBERING_PLAN = {
+    'international_prefix': ['00'],
+    'national_prefix': '0',
+    'national_length': 10,
+}
+NUMBERING_PLANS = {
+    # North American Numbering Plan
+    '1': {'international_prefix': ['011'], 'national_prefix': '1', 'national_length': 10},
+    # Russia and Kazakhstan
+    '7': {'international_prefix': ['810'], 'national_prefix': '8', 'national_length': 10},
+    'AU': {'international_prefix': ['0011'], 'national_prefix': '0', 'national_length': 9},
+    'JP': {'international_prefix': ['010'], 'national_prefix': '0', 'national_length': 10},
+    # the leading 0 is part of the national number
+    'IT': {'international_prefix': ['00'], 'national_prefix': '', 'national_length': 11},
+    'SM': {'international_prefix': ['00'], 'national_prefix': '', 'national_length': 10},
+    'VA': {'international_prefix': ['00'], 'national_prefix': '', 'national_length': 11},
+}
+
+
+def invalidate_phonenumber_rules():
+    """Force a reload of the numbering rules by all the processes"""
+    cache.set(PHONENUMBER_RULES_VERSION_KEY, time.time(), 60 * 60 * 24 * 30)
+
+
+def clean_number(phone_number):
+    """
+    Return the (digits, international) of a phone number, the digits are
+    None if the number holds other characters than digits and formatting
+
+    >>> clean_number('+34 (650) 12-34-56')
+    ('34650123456', True)
+    >>> clean_number('sip:1000@example.com')
+    (None, False)
+    """
+    phone_number = (phone_number or '').strip()
+    international = phone_number.startswith('+')
+    if international:
+        phone_number = phone_number[1:]
+    digits = ''.join([char for char in phone_number if char not in FORMAT_CHARS])
+    if not digits.isdigit():
+        return (None, international)
+    return (digits, international)
+
+
+def valid_e164(digits):
+    if digits and E164_MIN_DIGITS <= len(digits) <= E164_MAX_DIGITS and digits[0] != '0':
+        return digits
+    return None
+
+
+class NumberingRule(object):
+
+    """
+    NumberingRule reads the numbers dialed from a country
+
+    - country_code : calling code added to the national numbers
+    - international_prefixes : prefixes announcing an international number
+    - national_prefix : trunk prefix removed from the national numbers
+    - national_length : longest national number, longer ones without
+      prefix are taken as international numbers without their ``+``
+    """
+
+    __slots__ = ('country_code', 'international_prefixes', 'national_prefix', 'national_length')
+
+    def __init__(self, country_code='', international_prefix=None, national_prefix='', national_length=0):
+        self.country_code = str(country_code or '')
+        self.international_prefixes = sorted(set([prefix for prefix in international_prefix or [] if prefix]),
+                                             key=len, reverse=True)
+        self.national_prefix = national_prefix or ''
+        self.national_length = national_length if self.country_code else 0
+
+    def to_e164(self, phone_number):
+        """
+        Return the E.164 form of a phone number without its ``+``, None if
+        the number can't be read
+
+        >>> rule = NumberingRule('34', ['00'], '0', 9)
+        >>> rule.to_e164('650 12 34 56'), rule.to_e164('0034650123456'), rule.to_e164('+33 1 23 45 67 89')
+        ('34650123456', '34650123456', '33123456789')
+        """
+        (digits, international) = clean_number(phone_number)
+        if not digits or international:
+            return valid_e164(digits)
+        for prefix in self.international_prefixes:
+            if digits.startswith(prefix):
+                return valid_e164(digits[len(prefix):])
+        if not self.country_code:
+            # no country to read a national number
+            return valid_e164(digits)
+        if self.national_prefix and digits.startswith(self.national_prefix):
+            return valid_e164(self.country_code + digits[len(self.national_prefix):])
+        if len(digits) <= self.national_length:
+            return valid_e164(self.country_code + digits)
+        return valid_e164(digits)
+
+
+def compile_rule(country_code, iso2=None, overrides=None):
+    """Merge the numbering plans applying to a country in a NumberingRule"""
+    plan = dict(DEFAULT_NUMBERING_PLAN)
+    plan.update(NUMBERING_PLANS.get(country_code, {}))
+    if iso2:
+        plan.update(NUMBERING_PLANS.get(iso2, {}))
+        plan.update((overrides or {}).get(iso2, {}))
+    country_code = plan.pop('country_code', country_code)
+    return NumberingRule(country_code, **plan)
+
+
+class PhoneNumberRules(object):
+
+    """
+    PhoneNumberRules holds the numbering rules of the countries and the
+    country of the users
+
+    - load : compile the rules of the Country table
+    - get_rule : rule of a country, the rule without country if unknown
+    - get_user_country : country of a user, loaded on first use
+    """
+
+    def __init__(self):
+        self.rules = {}
+        self.user_country = {}
+        self.default_rule = NumberingRule(international_prefix=DEFAULT_NUMBERING_PLAN['international_prefix'])
+        self.version = None
+        self.loaded_at = 0
+
+    def load(self):
+        """Compile the rules of the countries"""
+        from country_dialcode.models import Country
+        self.version = cache.get(PHONENUMBER_RULES_VERSION_KEY)
+        overrides = getattr(settings, 'PHONENUMBER_RULES', {})
+        self.rules = {}
+        for (iso2, countryprefix) in Country.objects.values_list('iso2', 'countryprefix').iterator():
+            if iso2 and countryprefix:
+                self.rules[iso2.upper()] = compile_rule(str(countryprefix), iso2.upper(), overrides)
+        # countries missing from the Country table
+        for (iso2, plan) in overrides.items():
+            if iso2 not in self.rules and plan.get('country_code'):
+                self.rules[iso2] = compile_rule(str(plan['country_code']), iso2, overrides)
+        self.user_country = {}
+        self.loaded_at = time.time()
+
+    def refresh(self):
+        """Reload the rules if they changed since the last load"""
+        if self.loaded_at == 0 or cache.get(PHONENUMBER_RULES_VERSION_KEY) != self.version:
+            self.load()
+        else:
+            # the users may have changed their country
+            self.user_country = {}
+            self.loaded_at = time.time()
+
+    def get_rule(self, country=None):
+        country = str(country or getattr(settings, 'PHONENUMBER_DEFAULT_COUNTRY', '') or '').upper()
+        return self.rules.get(country, self.default_rule)
+
+    def get_user_country(self, user_id):
+        if user_id not in self.user_country:
+            from user_profile.models import UserProfile
+            country = UserProfile.objects.filter(user_id=user_id).values_list('country', flat=True)
+            self.user_country[user_id] = str(country[0] or '') if country else ''
+        return self.user_country[user_id]
+
+    def to_e164(self, phone_number, country=None, user_id=None):
+        if not country and user_id is not None:
+            country = self.get_user_country(user_id)
+        return self.get_rule(country).to_e164(phone_number)
+
+    def to_e164_list(self, list_phone_number, country=None, user_id=None, list_country=None):
+        """
+        Return the E.164 forms of a list of phone numbers, read with the
+        country of ``list_country`` at the same position if given, else
+        with ``country`` or the country of the user
+        """
+        if not country and user_id is not None:
+            country = self.get_user_country(user_id)
+        default_rule = self.get_rule(country)
+        if not list_country:
+            to_e164 = default_rule.to_e164
+            return [to_e164(phone_number) for phone_number in list_phone_number]
+        result = []
+        for (phone_number, number_country) in zip(list_phone_number, list_country):
+            if number_country:
+                rule = self.rules.get(str(number_country).upper(), default_rule)
+            else:
+                rule = default_rule
+            result.append(rule.to_e164(phone_number))
+        return result
+
+
+_rules = PhoneNumberRules()
+
+
+def get_phonenumber_rules():
+    """
+    Return the numbering rules of the current process,
+    checked for changes every settings.PHONENUMBER_RULES_REFRESH seconds
+    """
+    if time.time() - _rules.loaded_at >= getattr(settings, 'PHONENUMBER_RULES_REFRESH', 300):
+        _rules.refresh()
+    return _rules
+
+
+def get_owner_id(instance, field):
+    """
+    Return the user id of the object of the ``field`` foreign key of a
+    model instance, without loading the object unless it is already cached
+    """
+    related = getattr(instance, '_%s_cache' % field, None)
+    if related is not None:
+        return related.user_id
+    model = instance._meta.get_field(field).rel.to
+    owner = model.objects.filter(pk=getattr(instance, '%s_id' % field)).values_list('user_id', flat=True)
+    return owner[0] if owner else None
+
+
+def to_e164(phone_number, country=None, user_id=None):
+    """
+    Return the E.164 form of a phone number without its ``+``, None if
+    the number can't be read. The national numbers are read with the
+    rule of ``country``, else of the country of the user
+    """
+    return get_phonenumber_rules().to_e164(phone_number, country, user_id)
+
+
+def to_e164_list(list_phone_number, country=None, user_id=None, list_country=None):
+    """Batch version of to_e164 for the imports, see PhoneNumberRules.to_e164_list"""
+    return get_phonenumber_rules().to_e164_list(list_phone_number, country, user_id, list_country)
@@ -15,9 +15,18 @@
 from django.conf import settings
 from celery.task import Task
 from celery.utils.log import get_task_logger
-from dialer_campaign.models import Campaign, Subscriber
+from django.db import connection
+from django.db.models import F, Max
+from dialer_campaign.models import Campaign, CampaignPhonebookImport, Subscriber
+from dialer_campaign.constants import SUBSCRIBER_STATUS
+from dialer_contact.constants import CONTACT_STATUS, IMPORT_STATUS
+from dialer_contact.models import Contact, ContactImport
+from dialer_contact.importer import import_contacts
 from user_profile.models import UserProfile
 from django_lets_go.only_one_task import only_one
+from mod_metrics import metrics
+from django.utils.timezone import now
+from datetime import timedelta
 
 logger = get_task_logger(__name__)
 
@@ -29,8 +38,8 @@ class collect_subscriber(Task):
     @only_one(ikey="check_collect_subscriber", timeout=LOCK_EXPIRE)
     def run(self, campaign_id):
         """
-        This task will collect all the contact and create the Subscriber
-        if the phonebook_id is no in the list of imported_phonebook IDs.
+        This task will collect the contacts added to the phonebooks of the
+        campaign since its last run and create their Subscriber.
 
         **Attributes**:
 
@@ -38,81 +47,126 @@ class collect_subscriber(Task):
         """
         logger.debug("Collect subscribers for the campaign = %s" % str(campaign_id))
 
-        # Retrieve the list of active contact
         obj_campaign = Campaign.objects.get(id=campaign_id)
-        list_phonebook = obj_campaign.phonebook.all()
+        list_phonebook_id = list(obj_campaign.phonebook.values_list('id', flat=True))
+        imported_phonebook = [item for item in obj_campaign.imported_phonebook.split(',') if item]
 
-        for item_phonebook in list_phonebook:
-            phonebook_id = item_phonebook.id
+        for phonebook_id in list_phonebook_id:
+            count_import = importcontact_custom_sql(campaign_id, phonebook_id)
+            if count_import:
+                logger.info("ImportPhonebook %d for campaign = %d : %d subscribers" %
+                            (phonebook_id, campaign_id, count_import))
 
-            # check if phonebook_id is missing in imported_phonebook list
-            if not str(phonebook_id) in obj_campaign.imported_phonebook.split(','):
-                # Run import
-                logger.info("ImportPhonebook %d for campaign = %d" % (phonebook_id, campaign_id))
+            # Add the phonebook id to the imported list
+            if str(phonebook_id) not in imported_phonebook:
+                imported_phonebook.append(str(phonebook_id))
+                Campaign.objects.filter(pk=campaign_id).update(imported_phonebook=','.join(imported_phonebook))
+
+        return True
 
-                # Add the phonebook id to the imported list
-                if obj_campaign.imported_phonebook == '':
-                    sep = ''
-                else:
-                    sep = ','
-                obj_campaign.imported_phonebook = obj_campaign.imported_phonebook + \
-                    '%s%d' % (sep, phonebook_id)
-                obj_campaign.save()
 
-                # Faster method, ask the Database to do the job
-                importcontact_custom_sql(campaign_id, phonebook_id)
+class import_contact_file(Task):
+
+    def run(self, contact_import_id):
+        """
+        This task imports the uploaded CSV file of a ContactImport in the
+        phonebook of the import.
 
-        # Count contact imported
-        count_contact = Subscriber.objects.filter(campaign=campaign_id).count()
-        obj_campaign.totalcontact = count_contact
-        obj_campaign.save()
+        **Attributes**:
 
+            * ``contact_import_id`` - ContactImport ID
+        """
+        logger.info("Import contacts for the contact import = %s" % str(contact_import_id))
+        contact_import = ContactImport.objects.get(pk=contact_import_id)
+        try:
+            counters = import_contacts(contact_import)
+        except Exception as e:
+            logger.error("Contact import %d failed : %s" % (contact_import_id, e))
+            ContactImport.objects.filter(pk=contact_import_id).update(status=IMPORT_STATUS.FAILURE)
+            return False
+        logger.info("Contact import %d : %d imported, %d in error" %
+                    (contact_import_id, counters['imported_rows'], counters['error_rows']))
         return True
 
 
 def importcontact_custom_sql(campaign_id, phonebook_id):
-    # Call PL-SQL stored procedure
-    # Subscriber.importcontact_pl_sql(campaign_id, phonebook_id)
+    """
+    Create the Subscribers of the active contacts added to the phonebook
+    since the last collection for the campaign, return their number
+
+    A mark of the contact ids collected is kept per campaign and phonebook,
+    so each run only reads the new contacts, the contacts already
+    subscribed are skipped by the unique key (contact, campaign) without
+    locking dialer_subscriber
+
+    The ids are handed out before the commit, a contact can become visible
+    after a higher id was collected. The mark only moves past the contacts
+    created more than settings.CONTACT_COLLECT_WINDOW seconds ago, the
+    recent ones are read again on the next runs
+    """
+    if connection.vendor != 'postgresql':
+        # MYSQL Support removed
+        logger.error("Database not supported (%s)" % settings.DATABASES['default']['ENGINE'])
+        return 0
+
+    (mark, created) = CampaignPhonebookImport.objects.get_or_create(campaign_id=campaign_id,
+                                                                    phonebook_id=phonebook_id)
+    # the contacts committed during the run are left to the next one
+    max_contact_id = Contact.objects.filter(phonebook_id=phonebook_id, id__gt=mark.last_contact_id)\
+        .aggregate(Max('id'))['id__max']
+    if max_contact_id is None:
+        return 0
 
     # max_subr_cpg = max number of subscriber per campaign,
     # That is going to be checked when a contact is going to be imported
     # to the subscriber list
-
-    # TODO: to review first... accr max_subr_cpn/max_subr_cpg
     campaign_obj = Campaign.objects.get(pk=campaign_id)
     max_subr_cpg = UserProfile.objects.get(user=campaign_obj.user).dialersetting.max_subr_cpg
-
     if max_subr_cpg > 0:
-        # Check how many we are going to import and how many exist for that campaign already
-        imported_subscriber_count = Subscriber.objects.filter(campaign_id=campaign_id).count()
-        allowed_import = max_subr_cpg - imported_subscriber_count
-        if allowed_import > 0:
-            # handle negative value for to_import
-            limit_import = 'LIMIT %d' % allowed_import
-        else:
-            limit_import = 'LIMIT 0'
+        # totalcontact is maintained with the subscribers created, not with
+        # the ones deleted : it is counted again when the limit may be reached
+        totalcontact = campaign_obj.totalcontact or 0
+        if totalcontact + max_contact_id - mark.last_contact_id > max_subr_cpg:
+            totalcontact = Subscriber.objects.filter(campaign_id=campaign_id).count()
+            Campaign.objects.filter(pk=campaign_id).update(totalcontact=totalcontact)
+        allowed_import = max(0, max_subr_cpg - totalcontact)
+        if allowed_import == 0:
+            return 0
+        limit_import = 'LIMIT %d' % allowed_import
     else:
+        allowed_import = None
         limit_import = ''
 
-    from django.db import connection
     cursor = connection.cursor()
-    if settings.DATABASES['default']['ENGINE'] == 'django.db.backends.postgresql_psycopg2':
-        # Data insert operation - http://stackoverflow.com/questions/12451053/django-bulk-create-with-ignore-rows-that-cause-integrityerror
-        sqlimport = \
-            "LOCK TABLE dialer_subscriber IN EXCLUSIVE MODE;" \
-            "INSERT INTO dialer_subscriber "\
-            "(contact_id, campaign_id, duplicate_contact, status, created_date, updated_date) "\
-            "SELECT id, %d, contact, 1, NOW(), NOW() FROM dialer_contact "\
-            "WHERE phonebook_id=%d AND dialer_contact.status=1 AND NOT EXISTS (" \
-            "SELECT 1 FROM dialer_subscriber WHERE "\
-            "dialer_subscriber.campaign_id=%d "\
-            "AND dialer_contact.id = dialer_subscriber.contact_id ) %s;" % \
-            (campaign_id, phonebook_id, campaign_id, limit_import)
-    else:
-        # MYSQL Support removed
-        logger.error("Database not supported (%s)" % settings.DATABASES['default']['ENGINE'])
-        return False
-
-    cursor.execute(sqlimport)
-
-    return True
+    cursor.execute(
+        "WITH new_contact AS ("
+        "SELECT id, contact FROM dialer_contact c "
+        "WHERE phonebook_id = %%s AND status = %%s AND id > %%s AND id <= %%s "
+        "AND NOT EXISTS (SELECT 1 FROM dialer_subscriber s WHERE s.contact_id = c.id AND s.campaign_id = %%s) "
+        "ORDER BY id %s), "
+        "new_subscriber AS ("
+        "INSERT INTO dialer_subscriber "
+        "(contact_id, campaign_id, duplicate_contact, status, created_date, updated_date) "
+        "SELECT id, %%s, contact, %%s, NOW(), NOW() FROM new_contact "
+        "ON CONFLICT (contact_id, campaign_id) DO NOTHING "
+        "RETURNING contact_id) "
+        "SELECT (SELECT count(*) FROM new_subscriber), (SELECT count(*) FROM new_contact), "
+        "(SELECT max(id) FROM new_contact)" % limit_import,
+        [phonebook_id, CONTACT_STATUS.ACTIVE, mark.last_contact_id, max_contact_id, campaign_id,
+         campaign_id, SUBSCRIBER_STATUS.PENDING])
+    (count_import, count_read, last_read_id) = cursor.fetchone()
+
+    if allowed_import is None or count_read < allowed_import:
+        # all the contacts up to max_contact_id were read
+        last_read_id = max_contact_id
+    # the mark stays behind the contacts of the transactions which may still commit
+    last_contact_id = Contact.objects\
+        .filter(phonebook_id=phonebook_id, id__gt=mark.last_contact_id, id__lte=last_read_id,
+                created_date__lt=now() - timedelta(seconds=settings.CONTACT_COLLECT_WINDOW))\
+        .aggregate(Max('id'))['id__max']
+    if last_contact_id is not None:
+        CampaignPhonebookImport.objects.filter(pk=mark.id).update(last_contact_id=last_contact_id)
+    if count_import:
+        Campaign.objects.filter(pk=campaign_id).update(totalcontact=F('totalcontact') + count_import)
+        metrics.inc('newfies_subscribers_pending', count_import, campaign_id=campaign_id)
+    return count_import
@@ -15,18 +15,34 @@
 from django.contrib.auth.models import User
 from django.template import Template, Context
 from django.test import TestCase
+from django.test.utils import override_settings
 # from django.conf import settings
 from django.core.management import call_command
-from dialer_contact.models import Phonebook, Contact
+from django.db import connection, DatabaseError
+from dialer_contact.models import Phonebook, Contact, ContactImport
+from dialer_contact.constants import CONTACT_STATUS, IMPORT_STATUS
+from dialer_contact.ingest import contact_batch, ingest_contacts, bulk_create_contacts
+from dialer_contact.phonenumber import get_phonenumber_rules, get_owner_id, to_e164, to_e164_list
+from dialer_contact import importer
+from dialer_contact.importer import validate_row, validate_record, import_contacts, load_contacts, \
+    get_existing_contacts
 from dialer_contact.forms import Contact_fileImport, PhonebookForm, ContactForm, ContactSearchForm
 from dialer_contact.views import phonebook_add, phonebook_change, phonebook_list,\
     phonebook_del, contact_list, contact_add, contact_change, contact_del, contact_import,\
     get_contact_count
-from dialer_contact.tasks import collect_subscriber
+from dialer_contact.tasks import collect_subscriber, importcontact_custom_sql
+from dialer_campaign.models import Campaign, Subscriber, CampaignPhonebookImport
 from django_lets_go.utils import BaseAuthenticatedClient
+from dialer_settings.models import DialerSetting
+from country_dialcode.models import Country
 from datetime import datetime
 from django.utils.timezone import utc
-# import os
+from tempfile import mkdtemp
+from unittest import skipUnless
+import csv
+import json
+import os
+import shutil
 
 # csv_file = open(
 #    os.path.abspath('../../newfies-dialer/newfies/') + '/dialer_contact/fixtures/import_contacts.txt', 'r'
@@ -305,6 +321,46 @@ class DialerContactCeleryTaskTestCase(TestCase):
 
         call_command("create_contact", "3|10")
 
+    @skipUnless(connection.vendor == 'postgresql', 'the subscribers are collected on PostgreSQL only')
+    @override_settings(CONTACT_COLLECT_WINDOW=600)
+    def test_importcontact_incremental(self):
+        """Test that the contacts are collected once per campaign"""
+        Subscriber.objects.filter(campaign_id=1).delete()
+        Campaign.objects.filter(pk=1).update(totalcontact=0)
+        count_import = importcontact_custom_sql(1, 1)
+        self.assertEqual(Campaign.objects.get(pk=1).totalcontact, count_import)
+        self.assertEqual(importcontact_custom_sql(1, 1), 0)
+        contact = Contact.objects.create(phonebook_id=1, contact='650784399')
+        self.assertEqual(Subscriber.objects.filter(campaign_id=1, contact=contact).count(), 1)
+        self.assertEqual(importcontact_custom_sql(1, 1), 0)
+        self.assertEqual(Campaign.objects.get(pk=1).totalcontact, count_import + 1)
+
+        # a contact committed after a higher contact id was collected
+        late_contact = Contact.objects.create(phonebook_id=1, contact='650784398')
+        last_contact = Contact.objects.create(phonebook_id=1, contact='650784397')
+        Subscriber.objects.filter(contact=late_contact).delete()
+        self.assertEqual(importcontact_custom_sql(1, 1), 1)
+        self.assertEqual(Subscriber.objects.filter(campaign_id=1, contact=late_contact).count(), 1)
+        # the mark stays behind the contacts created in the window
+        self.assertTrue(CampaignPhonebookImport.objects.get(campaign_id=1, phonebook_id=1).last_contact_id <
+                        contact.id)
+        with self.settings(CONTACT_COLLECT_WINDOW=0):
+            self.assertEqual(importcontact_custom_sql(1, 1), 0)
+        self.assertEqual(CampaignPhonebookImport.objects.get(campaign_id=1, phonebook_id=1).last_contact_id,
+                         last_contact.id)
+
+    @skipUnless(connection.vendor == 'postgresql', 'the subscribers are collected on PostgreSQL only')
+    def test_importcontact_max_subscriber(self):
+        """Test that the subscribers deleted don't count against max_subr_cpg"""
+        count_contact = Contact.objects.filter(phonebook_id=1, status=CONTACT_STATUS.ACTIVE).count()
+        DialerSetting.objects.update(max_subr_cpg=count_contact)
+        # totalcontact is not decremented when the subscribers are deleted
+        Subscriber.objects.filter(campaign_id=1).delete()
+        Campaign.objects.filter(pk=1).update(totalcontact=count_contact)
+        self.assertEqual(importcontact_custom_sql(1, 1), count_contact)
+        self.assertEqual(Campaign.objects.get(pk=1).totalcontact, count_contact)
+        self.assertEqual(Subscriber.objects.filter(campaign_id=1).count(), count_contact)
+
 
 class DialerContactModel(TestCase):
 
@@ -355,3 +411,230 @@ class DialerContactModel(TestCase):
     def teardown(self):
         self.phonebook.delete()
         self.contact.delete()
+
+
+class ContactImportTestCase(TestCase):
+
+    """Test the import of the contact CSV files"""
+
+    fixtures = ['auth_user.json', 'phonebook.json']
+
+    def setUp(self):
+        self.directory = mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def test_validate_row(self):
+        (values, error) = validate_row(['650784355', 'Belaid', 'Arezqui', 'areski@gmail.com', 'test', '0',
+                                        'Address', 'Barcelona', 'State', 'es', '123', '{"age": "32"}'])
+        self.assertEqual(error, None)
+        self.assertEqual(values[5], 0)
+        self.assertEqual(values[9], 'ES')
+        self.assertEqual(values[11], {'age': '32'})
+        (values, error) = validate_row(['650784355'])
+        self.assertEqual(error, None)
+        self.assertEqual(values[5], 1)
+        self.assertEqual(validate_row(['650784355', '', '', '', '', '2'])[0], None)
+        self.assertEqual(validate_row(['650784355', '', '', 'not an email'])[0], None)
+        self.assertEqual(validate_row(['650784355', '', '', '', '', '1', '', '', '', 'ESP'])[0], None)
+        self.assertEqual(validate_row(['', 'Belaid'])[0], None)
+
+    def test_validate_record(self):
+        (values, error) = validate_record({'contact': 650784355, 'status': 0, 'additional_vars': {'age': 32}})
+        self.assertEqual(error, None)
+        self.assertEqual(values[0], '650784355')
+        self.assertEqual(values[5], 0)
+        self.assertEqual(values[11], {'age': 32})
+        self.assertEqual(validate_record('650784355')[0], None)
+        self.assertEqual(validate_record({'first_name': 'John'})[0], None)
+
+    def test_load_contacts(self):
+        user = User.objects.get(username='admin')
+        self.assertEqual(load_contacts(1, [validate_record({'contact': '650784355'})[0],
+                                           validate_record({'contact': '650784356'})[0]]), 2)
+        self.assertEqual(get_existing_contacts(user.id, ['650784355', '650784357']), set(['650784355']))
+
+    def test_import_contacts(self):
+        path = os.path.join(self.directory, 'contacts.csv')
+        with open(path, 'wb') as csv_file:
+            csv_file.write('650784355|Belaid|Arezqui|areski@gmail.com|test|1|Address|Barcelona|State|ES|123|\n'
+                           '\n'
+                           '650723032|Fourth|John|john@gmail.com|test|0|Address|Barcelona|State|ES|123|\n'
+                           '650723033|Fourth|John|john@gmail.com|test|x|Address|Barcelona|State|ES|123|\n')
+        contact_import = ContactImport.objects.create(
+            user=User.objects.get(username='admin'), phonebook_id=1, filename='contacts.csv', csv_path=path)
+        counters = import_contacts(contact_import, chunk_size=2)
+        self.assertEqual(counters['imported_rows'], 2)
+        self.assertEqual(counters['error_rows'], 1)
+        contact_import = ContactImport.objects.get(pk=contact_import.id)
+        self.assertEqual(contact_import.status, IMPORT_STATUS.SUCCESS)
+        self.assertEqual(contact_import.processed_rows, 3)
+        self.assertEqual(Contact.objects.filter(phonebook_id=1, contact='650723032', status=0).count(), 1)
+        self.assertFalse(os.path.exists(path))
+        with open(contact_import.error_path, 'rb') as error_file:
+            self.assertEqual(list(csv.reader(error_file))[1][0], '4')
+
+    def test_import_contacts_failure(self):
+        path = os.path.join(self.directory, 'contacts.csv')
+        with open(path, 'wb') as csv_file:
+            csv_file.write('650784355|Belaid|Arezqui|areski@gmail.com|test|1|Address|Barcelona|State|ES|123|\n'
+                           '650723033|Fourth|John|john@gmail.com|test|x|Address|Barcelona|State|ES|123|\n'
+                           '650723032|Fourth|John|john@gmail.com|test|0|Address|Barcelona|State|ES|123|\n')
+        contact_import = ContactImport.objects.create(
+            user=User.objects.get(username='admin'), phonebook_id=1, filename='contacts.csv', csv_path=path)
+        load = importer.load_contacts
+        chunks = []
+
+        def load_once(phonebook_id, list_values):
+            # the database is lost after the first chunk
+            chunks.append(list_values)
+            if len(chunks) > 1:
+                raise DatabaseError('connection lost')
+            return load(phonebook_id, list_values)
+
+        importer.load_contacts = load_once
+        try:
+            self.assertRaises(DatabaseError, import_contacts, contact_import, chunk_size=2)
+        finally:
+            importer.load_contacts = load
+        contact_import = ContactImport.objects.get(pk=contact_import.id)
+        self.assertEqual(contact_import.status, IMPORT_STATUS.FAILURE)
+        self.assertEqual((contact_import.processed_rows, contact_import.imported_rows,
+                          contact_import.error_rows), (2, 1, 1))
+        self.assertFalse(os.path.exists(path))
+        with open(contact_import.error_path, 'rb') as error_file:
+            self.assertEqual(list(csv.reader(error_file))[1][0], '2')
+
+
+class ContactIngestTestCase(TestCase):
+
+    """Test the subscription of the new contacts to the running campaigns"""
+
+    fixtures = ['auth_user.json', 'gateway.json', 'dialer_setting.json',
+                'user_profile.json', 'contenttype.json',
+                'phonebook.json', 'contact.json', 'survey.json',
+                'dnc_list.json', 'dnc_contact.json',
+                'campaign.json', 'subscriber.json']
+
+    def test_contact_batch(self):
+        totalcontact = Campaign.objects.get(pk=1).totalcontact
+        with contact_batch():
+            contact = Contact.objects.create(phonebook_id=1, contact='650784398')
+            Contact.objects.create(phonebook_id=1, contact='650784399', status=CONTACT_STATUS.INACTIVE)
+            self.assertEqual(Subscriber.objects.filter(contact=contact).count(), 0)
+        self.assertEqual(Subscriber.objects.filter(contact__phonebook_id=1,
+                                                   contact__contact__in=['650784398', '650784399']).count(), 1)
+        self.assertEqual(Campaign.objects.get(pk=1).totalcontact, totalcontact + 1)
+        # a second ingest of the same contact creates nothing
+        self.assertEqual(ingest_contacts([contact.id]), 0)
+
+    def test_bulk_create_contacts(self):
+        self.assertEqual(bulk_create_contacts([Contact(phonebook_id=1, contact='650784397')]), 1)
+        self.assertEqual(Subscriber.objects.filter(campaign_id=1, duplicate_contact='650784397').count(), 1)
+
+
+@override_settings(PHONENUMBER_RULES={'ES': {'country_code': '34', 'national_length': 9},
+                                      'US': {'country_code': '1'}})
+class PhoneNumberTestCase(TestCase):
+
+    """Test the normalisation of the phone numbers to their E.164 form"""
+
+    fixtures = ['auth_user.json', 'phonebook.json']
+
+    def setUp(self):
+        get_phonenumber_rules().load()
+
+    def tearDown(self):
+        # reloaded without the rules of the test on next use
+        get_phonenumber_rules().loaded_at = 0
+
+    def test_to_e164(self):
+        self.assertEqual(to_e164('650 78 43 55', 'ES'), '34650784355')
+        self.assertEqual(to_e164('0034650784355', 'ES'), '34650784355')
+        self.assertEqual(to_e164('34650784355', 'ES'), '34650784355')
+        self.assertEqual(to_e164('+34 650-784-355'), '34650784355')
+        self.assertEqual(to_e164('(212) 555-0100', 'US'), '12125550100')
+        self.assertEqual(to_e164('1 212 555 0100', 'US'), '12125550100')
+        self.assertEqual(to_e164('011 34 650784355', 'US'), '34650784355')
+        self.assertEqual(to_e164('123', 'ES'), None)
+        self.assertEqual(to_e164('sip:1000@example.com', 'ES'), None)
+        self.assertEqual(to_e164_list(['650784355', '2125550100', '0034650784355'], 'ES',
+                                      list_country=['', 'US', 'es']),
+                         ['34650784355', '12125550100', '34650784355'])
+
+    def test_contact_e164(self):
+        contact = Contact.objects.create(phonebook_id=1, contact='650 784 355', country='ES')
+        self.assertEqual(contact.e164, '34650784355')
+        bulk_create_contacts([Contact(phonebook_id=1, contact='(212) 555-0100', country='US')])
+        self.assertEqual(Contact.objects.get(phonebook_id=1, contact='(212) 555-0100').e164, '12125550100')
+        user = User.objects.get(username='admin')
+        self.assertEqual(get_existing_contacts(user.id, ['34650784355', '650784399']), set(['34650784355']))
+
+    def test_get_owner_id(self):
+        phonebook = Phonebook.objects.get(pk=1)
+        contact = Contact(phonebook_id=1, contact='650784355')
+        with self.assertNumQueries(1):
+            self.assertEqual(get_owner_id(contact, 'phonebook'), phonebook.user_id)
+        contact.phonebook = phonebook
+        with self.assertNumQueries(0):
+            self.assertEqual(get_owner_id(contact, 'phonebook'), phonebook.user_id)
+
+    def test_country_changed(self):
+        rules = get_phonenumber_rules()
+        Country.objects.create(countrycode='XAA', countryname='Test', countryprefix=998, iso2='XA')
+        # the change is seen by the next refresh of every process
+        rules.refresh()
+        self.assertEqual(to_e164('0123456789', 'XA'), '998123456789')
+
+    @override_settings(PHONENUMBER_DEFAULT_COUNTRY='ES')
+    def test_default_country(self):
+        self.assertEqual(to_e164('650784355'), '34650784355')
+        self.assertEqual(Contact.objects.create(phonebook_id=1, contact='650784355').e164, '34650784355')
+
+
+class BulkContactApiTestCase(BaseAuthenticatedClient):
+
+    """Test the bulk contact API"""
+
+    fixtures = ['auth_user.json', 'gateway.json', 'dialer_setting.json',
+                'user_profile.json', 'phonebook.json', 'contact.json']
+
+    def post_contacts(self, data, content_type='application/json', query=''):
+        response = self.client.post('/rest-api/bulkcontact/' + query, data=data, content_type=content_type)
+        self.assertEqual(response.status_code, 200)
+        return json.loads(response.content)
+
+    def test_json(self):
+        result = self.post_contacts(json.dumps({'phonebook_id': '1', 'contacts': [
+            {'contact': '650784355', 'first_name': 'John'},
+            {'contact': '650-784-355'},
+            {'contact': '640234000'},
+            {'first_name': 'Jane'}]}))
+        self.assertEqual((result['created'], result['duplicate'], result['error'], result['limit']), (1, 2, 1, 0))
+        self.assertEqual([row['status'] for row in result['rows']], ['created', 'duplicate', 'duplicate', 'error'])
+        self.assertEqual(Contact.objects.get(phonebook_id=1, contact='650784355').first_name, 'John')
+
+    def test_ndjson(self):
+        Contact.objects.create(phonebook_id=1, contact='650784355')
+        result = self.post_contacts('{"contact": "650784356"}\n\n{"contact": "650784355"}\nnot json\n',
+                                    content_type='application/x-ndjson', query='?phonebook_id=1')
+        self.assertEqual((result['created'], result['duplicate'], result['error'], result['limit']), (1, 1, 1, 0))
+        self.assertTrue(Contact.objects.filter(phonebook_id=1, contact='650784356').exists())
+
+    def test_phoneno_list(self):
+        result = self.post_contacts(json.dumps({'phonebook_id': '1', 'phoneno_list': '650784357,650784358,640234000'}))
+        self.assertEqual((result['created'], result['duplicate'], result['error'], result['limit']), (2, 1, 0, 0))
+        self.assertEqual(Contact.objects.filter(phonebook_id=1, contact__in=['650784357', '650784358']).count(), 2)
+
+    def test_limit(self):
+        # room left for a single contact
+        user = User.objects.get(username='admin')
+        DialerSetting.objects.filter(pk=1).update(
+            max_contact=Contact.objects.filter(phonebook__user=user).count() + 1)
+        result = self.post_contacts(json.dumps({'phonebook_id': '1', 'phoneno_list': '650784357,650784358'}))
+        self.assertEqual([row['status'] for row in result['rows']], ['created', 'limit'])
+        self.assertFalse(Contact.objects.filter(contact='650784358').exists())
+
+        result = self.post_contacts(json.dumps({'phonebook_id': '1', 'phoneno_list': '650784359'}))
+        self.assertTrue('error' in result and 'rows' not in result)
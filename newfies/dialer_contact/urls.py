@@ -26,6 +26,8 @@ urlpatterns = patterns('dialer_contact.views',
                        (r'^contact/$', 'contact_list'),
                        (r'^contact/add/$', 'contact_add'),
                        (r'^contact_import/$', 'contact_import'),
+                       (r'^contact_import/(\d+)/$', 'contact_import_status'),
+                       (r'^contact_import/(\d+)/errors/$', 'contact_import_errors'),
                        (r'^contact/del/(.+)/$', 'contact_del'),
                        (r'^contact/(.+)/$', 'contact_change'),
                        )
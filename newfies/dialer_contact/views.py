@@ -18,17 +18,19 @@ from django.template.context import RequestContext
 from django.utils.translation import ugettext as _
 from django.db.models import Q
 from django.db.models import Count
-from dialer_contact.models import Phonebook, Contact
+from dialer_contact.models import Phonebook, Contact, ContactImport
 from dialer_contact.forms import ContactSearchForm, Contact_fileImport, PhonebookForm, ContactForm
 from dialer_contact.constants import PHONEBOOK_COLUMN_NAME, CONTACT_COLUMN_NAME
-from dialer_contact.constants import STATUS_CHOICE
+from dialer_contact.constants import STATUS_CHOICE, IMPORT_STATUS
+from dialer_contact.importer import save_upload
+from dialer_contact.tasks import import_contact_file
 from dialer_campaign.function_def import check_dialer_setting, dialer_setting_limit
 from user_profile.constants import NOTIFICATION_NAME
 from frontend_notification.views import frontend_send_notification
-from django_lets_go.common_functions import striplist, getvar, get_pagination_vars,\
+from django_lets_go.common_functions import getvar, get_pagination_vars,\
     unset_session_var, source_desti_field_chk
-import csv
 import json
+import os
 
 redirect_url_to_phonebook_list = '/phonebook/'
 redirect_url_to_contact_list = '/contact/'
@@ -413,14 +415,9 @@ def contact_import(request):
 
         * Before adding contacts, check dialer setting limit if applicable
           to the user.
-        * Add new contacts which will belong to the logged in user
-          via csv file & get the result (upload success and failure
-          statistics)
-
-    **Important variable**:
-
-        * total_rows - Total no. of records in the CSV file
-        * retail_record_count - No. of records imported from the CSV file
+        * Save the uploaded CSV file to disk and start the import_contact_file
+          task, the progress of the import is shown by contact_import_status
+        * List the last imports of the logged in user
     """
     # Check dialer setting limit
     if request.user and request.method == 'POST':
@@ -434,103 +431,70 @@ def contact_import(request):
             return HttpResponseRedirect(redirect_url_to_contact_list)
 
     form = Contact_fileImport(request.user, request.POST or None, request.FILES or None)
-    csv_data = ''
-    msg = ''
-    error_msg = ''
-    success_import_list = []
-    type_error_import_list = []
-    contact_cnt = 0
-    bulk_record = []
-
     if form.is_valid():
-        # col_no - field name
-        #  0     - contact
-        #  1     - last_name
-        #  2     - first_name
-        #  3     - email
-        #  4     - description
-        #  5     - status
-        #  6     - address
-        #  7     - city
-        #  8     - country
-        #  9     - country
-        # 10     - unit_number
-        # 11     - additional_vars
-        # To count total rows of CSV file
-        records = csv.reader(request.FILES['csv_file'], delimiter='|', quotechar='"')
-        total_rows = len(list(records))
-        BULK_SIZE = 1000
-        csv_data = csv.reader(request.FILES['csv_file'], delimiter='|', quotechar='"')
         # Get Phonebook Obj
         phonebook = get_object_or_404(Phonebook, pk=request.POST['phonebook'], user=request.user)
-        # Read each Row
-        for row in csv_data:
-            row = striplist(row)
-            if not row or str(row[0]) == 0:
-                continue
-
-            # Check field type
-            if not int(row[5]):
-                error_msg = _("invalid value for import! please check the import samples or phonebook is not valid")
-                type_error_import_list.append(row)
-                break
-
-            if len(row[9]) > 2:
-                error_msg = _("invalid value for country code, it needs to be a valid ISO 3166-1 alpha-2 codes")
-                type_error_import_list.append(row)
-                break
-
-            row_11 = ''
-            if row[11]:
-                try:
-                    row_11 = json.loads(row[11])
-                except:
-                    row_11 = ''
-
-            bulk_record.append(
-                Contact(
-                    phonebook=phonebook,
-                    contact=row[0],
-                    last_name=row[1],
-                    first_name=row[2],
-                    email=row[3],
-                    description=row[4],
-                    status=int(row[5]),
-                    address=row[6],
-                    city=row[7],
-                    state=row[8],
-                    country=row[9],  # Note: country needs to be a country code (CA, ES)
-                    unit_number=row[10],
-                    additional_vars=row_11)
-            )
+        contact_import = ContactImport.objects.create(
+            user=request.user,
+            phonebook=phonebook,
+            filename=request.FILES['csv_file'].name[:250],
+            csv_path=save_upload(request.FILES['csv_file']))
+        import_contact_file.delay(contact_import.id)
+        return HttpResponseRedirect('/contact_import/%d/' % contact_import.id)
+
+    data = {
+        'form': form,
+        'contact_import_list': ContactImport.objects.filter(user=request.user).order_by('-id')[:10],
+    }
+    return render_to_response('dialer_contact/contact/import_contact.html',
+                              data, context_instance=RequestContext(request))
+
 
-            contact_cnt = contact_cnt + 1
+@login_required
+def contact_import_status(request, object_id):
+    """Progress of a contact import of the logged in user
 
-            if contact_cnt < 100:
-                # We want to display only 100 lines of the success import
-                success_import_list.append(row)
+    **Attributes**:
 
-            if contact_cnt % BULK_SIZE == 0:
-                # Bulk insert
-                Contact.objects.bulk_create(bulk_record)
-                bulk_record = []
+        * ``object_id`` - Selected contact import object
+        * ``template`` - dialer_contact/contact/import_status.html
 
-        # remaining record
-        Contact.objects.bulk_create(bulk_record)
-        bulk_record = []
+    **Logic Description**:
 
-    # check if there is contact imported
-    if contact_cnt > 0:
-        msg = _('%(contact_cnt)s contact(s) have been uploaded successfully out of %(total_rows)s row(s)!') \
-            % {'contact_cnt': contact_cnt, 'total_rows': total_rows}
+        * The ajax requests get the counters of the import in JSON
+    """
+    contact_import = get_object_or_404(ContactImport, pk=object_id, user=request.user)
+    if request.is_ajax():
+        data = {
+            'status': contact_import.status,
+            'status_name': unicode(dict(list(IMPORT_STATUS))[contact_import.status]),
+            'total_rows': contact_import.total_rows,
+            'processed_rows': contact_import.processed_rows,
+            'imported_rows': contact_import.imported_rows,
+            'error_rows': contact_import.error_rows,
+            'progress': contact_import.progress(),
+        }
+        return HttpResponse(json.dumps(data), content_type='application/json')
 
     data = {
-        'form': form,
-        'csv_data': csv_data,
-        'msg': msg,
-        'error_msg': error_msg,
-        'success_import_list': success_import_list,
-        'type_error_import_list': type_error_import_list,
+        'contact_import': contact_import,
+        'IMPORT_STATUS': IMPORT_STATUS,
     }
-    return render_to_response('dialer_contact/contact/import_contact.html',
+    return render_to_response('dialer_contact/contact/import_status.html',
                               data, context_instance=RequestContext(request))
+
+
+@login_required
+def contact_import_errors(request, object_id):
+    """Download the report of the rows in error of a contact import
+
+    **Attributes**:
+
+        * ``object_id`` - Selected contact import object
+    """
+    contact_import = get_object_or_404(ContactImport, pk=object_id, user=request.user)
+    if not contact_import.error_path or not os.path.isfile(contact_import.error_path):
+        raise Http404
+    response = HttpResponse(open(contact_import.error_path, 'rb'), content_type='text/csv')
+    response['Content-Disposition'] = 'attachment;filename=import_errors_%d.csv' % contact_import.id
+    return response
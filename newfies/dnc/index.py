@@ -0,0 +1,232 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+In-process index of the Do Not Call lists.
+
+Each DNC list is loaded once in a sorted array of packed integers, the
+numbers are prefixed with a 1 before packing so leading zeros are kept.
+Entries ending with ``*`` are wildcard prefixes blocking all the numbers
+starting with them. The E.164 form of the numbers is indexed as well and
+the numbers looked up are matched raw or by their E.164 form, so the
+formatting variants of a number are found, rows without E.164 form
+(inserted by the IVR) are read with the country of the owner of the
+list. The index is refreshed
+incrementally on updated_date, changes that can't be seen this way
+(delete, edit of a number) bump a version in the cache which triggers a
+full reload.
+"""
+
+from django.conf import settings
+from django.core.cache import cache
+from dialer_contact.phonenumber import to_e164_list
+from array import array
+from bisect import bisect_left
+from datetime import timedelta
+from heapq import merge
+import sys
+import time
+
+# Packed numbers are unsigned longs, on 64 bits the leading 1 leaves room for 18 digits
+TYPECODE = 'L'
+PACKED_MAX_DIGITS = 18 if array(TYPECODE).itemsize == 8 else 8
+# New numbers are merged in the sorted array past this size
+MERGE_THRESHOLD = 10000
+# Overlap of the incremental refresh, catch the rows committed late
+REFRESH_OVERLAP = 5
+# Number of rows loaded per query
+LOAD_CHUNK = 50000
+
+
+def pack_number(phone_number):
+    """Pack a phone number in an integer, None if it doesn't fit"""
+    if not phone_number.isdigit() or len(phone_number) > PACKED_MAX_DIGITS:
+        return None
+    return int('1' + phone_number)
+
+
+def unique_sorted(numbers):
+    """Yield the sorted numbers without duplicates"""
+    previous = None
+    for number in numbers:
+        if number != previous:
+            yield number
+        previous = number
+
+
+def get_version_key(dnc_id):
+    return 'dnc_index_version_%d' % dnc_id
+
+
+def invalidate_dnc_index(dnc_id):
+    """Force a full reload of the DNC list by all the processes"""
+    cache.set(get_version_key(dnc_id), time.time(), 60 * 60 * 24 * 30)
+
+
+class DNCIndex(object):
+
+    """
+    DNCIndex holds the phone numbers of one DNC list
+
+    - load : full load of the list
+    - refresh : add the numbers created or updated since the last load
+    - contains / filter_numbers : lookup one number / a batch of numbers
+    """
+
+    def __init__(self, dnc_id):
+        self.dnc_id = dnc_id
+        # owner of the list, reads the numbers stored without E.164 form
+        self.user_id = None
+        self.numbers = array(TYPECODE)
+        # numbers added since the last merge, and the ones that can't be packed
+        self.recent = set()
+        self.others = set()
+        self.prefixes = set()
+        self.max_prefix = 0
+        self.last_updated = None
+        self.version = None
+        self.loaded_at = 0
+
+    def __len__(self):
+        return len(self.numbers) + len(self.recent) + len(self.others) + len(self.prefixes)
+
+    def _add(self, phone_number, buffer):
+        phone_number = phone_number.strip()
+        if not phone_number:
+            return
+        if phone_number.endswith('*'):
+            prefix = phone_number.rstrip('*')
+            self.prefixes.add(prefix)
+            self.max_prefix = max(self.max_prefix, len(prefix))
+            return
+        packed = pack_number(phone_number)
+        if packed is None:
+            self.others.add(phone_number)
+        elif buffer is not None:
+            buffer.append(packed)
+        else:
+            self.recent.add(packed)
+
+    def _merge(self):
+        """Merge the recent numbers in the sorted array"""
+        if not self.recent:
+            return
+        self.numbers = array(TYPECODE, unique_sorted(merge(self.numbers, sorted(self.recent))))
+        self.recent = set()
+
+    def _load_rows(self, queryset, buffer=None):
+        """
+        Add the numbers of the queryset by chunk of primary keys,
+        in ``buffer`` on a full load or in the recent set on a refresh
+        """
+        last_id = 0
+        while True:
+            rows = list(queryset.filter(id__gt=last_id).order_by('id')
+                        .values_list('id', 'phone_number', 'e164', 'updated_date')[:LOAD_CHUNK])
+            if not rows:
+                break
+            # the numbers added by the IVR have no E.164 form
+            list_missing = [phone_number for (row_id, phone_number, e164, updated_date) in rows
+                            if e164 is None and not phone_number.strip().endswith('*')]
+            missing_e164 = dict(zip(list_missing, to_e164_list(list_missing, user_id=self.user_id)))
+            for (row_id, phone_number, e164, updated_date) in rows:
+                self._add(phone_number, buffer)
+                if e164 is None:
+                    e164 = missing_e164.get(phone_number)
+                if e164 and e164 != phone_number:
+                    self._add(e164, buffer)
+                if self.last_updated is None or updated_date > self.last_updated:
+                    self.last_updated = updated_date
+            last_id = rows[-1][0]
+            if len(self.recent) > MERGE_THRESHOLD:
+                self._merge()
+        self._merge()
+
+    def load(self):
+        """Full load of the DNC list"""
+        from dnc.models import DNC, DNCContact
+        self.version = cache.get(get_version_key(self.dnc_id))
+        owner = DNC.objects.filter(pk=self.dnc_id).values_list('user_id', flat=True)
+        self.user_id = owner[0] if owner else None
+        self.recent = set()
+        self.others = set()
+        self.prefixes = set()
+        self.max_prefix = 0
+        self.last_updated = None
+        buffer = array(TYPECODE)
+        self._load_rows(DNCContact.objects.filter(dnc_id=self.dnc_id), buffer)
+        self.numbers = array(TYPECODE, unique_sorted(sorted(buffer)))
+        self.loaded_at = time.time()
+
+    def refresh(self):
+        """Add the numbers created or updated since the last load"""
+        from dnc.models import DNCContact
+        if self.loaded_at == 0 or cache.get(get_version_key(self.dnc_id)) != self.version:
+            self.load()
+            return
+        queryset = DNCContact.objects.filter(dnc_id=self.dnc_id)
+        if self.last_updated is not None:
+            queryset = queryset.filter(
+                updated_date__gte=self.last_updated - timedelta(seconds=REFRESH_OVERLAP))
+        self._load_rows(queryset)
+        self.loaded_at = time.time()
+
+    def contains(self, phone_number):
+        """Return True if the phone number is in the DNC list"""
+        if self.prefixes:
+            for length in range(1, min(self.max_prefix, len(phone_number)) + 1):
+                if phone_number[:length] in self.prefixes:
+                    return True
+        packed = pack_number(phone_number)
+        if packed is None:
+            return phone_number in self.others
+        if packed in self.recent:
+            return True
+        pos = bisect_left(self.numbers, packed)
+        return pos < len(self.numbers) and self.numbers[pos] == packed
+
+    __contains__ = contains
+
+    def filter_numbers(self, list_phone_number, country=None, user_id=None):
+        """
+        Return the set of the phone numbers in the DNC list, raw or by their
+        E.164 form read with ``country`` or the country of the user
+        """
+        list_e164 = to_e164_list(list_phone_number, country, user_id)
+        return set([phone_number for (phone_number, e164) in zip(list_phone_number, list_e164)
+                    if self.contains(phone_number) or (e164 and e164 != phone_number and self.contains(e164))])
+
+    def memory_usage(self):
+        """Approximate size of the index in bytes"""
+        size = self.numbers.buffer_info()[1] * self.numbers.itemsize
+        for container in (self.recent, self.others, self.prefixes):
+            size += sys.getsizeof(container)
+            size += sum([sys.getsizeof(item) for item in container])
+        return size
+
+
+_indexes = {}
+
+
+def get_dnc_index(dnc_id):
+    """
+    Return the index of a DNC list for the current process,
+    refreshed every settings.DNC_INDEX_REFRESH seconds
+    """
+    index = _indexes.get(dnc_id)
+    if index is None:
+        index = _indexes[dnc_id] = DNCIndex(dnc_id)
+    if time.time() - index.loaded_at >= getattr(settings, 'DNC_INDEX_REFRESH', 30):
+        index.refresh()
+    return index
@@ -0,0 +1,108 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand
+from django.db import connection
+from optparse import make_option
+from dnc.models import DNC, DNCContact
+from dnc.index import DNCIndex
+import random
+import time
+
+BULK_SIZE = 10000
+
+
+def create_dnc_list(size):
+    """Create a DNC list of ``size`` random numbers"""
+    user = User.objects.filter(is_superuser=True).order_by('id')[0]
+    dnc = DNC.objects.create(name='benchmark %d' % size, user=user)
+    count = 0
+    while count < size:
+        bulk_record = []
+        for i in range(min(BULK_SIZE, size - count)):
+            bulk_record.append(DNCContact(dnc=dnc, phone_number='%d' % random.randint(10 ** 10, 10 ** 11)))
+        DNCContact.objects.bulk_create(bulk_record)
+        count += len(bulk_record)
+        if count % (BULK_SIZE * 100) == 0:
+            print "  %d numbers created" % count
+    return dnc
+
+
+def delete_dnc_list(dnc):
+    # raw delete, the post_delete signal would load every contact
+    cursor = connection.cursor()
+    cursor.execute("DELETE FROM dnc_contact WHERE dnc_id = %s", [dnc.id])
+    dnc.delete()
+
+
+def run_benchmark(dnc_id, lookups):
+    sample = list(DNCContact.objects.filter(dnc_id=dnc_id)
+                  .values_list('phone_number', flat=True).order_by('?')[:lookups / 2])
+    numbers = sample + ['%d' % random.randint(10 ** 10, 10 ** 11) for i in range(lookups - len(sample))]
+    random.shuffle(numbers)
+
+    start = time.time()
+    index = DNCIndex(dnc_id)
+    index.load()
+    print "index load: %.2fs, %d entries, %.1f MB" % \
+        (time.time() - start, len(index), index.memory_usage() / 1048576.0)
+
+    start = time.time()
+    hits = len([number for number in numbers if number in index])
+    elapsed = time.time() - start
+    print "index lookup: %.2f us per number (%d hits)" % (elapsed * 1000000 / len(numbers), hits)
+
+    start = time.time()
+    hits = 0
+    for number in numbers:
+        if DNCContact.objects.filter(dnc_id=dnc_id, phone_number=number).exists():
+            hits += 1
+    elapsed = time.time() - start
+    print "SQL lookup: %.2f us per number (%d hits)" % (elapsed * 1000000 / len(numbers), hits)
+
+
+class Command(BaseCommand):
+    args = 'dnc_id, size, lookups'
+    help = "Compare the in-memory DNC index with the SQL per-number check\n" \
+           "-------------------------------------------------------------\n" \
+           "python manage.py dnc_benchmark --dnc_id=1\n" \
+           "python manage.py dnc_benchmark --size=1000000,10000000 --lookups=10000"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--dnc_id', default=None, dest='dnc_id',
+                    help='benchmark an existing DNC list'),
+        make_option('--size', default='1000000,10000000', dest='size',
+                    help='sizes of the random DNC lists to create'),
+        make_option('--lookups', default=10000, dest='lookups',
+                    help='number of lookups, half of them are in the list'),
+        make_option('--keep', action='store_true', default=False, dest='keep',
+                    help='keep the random DNC lists'),
+    )
+
+    def handle(self, *args, **options):
+        lookups = int(options['lookups'])
+        if options.get('dnc_id'):
+            run_benchmark(int(options['dnc_id']), lookups)
+            return
+
+        for size in options['size'].split(','):
+            size = int(size)
+            print "DNC list of %d numbers" % size
+            dnc = create_dnc_list(size)
+            try:
+                run_benchmark(dnc.id, lookups)
+            finally:
+                if not options['keep']:
+                    delete_dnc_list(dnc)
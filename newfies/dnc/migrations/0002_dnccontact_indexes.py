@@ -0,0 +1,38 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+INDEXES = [
+    # lookup of a number in a DNC list
+    ('dnc_contact_dnc_phone_number_idx',
+     'ON dnc_contact (dnc_id, phone_number)'),
+    # incremental refresh of the DNC index
+    ('dnc_contact_dnc_updated_date_idx',
+     'ON dnc_contact (dnc_id, updated_date)'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for (name, definition) in INDEXES:
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS %s %s' % (name, definition))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for (name, definition) in INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dnc', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
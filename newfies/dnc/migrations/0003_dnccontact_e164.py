@@ -0,0 +1,21 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import models, migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dnc', '0002_dnccontact_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='dnccontact',
+            name='e164',
+            field=models.CharField(max_length=15, null=True, verbose_name='E.164 number', editable=False,
+                                   blank=True),
+            preserve_default=True,
+        ),
+    ]
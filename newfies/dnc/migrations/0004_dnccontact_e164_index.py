@@ -0,0 +1,35 @@
+# -*- coding: utf-8 -*-
+from __future__ import unicode_literals
+
+from django.db import migrations
+
+INDEXES = [
+    # duplicates of the imported numbers by their E.164 form
+    ('dnc_contact_dnc_e164_idx',
+     'ON dnc_contact (dnc_id, e164)'),
+]
+
+
+def create_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for (name, definition) in INDEXES:
+        schema_editor.execute('CREATE INDEX IF NOT EXISTS %s %s' % (name, definition))
+
+
+def drop_indexes(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+    for (name, definition) in INDEXES:
+        schema_editor.execute('DROP INDEX IF EXISTS %s' % name)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('dnc', '0003_dnccontact_e164'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_indexes, drop_indexes),
+    ]
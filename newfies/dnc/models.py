@@ -13,7 +13,9 @@
 #
 
 from django.db import models
+from django.db.models.signals import post_save, post_delete
 from django.utils.translation import ugettext_lazy as _
+from dialer_contact.phonenumber import to_e164, get_owner_id
 
 
 class DNC(models.Model):
@@ -63,6 +65,7 @@ class DNCContact(models.Model):
     **Attributes**:
 
         * ``phone_number`` - Phone number
+        * ``e164`` - E.164 form of the phone number, without the +
         * ``dnc`` - DNC List
 
     **Relationships**:
@@ -73,6 +76,7 @@ class DNCContact(models.Model):
     """
     dnc = models.ForeignKey(DNC, verbose_name=_("Do Not Call List"))
     phone_number = models.CharField(max_length=120, db_index=True, verbose_name=_("phone number"))
+    e164 = models.CharField(max_length=15, blank=True, null=True, editable=False, verbose_name=_("E.164 number"))
 
     created_date = models.DateTimeField(auto_now_add=True)
     updated_date = models.DateTimeField(auto_now=True,)
@@ -80,6 +84,11 @@ class DNCContact(models.Model):
     def __unicode__(self):
         return '[%s] %s' % (self.id, self.phone_number)
 
+    def save(self, *args, **kwargs):
+        # national numbers are read with the country of the DNC list owner
+        self.e164 = to_e164(self.phone_number, user_id=get_owner_id(self, 'dnc'))
+        super(DNCContact, self).save(*args, **kwargs)
+
     class Meta:
         permissions = (
             ("view_dnc_contact", _('can see Do Not Call contact')),
@@ -87,3 +96,15 @@ class DNCContact(models.Model):
         db_table = "dnc_contact"
         verbose_name = _("Do Not Call contact")
         verbose_name_plural = _("Do Not Call contacts")
+
+
+def dnc_contact_changed(sender, **kwargs):
+    """Numbers edited or deleted can't be seen by the incremental refresh
+    of the DNC index, force a full reload of the list"""
+    if kwargs.get('created'):
+        return
+    from dnc.index import invalidate_dnc_index
+    invalidate_dnc_index(kwargs['instance'].dnc_id)
+
+post_save.connect(dnc_contact_changed, sender=DNCContact)
+post_delete.connect(dnc_contact_changed, sender=DNCContact)
@@ -13,9 +13,12 @@
 #
 
 from django.test import TestCase
+from django.test.utils import override_settings
 from django.contrib.auth.models import User
 from django.conf import settings
 from dnc.models import DNC, DNCContact
+from dnc.index import DNCIndex
+from dialer_contact.phonenumber import get_phonenumber_rules
 from dnc.views import dnc_add, dnc_change, dnc_list, dnc_del,\
     dnc_contact_list, dnc_contact_add, dnc_contact_change, \
     dnc_contact_del, get_dnc_contact_count, dnc_contact_import
@@ -243,6 +246,26 @@ class DNCCustomerView(BaseAuthenticatedClient):
         response = dnc_contact_import(request)
         self.assertEqual(response.status_code, 200)
 
+    def test_dnc_contact_view_import_duplicate(self):
+        """Test Function to check the numbers already in the DNC list are not imported again"""
+        for count in range(2):
+            with open(settings.APPLICATION_DIR + '/dnc/fixtures/import_dnc_contact_10.txt', 'r') as dnc_file:
+                response = self.client.post('/module/dnc_contact_import/',
+                                            data={'dnc_list': '1', 'csv_file': dnc_file})
+            self.assertEqual(response.status_code, 200)
+        self.assertEqual(DNCContact.objects.filter(dnc_id=1, phone_number__startswith='6602000').count(), 10)
+        self.assertEqual(response.context['error_msg'], 'Duplicate DNC contact(s) 10 are not inserted!!')
+
+    def test_dnc_contact_view_import_wildcard(self):
+        """Test Function to check the numbers covered by a wildcard prefix are imported"""
+        DNCContact.objects.create(dnc_id=1, phone_number='6602*')
+        with open(settings.APPLICATION_DIR + '/dnc/fixtures/import_dnc_contact_10.txt', 'r') as dnc_file:
+            response = self.client.post('/module/dnc_contact_import/',
+                                        data={'dnc_list': '1', 'csv_file': dnc_file})
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(DNCContact.objects.filter(dnc_id=1, phone_number__startswith='6602000').count(), 10)
+        self.assertEqual(response.context['error_msg'], '')
+
     def test_get_dnc_contact_count(self):
         request = self.factory.get('/module/dnc_contact/', {'ids': '1'})
         request.user = self.user
@@ -302,3 +325,61 @@ class DNCModel(TestCase):
     def teardown(self):
         self.dnc.delete()
         self.dnc_contact.delete()
+
+
+class DNCIndexTestCase(TestCase):
+
+    """
+    Test the in-memory DNC index
+    """
+
+    fixtures = ['auth_user.json']
+
+    def setUp(self):
+        self.user = User.objects.get(username='admin')
+        self.dnc = DNC.objects.create(name='index_dnc', user=self.user)
+        for phone_number in ['123456', '0044123', '4420*', '+33 1234', '1234567890123456789012']:
+            DNCContact.objects.create(dnc=self.dnc, phone_number=phone_number)
+
+    def test_lookup(self):
+        index = DNCIndex(self.dnc.id)
+        index.load()
+        self.assertEqual(len(index), 5)
+        self.assertTrue('123456' in index)
+        self.assertTrue('0044123' in index)
+        self.assertFalse('44123' in index)
+        self.assertTrue('442071234567' in index)
+        self.assertTrue('+33 1234' in index)
+        self.assertTrue('1234567890123456789012' in index)
+        self.assertFalse('1234567' in index)
+        self.assertEqual(index.filter_numbers(['123456', '654321', '44201']), set(['123456', '44201']))
+
+    def test_refresh(self):
+        index = DNCIndex(self.dnc.id)
+        index.load()
+        DNCContact.objects.create(dnc=self.dnc, phone_number='987654')
+        index.refresh()
+        self.assertTrue('987654' in index)
+
+        # a deleted number is removed by the full reload
+        DNCContact.objects.filter(dnc=self.dnc, phone_number='123456').delete()
+        index.refresh()
+        self.assertFalse('123456' in index)
+        self.assertTrue('987654' in index)
+
+    @override_settings(PHONENUMBER_RULES={'ES': {'country_code': '34', 'national_length': 9}})
+    def test_e164(self):
+        rules = get_phonenumber_rules()
+        rules.load()
+        # reloaded without the rules of the test on next use
+        self.addCleanup(setattr, rules, 'loaded_at', 0)
+        DNCContact.objects.create(dnc=self.dnc, phone_number='+34 650 784 355')
+        # inserted by the IVR without E.164 form
+        ivr_contact = DNCContact.objects.create(dnc=self.dnc, phone_number='+34 650 784 357')
+        DNCContact.objects.filter(pk=ivr_contact.id).update(e164=None)
+        index = DNCIndex(self.dnc.id)
+        index.load()
+        self.assertTrue('34650784355' in index)
+        self.assertTrue('34650784357' in index)
+        self.assertEqual(index.filter_numbers(['0034650784355', '650784355', '650784356'], 'ES'),
+                         set(['0034650784355', '650784355']))
@@ -12,6 +12,7 @@
 # Arezqui Belaid <info@star2billing.com>
 #
 from django.contrib.auth.decorators import login_required, permission_required
+from django.db.models import Q
 from django.http import HttpResponseRedirect, HttpResponse, Http404
 from django.shortcuts import render_to_response, get_object_or_404
 from django.template.context import RequestContext
@@ -23,6 +24,7 @@ from dnc.constants import DNC_COLUMN_NAME, DNC_CONTACT_COLUMN_NAME
 from django_lets_go.common_functions import get_pagination_vars, striplist, source_desti_field_chk,\
     getvar
 from mod_utils.helper import Export_choice
+from dialer_contact.phonenumber import get_phonenumber_rules
 import tablib
 import csv
 
@@ -350,6 +352,33 @@ def dnc_contact_change(request, object_id):
     return render_to_response('dnc/dnc_contact/change.html', data, context_instance=RequestContext(request))
 
 
+def insert_dnc_rows(dnc_id, list_row, imported):
+    """
+    Insert the (row, e164) of ``list_row`` whose number is not in the DNC
+    list yet, nor in ``imported``, and return their rows. The numbers are
+    matched exactly, raw or by their E.164 form, with one query
+    """
+    list_number = set()
+    for (row, e164) in list_row:
+        list_number.update([row[0], e164] if e164 else [row[0]])
+    existing = set()
+    for (phone_number, e164) in DNCContact.objects.filter(dnc_id=dnc_id)\
+            .filter(Q(phone_number__in=list_number) | Q(e164__in=list_number))\
+            .values_list('phone_number', 'e164'):
+        existing.update([phone_number, e164] if e164 else [phone_number])
+    bulk_record = []
+    list_inserted = []
+    for (row, e164) in list_row:
+        numbers = set([row[0], e164] if e164 else [row[0]])
+        if numbers & existing or numbers & imported:
+            continue
+        imported.update(numbers)
+        bulk_record.append(DNCContact(dnc_id=dnc_id, phone_number=row[0], e164=e164))
+        list_inserted.append(row)
+    DNCContact.objects.bulk_create(bulk_record)
+    return list_inserted
+
+
 @login_required
 def dnc_contact_import(request):
     """Import CSV file of DNC Contacts for the logged in user
@@ -378,7 +407,6 @@ def dnc_contact_import(request):
     type_error_import_list = []
     contact_cnt = 0
     dup_contact_cnt = 0
-    bulk_record = []
 
     if form.is_valid():
         # col_no - field name
@@ -391,6 +419,9 @@ def dnc_contact_import(request):
         total_rows = len(list(records))
         BULK_SIZE = 1000
         csv_data = csv.reader(request.FILES['csv_file'])
+        # bulk_create doesn't call save, the E.164 forms are computed here
+        phonenumber_rules = get_phonenumber_rules()
+        list_row = []
 
         # Read each Row
         for row in csv_data:
@@ -406,25 +437,16 @@ def dnc_contact_import(request):
                 type_error_import_list.append(row)
                 continue
 
-            bulk_record.append(
-                DNCContact(
-                    dnc_id=dnc.id,
-                    phone_number=row[0])
-            )
-            contact_cnt = contact_cnt + 1
-            if contact_cnt < 100:
-                # We want to display only 100 lines of the success import
-                success_import_list.append(row)
-
-            if contact_cnt % BULK_SIZE == 0:
-                # Bulk insert
-                DNCContact.objects.bulk_create(bulk_record)
-                bulk_record = []
-
-        if bulk_record:
-            # Remaining record
-            DNCContact.objects.bulk_create(bulk_record)
-            bulk_record = []
+            list_row.append((row, phonenumber_rules.to_e164(row[0], user_id=request.user.id)))
+
+        # numbers of the upload already inserted
+        imported = set()
+        for position in range(0, len(list_row), BULK_SIZE):
+            list_inserted = insert_dnc_rows(dnc.id, list_row[position:position + BULK_SIZE], imported)
+            contact_cnt += len(list_inserted)
+            dup_contact_cnt += min(BULK_SIZE, len(list_row) - position) - len(list_inserted)
+            # We want to display only 100 lines of the success import
+            success_import_list.extend(list_inserted[:max(0, 99 - len(success_import_list))])
 
     # check if there is contact imported
     if contact_cnt > 0:
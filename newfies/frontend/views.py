@@ -26,7 +26,7 @@ from dialer_contact.constants import CONTACT_STATUS
 from dialer_campaign.models import Campaign, Subscriber
 from dialer_campaign.function_def import date_range
 from dialer_cdr.models import VoIPCall
-from dialer_cdr.constants import CALL_DISPOSITION
+from dialer_cdr.constants import CALL_DISPOSITION, DISPOSITION_CODE
 from frontend.forms import LoginForm, DashboardForm
 from frontend.function_def import calculate_date
 from frontend.constants import COLOR_DISPOSITION, SEARCH_TYPE
@@ -196,28 +196,23 @@ def customer_dashboard(request, on_index=None):
                     duration__isnull=False,
                     user=request.user,
                     starting_date__range=(start_date, end_date))\
-            .extra(select=select_data)\
-            .values('starting_date', 'disposition')\
-            .annotate(Count('starting_date'))\
-            .order_by('starting_date')
+            .values('disposition_code')\
+            .annotate(Count('id'))
 
         logging.debug('Aggregate VoIPCall')
 
+        disposition_count = dict((code, 0) for (code, name) in DISPOSITION_CODE)
         for i in calls:
-            total_call_count += i['starting_date__count']
-            if i['disposition'] == CALL_DISPOSITION.ANSWER or i['disposition'] == 'NORMAL_CLEARING':
-                total_answered += i['starting_date__count']
-            elif i['disposition'] == CALL_DISPOSITION.BUSY or i['disposition'] == 'USER_BUSY':
-                total_busy += i['starting_date__count']
-            elif i['disposition'] == CALL_DISPOSITION.NOANSWER or i['disposition'] == 'NO_ANSWER':
-                total_not_answered += i['starting_date__count']
-            elif i['disposition'] == CALL_DISPOSITION.CANCEL or i['disposition'] == 'ORIGINATOR_CANCEL':
-                total_cancel += i['starting_date__count']
-            elif i['disposition'] == CALL_DISPOSITION.CONGESTION or i['disposition'] == 'NORMAL_CIRCUIT_CONGESTION':
-                total_congestion += i['starting_date__count']
-            else:
-                # VOIP CALL FAILED
-                total_failed += i['starting_date__count']
+            total_call_count += i['id__count']
+            code = i['disposition_code'] or DISPOSITION_CODE.FAILED
+            disposition_count[code] += i['id__count']
+        total_answered = disposition_count[DISPOSITION_CODE.ANSWER]
+        total_busy = disposition_count[DISPOSITION_CODE.BUSY]
+        total_not_answered = disposition_count[DISPOSITION_CODE.NOANSWER]
+        total_cancel = disposition_count[DISPOSITION_CODE.CANCEL]
+        total_congestion = disposition_count[DISPOSITION_CODE.CONGESTION]
+        # VOIP CALL FAILED
+        total_failed = disposition_count[DISPOSITION_CODE.FAILED]
 
         # following calls list is without disposition & group by call date
         calls = VoIPCall.objects\
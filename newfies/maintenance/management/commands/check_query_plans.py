@@ -0,0 +1,50 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from maintenance.query_plans import check_query_plans
+import json
+
+
+class Command(BaseCommand):
+    args = 'rows'
+    help = "EXPLAIN the hot queries of the dialer and fail on sequential scans\n" \
+           "the synthetic rows are loaded in a transaction rolled back at the end\n" \
+           "-------------------------------------------------------------------\n" \
+           "python manage.py check_query_plans --rows=2000000"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--rows', default=2000000, dest='rows',
+                    help='synthetic rows per hot table, 0 to check the plans on the current data'),
+        make_option('--show-plan', action='store_true', default=False, dest='show-plan',
+                    help='print the plan of each query'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("The query plans can only be checked on PostgreSQL")
+
+        failed = []
+        for (name, seq_scans, plan) in check_query_plans(int(options['rows'])):
+            if seq_scans:
+                failed.append(name)
+                print "%-30s FAIL seq scan on %s" % (name, ', '.join(seq_scans))
+            else:
+                print "%-30s OK" % name
+            if options['show-plan']:
+                print json.dumps(plan, indent=2)
+        if failed:
+            raise CommandError("Sequential scan on %d hot queries" % len(failed))
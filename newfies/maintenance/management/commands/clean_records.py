@@ -14,12 +14,8 @@
 
 from django.core.management.base import BaseCommand
 from optparse import make_option
-from dialer_campaign.models import Campaign, Subscriber
-from dialer_cdr.models import Callrequest, VoIPCall
-# from dialer_contact.models import Phonebook, Contact
-from survey.models import Survey, Section, Branching, Result, ResultAggregate
-# from django.db import connection
-# from survey.models import Section
+from survey.models import Survey, Section, Branching
+from maintenance.retention import RetentionEngine
 from datetime import datetime
 from django.utils.timezone import utc
 from dateutil.relativedelta import relativedelta
@@ -28,11 +24,21 @@ from dateutil.relativedelta import relativedelta
 class Command(BaseCommand):
     args = 'older-than-day'
     help = "Clean records older than the giving older-than-day setting (default=365)\n" \
+           "the rows are deleted in batches, an interrupted run is resumed from its checkpoint\n" \
            "------------------------------------------------------------------------\n" \
-           "python manage.py clean_records --older-than-day=365"
+           "python manage.py clean_records --older-than-day=365 --batch-size=5000 --max-rate=20000\n" \
+           "python manage.py clean_records --older-than-day=365 --dry-run"
 
     option_list = BaseCommand.option_list + (
         make_option('--older-than-day', default=None, dest='older-than-day', help=help),
+        make_option('--batch-size', default=None, dest='batch-size',
+                    help='rows deleted per transaction'),
+        make_option('--max-rate', default=None, dest='max-rate',
+                    help='rows deleted per second, 0 for no throttle'),
+        make_option('--checkpoint', default=None, dest='checkpoint',
+                    help='file keeping the progress, to resume an interrupted run'),
+        make_option('--dry-run', action='store_true', default=False, dest='dry-run',
+                    help='only count the rows to delete'),
     )
 
     def handle(self, *args, **options):
@@ -45,145 +51,48 @@ class Command(BaseCommand):
                 older_than_day = int(options.get('older-than-day'))
             except ValueError:
                 older_than_day = 365
+        max_rate = options.get('max-rate')
+        if max_rate is not None:
+            max_rate = float(max_rate)
 
-        clean_records(older_than_day)
+        clean_records(older_than_day, batch_size=options.get('batch-size'), max_rate=max_rate,
+                      checkpoint=options.get('checkpoint'), dry_run=options['dry-run'])
 
 
-def clean_records(older_than_day):
+def print_progress(name, deleted, elapsed):
+    print "  %-25s %10d deleted %8.0f rows/s" % (name, deleted, deleted / max(elapsed, 0.001))
+
+
+def clean_records(older_than_day, batch_size=None, max_rate=None, checkpoint=None, dry_run=False):
     """
     This function delete older database records in order to clean the database:
         * older_than_day
 
     """
     old_date = datetime.utcnow().replace(tzinfo=utc) + relativedelta(days=-abs(older_than_day))
+    engine = RetentionEngine(old_date, batch_size=batch_size, max_rate=max_rate,
+                             checkpoint=checkpoint, report=print_progress)
+
+    if dry_run:
+        print "Records older than %d days that would be deleted:" % older_than_day
+        for (name, count) in engine.count():
+            print "  %-25s %10d" % (name, count)
+        return
 
     print "We will deleted from the database all the records older than: %d days" % older_than_day
-    print "The following models will be cleaned:"
-    print "  - Campaign"
-    print "  - Subscriber"
-    print "  - Callrequest"
-    print "  - VoIPCall"
-    # print "  - Phonebook"
-    # print "  - Contact"
+    if engine.state['done'] or engine.state['last_id']:
+        print "Resuming from %s, steps done: %s" % (checkpoint, ', '.join(engine.state['done']) or '-')
     print ""
 
-    # Delete old Campaigns
-    print "Deleting old Campaigns => number to delete: %(count)s" % \
-        {'count': Campaign.objects.filter(created_date__lt=old_date).count()}
-
-    list_obj = Campaign.objects.filter(created_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting Campaign => : %s" % obj
-        obj.delete()
-
-    # Delete old Subscribers
-    print "Deleting old Subscribers => number to delete: %(count)s" % \
-        {'count': Subscriber.objects.filter(created_date__lt=old_date).count()}
-
-    list_obj = Subscriber.objects.filter(created_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting Subscriber => : %s" % obj
-        obj.delete()
-
-    # Delete old Callrequests
-    print "Deleting old Callrequests => number to delete: %(count)s" % \
-        {'count': Callrequest.objects.filter(created_date__lt=old_date).count()}
-
-    list_obj = Callrequest.objects.filter(created_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting Callrequest => : %s" % obj
-        obj.delete()
-
-    # Delete old VoIPCalls
-    print "Deleting old VoIPCalls => number to delete: %(count)s" % \
-        {'count': VoIPCall.objects.filter(starting_date__lt=old_date).count()}
-
-    list_obj = VoIPCall.objects.filter(starting_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting VoIPCall => : %s" % obj
-        obj.delete()
-
-    # Delete old Phonebooks
-    # print "Deleting old Phonebooks => number to delete: %(count)s" % \
-    #     {'count': Phonebook.objects.filter(created_date__lt=old_date).count()}
-
-    # list_obj = Phonebook.objects.filter(created_date__lt=old_date)
-    # for obj in list_obj:
-    #     print "Deleting Phonebook => : %s" % obj
-    #     obj.delete()
-
-    # #Delete old Contacts
-    # print "Deleting old Contacts => number to delete: %(count)s" % \
-    #     {'count': Contact.objects.filter(created_date__lt=old_date).count()}
-
-    # list_obj = Contact.objects.filter(created_date__lt=old_date)
-    # for obj in list_obj:
-    #     print "Deleting Contact => : %s" % obj
-    #     obj.delete()
-
-    # Delete old ResultAggregates
-    print "Deleting old ResultAggregates => number to delete: %(count)s" % \
-        {'count': ResultAggregate.objects.filter(created_date__lt=old_date).count()}
-
-    list_obj = ResultAggregate.objects.filter(created_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting ResultAggregate => : %s" % obj
-        obj.delete()
-
-    # Delete old Result
-    print "Deleting old Result => number to delete: %(count)s" % \
-        {'count': Result.objects.filter(created_date__lt=old_date).count()}
-
-    list_obj = Result.objects.filter(created_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting Result => : %s" % obj
-        obj.delete()
-
-    # Delete old Branchings
-    print "Deleting old Branchings => number to delete: %(count)s" % \
-        {'count': Branching.objects.filter(created_date__lt=old_date).count()}
-
-    list_obj = Branching.objects.filter(created_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting Branching => : %s" % obj
-        obj.delete()
-
-    # Delete old Sections
-    print "Deleting old Sections => number to delete: %(count)s" % \
-        {'count': Section.objects.filter(created_date__lt=old_date).count()}
-
-    list_obj = Section.objects.filter(created_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting Section => : %s" % obj
-        obj.delete()
-
-    # Delete old Surveys
-    print "Deleting old Surveys => number to delete: %(count)s" % \
-        {'count': Survey.objects.filter(created_date__lt=old_date).count()}
-
-    list_obj = Survey.objects.filter(created_date__lt=old_date)
-    for obj in list_obj:
-        print "Deleting Survey => : %s" % obj
-        obj.delete()
+    total = 0
+    for (name, deleted, seconds) in engine.run():
+        total += deleted
+        print "%-27s %10d deleted in %.1fs (%.0f rows/s)" % (name, deleted, seconds, deleted / max(seconds, 0.001))
+
+    # The survey templates are few, deleted with their sections and branchings
+    Branching.objects.filter(created_date__lt=engine.older_than).delete()
+    Section.objects.filter(created_date__lt=engine.older_than).delete()
+    Survey.objects.filter(created_date__lt=engine.older_than).delete()
 
     # -------------------------------
-    print "The cleaning is finished!"
-
-
-"""
-    DELETE FROM "dialer_campaign_phonebook" WHERE campaign_id IN
-        (SELECT id FROM "dialer_campaign" WHERE "dialer_campaign"."created_date" < '2014-07-31 18:57:57');
-    DELETE FROM "dialer_campaign" WHERE "dialer_campaign"."created_date" < '2014-07-31 18:57:57';
-    DELETE FROM "dialer_subscriber" WHERE "dialer_subscriber"."created_date" < '2014-07-31 18:57:57';
-    DELETE FROM "dialer_callrequest" WHERE "dialer_callrequest"."created_date" < '2014-07-31 18:57:57';
-    DELETE FROM "dialer_cdr" WHERE "dialer_cdr"."starting_date" < '2014-07-31 18:57:57';
-    DELETE FROM "survey_resultaggregate" WHERE "survey_resultaggregate"."created_date" < '2014-07-31 18:57:57';
-    DELETE FROM "survey_result" WHERE "survey_result"."created_date" < '2014-07-31 18:57:57';
-    DELETE FROM "survey_branching" WHERE "survey_branching"."created_date" < '2014-07-31 18:57:57';
-    DELETE FROM "survey_section" WHERE "survey_section"."created_date" < '2014-07-31 18:57:57';
-    DELETE FROM "survey_survey" WHERE "survey_survey"."created_date" < '2014-07-31 18:57:57';
-
-    DELETE FROM "dialer_contact" WHERE "created_date" < '2014-07-31 18:57:57';
-    DELETE FROM "dialer_phonebook" WHERE "created_date" < '2014-07-31 18:57:57';
-
-"""
+    print "The cleaning is finished! %d records deleted" % total
@@ -0,0 +1,65 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection
+from optparse import make_option
+from maintenance.partitions import convert_table, get_partitions, is_partitioned, \
+    partition_maintenance, PartitionError
+
+
+class Command(BaseCommand):
+    args = 'convert'
+    help = "Partition the CDR and call event tables by date and apply their retention\n" \
+           "without option, create the upcoming partitions and drop the expired ones\n" \
+           "-------------------------------------------------------------------------\n" \
+           "python manage.py partition_tables --convert=dialer_cdr\n" \
+           "python manage.py partition_tables --list"
+
+    option_list = BaseCommand.option_list + (
+        make_option('--convert', default=None, dest='convert',
+                    help='table to convert, one of PARTITIONED_TABLES'),
+        make_option('--list', action='store_true', default=False, dest='list',
+                    help='list the partitions of each table'),
+    )
+
+    def handle(self, *args, **options):
+        if connection.vendor != 'postgresql':
+            raise CommandError("Tables can only be partitioned on PostgreSQL")
+
+        table = options.get('convert')
+        if table:
+            if table not in settings.PARTITIONED_TABLES:
+                raise CommandError("%s is not in PARTITIONED_TABLES" % table)
+            try:
+                convert_table(table, settings.PARTITIONED_TABLES[table])
+            except PartitionError as e:
+                raise CommandError(str(e))
+            print "%s partitioned on %s" % (table, settings.PARTITIONED_TABLES[table])
+
+        if options['list']:
+            for table in sorted(settings.PARTITIONED_TABLES):
+                if not is_partitioned(table):
+                    print "%s : not partitioned" % table
+                    continue
+                print "%s :" % table
+                for partition in get_partitions(table):
+                    print "  %-40s %s - %s" % (partition['name'],
+                                               partition['lower'] or '', partition['upper'] or '')
+            return
+
+        for (table, (created, removed)) in partition_maintenance().items():
+            print "%s : %d partitions ensured, %d dropped %s" % (
+                table, len(created), len(removed), ', '.join(removed))
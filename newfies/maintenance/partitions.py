@@ -0,0 +1,269 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Range partitioning of the append-only tables (PostgreSQL 11+ only).
+
+A table is converted once: the existing table becomes the partition
+holding everything up to the end of the current period, and new rows
+go to one partition per day or month created ahead of time. Retention
+is then a DETACH / DROP of the partitions past the retention date, and
+the queries filtering on the partition column only scan the partitions
+of their date range.
+
+dialer_callrequest is not partitioned, the foreign keys pointing to it
+need a primary key on id alone.
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.utils.timezone import utc
+from dateutil.relativedelta import relativedelta
+from datetime import datetime, date, timedelta
+import logging
+import re
+
+logger = logging.getLogger('newfies.filelog')
+
+PARTITION_DAY = 'day'
+PARTITION_MONTH = 'month'
+
+BOUND_RE = re.compile(r"FROM \((.+)\) TO \((.+)\)")
+
+
+class PartitionError(Exception):
+
+    """Raised when a table cannot be partitioned"""
+    pass
+
+
+def period_start(day, interval):
+    """First day of the period containing ``day``"""
+    if interval == PARTITION_MONTH:
+        return day.replace(day=1)
+    return day
+
+
+def next_period(start, interval):
+    if interval == PARTITION_MONTH:
+        return start + relativedelta(months=1)
+    return start + timedelta(days=1)
+
+
+def partition_name(table, start, interval):
+    if interval == PARTITION_MONTH:
+        return '%s_p%s' % (table, start.strftime('%Y%m'))
+    return '%s_p%s' % (table, start.strftime('%Y%m%d'))
+
+
+def bound_literal(day):
+    """Partition bound of a day, midnight UTC"""
+    return "'%s 00:00:00+00'" % day.isoformat()
+
+
+def parse_bound(value):
+    """Return the date of a partition bound, None for MINVALUE / MAXVALUE"""
+    value = value.strip("'")
+    if value in ('MINVALUE', 'MAXVALUE'):
+        return None
+    return datetime.strptime(value[:10], '%Y-%m-%d').date()
+
+
+def is_partitioned(table):
+    cursor = connection.cursor()
+    cursor.execute("SELECT relkind FROM pg_class WHERE oid = to_regclass(%s)", [table])
+    row = cursor.fetchone()
+    return bool(row) and row[0] == 'p'
+
+
+def get_partitions(table):
+    """
+    Return the partitions of ``table`` as a list of dict with the name and
+    the lower / upper dates, sorted on the lower date. The bounds of the
+    default partition are None, it has 'default' set.
+    """
+    cursor = connection.cursor()
+    cursor.execute(
+        "SELECT c.relname, pg_get_expr(c.relpartbound, c.oid) FROM pg_inherits i "
+        "JOIN pg_class c ON c.oid = i.inhrelid WHERE i.inhparent = to_regclass(%s)", [table])
+    partitions = []
+    for (name, bound) in cursor.fetchall():
+        match = BOUND_RE.search(bound)
+        if match:
+            partitions.append({'name': name, 'default': False,
+                               'lower': parse_bound(match.group(1)), 'upper': parse_bound(match.group(2))})
+        else:
+            partitions.append({'name': name, 'default': True, 'lower': None, 'upper': None})
+    partitions.sort(key=lambda partition: (not partition['default'], partition['lower'] or date.min))
+    return partitions
+
+
+def ensure_partitions(table, interval=None, premake=None, today=None):
+    """
+    Create the partitions up to ``premake`` periods after today and the
+    default partition catching the rows out of range, return the names
+    of the created partitions
+    """
+    if interval is None:
+        interval = settings.PARTITION_INTERVAL
+    if premake is None:
+        premake = settings.PARTITION_PREMAKE
+    if today is None:
+        today = datetime.utcnow().replace(tzinfo=utc).date()
+
+    partitions = get_partitions(table)
+    uppers = [partition['upper'] for partition in partitions if partition['upper']]
+    start = period_start(today, interval)
+    if uppers and max(uppers) > start:
+        start = max(uppers)
+    last = period_start(today, interval)
+    for count in range(premake):
+        last = next_period(last, interval)
+
+    cursor = connection.cursor()
+    created = []
+    while start <= last:
+        end = next_period(start, interval)
+        name = partition_name(table, start, interval)
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s PARTITION OF %s FOR VALUES FROM (%s) TO (%s)" %
+                       (name, table, bound_literal(start), bound_literal(end)))
+        created.append(name)
+        start = end
+    if not [partition for partition in partitions if partition['default']]:
+        cursor.execute("CREATE TABLE IF NOT EXISTS %s_pdefault PARTITION OF %s DEFAULT" % (table, table))
+    return created
+
+
+def drop_partitions(table, before, detach_only=False):
+    """
+    Remove the partitions holding only rows older than ``before``,
+    a detached partition is kept as a plain table for archiving.
+    Return the names of the removed partitions
+    """
+    cursor = connection.cursor()
+    removed = []
+    for partition in get_partitions(table):
+        if partition['default'] or partition['upper'] is None or partition['upper'] > before:
+            continue
+        with transaction.atomic():
+            cursor.execute("ALTER TABLE %s DETACH PARTITION %s" % (table, partition['name']))
+            if not detach_only:
+                cursor.execute("DROP TABLE %s" % partition['name'])
+        logger.info('Partition %s removed from %s' % (partition['name'], table))
+        removed.append(partition['name'])
+    return removed
+
+
+def copy_index_sql(indexdef, table):
+    """Rewrite the CREATE INDEX of the original table for the partitioned table"""
+    match = re.match(r'CREATE (UNIQUE )?INDEX (\S+) ON (\S+) (USING .+)$', indexdef)
+    if not match or match.group(1):
+        # a unique index would have to include the partition column
+        return None
+    return 'CREATE INDEX %s ON %s %s' % ((match.group(2) + '_part')[:63], table, match.group(4))
+
+
+def convert_table(table, column, interval=None, premake=None):
+    """
+    Turn ``table`` into a table partitioned by range on ``column``,
+    the existing table is attached as the partition of all the rows
+    up to the end of the current period
+    """
+    if interval is None:
+        interval = settings.PARTITION_INTERVAL
+    if connection.vendor != 'postgresql' or connection.pg_version < 110000:
+        raise PartitionError('Partitioning requires PostgreSQL 11 or later')
+    if is_partitioned(table):
+        raise PartitionError('%s is already partitioned' % table)
+
+    legacy = '%s_plegacy' % table
+    new = '%s_partitioned' % table
+    bound = ('%s_pbound' % table)[:63]
+    upper = next_period(period_start(datetime.utcnow().replace(tzinfo=utc).date(), interval), interval)
+    cursor = connection.cursor()
+    # ATTACH PARTITION scans the table under the ACCESS EXCLUSIVE lock unless
+    # a valid constraint already proves its rows fit the partition bound,
+    # the constraint is validated beforehand with the writes still going on
+    cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s CHECK (%s IS NOT NULL AND %s < %s) NOT VALID" %
+                   (table, bound, column, column, bound_literal(upper)))
+    try:
+        cursor.execute("ALTER TABLE %s VALIDATE CONSTRAINT %s" % (table, bound))
+        with transaction.atomic():
+            lock_and_convert(cursor, table, column, legacy, new, bound, upper, interval, premake)
+    except Exception:
+        # the constraint would reject the rows of the next periods
+        cursor.execute("ALTER TABLE %s DROP CONSTRAINT IF EXISTS %s" % (table, bound))
+        raise
+    logger.info('%s partitioned by %s on %s' % (table, interval, column))
+
+
+def lock_and_convert(cursor, table, column, legacy, new, bound, upper, interval, premake):
+    """Swap ``table`` for its partitioned copy, ``bound`` is validated on ``table``"""
+    cursor.execute("LOCK TABLE %s IN ACCESS EXCLUSIVE MODE" % table)
+    cursor.execute(
+        "CREATE TABLE %s (LIKE %s INCLUDING DEFAULTS INCLUDING CONSTRAINTS INCLUDING STORAGE) "
+        "PARTITION BY RANGE (%s)" % (new, table, column))
+    cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (new, bound))
+    # the primary key of a partitioned table has to include the partition column
+    cursor.execute("ALTER TABLE %s ADD PRIMARY KEY (id, %s)" % (new, column))
+
+    cursor.execute(
+        "SELECT indexdef FROM pg_indexes WHERE tablename = %s AND indexname NOT IN "
+        "(SELECT conname FROM pg_constraint WHERE conrelid = to_regclass(%s) AND contype = 'p')",
+        [table, table])
+    for (indexdef,) in cursor.fetchall():
+        sql = copy_index_sql(indexdef, new)
+        if sql:
+            cursor.execute(sql)
+
+    cursor.execute(
+        "SELECT conname, pg_get_constraintdef(oid) FROM pg_constraint "
+        "WHERE conrelid = to_regclass(%s) AND contype = 'f'", [table])
+    for (name, definition) in cursor.fetchall():
+        cursor.execute("ALTER TABLE %s ADD CONSTRAINT %s %s" % (new, (name + '_part')[:63], definition))
+
+    cursor.execute("ALTER TABLE %s RENAME TO %s" % (table, legacy))
+    cursor.execute("ALTER TABLE %s RENAME TO %s" % (new, table))
+    # dropping the old rows must not drop the sequence of the ids
+    cursor.execute("SELECT pg_get_serial_sequence(%s, 'id')", [legacy])
+    sequence = cursor.fetchone()[0]
+    if sequence:
+        cursor.execute("ALTER SEQUENCE %s OWNED BY %s.id" % (sequence, table))
+
+    cursor.execute("ALTER TABLE %s ATTACH PARTITION %s FOR VALUES FROM (MINVALUE) TO (%s)" %
+                   (table, legacy, bound_literal(upper)))
+    cursor.execute("ALTER TABLE %s DROP CONSTRAINT %s" % (legacy, bound))
+    ensure_partitions(table, interval, premake)
+
+
+def partition_maintenance(today=None):
+    """
+    Create the upcoming partitions of the partitioned tables and remove
+    the partitions past the retention of PARTITION_RETENTION (in days)
+    """
+    if connection.vendor != 'postgresql':
+        return {}
+    if today is None:
+        today = datetime.utcnow().replace(tzinfo=utc).date()
+    retention = settings.PARTITION_RETENTION
+    result = {}
+    for table in sorted(settings.PARTITIONED_TABLES):
+        if not is_partitioned(table):
+            continue
+        created = ensure_partitions(table, today=today)
+        removed = []
+        if retention.get(table):
+            removed = drop_partitions(table, today - timedelta(days=retention[table]))
+        result[table] = (created, removed)
+    return result
@@ -0,0 +1,161 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Query plan regression checks of the dialer hot paths (PostgreSQL only).
+
+A synthetic dataset is loaded in the hot tables inside a transaction that
+is rolled back at the end, each hot query is run through EXPLAIN and the
+sequential scans on the hot tables are reported.
+"""
+
+from django.db import connection, transaction
+import json
+
+HOT_TABLES = ['dialer_subscriber', 'dialer_callrequest', 'call_event', 'dnc_contact']
+
+CAMPAIGNS = 50
+DNC_LISTS = 5
+
+# (name, sql, params) of the queries run on each tick of the dialer
+HOT_QUERIES = [
+    ('subscriber_claim',
+     "SELECT id FROM dialer_subscriber WHERE campaign_id = %s AND status = 1 "
+     "ORDER BY id LIMIT 100 FOR UPDATE SKIP LOCKED", [7]),
+    ('subscriber_count_status',
+     "SELECT status, count(*) FROM dialer_subscriber WHERE campaign_id = %s GROUP BY status", [7]),
+    ('callrequest_request_uuid',
+     "SELECT id FROM dialer_callrequest WHERE request_uuid = %s", ['0c8e5d4e-8a4a-11e4-b116-123b93f75cba']),
+    ('callrequest_calling_campaign',
+     "SELECT count(*) FROM dialer_callrequest WHERE campaign_id = %s AND status = 7", [7]),
+    ('callrequest_calling_gateway',
+     "SELECT count(*) FROM dialer_callrequest WHERE aleg_gateway_id = %s AND status = 7", [1]),
+    ('callrequest_pending',
+     "SELECT id FROM dialer_callrequest WHERE status = 1 AND call_time <= now()", []),
+    ('call_event_pending',
+     "SELECT id, event_name FROM call_event WHERE status = 1 LIMIT 1000 OFFSET 0", []),
+    ('dnc_contact_lookup',
+     "SELECT 1 FROM dnc_contact WHERE dnc_id = %s AND phone_number = %s", [2, '34650123456']),
+]
+
+# Same columns as listener.lua
+CREATE_CALL_EVENT = """
+    CREATE TABLE if not exists call_event (
+        id serial NOT NULL PRIMARY KEY,
+        event_name varchar(200) NOT NULL,
+        body varchar(200) NOT NULL,
+        job_uuid varchar(200),
+        call_uuid varchar(200) NOT NULL,
+        used_gateway_id integer,
+        callrequest_id integer,
+        alarm_request_id integer,
+        callerid varchar(200),
+        phonenumber varchar(200),
+        duration integer DEFAULT 0,
+        billsec integer DEFAULT 0,
+        hangup_cause varchar(40),
+        hangup_cause_q850 varchar(10),
+        amd_status varchar(40),
+        leg varchar(10) DEFAULT 'aleg',
+        starting_date timestamp with time zone,
+        status smallint,
+        created_date timestamp with time zone NOT NULL
+        );
+    CREATE INDEX IF NOT EXISTS call_event_idx_status ON call_event (status);
+    CREATE INDEX IF NOT EXISTS call_event_pending_idx ON call_event (id) WHERE status = 1;
+"""
+
+# 5% of the subscribers pending, 1% of the callrequests calling, 0.1% of the events pending,
+# the foreign keys are deferred and never checked as the transaction is rolled back
+LOAD_DATASET = [
+    "INSERT INTO dialer_subscriber (contact_id, campaign_id, duplicate_contact, status, "
+    "count_attempt, completion_count_attempt, created_date, updated_date) "
+    "SELECT g, g %% {campaigns} + 1, (34600000000 + g)::text, "
+    "CASE WHEN g %% 20 = 0 THEN 1 ELSE 8 END, 0, 0, now(), now() "
+    "FROM generate_series(1, %s) g",
+    "INSERT INTO dialer_callrequest (user_id, request_uuid, call_time, created_date, updated_date, "
+    "call_type, status, callerid, caller_name, phone_number, timeout, timelimit, extra_dial_string, "
+    "campaign_id, aleg_gateway_id, content_type_id, object_id, completed, extra_data, num_attempt, "
+    "result, hangup_cause) "
+    "SELECT 1, md5(g::text), now() - interval '1 day', now(), now(), 1, "
+    "CASE WHEN g %% 100 = 0 THEN 7 WHEN g %% 1000 = 1 THEN 1 ELSE 4 END, '', '', "
+    "(34600000000 + g)::text, 30, 3600, '', g %% {campaigns} + 1, g %% 4 + 1, 1, 1, false, '', 1, '', '' "
+    "FROM generate_series(1, %s) g",
+    "INSERT INTO call_event (event_name, body, call_uuid, status, created_date) "
+    "SELECT 'CHANNEL_HANGUP_COMPLETE', '', md5(g::text), CASE WHEN g %% 1000 = 0 THEN 1 ELSE 2 END, now() "
+    "FROM generate_series(1, %s) g",
+    "INSERT INTO dnc_contact (dnc_id, phone_number, created_date, updated_date) "
+    "SELECT g %% {dnc_lists} + 1, (34650000000 + g)::text, now(), now() "
+    "FROM generate_series(1, %s) g",
+]
+
+
+class Rollback(Exception):
+    pass
+
+
+def load_dataset(cursor, rows):
+    """Load ``rows`` synthetic rows in each hot table and refresh the statistics"""
+    cursor.execute(CREATE_CALL_EVENT)
+    for sql_statement in LOAD_DATASET:
+        cursor.execute(sql_statement.format(campaigns=CAMPAIGNS, dnc_lists=DNC_LISTS), [rows])
+    for table in HOT_TABLES:
+        cursor.execute("ANALYZE %s" % table)
+
+
+def get_seq_scans(plan):
+    """Return the relations read with a sequential scan in an EXPLAIN (FORMAT JSON) plan"""
+    seq_scans = []
+    if plan.get('Node Type') == 'Seq Scan':
+        seq_scans.append(plan.get('Relation Name'))
+    for child in plan.get('Plans', []):
+        seq_scans.extend(get_seq_scans(child))
+    return seq_scans
+
+
+def explain(cursor, sql_statement, params):
+    cursor.execute("EXPLAIN (FORMAT JSON) " + sql_statement, params)
+    plan = cursor.fetchone()[0]
+    if isinstance(plan, basestring):
+        plan = json.loads(plan)
+    return plan[0]['Plan']
+
+
+def check_query_plans(rows=None, seqscan=True):
+    """
+    Return a list of (name, seq_scans, plan) for each hot query, the
+    seq_scans are the hot tables read sequentially
+
+    If ``rows`` is set, the synthetic dataset is loaded first and
+    everything is rolled back once the plans are collected. Without
+    ``seqscan`` the planner only reads a table sequentially when no index
+    serves the query, the check holds on a dataset too small for the
+    planner to pick the indexes
+    """
+    results = []
+    try:
+        with transaction.atomic():
+            cursor = connection.cursor()
+            if not seqscan:
+                cursor.execute("SET LOCAL enable_seqscan = off")
+            if rows:
+                load_dataset(cursor, rows)
+            for (name, sql_statement, params) in HOT_QUERIES:
+                plan = explain(cursor, sql_statement, params)
+                seq_scans = [table for table in get_seq_scans(plan) if table in HOT_TABLES]
+                results.append((name, seq_scans, plan))
+            raise Rollback()
+    except Rollback:
+        pass
+    return results
@@ -0,0 +1,254 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Retention of the high volume tables.
+
+The old rows are deleted in batches of ids read in primary key order
+(keyset pagination), each batch in one transaction, with the same
+cascade as the ORM but set-based:
+
+- the rows pointing to the batch are handled according to the
+  ``on_delete`` of their foreign key: deleted for CASCADE, recursively
+  and children first, detached for SET_NULL and left alone for
+  DO_NOTHING
+- then the batch itself is deleted
+
+A row older than the cut-off date is kept while a row of another step
+table points to it with a date past the cut-off: a campaign with recent
+subscribers or callrequests, a subscriber or a callrequest still being
+called, stay until their children expire.
+
+The steps run children first. The last id of each step is saved in a
+checkpoint file, an interrupted run started again with the same file
+resumes where it stopped, with the same cut-off date.
+"""
+
+from django.conf import settings
+from django.db import connection, transaction
+from django.db.models.deletion import CASCADE, SET_NULL, DO_NOTHING
+from datetime import datetime
+import json
+import os
+import time
+
+
+def get_retention_steps():
+    """
+    Return the (name, table, date column, model) of the steps in
+    dependency order, model is None for the tables without model
+    """
+    from sms.models import Message
+    from survey.models import Result, ResultAggregate
+    from dialer_cdr.models import Callrequest, VoIPCall
+    from dialer_campaign.models import Campaign, Subscriber
+    steps = [('call_event', 'call_event', 'created_date', None)]
+    for (name, model, column) in [
+            ('sms_message', Message, 'send_date'),
+            ('survey_result', Result, 'created_date'),
+            ('survey_resultaggregate', ResultAggregate, 'created_date'),
+            ('voipcall', VoIPCall, 'starting_date'),
+            ('callrequest', Callrequest, 'created_date'),
+            ('subscriber', Subscriber, 'created_date'),
+            ('campaign', Campaign, 'created_date')]:
+        steps.append((name, model._meta.db_table, column, model))
+    return steps
+
+
+class RetentionError(Exception):
+
+    """Raised when the rows depending on a batch can't be handled"""
+    pass
+
+
+def get_dependents(model):
+    """
+    Return the (model, table, column, on_delete) of the foreign keys
+    pointing to ``model``, including the tables of its many to many fields
+    """
+    if model is None:
+        return []
+    dependents = []
+    for related in model._meta.get_all_related_objects(include_hidden=True):
+        field = related.field
+        dependents.append((related.model, related.model._meta.db_table, field.column, field.rel.on_delete))
+    return dependents
+
+
+def id_list(list_id):
+    return ','.join([str(int(item)) for item in list_id])
+
+
+class RetentionEngine(object):
+
+    """
+    Delete the rows older than ``older_than`` from the tables of the steps
+
+    **Attributes**:
+
+        * ``batch_size`` - Rows deleted per transaction
+        * ``max_rate`` - Rows per second not to go over, 0 for no throttle
+        * ``checkpoint`` - Path of the JSON file keeping the progress
+        * ``report`` - Called with (name, deleted, elapsed) after each batch
+    """
+
+    def __init__(self, older_than, batch_size=None, max_rate=None, checkpoint=None, report=None,
+                 steps=None):
+        if batch_size is None:
+            batch_size = settings.RETENTION_BATCH_SIZE
+        if max_rate is None:
+            max_rate = settings.RETENTION_MAX_RATE
+        self.older_than = older_than
+        self.batch_size = int(batch_size)
+        self.max_rate = max_rate
+        self.checkpoint = checkpoint
+        self.report = report
+        self.steps = steps if steps is not None else get_retention_steps()
+        # date column of the step tables, a row is kept while it has a recent child in one of them
+        self.date_columns = dict((table, column) for (name, table, column, model)
+                                 in get_retention_steps() + list(self.steps))
+        self.dependents = {}
+        self.state = {'older_than': older_than.isoformat(), 'last_id': {}, 'done': []}
+        self.load_checkpoint()
+
+    def load_checkpoint(self):
+        if not self.checkpoint or not os.path.exists(self.checkpoint):
+            return
+        with open(self.checkpoint) as f:
+            self.state = json.load(f)
+        # resume with the cut-off date of the interrupted run
+        self.older_than = datetime.strptime(self.state['older_than'][:19], '%Y-%m-%dT%H:%M:%S')\
+            .replace(tzinfo=self.older_than.tzinfo)
+
+    def save_checkpoint(self):
+        if not self.checkpoint:
+            return
+        with open(self.checkpoint + '.tmp', 'w') as f:
+            json.dump(self.state, f)
+        os.rename(self.checkpoint + '.tmp', self.checkpoint)
+
+    def table_exists(self, table):
+        return table in connection.introspection.table_names()
+
+    def get_dependents(self, model):
+        if model not in self.dependents:
+            self.dependents[model] = get_dependents(model)
+        return self.dependents[model]
+
+    def get_expired_sql(self, table, column, model):
+        """Return the (condition, params) of the expired rows of a step table aliased t"""
+        condition = "t.%s < %%s" % column
+        params = [self.older_than]
+        for (child_model, child_table, child_column, on_delete) in self.get_dependents(model):
+            date_column = self.date_columns.get(child_table)
+            if date_column:
+                condition += " AND NOT EXISTS (SELECT 1 FROM %s c WHERE c.%s = t.id AND c.%s >= %%s)" % \
+                    (child_table, child_column, date_column)
+                params.append(self.older_than)
+        return (condition, params)
+
+    def count(self):
+        """Return the (name, rows to delete) of each step, for a dry run"""
+        cursor = connection.cursor()
+        result = []
+        for (name, table, column, model) in self.steps:
+            if not self.table_exists(table):
+                continue
+            (condition, params) = self.get_expired_sql(table, column, model)
+            cursor.execute("SELECT count(*) FROM %s t WHERE %s" % (table, condition), params)
+            result.append((name, cursor.fetchone()[0]))
+        return result
+
+    def delete_rows(self, cursor, model, table, list_id):
+        """Delete the rows of ``list_id`` after the rows depending on them"""
+        ids = id_list(list_id)
+        for (child_model, child_table, column, on_delete) in self.get_dependents(model):
+            if on_delete is DO_NOTHING:
+                continue
+            elif on_delete is SET_NULL:
+                cursor.execute("UPDATE %s SET %s = NULL WHERE %s IN (%s)" % (child_table, column, column, ids))
+            elif on_delete is not CASCADE:
+                raise RetentionError('%s.%s : only CASCADE, SET_NULL and DO_NOTHING are handled' %
+                                     (child_table, column))
+            elif self.get_dependents(child_model):
+                # the children of the children go first
+                sql = "SELECT id FROM %s WHERE %s IN (%s)" % (child_table, column, ids)
+                if child_table == table:
+                    sql += " AND id NOT IN (%s)" % ids
+                cursor.execute(sql)
+                list_child_id = [row[0] for row in cursor.fetchall()]
+                if list_child_id:
+                    self.delete_rows(cursor, child_model, child_table, list_child_id)
+            else:
+                cursor.execute("DELETE FROM %s WHERE %s IN (%s)" % (child_table, column, ids))
+        cursor.execute("DELETE FROM %s WHERE id IN (%s)" % (table, ids))
+        return cursor.rowcount
+
+    def delete_batch(self, table, list_id, model):
+        with transaction.atomic():
+            return self.delete_rows(connection.cursor(), model, table, list_id)
+
+    def drop_partitions(self, table):
+        """Expired partitions go away with a DROP instead of row deletes"""
+        if connection.vendor != 'postgresql' or table not in settings.PARTITIONED_TABLES:
+            return
+        from maintenance.partitions import is_partitioned, drop_partitions
+        if is_partitioned(table):
+            drop_partitions(table, self.older_than.date())
+
+    def run_step(self, name, table, column, model):
+        self.drop_partitions(table)
+        (condition, params) = self.get_expired_sql(table, column, model)
+        cursor = connection.cursor()
+        last_id = self.state['last_id'].get(name, 0)
+        deleted = 0
+        start = time.time()
+        while True:
+            cursor.execute(
+                "SELECT t.id FROM %s t WHERE %s AND t.id > %%s ORDER BY t.id LIMIT %%s" % (table, condition),
+                params + [last_id, self.batch_size])
+            list_id = [row[0] for row in cursor.fetchall()]
+            if not list_id:
+                break
+            deleted += self.delete_batch(table, list_id, model)
+            last_id = list_id[-1]
+            self.state['last_id'][name] = last_id
+            self.save_checkpoint()
+            elapsed = time.time() - start
+            if self.report:
+                self.report(name, deleted, elapsed)
+            if self.max_rate:
+                # throttle : never go over max_rate rows per second
+                wait = float(deleted) / self.max_rate - elapsed
+                if wait > 0:
+                    time.sleep(wait)
+            if len(list_id) < self.batch_size:
+                break
+        return deleted
+
+    def run(self):
+        """Run the steps not done yet, return the (name, deleted, seconds) of each"""
+        result = []
+        for (name, table, column, model) in self.steps:
+            if name in self.state['done'] or not self.table_exists(table):
+                continue
+            start = time.time()
+            deleted = self.run_step(name, table, column, model)
+            result.append((name, deleted, time.time() - start))
+            self.state['done'].append(name)
+            self.save_checkpoint()
+        if self.checkpoint and os.path.exists(self.checkpoint):
+            # finished, the next run starts from scratch
+            os.remove(self.checkpoint)
+        return result
@@ -0,0 +1,39 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from celery.decorators import periodic_task
+from celery.utils.log import get_task_logger
+from django_lets_go.only_one_task import only_one
+from maintenance.partitions import partition_maintenance
+from datetime import timedelta
+
+LOCK_EXPIRE = 60 * 30  # Lock expires in 30 minutes
+
+logger = get_task_logger(__name__)
+
+
+@periodic_task(run_every=timedelta(days=1))  # every 1 day
+@only_one(ikey="partition_maintenance", timeout=LOCK_EXPIRE)
+def run_partition_maintenance(*args, **kwargs):
+    """A periodic task that creates the upcoming partitions and drops
+    the partitions past their retention
+
+    **Usage**:
+
+        run_partition_maintenance.delay()
+    """
+    logger.info("TASK :: run_partition_maintenance")
+    for (table, (created, removed)) in partition_maintenance().items():
+        if removed:
+            logger.info("%s : dropped partitions %s" % (table, ', '.join(removed)))
@@ -1,3 +1,185 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from django.db import connection
 from django.test import TestCase
+from maintenance.query_plans import check_query_plans, get_seq_scans
+from maintenance.partitions import convert_table, copy_index_sql, drop_partitions, \
+    ensure_partitions, get_partitions, next_period, parse_bound, partition_name, period_start
+from maintenance.retention import RetentionEngine, get_retention_steps
+from dialer_campaign.models import Campaign, Subscriber
+from dialer_cdr.models import Callrequest, VoIPCall
+from survey.models import Survey
+from datetime import date, datetime, timedelta
+from django.utils.timezone import utc
+from unittest import skipUnless
+from uuid import uuid1
+import os
+import tempfile
+
+
+class QueryPlanTestCase(TestCase):
+
+    """Test that the hot queries of the dialer use the indexes"""
+
+    def test_get_seq_scans(self):
+        plan = {
+            'Node Type': 'Limit',
+            'Plans': [
+                {'Node Type': 'Seq Scan', 'Relation Name': 'call_event'},
+                {'Node Type': 'Index Scan', 'Relation Name': 'dialer_subscriber'},
+            ]
+        }
+        self.assertEqual(get_seq_scans(plan), ['call_event'])
+
+    @skipUnless(connection.vendor == 'postgresql', 'query plans are checked on PostgreSQL')
+    def test_hot_query_plans(self):
+        if settings.QUERY_PLAN_TEST_ROWS:
+            # the plans picked by the planner on a large dataset
+            results = check_query_plans(settings.QUERY_PLAN_TEST_ROWS)
+        else:
+            # an index serves each query
+            results = check_query_plans(10000, seqscan=False)
+        for (name, seq_scans, plan) in results:
+            self.assertEqual(seq_scans, [], '%s reads %s sequentially' % (name, seq_scans))
+
+
+class PartitionTestCase(TestCase):
+
+    """Test the date partitioning of the CDR and call event tables"""
+
+    def test_periods(self):
+        self.assertEqual(period_start(date(2015, 3, 17), 'month'), date(2015, 3, 1))
+        self.assertEqual(next_period(date(2015, 12, 1), 'month'), date(2016, 1, 1))
+        self.assertEqual(next_period(date(2015, 2, 28), 'day'), date(2015, 3, 1))
+        self.assertEqual(partition_name('call_event', date(2015, 3, 1), 'month'), 'call_event_p201503')
+        self.assertEqual(partition_name('call_event', date(2015, 3, 17), 'day'), 'call_event_p20150317')
+        self.assertEqual(parse_bound("'2015-03-01 00:00:00+00'"), date(2015, 3, 1))
+        self.assertEqual(parse_bound('MINVALUE'), None)
+
+    def test_copy_index_sql(self):
+        self.assertEqual(
+            copy_index_sql('CREATE INDEX call_event_idx_status ON public.call_event USING btree (status)',
+                           'call_event_partitioned'),
+            'CREATE INDEX call_event_idx_status_part ON call_event_partitioned USING btree (status)')
+        self.assertEqual(
+            copy_index_sql('CREATE UNIQUE INDEX call_event_uuid ON public.call_event USING btree (call_uuid)',
+                           'call_event_partitioned'), None)
+
+    @skipUnless(connection.vendor == 'postgresql', 'tables are partitioned on PostgreSQL')
+    def test_convert_table(self):
+        if connection.pg_version < 110000:
+            self.skipTest('partitioning requires PostgreSQL 11')
+        cursor = connection.cursor()
+        cursor.execute("CREATE TABLE partition_test (id serial PRIMARY KEY, "
+                       "created_date timestamp with time zone NOT NULL, status smallint)")
+        cursor.execute("CREATE INDEX partition_test_status ON partition_test (status)")
+        cursor.execute("INSERT INTO partition_test (created_date, status) VALUES ('2015-01-10', 1)")
+
+        convert_table('partition_test', 'created_date', 'month', premake=2)
+        partitions = get_partitions('partition_test')
+        self.assertEqual(partitions[0]['name'], 'partition_test_pdefault')
+        self.assertEqual(partitions[1]['name'], 'partition_test_plegacy')
+        self.assertEqual(len(partitions), 4)
+        # the bound checked before attaching the legacy table is dropped
+        cursor.execute("SELECT count(*) FROM pg_constraint WHERE conname = 'partition_test_pbound'")
+        self.assertEqual(cursor.fetchone()[0], 0)
+        # the legacy rows are still there and the ids keep going
+        cursor.execute("INSERT INTO partition_test (created_date, status) VALUES (now(), 1) RETURNING id")
+        self.assertEqual(cursor.fetchone()[0], 2)
+        cursor.execute("SELECT count(*) FROM partition_test")
+        self.assertEqual(cursor.fetchone()[0], 2)
+
+        # nothing to create on the next run, then everything expires
+        self.assertEqual(len(ensure_partitions('partition_test', 'month', premake=2)), 0)
+        removed = drop_partitions('partition_test', date(2100, 1, 1))
+        self.assertEqual(len(removed), 3)
+        cursor.execute("SELECT count(*) FROM partition_test")
+        self.assertEqual(cursor.fetchone()[0], 0)
+
+
+class RetentionTestCase(TestCase):
+
+    """Test the batched retention of clean_records"""
+
+    fixtures = ['auth_user.json', 'gateway.json', 'dialer_setting.json',
+                'user_profile.json', 'phonebook.json', 'contact.json',
+                'dnc_list.json', 'dnc_contact.json', 'survey.json',
+                'campaign.json', 'subscriber.json', 'callrequest.json', 'voipcall.json']
+
+    def setUp(self):
+        self.now = datetime.utcnow().replace(tzinfo=utc)
+        callrequest = Callrequest.objects.get(pk=1)
+        self.old_callrequest = []
+        for count in range(5):
+            callrequest.pk = None
+            callrequest.request_uuid = str(uuid1())
+            callrequest.save()
+            self.old_callrequest.append(callrequest.id)
+        Callrequest.objects.exclude(id__in=self.old_callrequest).update(created_date=self.now)
+        Callrequest.objects.filter(id__in=self.old_callrequest)\
+            .update(created_date=self.now - timedelta(days=400))
+        VoIPCall.objects.update(starting_date=self.now)
+        # a recent CDR of an old callrequest
+        self.voipcall = VoIPCall.objects.all()[0]
+        VoIPCall.objects.filter(id=self.voipcall.id).update(callrequest=self.old_callrequest[0])
+        self.steps = [step for step in get_retention_steps() if step[0] in ('voipcall', 'callrequest')]
+
+    def test_dry_run(self):
+        engine = RetentionEngine(self.now - timedelta(days=365), batch_size=2, steps=self.steps)
+        # the callrequest with a recent CDR is kept
+        self.assertEqual(dict(engine.count())['callrequest'], 4)
+        self.assertEqual(Callrequest.objects.filter(id__in=self.old_callrequest).count(), 5)
+
+    def test_run(self):
+        checkpoint = os.path.join(tempfile.mkdtemp(), 'retention.json')
+        reports = []
+        engine = RetentionEngine(self.now - timedelta(days=365), batch_size=2, checkpoint=checkpoint,
+                                 report=lambda name, deleted, elapsed: reports.append((name, deleted)),
+                                 steps=self.steps)
+        result = dict((name, deleted) for (name, deleted, seconds) in engine.run())
+        self.assertEqual(result['callrequest'], 4)
+        self.assertEqual(reports[-1], ('callrequest', 4))
+        # the callrequest of the recent CDR is kept until the CDR expires
+        self.assertEqual(list(Callrequest.objects.filter(id__in=self.old_callrequest).values_list('id', flat=True)),
+                         [self.old_callrequest[0]])
+        self.assertEqual(VoIPCall.objects.get(pk=self.voipcall.id).callrequest_id, self.old_callrequest[0])
+        self.assertFalse(os.path.exists(checkpoint))
 
-# Create your tests here.
+    def test_cascade(self):
+        old = self.now - timedelta(days=400)
+        Campaign.objects.update(created_date=old)
+        Subscriber.objects.update(created_date=old)
+        Callrequest.objects.update(created_date=old)
+        VoIPCall.objects.update(starting_date=old)
+        # a recent subscriber keeps its campaign
+        subscriber = Subscriber.objects.create(contact_id=1, campaign_id=2, duplicate_contact='640234000')
+        orphans = (Subscriber.objects.filter(campaign__isnull=True).count(),
+                   Callrequest.objects.filter(campaign__isnull=True).count(),
+                   Survey.objects.filter(campaign__isnull=True).count())
+        steps = [step for step in get_retention_steps() if step[0] == 'campaign']
+        result = RetentionEngine(self.now - timedelta(days=365), batch_size=1, steps=steps).run()
+        self.assertEqual(result[0][:2], ('campaign', 1))
+        self.assertFalse(Campaign.objects.filter(pk=1).exists())
+        self.assertTrue(Campaign.objects.filter(pk=2).exists())
+        self.assertTrue(Subscriber.objects.filter(pk=subscriber.id).exists())
+        # the rows of the campaign go with it, down to the CDR of its callrequests
+        self.assertFalse(Subscriber.objects.filter(pk=1).exists())
+        self.assertFalse(Callrequest.objects.filter(id__in=self.old_callrequest).exists())
+        self.assertFalse(VoIPCall.objects.filter(pk=self.voipcall.id).exists())
+        self.assertFalse(Survey.objects.filter(pk=1).exists())
+        self.assertEqual((Subscriber.objects.filter(campaign__isnull=True).count(),
+                          Callrequest.objects.filter(campaign__isnull=True).count(),
+                          Survey.objects.filter(campaign__isnull=True).count()), orphans)
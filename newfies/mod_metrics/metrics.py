@@ -0,0 +1,264 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+"""
+Counters and gauges of the dialer, exposed in the Prometheus text format.
+
+The values live in the cache, shared by all the processes, and are
+updated with ``cache.incr`` by the tasks as they move subscribers,
+callrequests, CDRs and messages, so a scrape only reads the cache and
+never counts the large tables. The gauges which can drift (a worker
+killed between a write and its update) are set back to the exact value
+by the metrics_reconcile task.
+"""
+
+from django.core.cache import cache
+from celery.utils.log import get_task_logger
+import time
+
+logger = get_task_logger(__name__)
+
+COUNTER = 'counter'
+GAUGE = 'gauge'
+
+# name: (type, help, label names)
+METRICS = {
+    'newfies_subscribers_pending': (
+        GAUGE, 'Subscribers PENDING per campaign', ('campaign_id',)),
+    'newfies_callrequests_calling': (
+        GAUGE, 'Callrequests in CALLING per campaign', ('campaign_id',)),
+    'newfies_call_event_backlog': (
+        GAUGE, 'Call events waiting to be processed', ()),
+    'newfies_originate_backlog': (
+        GAUGE, 'Callrequests spooled and waiting for their originate (Celery ETA or dispatcher)', ()),
+    'newfies_callrequests_spooled_total': (
+        COUNTER, 'Callrequests spooled per campaign, retries included', ('campaign_id',)),
+    'newfies_originate_total': (
+        COUNTER, 'Originates sent to FreeSWITCH by result (success or error)', ('result',)),
+    'newfies_cdr_total': (
+        COUNTER, 'CDRs written by disposition', ('disposition',)),
+    'newfies_sms_total': (
+        COUNTER, 'SMS messages queued for sending by origin (campaign or alarm)', ('origin',)),
+    'newfies_alarm_total': (
+        COUNTER, 'Alarms performed by method', ('method',)),
+}
+
+METRIC_KEY_EXPIRE = 60 * 60 * 24 * 30
+# seconds between two checks that a series known by the process is still in the cache
+REGISTRY_CHECK_INTERVAL = 300
+
+# series registered by this process, with the time of their last check
+_known_series = {}
+
+
+def get_series_key(name, label_values, prefix='metrics'):
+    # memcached keys cannot hold spaces
+    return '%s_%s_%s' % (prefix, name, '_'.join([str(value).replace(' ', '-') for value in label_values]))
+
+
+def get_registry_key(name):
+    """Number of series of the metric, each one is listed in its own slot key"""
+    return 'metrics_series_%s' % name
+
+
+def get_slot_key(name, number):
+    return 'metrics_series_%s_%d' % (name, number)
+
+
+def get_label_values(name, labels):
+    return tuple([labels.get(label, '') for label in METRICS[name][2]])
+
+
+def register_series(name, label_values):
+    """
+    Add the series to the ones listed on a scrape : cache.add on its
+    marker lets a single process give it the next slot of the metric.
+    The process checks again every REGISTRY_CHECK_INTERVAL seconds that
+    its series are still registered, the cache may have dropped them
+    """
+    checked = _known_series.get((name, label_values))
+    if checked and checked > time.time() - REGISTRY_CHECK_INTERVAL:
+        return
+    marker_key = get_series_key(name, label_values, 'metrics_slot')
+    number = cache.get(marker_key)
+    if number and cache.get(get_slot_key(name, number)) == label_values:
+        # still registered, keep it from expiring
+        cache.set_many({marker_key: number, get_slot_key(name, number): label_values}, METRIC_KEY_EXPIRE)
+    elif number == 0 and not checked:
+        # another process is giving it a slot, checked again on the next interval
+        pass
+    elif number is not None or cache.add(marker_key, 0, METRIC_KEY_EXPIRE):
+        # a slot lost or never given, the other processes see the marker and leave it to us
+        registry_key = get_registry_key(name)
+        cache.add(registry_key, 0, METRIC_KEY_EXPIRE)
+        try:
+            number = cache.incr(registry_key)
+        except ValueError:
+            # expired between add and incr
+            number = 1
+            cache.set(registry_key, number, METRIC_KEY_EXPIRE)
+        cache.set_many({get_slot_key(name, number): label_values, marker_key: number}, METRIC_KEY_EXPIRE)
+    _known_series[(name, label_values)] = time.time()
+
+
+def get_registered_series():
+    """Return the label values of the series of each metric"""
+    counts = cache.get_many([get_registry_key(name) for name in METRICS])
+    slot_keys = []
+    for name in METRICS:
+        count = counts.get(get_registry_key(name)) or 0
+        slot_keys.extend([get_slot_key(name, number) for number in range(1, count + 1)])
+    slots = cache.get_many(slot_keys)
+    result = {}
+    for name in METRICS:
+        series = result[name] = []
+        count = counts.get(get_registry_key(name)) or 0
+        for number in range(1, count + 1):
+            label_values = slots.get(get_slot_key(name, number))
+            # a series registered again after its slot was lost holds two slots
+            if label_values is not None and label_values not in series:
+                series.append(label_values)
+    return result
+
+
+def inc(name, value=1, **labels):
+    """Add ``value`` to a counter or a gauge, the errors are logged only"""
+    if not value:
+        return
+    try:
+        label_values = get_label_values(name, labels)
+        register_series(name, label_values)
+        key = get_series_key(name, label_values)
+        cache.add(key, 0, METRIC_KEY_EXPIRE)
+        try:
+            cache.incr(key, value)
+        except ValueError:
+            # expired between add and incr
+            cache.set(key, value, METRIC_KEY_EXPIRE)
+    except Exception as e:
+        logger.error('Metric %s not updated : %s' % (name, e))
+
+
+def dec(name, value=1, **labels):
+    inc(name, -value, **labels)
+
+
+def set_gauge(name, value, **labels):
+    label_values = get_label_values(name, labels)
+    register_series(name, label_values)
+    cache.set(get_series_key(name, label_values), value, METRIC_KEY_EXPIRE)
+
+
+def set_gauges(name, values):
+    """
+    Set the gauge of each label value of ``values``, a dict keyed by the
+    value of the only label of the metric, the other series drop to 0
+    """
+    label_values = [(value,) for value in values]
+    for known in get_registered_series()[name]:
+        if known not in label_values:
+            label_values.append(known)
+    for labels in label_values:
+        register_series(name, labels)
+    cache.set_many(dict([(get_series_key(name, labels), values.get(labels[0], 0)) for labels in label_values]),
+                   METRIC_KEY_EXPIRE)
+
+
+def get_samples():
+    """Return the (name, type, help, [(labels, value)]) of the metrics"""
+    registries = get_registered_series()
+    keys = []
+    for name in METRICS:
+        keys.extend([get_series_key(name, labels) for labels in registries[name]])
+    values = cache.get_many(keys)
+    result = []
+    for name in sorted(METRICS):
+        (metric_type, help_text, label_names) = METRICS[name]
+        samples = []
+        for labels in registries[name]:
+            samples.append((dict(zip(label_names, labels)), values.get(get_series_key(name, labels), 0)))
+        result.append((name, metric_type, help_text, samples))
+    return result
+
+
+def escape_label(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def format_labels(labels):
+    if not labels:
+        return ''
+    return '{%s}' % ','.join(['%s="%s"' % (name, escape_label(labels[name])) for name in sorted(labels)])
+
+
+def format_value(value):
+    if isinstance(value, float):
+        return repr(value)
+    return str(value)
+
+
+def render_metric(name, metric_type, help_text, samples):
+    lines = ['# HELP %s %s' % (name, help_text), '# TYPE %s %s' % (name, metric_type)]
+    for (labels, value) in samples:
+        lines.append('%s%s %s' % (name, format_labels(labels), format_value(value)))
+    return lines
+
+
+def render_trace_stats():
+    """Histograms of the call stages recorded by dialer_cdr.tracing"""
+    from dialer_cdr.tracing import get_trace_stats, STAGES
+    stats = get_trace_stats()
+    lines = ['# HELP newfies_call_stage_seconds Latency of the stages of the calls',
+             '# TYPE newfies_call_stage_seconds histogram']
+    for stage in STAGES:
+        for (bound, total) in stats[stage]['buckets']:
+            lines.append('newfies_call_stage_seconds_bucket%s %d' %
+                         (format_labels({'stage': stage, 'le': bound}), total))
+        lines.append('newfies_call_stage_seconds_count%s %d' % (format_labels({'stage': stage}),
+                                                               stats[stage]['count']))
+        lines.append('newfies_call_stage_seconds_sum%s %s' % (format_labels({'stage': stage}),
+                                                             repr(stats[stage]['sum'])))
+    lines.extend(['# HELP newfies_call_stage_queries_total SQL queries run by the stages of the calls',
+                  '# TYPE newfies_call_stage_queries_total counter'])
+    for stage in STAGES:
+        if stats[stage]['runs']:
+            lines.append('newfies_call_stage_queries_total%s %d' % (format_labels({'stage': stage}),
+                                                                   stats[stage]['queries']))
+    return lines
+
+
+def render_callevent_latency():
+    """Hangup to CDR latency published by the callevent_listener command"""
+    from dialer_cdr.callevent_listener import CALLEVENT_LATENCY_KEY
+    stats = cache.get(CALLEVENT_LATENCY_KEY)
+    if not stats:
+        return []
+    lines = ['# HELP newfies_callevent_latency_seconds Hangup to CDR latency of the call event listener',
+             '# TYPE newfies_callevent_latency_seconds summary']
+    for (quantile, field) in (('0.5', 'p50'), ('0.95', 'p95'), ('1', 'max')):
+        lines.append('newfies_callevent_latency_seconds%s %s' %
+                     (format_labels({'quantile': quantile}), repr(float(stats[field]))))
+    lines.append('newfies_callevent_latency_seconds_count %d' % stats['count'])
+    lines.append('newfies_callevent_latency_seconds_sum %s' % repr(float(stats['avg'] * stats['count'])))
+    return lines
+
+
+def render_metrics():
+    """Return all the metrics in the Prometheus text format"""
+    lines = []
+    for (name, metric_type, help_text, samples) in get_samples():
+        lines.extend(render_metric(name, metric_type, help_text, samples))
+    lines.extend(render_trace_stats())
+    lines.extend(render_callevent_latency())
+    return '\n'.join(lines) + '\n'
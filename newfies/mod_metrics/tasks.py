@@ -0,0 +1,74 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from django.db import connection
+from django.db.models import Count
+from celery.decorators import periodic_task
+from celery.utils.log import get_task_logger
+from django_lets_go.only_one_task import only_one
+from dialer_campaign.models import Campaign, Subscriber
+from dialer_campaign.constants import SUBSCRIBER_STATUS
+from dialer_cdr.models import Callrequest
+from dialer_cdr.constants import CALLREQUEST_STATUS, CALLEVENT_STATUS
+from mod_metrics.metrics import set_gauge, set_gauges
+from datetime import timedelta
+
+LOCK_EXPIRE = 60 * 5  # Lock expires in 5 minutes
+
+logger = get_task_logger(__name__)
+
+
+def reconcile_gauges():
+    """
+    Set the gauges maintained by the tasks back to their exact value,
+    with one grouped count per gauge on the partial indexes
+    """
+    list_campaign_id = list(Campaign.objects.get_running_campaign().values_list('id', flat=True))
+    pending = dict(Subscriber.objects
+                   .filter(campaign_id__in=list_campaign_id, status=SUBSCRIBER_STATUS.PENDING)
+                   .values_list('campaign_id').annotate(Count('id')).order_by())
+    set_gauges('newfies_subscribers_pending', pending)
+
+    calling = dict(Callrequest.objects
+                   .filter(status=CALLREQUEST_STATUS.CALLING, campaign__isnull=False)
+                   .values_list('campaign_id').annotate(Count('id')).order_by())
+    set_gauges('newfies_callrequests_calling', calling)
+
+    # spooled campaign callrequests waiting for their originate, the ETA
+    # tasks lost by the broker are never originated nor counted down
+    set_gauge('newfies_originate_backlog',
+              Callrequest.objects.filter(status=CALLREQUEST_STATUS.PENDING, campaign__isnull=False).count())
+
+    if connection.vendor == 'postgresql':
+        cursor = connection.cursor()
+        # call_event is created by listener.lua
+        cursor.execute("SELECT to_regclass('call_event') IS NOT NULL")
+        if cursor.fetchone()[0]:
+            cursor.execute("SELECT count(*) FROM call_event WHERE status IN (%s, %s)",
+                           [CALLEVENT_STATUS.PENDING, CALLEVENT_STATUS.CLAIMED])
+            set_gauge('newfies_call_event_backlog', cursor.fetchone()[0])
+
+
+@periodic_task(run_every=timedelta(seconds=settings.METRICS_RECONCILE_INTERVAL))
+@only_one(ikey="metrics_reconcile", timeout=LOCK_EXPIRE)
+def metrics_reconcile(*args, **kwargs):
+    """A periodic task that sets the dialer gauges back to their exact value
+
+    **Usage**:
+
+        metrics_reconcile.delay()
+    """
+    logger.debug("TASK :: metrics_reconcile")
+    reconcile_gauges()
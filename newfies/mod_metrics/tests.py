@@ -0,0 +1,94 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.core.cache import cache
+from django.test import TestCase
+from django.test.utils import override_settings
+from mod_metrics.metrics import inc, dec, set_gauges, get_samples, render_metric, render_metrics, \
+    get_registry_key
+from mod_metrics.tasks import reconcile_gauges
+from mod_metrics import metrics
+
+
+class MetricsTestCase(TestCase):
+
+    """Test the dialer counters and gauges"""
+
+    def setUp(self):
+        cache.clear()
+        # the series registered by the other tests are gone with the cache
+        metrics._known_series.clear()
+
+    def get_values(self, name):
+        for (metric_name, metric_type, help_text, samples) in get_samples():
+            if metric_name == name:
+                return dict([(tuple(labels.values()), value) for (labels, value) in samples])
+
+    def test_counter(self):
+        inc('newfies_originate_total', result='success')
+        inc('newfies_originate_total', 2, result='success')
+        inc('newfies_originate_total', result='error')
+        inc('newfies_originate_total', 0, result='nothing')
+        self.assertEqual(self.get_values('newfies_originate_total'), {('success',): 3, ('error',): 1})
+        # unknown metric, logged only
+        inc('newfies_unknown_total')
+
+    def test_gauges(self):
+        inc('newfies_subscribers_pending', 10, campaign_id=1)
+        dec('newfies_subscribers_pending', 4, campaign_id=1)
+        inc('newfies_subscribers_pending', 5, campaign_id=2)
+        self.assertEqual(self.get_values('newfies_subscribers_pending'), {(1,): 6, (2,): 5})
+        set_gauges('newfies_subscribers_pending', {1: 7, 3: 1})
+        self.assertEqual(self.get_values('newfies_subscribers_pending'), {(1,): 7, (3,): 1, (2,): 0})
+        self.assertEqual(cache.get(get_registry_key('newfies_subscribers_pending')), 3)
+
+    def test_register_series(self):
+        inc('newfies_alarm_total', method=1)
+        # another process registers its series
+        metrics._known_series.clear()
+        inc('newfies_alarm_total', method=2)
+        inc('newfies_alarm_total', method=1)
+        self.assertEqual(self.get_values('newfies_alarm_total'), {(1,): 2, (2,): 1})
+        self.assertEqual(cache.get(get_registry_key('newfies_alarm_total')), 2)
+        # the cache dropped the series, registered again on the next check
+        cache.clear()
+        inc('newfies_alarm_total', method=1)
+        self.assertEqual(self.get_values('newfies_alarm_total'), {})
+        metrics._known_series[('newfies_alarm_total', (1,))] = 0
+        inc('newfies_alarm_total', method=1)
+        self.assertEqual(self.get_values('newfies_alarm_total'), {(1,): 2})
+
+    def test_reconcile(self):
+        # originates lost by the broker leave the backlog up
+        inc('newfies_originate_backlog', 5)
+        reconcile_gauges()
+        self.assertEqual(self.get_values('newfies_originate_backlog'), {(): 0})
+
+    def test_render(self):
+        lines = render_metric('newfies_cdr_total', 'counter', 'CDRs written',
+                              [({'disposition': 'ANSWER'}, 3), ({'disposition': 'a"b\\c'}, 1.5)])
+        self.assertEqual(lines, ['# HELP newfies_cdr_total CDRs written',
+                                 '# TYPE newfies_cdr_total counter',
+                                 'newfies_cdr_total{disposition="ANSWER"} 3',
+                                 'newfies_cdr_total{disposition="a\\"b\\\\c"} 1.5'])
+        self.assertTrue(render_metrics().endswith('\n'))
+
+    @override_settings(METRICS_ALLOWED_IPS=['127.0.0.1'])
+    def test_view(self):
+        inc('newfies_alarm_total', method=1)
+        response = self.client.get('/metrics/')
+        self.assertEqual(response.status_code, 200)
+        self.assertTrue('newfies_alarm_total{method="1"} 1' in response.content)
+        response = self.client.get('/metrics/', REMOTE_ADDR='10.0.0.1')
+        self.assertEqual(response.status_code, 403)
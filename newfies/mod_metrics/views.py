@@ -0,0 +1,29 @@
+#
+# Newfies-Dialer License
+# http://www.newfies-dialer.org
+#
+# This Source Code Form is subject to the terms of the Mozilla Public
+# License, v. 2.0. If a copy of the MPL was not distributed with this file,
+# You can obtain one at http://mozilla.org/MPL/2.0/.
+#
+# Copyright (C) 2011-2015 Star2Billing S.L.
+#
+# The primary maintainer of this project is
+# Arezqui Belaid <info@star2billing.com>
+#
+
+from django.conf import settings
+from django.http import HttpResponse, HttpResponseForbidden
+from mod_metrics.metrics import render_metrics
+
+
+def metrics(request):
+    """
+    Dialer metrics in the Prometheus text format, for the addresses
+    of settings.METRICS_ALLOWED_IPS
+
+    **URL**: /metrics/
+    """
+    if settings.METRICS_ALLOWED_IPS and request.META.get('REMOTE_ADDR') not in settings.METRICS_ALLOWED_IPS:
+        return HttpResponseForbidden()
+    return HttpResponse(render_metrics(), content_type='text/plain; version=0.0.4; charset=utf-8')
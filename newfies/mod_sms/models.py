@@ -17,7 +17,6 @@ from django.utils.translation import ugettext_lazy as _
 from django.utils.timezone import now
 from django.core.urlresolvers import reverse
 from django.core.cache import cache
-from django.db.models.signals import post_save
 from django.utils.encoding import force_unicode
 from dateutil.relativedelta import relativedelta
 from dialer_contact.models import Phonebook, Contact
@@ -535,33 +534,3 @@ class SMSTemplate(Model):
 
     def __unicode__(self):
         return force_unicode(self.template_key)
-
-
-def post_save_add_contact(sender, **kwargs):
-    """A ``post_save`` signal is sent by the Contact model instance whenever
-    it is going to save.
-
-    **Logic Description**:
-
-        * When new contact is added into ``Contact`` model, active the
-          campaign list will be checked with the contact status.
-        * If the active campaign list count is more than one & the contact
-          is active, the contact will be added into ``SMSCampaignSubscriber``
-          model.
-    """
-    obj = kwargs['instance']
-    active_campaign_list = SMSCampaign.objects.filter(
-        phonebook__contact__id=obj.id, status=SMS_CAMPAIGN_STATUS.START)
-    # created instance = True + active contact + active_campaign
-    if kwargs['created'] and obj.status == SMS_CAMPAIGN_STATUS.START and active_campaign_list.count() >= 1:
-        for elem_campaign in active_campaign_list:
-            try:
-                SMSCampaignSubscriber.objects.create(
-                    contact=obj,
-                    duplicate_contact=obj.contact,
-                    status=SMS_CAMPAIGN_STATUS.START,  # START
-                    sms_campaign=elem_campaign)
-            except:
-                pass
-
-post_save.connect(post_save_add_contact, sender=Contact)
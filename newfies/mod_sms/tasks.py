@@ -23,6 +23,7 @@ from sms.tasks import SendMessage
 from mod_sms.models import SMSCampaign, SMSCampaignSubscriber, SMSMessage
 from mod_sms.constants import SMS_SUBSCRIBER_STATUS, SMS_CAMPAIGN_STATUS
 from dialer_campaign.function_def import user_dialer_setting
+from mod_metrics import metrics
 from datetime import datetime, timedelta
 from django.utils.timezone import utc
 from math import ceil
@@ -85,6 +86,7 @@ def init_smsrequest(obj_subscriber, obj_sms_campaign):
         # Send sms
         logger.warning("[SMS_TASK] Call msg_obj id:%d - gateway_id:%d" % (msg_obj.id, obj_sms_campaign.sms_gateway_id))
         SendMessage.delay(msg_obj.id, obj_sms_campaign.sms_gateway_id)
+        metrics.inc('newfies_sms_total', origin='campaign')
     else:
         logger.error("[SMS_TASK] Max retry exceeded, sub_id:%s" % obj_subscriber.id)
 
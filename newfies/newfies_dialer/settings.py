@@ -239,6 +239,7 @@ INSTALLED_APPS = (
     'appointment',
     'mod_mailer',
     'mod_utils',
+    'mod_metrics',
     'frontend_notification',
     'django_nvd3',
     'rest_framework',
@@ -505,6 +506,114 @@ HEARTBEAT_MIN = 1  # accepted value from 1 to 10
 # Delay outbound call of X seconds
 DELAY_OUTBOUND = 0
 
+# Originate all the calls of a heartbeat from a single task per campaign,
+# instead of one task per call
+DIALER_BATCH_DISPATCH = False
+
+# Release the calls from the long-running dispatcher (python manage.py run_dispatcher)
+# instead of the campaign_running heartbeat
+DIALER_DISPATCHER = False
+# Seconds between two reloads of the running campaigns by the dispatcher
+DIALER_DISPATCHER_REFRESH = 10
+# Seconds after which the callrequests spooled but never originated are put
+# back by the dispatcher when it starts, left by a dispatcher which died
+DIALER_DISPATCHER_STALE = 300
+
+# Seconds between two incremental refreshes of the in-memory DNC index
+DNC_INDEX_REFRESH = 30
+# Seconds between two checks for changes of the in-memory dialcode prefix index
+PREFIX_INDEX_REFRESH = 60
+
+# Process each page of call events in a single task with bulk writes,
+# instead of one task per call event
+CALLEVENT_BATCH = True
+
+# Receive the call events pushed by listener.lua with LISTEN/NOTIFY
+# (python manage.py callevent_listener) instead of polling call_event
+# every 15 seconds, PostgreSQL only
+CALLEVENT_LISTENER = False
+# Call events processed per transaction by the callevent_listener
+CALLEVENT_LISTENER_BATCH = 200
+# Keep the processed call events with status=2 (default), set to True to
+# delete them once processed and stop call_event from growing, only if
+# nothing else reads the processed events from call_event
+CALLEVENT_DELETE = False
+# Seconds after which call events claimed by a consumer that never
+# released them are put back to pending
+CALLEVENT_CLAIM_TIMEOUT = 300
+# Attempts of the callevent_listener at a call event failing on its own,
+# then it is left in call_event with status=4 (failed) for inspection
+CALLEVENT_MAX_ATTEMPTS = 3
+
+# Tables partitioned by range on their date column once converted with
+# python manage.py partition_tables --convert=<table> (PostgreSQL 11+)
+# The keys are database table names: the CDRs of VoIPCall are stored in
+# dialer_cdr (its Meta.db_table), there is no dialer_cdr_voipcall table
+PARTITIONED_TABLES = {
+    'dialer_cdr': 'starting_date',
+    'call_event': 'created_date',
+}
+# One partition per 'day' or 'month', created PARTITION_PREMAKE periods ahead
+PARTITION_INTERVAL = 'month'
+PARTITION_PREMAKE = 2
+# Days of data kept per partitioned table, the older partitions are dropped
+# every night. Tables not listed are kept forever
+PARTITION_RETENTION = {
+    'call_event': 7,
+}
+
+# python manage.py clean_records : rows deleted per transaction
+# and rows deleted per second, 0 for no throttle
+RETENTION_BATCH_SIZE = 5000
+RETENTION_MAX_RATE = 0
+
+# Synthetic rows per hot table of the query plan test, 0 checks on a small
+# dataset that an index serves each hot query, 2000000 checks the plans
+# picked on a large one (python manage.py check_query_plans loads 2000000)
+QUERY_PLAN_TEST_ROWS = 0
+
+# Record the latency of each stage of the calls, from the spool to the CDR,
+# see python manage.py call_trace_stats
+CALL_TRACING = False
+# Seconds between two flushes of the counters of a process to the cache
+CALL_TRACING_FLUSH = 10
+
+# Addresses allowed to read the Prometheus metrics on /metrics/, empty for all
+METRICS_ALLOWED_IPS = ['127.0.0.1']
+# Seconds between two reconciliations of the metric gauges with the database
+METRICS_RECONCILE_INTERVAL = 60
+
+# Directory of the uploaded contact CSV files and of their error reports,
+# read by the celery workers, it should not be served as media
+CONTACT_IMPORT_DIR = os.path.join(APPLICATION_DIR, 'contact_import')
+# Rows validated and loaded per transaction by the contact import
+CONTACT_IMPORT_CHUNK = 5000
+# Seconds the subscriber collection keeps reading again the contacts created,
+# a contact committed later than this after a higher contact id can be missed
+CONTACT_COLLECT_WINDOW = 600
+
+# Normalisation of the phone numbers to their E.164 form (see dialer_contact.phonenumber):
+# country reading the national numbers of the users without country in their profile
+PHONENUMBER_DEFAULT_COUNTRY = ''
+# numbering rules overriding the built-in ones per ISO 3166-1 alpha-2 code, e.g.
+# {'ES': {'international_prefix': ['00'], 'national_prefix': '', 'national_length': 9}}
+PHONENUMBER_RULES = {}
+# Seconds between two checks for changes of the in-memory numbering rules
+PHONENUMBER_RULES_REFRESH = 300
+# Dial the E.164 form of the numbers, the prefixes of the gateways are applied to it
+PHONENUMBER_DIAL_E164 = False
+
+# Pacing controller computing the calls to originate per campaign on each heartbeat:
+# - dialer_campaign.pacing.FixedFrequencyController : campaign frequency per minute
+# - dialer_campaign.pacing.ConcurrentCallsController : options {'max_concurrent': 50}
+# - dialer_campaign.pacing.AbandonRateController : options {'target_abandon': 0.03}
+DIALER_PACING_CONTROLLER = 'dialer_campaign.pacing.FixedFrequencyController'
+DIALER_PACING_OPTIONS = {}
+# Window in seconds of the answer / abandon ratios
+DIALER_PACING_WINDOW = 300
+# Answered calls shorter than this number of seconds are counted as abandoned
+DIALER_PACING_ABANDON_BILLSEC = 2
+
 # Audio Convertion
 # ================
 
@@ -526,6 +635,28 @@ ESL_HOSTNAME = '127.0.0.1'
 ESL_PORT = '8021'
 ESL_SECRET = 'ClueCon'
 ESL_SCRIPT = '&lua(/usr/share/newfies-lua/newfies.lua)'
+# Number of ESL connections kept open per worker process
+ESL_POOL_SIZE = 2
+# Idle connections older than this (seconds) are checked before being reused
+ESL_POOL_CHECK_INTERVAL = 30
+
+# List of FreeSWITCH nodes used to originate the calls, if empty only the
+# node defined by ESL_HOSTNAME, ESL_PORT and ESL_SECRET is used
+# ESL_NODES = [
+#     {'name': 'fs1', 'hostname': '10.0.0.1', 'port': '8021', 'secret': 'ClueCon',
+#      'weight': 2, 'max_channels': 1000},
+#     {'name': 'fs2', 'hostname': '10.0.0.2', 'port': '8021', 'secret': 'ClueCon',
+#      'weight': 1, 'max_channels': 500},
+# ]
+ESL_NODES = []
+# Node selection : 'least_loaded' or 'weighted_round_robin'
+ESL_NODE_STRATEGY = 'least_loaded'
+# Consecutive failed originates before a node is taken out of rotation
+ESL_NODE_MAX_ERRORS = 3
+# Seconds a failing node stays out of rotation
+ESL_NODE_QUARANTINE = 60
+# Seconds between refreshes of the live channel count of the nodes
+ESL_NODE_REFRESH = 5
 
 # DIAL SETTINGS
 # =============
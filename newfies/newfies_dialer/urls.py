@@ -29,6 +29,7 @@ from frontend_notification.urls import urlpatterns as urlpatterns_frontend_notif
 # from agent.urls import urlpatterns as urlpatterns_agent
 # from callcenter.urls import urlpatterns as urlpatterns_callcenter
 from mod_sms.urls import urlpatterns as urlpatterns_mod_sms
+from mod_metrics.urls import urlpatterns as urlpatterns_mod_metrics
 from dajaxice.core import dajaxice_autodiscover, dajaxice_config
 from django.contrib import admin
 import os
@@ -78,6 +79,7 @@ urlpatterns += urlpatterns_frontend_notification
 # urlpatterns += urlpatterns_callcenter
 urlpatterns += urlpatterns_appointment
 urlpatterns += urlpatterns_mod_sms
+urlpatterns += urlpatterns_mod_metrics
 
 urlpatterns += patterns('',
                         (r'^%s/(?P<path>.*)$' % settings.MEDIA_URL.strip(os.sep),